@@ -1,10 +1,11 @@
 "use client"
 
-import { useState, useCallback } from "react"
+import { useState, useCallback, useEffect, useRef } from "react"
 import { motion } from "framer-motion"
 import { Button } from "@/components/ui/button"
 import { Card, CardContent, CardHeader, CardTitle } from "@/components/ui/card"
 import { Textarea } from "@/components/ui/textarea"
+import { Badge } from "@/components/ui/badge"
 import { Progress } from "@/components/ui/progress"
 import { Upload, FileText, Brain, Stethoscope, Pill, Activity, AlertTriangle, CheckCircle, Clock, Zap } from 'lucide-react'
 import { Sidebar } from "@/components/sidebar"
@@ -12,6 +13,7 @@ import { VoiceControl } from "@/components/voice-control"
 import { MedicalAnalysisResults } from "@/components/medical-analysis-results"
 import { useDropzone } from "react-dropzone"
 import { useRouter } from "next/navigation"
+import { useLiveAnalysis } from "@/hooks/useLiveAnalysis"
 
 interface AnalysisResult {
   success: boolean
@@ -82,6 +84,37 @@ export default function AnalysisPage() {
   const [uploadedFile, setUploadedFile] = useState<File | null>(null)
   const [uploadedFileName, setUploadedFileName] = useState<string>("")
   const [analysisProgress, setAnalysisProgress] = useState(0)
+  const progressIntervalRef = useRef<ReturnType<typeof setInterval> | null>(null)
+
+  const finishAnalysis = () => {
+    if (progressIntervalRef.current) clearInterval(progressIntervalRef.current)
+    progressIntervalRef.current = null
+    setIsAnalyzing(false)
+  }
+
+  // Typed text is analyzed incrementally over a live session; "Analyze Text"
+  // then saves that session instead of sending the whole text again
+  const liveAnalysis = useLiveAnalysis({
+    analysisProfile: "standard",
+    onSaved: (analysisId, results) => {
+      setAnalysisResult({ success: true, analysis_id: analysisId, results })
+      setAnalysisProgress(100)
+      finishAnalysis()
+    }
+  })
+
+  useEffect(() => {
+    if (liveAnalysis.error && isAnalyzing && !uploadedFile) {
+      setAnalysisResult({ success: false, error: liveAnalysis.error })
+      finishAnalysis()
+    }
+    // eslint-disable-next-line react-hooks/exhaustive-deps
+  }, [liveAnalysis.error])
+
+  const updateAnalysisText = (text: string) => {
+    setAnalysisText(text)
+    liveAnalysis.updateText(text)
+  }
 
   const onDrop = useCallback((acceptedFiles: File[]) => {
     const file = acceptedFiles[0]
@@ -93,7 +126,7 @@ export default function AnalysisPage() {
       if (file.type.startsWith('text/')) {
         const reader = new FileReader()
         reader.onload = (e) => {
-          setAnalysisText(e.target?.result as string || "")
+          updateAnalysisText(e.target?.result as string || "")
         }
         reader.readAsText(file)
       }
@@ -106,7 +139,8 @@ export default function AnalysisPage() {
       'text/plain': ['.txt'],
       'application/pdf': ['.pdf'],
       'application/msword': ['.doc'],
-      'application/vnd.openxmlformats-officedocument.wordprocessingml.document': ['.docx']
+      'application/vnd.openxmlformats-officedocument.wordprocessingml.document': ['.docx'],
+      'application/rtf': ['.rtf']
     },
     maxFiles: 1
   })
@@ -130,6 +164,14 @@ export default function AnalysisPage() {
         return prev + 10
       })
     }, 200)
+    progressIntervalRef.current = progressInterval
+
+    if (!uploadedFile && liveAnalysis.isConnected) {
+      // The live session already holds the text; finished in onSaved
+      setUploadedFileName("Direct Text Input")
+      liveAnalysis.save()
+      return
+    }
 
     try {
       let response: Response
@@ -171,13 +213,12 @@ export default function AnalysisPage() {
         error: String(error)
       })
     } finally {
-      clearInterval(progressInterval)
-      setIsAnalyzing(false)
+      finishAnalysis()
     }
   }
 
   const clearAnalysis = () => {
-    setAnalysisText("")
+    updateAnalysisText("")
     setAnalysisResult(null)
     setUploadedFile(null)
     setAnalysisProgress(0)
@@ -303,7 +344,7 @@ export default function AnalysisPage() {
                       <div>
                         <p className="font-medium">Drop medical documents here</p>
                         <p className="text-sm text-muted-foreground">
-                          Supports PDF, TXT, DOC files (max 10MB)
+                          Supports PDF, TXT, DOCX, RTF files (max 10MB)
                         </p>
                       </div>
                     )}
@@ -321,9 +362,21 @@ export default function AnalysisPage() {
 Example:
 Patient presents with chest pain, shortness of breath, and fatigue. History of hypertension and diabetes. Current medications include metformin and lisinopril. Vital signs show elevated blood pressure and heart rate."
                       value={analysisText}
-                      onChange={(e) => setAnalysisText(e.target.value)}
+                      onChange={(e) => updateAnalysisText(e.target.value)}
                       className="min-h-[200px] border-2 border-border rounded-md"
                     />
+                    {liveAnalysis.isConnected && analysisText.trim() && (
+                      <div className="mt-2 flex flex-wrap gap-1">
+                        <span className="text-xs text-muted-foreground mr-1">
+                          Live: {liveAnalysis.entities.length} entities
+                        </span>
+                        {liveAnalysis.entities.slice(0, 30).map((entity) => (
+                          <Badge key={entity.id} variant="secondary" className="text-xs" title={entity.label}>
+                            {entity.text}
+                          </Badge>
+                        ))}
+                      </div>
+                    )}
                   </div>
 
                   {/* Action Buttons */}
@@ -1,6 +1,6 @@
 "use client"
 
-import { useState, useEffect } from "react"
+import { useState, useEffect, useRef } from "react"
 import { motion } from "framer-motion"
 import { Button } from "@/components/ui/button"
 import { Card, CardContent, CardHeader, CardTitle } from "@/components/ui/card"
@@ -24,12 +24,19 @@ interface Patient {
   metadata?: any
 }
 
+// Patients are loaded a page at a time (keyset pagination) and searched on the server
+const PATIENT_PAGE_SIZE = 48
+
 export default function PatientsPage() {
   const router = useRouter()
   const [patients, setPatients] = useState<Patient[]>([])
   const [searchQuery, setSearchQuery] = useState("")
   const [isCreateModalOpen, setIsCreateModalOpen] = useState(false)
   const [isLoading, setIsLoading] = useState(true)
+  const [nextCursor, setNextCursor] = useState<string | null>(null)
+  const [isLoadingMore, setIsLoadingMore] = useState(false)
+  const searchQueryRef = useRef("")
+  const requestRef = useRef(0)
   const [isCreating, setIsCreating] = useState(false)
   const [newPatient, setNewPatient] = useState({
     name: "",
@@ -38,10 +45,12 @@ export default function PatientsPage() {
     email: ""
   })
 
-  // Fetch patients on component mount
+  // Fetch the first page on mount, and again (debounced) whenever the search changes
   useEffect(() => {
-    fetchPatients()
-  }, [])
+    searchQueryRef.current = searchQuery
+    const timer = setTimeout(fetchPatients, searchQuery ? 300 : 0)
+    return () => clearTimeout(timer)
+  }, [searchQuery])
 
   // Refresh patients when page comes back into focus (e.g., after navigation)
   useEffect(() => {
@@ -53,20 +62,53 @@ export default function PatientsPage() {
     return () => window.removeEventListener('focus', handleFocus)
   }, [])
 
+  const patientsUrl = (cursor: string | null) => {
+    const params = new URLSearchParams({ limit: String(PATIENT_PAGE_SIZE) })
+    const query = searchQueryRef.current.trim()
+    if (query) params.set('q', query)
+    if (cursor) params.set('cursor', cursor)
+    return `http://localhost:8000/patients?${params}`
+  }
+
+  // Loads the first page; responses to superseded requests (older searches) are dropped
   const fetchPatients = async () => {
+    const request = ++requestRef.current
     try {
       setIsLoading(true)
-      const response = await fetch('http://localhost:8000/patients')
-      if (response.ok) {
-        const data = await response.json()
-        setPatients(data.patients || [])
-      } else {
+      const response = await fetch(patientsUrl(null))
+      if (!response.ok) {
         console.error('Failed to fetch patients')
+        return
       }
+      const data = await response.json()
+      if (request !== requestRef.current) return
+      setPatients(data.patients || [])
+      setNextCursor(data.has_more ? data.next_cursor : null)
     } catch (error) {
       console.error('Error fetching patients:', error)
     } finally {
-      setIsLoading(false)
+      if (request === requestRef.current) setIsLoading(false)
+    }
+  }
+
+  const loadMorePatients = async () => {
+    if (!nextCursor || isLoadingMore) return
+    const request = requestRef.current
+    try {
+      setIsLoadingMore(true)
+      const response = await fetch(patientsUrl(nextCursor))
+      if (!response.ok) {
+        console.error('Failed to fetch patients')
+        return
+      }
+      const data = await response.json()
+      if (request !== requestRef.current) return
+      setPatients(prev => [...prev, ...(data.patients || [])])
+      setNextCursor(data.has_more ? data.next_cursor : null)
+    } catch (error) {
+      console.error('Error fetching patients:', error)
+    } finally {
+      setIsLoadingMore(false)
     }
   }
 
@@ -121,9 +163,8 @@ export default function PatientsPage() {
     }
   }
 
-  const filteredPatients = patients.filter(patient =>
-    patient.name.toLowerCase().includes(searchQuery.toLowerCase())
-  )
+  // Already filtered by the server (q=searchQuery)
+  const filteredPatients = patients
 
   const formatDate = (dateString: string) => {
     return new Date(dateString).toLocaleDateString()
@@ -208,9 +249,17 @@ export default function PatientsPage() {
     }
   }
 
-  const handleVoiceDeletePatient = (patientName: string) => {
-    // Find patient by name
-    const patient = patients.find(p => p.name.toLowerCase().includes(patientName.toLowerCase()))
+  const handleVoiceDeletePatient = async (patientName: string) => {
+    // Find patient by name (on the server: only a page of patients is loaded)
+    let patient = patients.find(p => p.name.toLowerCase().includes(patientName.toLowerCase()))
+    if (!patient) {
+      try {
+        const response = await fetch(`http://localhost:8000/patients?limit=1&q=${encodeURIComponent(patientName)}`)
+        if (response.ok) patient = (await response.json()).patients?.[0]
+      } catch (error) {
+        console.error('Error searching patients:', error)
+      }
+    }
     if (patient) {
       // Navigate to patient detail page where deletion can be confirmed
       router.push(`/patients/${patient.id}`)
@@ -377,7 +426,7 @@ export default function PatientsPage() {
                   key={patient.id}
                   initial={{ opacity: 0, y: 20 }}
                   animate={{ opacity: 1, y: 0 }}
-                  transition={{ duration: 0.3, delay: index * 0.1 }}
+                  transition={{ duration: 0.3, delay: (index % PATIENT_PAGE_SIZE) * 0.02 }}
                 >
                   <Link href={`/patients/${patient.id}`}>
                     <Card className="bg-card text-card-foreground border-2 border-black rounded-md shadow-lg hover:shadow-xl transition-all duration-300 cursor-pointer h-full">
@@ -436,6 +485,20 @@ export default function PatientsPage() {
               ))}
             </div>
           )}
+
+          {/* Next page of patients */}
+          {!isLoading && nextCursor && (
+            <div className="text-center mt-6">
+              <Button
+                variant="outline"
+                onClick={loadMorePatients}
+                disabled={isLoadingMore}
+                className="border-2 border-black rounded-md shadow-lg hover:shadow-xl transition-all duration-300"
+              >
+                {isLoadingMore ? "Loading..." : "Load more patients"}
+              </Button>
+            </div>
+          )}
         </motion.div>
       </div>
 
@@ -1,16 +1,18 @@
 "use client"
 
-import { useState, useCallback, useEffect } from "react"
+import { useState, useCallback, useEffect, useRef } from "react"
 import { motion } from "framer-motion"
 import { Button } from "@/components/ui/button"
 import { Card, CardContent, CardHeader, CardTitle } from "@/components/ui/card"
 import { Progress } from "@/components/ui/progress"
+import { Input } from "@/components/ui/input"
 import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from "@/components/ui/select"
 import { Upload, FileText, Trash2, CheckCircle, User, Folder } from 'lucide-react'
 import { Sidebar } from "@/components/sidebar"
 import { VoiceControl } from "@/components/voice-control"
 import { useDropzone } from "react-dropzone"
 import { useRouter } from "next/navigation"
+import { RESUMABLE_UPLOAD_THRESHOLD, uploadResumable } from "@/lib/resumableUpload"
 
 interface UploadedFile {
   id: string
@@ -35,6 +37,9 @@ interface Directory {
   color: string
 }
 
+// Patients for the picker are loaded a page at a time and searched on the server
+const PATIENT_PAGE_SIZE = 50
+
 export default function UploadPage() {
   const router = useRouter()
   const [files, setFiles] = useState<UploadedFile[]>([]);
@@ -48,6 +53,10 @@ export default function UploadPage() {
   const [directories, setDirectories] = useState<Directory[]>([]);
   const [selectedDirectoryId, setSelectedDirectoryId] = useState<string>("");
   const [isLoadingPatients, setIsLoadingPatients] = useState(true);
+  const [patientSearch, setPatientSearch] = useState("");
+  const [nextPatientCursor, setNextPatientCursor] = useState<string | null>(null);
+  const [isLoadingMorePatients, setIsLoadingMorePatients] = useState(false);
+  const patientRequestRef = useRef(0);
   const [prefilledInfo, setPrefilledInfo] = useState<{
     patientName?: string;
     directoryName?: string;
@@ -75,10 +84,11 @@ export default function UploadPage() {
     }
   }, []);
 
-  // Fetch patients on component mount
+  // Fetch the first page of patients on mount, and again (debounced) as the search changes
   useEffect(() => {
-    fetchPatients();
-  }, []);
+    const timer = setTimeout(() => fetchPatients(patientSearch), patientSearch ? 300 : 0);
+    return () => clearTimeout(timer);
+  }, [patientSearch]);
 
   // Fetch directories when patient is selected
   useEffect(() => {
@@ -90,20 +100,40 @@ export default function UploadPage() {
     }
   }, [selectedPatientId]);
 
-  const fetchPatients = async () => {
+  const patientsUrl = (query: string, cursor: string | null) => {
+    const params = new URLSearchParams({ limit: String(PATIENT_PAGE_SIZE) });
+    if (query.trim()) params.set('q', query.trim());
+    if (cursor) params.set('cursor', cursor);
+    return `http://localhost:8000/patients?${params}`;
+  };
+
+  // Loads a page of patients (the first one unless a cursor is given); stale searches are dropped
+  const fetchPatients = async (query: string, cursor: string | null = null) => {
+    const request = cursor ? patientRequestRef.current : ++patientRequestRef.current;
     try {
-      setIsLoadingPatients(true);
-      const response = await fetch('http://localhost:8000/patients');
-      if (response.ok) {
-        const data = await response.json();
-        setPatients(data.patients || []);
+      if (cursor) {
+        setIsLoadingMorePatients(true);
       } else {
+        setIsLoadingPatients(true);
+      }
+      const response = await fetch(patientsUrl(query, cursor));
+      if (!response.ok) {
         console.error('Failed to fetch patients');
+        return;
       }
+      const data = await response.json();
+      if (request !== patientRequestRef.current) return;
+      const page: Patient[] = data.patients || [];
+      setPatients(prev => cursor ? [...prev, ...page] : page);
+      setNextPatientCursor(data.has_more ? data.next_cursor : null);
     } catch (error) {
       console.error('Error fetching patients:', error);
     } finally {
-      setIsLoadingPatients(false);
+      if (cursor) {
+        setIsLoadingMorePatients(false);
+      } else if (request === patientRequestRef.current) {
+        setIsLoadingPatients(false);
+      }
     }
   };
 
@@ -170,17 +200,39 @@ export default function UploadPage() {
         ? `http://localhost:8000/patients/${selectedPatientId}/directories/${selectedDirectoryId}/documents`
         : "http://localhost:8000/analyze/text";
       
-      const res = await fetch(apiUrl, {
-        method: "POST",
-        body: formData,
-      });
-      
-      if (!res.ok) {
-        const errorText = await res.text();
-        throw new Error(`Analysis failed: ${errorText}`);
+      let data: any;
+      if (selectedPatientId && selectedDirectoryId && actualFile.size > RESUMABLE_UPLOAD_THRESHOLD) {
+        // Large patient documents are sent in resumable chunks
+        data = await uploadResumable(actualFile, selectedPatientId, selectedDirectoryId);
+      } else {
+        const res = await fetch(apiUrl, {
+          method: "POST",
+          body: formData,
+        });
+        
+        if (!res.ok) {
+          const errorText = await res.text();
+          throw new Error(`Analysis failed: ${errorText}`);
+        }
+        
+        data = await res.json();
       }
       
-      const data = await res.json();
+      // Patient documents are analyzed in the background (202 Accepted): wait for the job
+      if (data.status_url) {
+        let job: any = null;
+        while (!job || job.status === "queued" || job.status === "running") {
+          await new Promise(resolve => setTimeout(resolve, 1000));
+          const jobRes = await fetch(`http://localhost:8000${data.status_url}`);
+          job = (await jobRes.json()).job;
+        }
+        if (job.status !== "completed") {
+          throw new Error(`Analysis failed: ${job.error || job.status}`);
+        }
+        const analysisRes = await fetch(`http://localhost:8000/analysis/${job.analysis_id}`);
+        const analysis = await analysisRes.json();
+        data = { ...data, analysis_id: job.analysis_id, analysis_results: analysis.results };
+      }
       
       // Transform the response to match the expected format
       const transformedData = {
@@ -208,9 +260,19 @@ export default function UploadPage() {
   };
 
   // Voice control handlers
-  const handleVoiceUploadDocument = (patientName: string, directoryName: string) => {
-    // Find patient by name
-    const patient = patients.find(p => p.name.toLowerCase().includes(patientName.toLowerCase()))
+  const handleVoiceUploadDocument = async (patientName: string, directoryName: string) => {
+    // Find patient by name (on the server: only a page of patients is loaded)
+    let patient = patients.find(p => p.name.toLowerCase().includes(patientName.toLowerCase()))
+    if (!patient) {
+      try {
+        const response = await fetch(`http://localhost:8000/patients?limit=1&q=${encodeURIComponent(patientName)}`)
+        if (response.ok) patient = (await response.json()).patients?.[0]
+        const found = patient
+        if (found) setPatients(prev => [found, ...prev])
+      } catch (error) {
+        console.error('Error searching patients:', error)
+      }
+    }
     if (patient) {
       setSelectedPatientId(patient.id)
       
@@ -243,7 +305,8 @@ export default function UploadPage() {
       'application/pdf': ['.pdf'],
       'text/plain': ['.txt'],
       'application/msword': ['.doc'],
-      'application/vnd.openxmlformats-officedocument.wordprocessingml.document': ['.docx']
+      'application/vnd.openxmlformats-officedocument.wordprocessingml.document': ['.docx'],
+      'application/rtf': ['.rtf']
     }
   })
 
@@ -304,11 +367,27 @@ export default function UploadPage() {
                   <label className="block text-sm font-medium mb-2">
                     Patient
                   </label>
+                  <Input
+                    placeholder="Search patients..."
+                    value={patientSearch}
+                    onChange={(e) => setPatientSearch(e.target.value)}
+                    className="mb-2 border-2 border-border rounded-md"
+                  />
                   <Select value={selectedPatientId} onValueChange={setSelectedPatientId}>
                     <SelectTrigger className="border-2 border-border rounded-md">
                       <SelectValue placeholder={isLoadingPatients ? "Loading patients..." : "Select a patient"} />
                     </SelectTrigger>
                     <SelectContent>
+                      {/* A patient linked to from elsewhere may not be on the loaded pages */}
+                      {selectedPatientId && prefilledInfo.patientName &&
+                        !patients.some((patient) => patient.id === selectedPatientId) && (
+                        <SelectItem value={selectedPatientId}>
+                          <div className="flex items-center">
+                            <User className="h-4 w-4 mr-2" />
+                            {prefilledInfo.patientName}
+                          </div>
+                        </SelectItem>
+                      )}
                       {patients.map((patient) => (
                         <SelectItem key={patient.id} value={patient.id}>
                           <div className="flex items-center">
@@ -319,6 +398,17 @@ export default function UploadPage() {
                       ))}
                     </SelectContent>
                   </Select>
+                  {nextPatientCursor && (
+                    <Button
+                      variant="ghost"
+                      size="sm"
+                      onClick={() => fetchPatients(patientSearch, nextPatientCursor)}
+                      disabled={isLoadingMorePatients}
+                      className="mt-1 w-full text-xs"
+                    >
+                      {isLoadingMorePatients ? "Loading..." : "Load more patients"}
+                    </Button>
+                  )}
                 </div>
                 
                 <div>
@@ -379,7 +469,7 @@ export default function UploadPage() {
                   <div>
                     <p className="text-lg mb-2">Drag & drop files here, or click to select</p>
                     <p className="text-sm text-muted-foreground">
-                      Supports PDF, TXT, DOC, DOCX files up to 10MB
+                      Supports PDF, TXT, DOC, DOCX, RTF files up to 10MB (larger files when filed to a patient directory)
                     </p>
                   </div>
                 )}
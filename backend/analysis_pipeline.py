@@ -0,0 +1,650 @@
+#!/usr/bin/env python3
+"""
+Staged Medical Text Analysis Pipeline
+A Document is preprocessed once (lowered text, tokens, sentences, sections) and
+then flows through pluggable stages that annotate it: dictionary, patterns,
+measurements, merge, summary, differential and critical findings.
+"""
+import re
+import time
+from bisect import bisect_right
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Any, Dict, List, Optional, Tuple
+
+from entity_store import EntityStore, LABELS, SOURCES
+from lab_values import ANALYTES, extract_measurement_spans, measurement_dicts
+from sentence_memo import SENTENCE_MEMO, SentenceMemo
+
+# Output categories and the entity label each one is built from
+ENTITY_CATEGORIES = {
+    "symptoms": "SYMPTOM",
+    "conditions": "CONDITION",
+    "medications": "MEDICATION",
+    "vital_signs": "VITAL_SIGNS",
+    "lab_values": "LAB_VALUES",
+    "anatomy": "ANATOMY",
+    "procedures": "PROCEDURES",
+    "allergies": "ALLERGIES",
+    "family_history": "FAMILY_HISTORY",
+    "social_history": "SOCIAL_HISTORY"
+}
+
+LABEL_TO_CATEGORY = {label: category for category, label in ENTITY_CATEGORIES.items()}
+
+# Analysis profiles - which pipeline stages run for each tier
+ANALYSIS_PROFILES = {
+    "fast": {
+        "dictionary": False,     # Skip the full medical database scan
+        "dictionary_limit": 0,
+        "summary": False,
+        "critical_findings": True,
+        "differential": False,
+        "differential_limit": 0,
+        "models": False          # No transformer model tier
+    },
+    "standard": {
+        "dictionary": True,
+        "dictionary_limit": 100,
+        "summary": True,
+        "critical_findings": True,
+        "differential": True,
+        "differential_limit": 5,
+        "models": True
+    },
+    "deep": {
+        "dictionary": True,
+        "dictionary_limit": 500,
+        "summary": True,
+        "critical_findings": True,
+        "differential": True,
+        "differential_limit": 10,
+        "models": True
+    }
+}
+
+DEFAULT_ANALYSIS_PROFILE = "standard"
+
+# Enhanced medical entity patterns for comprehensive analysis
+MEDICAL_PATTERNS = {
+    "SYMPTOM": [
+        r'\b(?:chest pain|shortness of breath|dyspnea|headache|nausea|vomiting|dizziness|fatigue|fever|cough|abdominal pain|back pain|joint pain|muscle pain|difficulty breathing|palpitations|sweating|weakness|numbness|tingling|blurred vision|confusion|memory loss|seizure|syncope|edema|swelling|rash|itching|burning|cramping|stiffness|soreness|aching|throbbing|sharp pain|dull pain|radiating pain|intermittent pain|chronic pain|acute pain|severe pain|mild pain|moderate pain)\b',
+        r'\b(?:difficulty swallowing|dysphagia|loss of appetite|weight loss|weight gain|night sweats|chills|shivering|tremor|spasms|twitching|restlessness|insomnia|drowsiness|lethargy|malaise|irritability|mood changes|anxiety|depression|panic|fear|stress|tension)\b',
+        r'\b(?:bleeding|bruising|discharge|drainage|swelling|inflammation|redness|warmth|tenderness|sensitivity|pressure|fullness|bloating|distension|constipation|diarrhea|incontinence|urgency|frequency|hesitancy|retention)\b'
+    ],
+    "CONDITION": [
+        r'\b(?:hypertension|high blood pressure|diabetes|type 1 diabetes|type 2 diabetes|heart disease|coronary artery disease|myocardial infarction|heart attack|stroke|cerebrovascular accident|pneumonia|asthma|copd|chronic obstructive pulmonary disease|cancer|tumor|malignancy|depression|anxiety|arthritis|osteoporosis|kidney disease|liver disease|thyroid disease|anemia|infection|sepsis|pneumothorax|pleural effusion|atrial fibrillation|heart failure|cardiomyopathy)\b',
+        r'\b(?:bronchitis|emphysema|tuberculosis|tb|hepatitis|cirrhosis|pancreatitis|gastritis|ulcer|gastroesophageal reflux|gerd|irritable bowel syndrome|ibs|crohn\'s disease|ulcerative colitis|diverticulitis|appendicitis|cholecystitis|nephritis|cystitis|prostatitis|endometriosis|fibromyalgia|lupus|rheumatoid arthritis|osteoarthritis|gout|migraine|epilepsy|parkinson\'s disease|alzheimer\'s disease|dementia)\b',
+        r'\b(?:hyperthyroidism|hypothyroidism|hyperlipidemia|obesity|metabolic syndrome|sleep apnea|chronic fatigue syndrome|fibromyalgia|multiple sclerosis|muscular dystrophy|cerebral palsy|spina bifida|down syndrome|autism|adhd|bipolar disorder|schizophrenia|ptsd|eating disorder|substance abuse|alcoholism|smoking|tobacco use)\b'
+    ],
+    "MEDICATION": [
+        r'\b(?:aspirin|acetylsalicylic acid|metformin|lisinopril|atorvastatin|amlodipine|metoprolol|hydrochlorothiazide|hctz|omeprazole|levothyroxine|warfarin|insulin|prednisone|albuterol|furosemide|gabapentin|tramadol|ibuprofen|acetaminophen|tylenol|morphine|oxycodone|amoxicillin|azithromycin|ciprofloxacin|doxycycline)\b',
+        r'\b(?:simvastatin|rosuvastatin|crestor|lipitor|losartan|valsartan|enalapril|captopril|diltiazem|nifedipine|propranolol|atenolol|carvedilol|spironolactone|digoxin|clopidogrel|plavix|rivaroxaban|apixaban|dabigatran|heparin|enoxaparin)\b',
+        r'\b(?:sertraline|fluoxetine|paroxetine|citalopram|escitalopram|venlafaxine|duloxetine|bupropion|trazodone|mirtazapine|lorazepam|alprazolam|clonazepam|diazepam|zolpidem|eszopiclone|quetiapine|risperidone|olanzapine|aripiprazole)\b',
+        r'\b(?:methotrexate|hydroxychloroquine|sulfasalazine|adalimumab|etanercept|infliximab|rituximab|cyclophosphamide|azathioprine|mycophenolate|tacrolimus|cyclosporine|sirolimus|everolimus)\b'
+    ],
+    "VITAL_SIGNS": [
+        r'\b(?:blood pressure|bp|systolic|diastolic|heart rate|hr|pulse rate|temperature|temp|respiratory rate|rr|breathing rate|oxygen saturation|o2 sat|spo2|pulse|weight|height|bmi|body mass index)\b',
+        r'\b(?:\d+/\d+\s*mmhg|\d+\s*bpm|\d+\.\d+°[cf]|\d+°[cf]|\d+\s*kg|\d+\s*lbs|\d+\s*cm|\d+\s*ft|\d+\'\d+"|\d+\s*%\s*o2|\d+\s*breaths/min)\b'
+    ],
+    "LAB_VALUES": [
+        r'\b(?:glucose|blood sugar|cholesterol|total cholesterol|triglycerides|hdl|ldl|hemoglobin|hgb|hematocrit|hct|white blood cell|wbc|red blood cell|rbc|platelet|plt|creatinine|bun|blood urea nitrogen|sodium|potassium|chloride|co2|bicarbonate|ast|alt|bilirubin|albumin|protein|inr|pt|ptt|aptt)\b',
+        r'\b(?:thyroid stimulating hormone|tsh|free t4|free t3|vitamin d|vitamin b12|folate|iron|ferritin|transferrin|c-reactive protein|crp|erythrocyte sedimentation rate|esr|troponin|ck-mb|bnp|nt-probnp|psa|cea|ca 19-9|ca 125|afp)\b',
+        r'\b(?:hba1c|hemoglobin a1c|microalbumin|egfr|estimated glomerular filtration rate|lipase|amylase|lactate|lactic acid|arterial blood gas|abg|ph|pco2|po2|base excess|anion gap)\b'
+    ],
+    "ANATOMY": [
+        r'\b(?:heart|cardiac|lung|pulmonary|liver|hepatic|kidney|renal|brain|cerebral|stomach|gastric|intestine|bowel|colon|colonic|pancreas|pancreatic|gallbladder|spleen|splenic|thyroid|prostate|breast|mammary|uterus|uterine|ovary|ovarian|bladder|vesical|skin|dermal|bone|osseous|muscle|muscular|joint|articular|artery|arterial|vein|venous|nerve|neural|spine|spinal|chest|thoracic|abdomen|abdominal|pelvis|pelvic|extremities)\b',
+        r'\b(?:head|neck|shoulder|arm|elbow|wrist|hand|finger|thumb|back|hip|thigh|knee|leg|ankle|foot|toe|eye|ear|nose|mouth|throat|esophagus|trachea|bronchi|alveoli|atrium|ventricle|valve|aorta|carotid|jugular|femoral|portal|hepatic|renal|cerebral|coronary)\b'
+    ],
+    "PROCEDURES": [
+        r'\b(?:x-ray|ct scan|mri|ultrasound|echocardiogram|ekg|ecg|stress test|colonoscopy|endoscopy|bronchoscopy|biopsy|surgery|operation|procedure|catheterization|angioplasty|stent|pacemaker|defibrillator|dialysis|chemotherapy|radiation therapy|physical therapy|occupational therapy)\b',
+        r'\b(?:blood test|urine test|stool test|culture|sensitivity|pathology|histology|cytology|mammogram|bone scan|pet scan|nuclear medicine|fluoroscopy|angiography|venography|arthrography|myelography)\b'
+    ],
+    "ALLERGIES": [
+        r'\b(?:allergic to|allergy to|allergies|hypersensitive to|intolerant to|adverse reaction to|penicillin allergy|sulfa allergy|latex allergy|food allergy|drug allergy|environmental allergy|seasonal allergy|pollen allergy|dust allergy|mold allergy|pet allergy|shellfish allergy|nut allergy)\b'
+    ],
+    "FAMILY_HISTORY": [
+        r'\b(?:family history|familial|hereditary|genetic|mother had|father had|sibling had|parent had|grandmother had|grandfather had|runs in family|family member|relative had)\b'
+    ],
+    "SOCIAL_HISTORY": [
+        r'\b(?:smoking|tobacco|cigarettes|alcohol|drinking|drug use|substance use|occupation|work|exercise|diet|lifestyle|married|single|divorced|widowed|lives alone|lives with|social support|insurance|medicare|medicaid)\b'
+    ]
+}
+
+def pattern_crosses_sentences(pattern: str) -> bool:
+    """Whether a regex could match across a sentence boundary: it matches more whitespace than a literal space"""
+    return re.search(r"\\[sSnWD]|\[\^|(?<!\\)\.|[.!?] ", pattern) is not None
+
+# Compiled once at import; matched against lowered text. The index keeps
+# candidates in family order when per-sentence results are combined.
+COMPILED_PATTERNS = [
+    (index, label, compiled)
+    for index, (label, compiled) in enumerate(
+        (label, re.compile(pattern, re.IGNORECASE))
+        for label, patterns in MEDICAL_PATTERNS.items()
+        for pattern in patterns
+    )
+]
+# Families whose matches stay inside one sentence are memoized per sentence; the
+# others are matched over the whole text
+SENTENCE_PATTERNS = [entry for entry in COMPILED_PATTERNS if not pattern_crosses_sentences(entry[2].pattern)]
+TEXT_PATTERNS = [entry for entry in COMPILED_PATTERNS if pattern_crosses_sentences(entry[2].pattern)]
+
+CRITICAL_SYMPTOMS = ["chest pain", "shortness of breath", "severe pain", "difficulty breathing", "seizure", "syncope"]
+CRITICAL_CONDITIONS = ["myocardial infarction", "heart attack", "stroke", "sepsis", "pneumothorax"]
+
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+|\s*\n\s*')
+SECTION_HEADER = re.compile(r'^[ \t]*([A-Za-z][A-Za-z /&-]{1,40}):', re.MULTILINE)
+TOKEN = re.compile(r'\S+')
+
+def term_crosses_sentences(term: str) -> bool:
+    """Whether a dictionary term could match across a sentence boundary"""
+    return term != term.strip() or SENTENCE_BOUNDARY.search(term) is not None
+
+def split_sentences(text: str, offset: int = 0) -> List[Tuple[int, int]]:
+    """(start, end) offsets of trimmed sentences, split on terminal punctuation and line breaks"""
+    spans = []
+    start = 0
+    for boundary in list(SENTENCE_BOUNDARY.finditer(text)) + [None]:
+        end = boundary.start() if boundary else len(text)
+        piece = text[start:end]
+        stripped = piece.strip()
+        if stripped:
+            piece_start = offset + start + (len(piece) - len(piece.lstrip()))
+            spans.append((piece_start, piece_start + len(stripped)))
+        if boundary:
+            start = boundary.end()
+    return spans
+
+@dataclass(frozen=True)
+class AnalysisOptions:
+    """Profile and category filter a pipeline run was made with"""
+    profile: str = DEFAULT_ANALYSIS_PROFILE
+    categories: Optional[Tuple[str, ...]] = None  # None = every category
+
+    @property
+    def settings(self) -> Dict[str, Any]:
+        return ANALYSIS_PROFILES[self.profile]
+
+    @property
+    def requested_categories(self) -> List[str]:
+        return list(self.categories) if self.categories else list(ENTITY_CATEGORIES)
+
+    @property
+    def requested_labels(self) -> Optional[set]:
+        """Entity labels to keep, or None when no category filter was given"""
+        if not self.categories:
+            return None
+        return {ENTITY_CATEGORIES[c] for c in self.categories}
+
+    def wants_label(self, label: str) -> bool:
+        labels = self.requested_labels
+        return labels is None or label in labels
+
+class Document:
+    """Medical text preprocessed once and annotated by pipeline stages
+
+    A copy-forward analysis (copy_forward.py) sets scan_sentences to the sentences
+    that changed and carries the earlier note's entities and measurements for the
+    rest; the extraction stages then only scan scan_sentences.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.lower = text.lower()
+        self.annotations: Dict[str, Any] = {}
+        self.stage_timings: Dict[str, float] = {}
+        self.stages_skipped: List[str] = []
+        self._stage_cache: Dict[Tuple[str, AnalysisOptions], Any] = {}
+        self.scan_sentences: Optional[List[Tuple[int, int]]] = None
+        self.carried_entities: List[Tuple[int, int, str, str, int]] = []
+        self.carried_measurements: List[Tuple[int, int, str, float, str, str]] = []
+
+    @cached_property
+    def tokens(self) -> List[Tuple[int, int]]:
+        """(start, end) offsets of whitespace separated tokens"""
+        return [m.span() for m in TOKEN.finditer(self.text)]
+
+    @cached_property
+    def sentences(self) -> List[Tuple[int, int]]:
+        """(start, end) offsets of trimmed sentences"""
+        return split_sentences(self.text)
+
+    @cached_property
+    def sections(self) -> List[Tuple[str, int, int]]:
+        """(name, start, end) for note sections introduced by headers such as 'Assessment:'"""
+        headers = [(m.group(1).strip().lower(), m.start()) for m in SECTION_HEADER.finditer(self.text)]
+        sections = []
+        for i, (name, start) in enumerate(headers):
+            end = headers[i + 1][1] if i + 1 < len(headers) else len(self.text)
+            sections.append((name, start, end))
+        return sections
+
+    @property
+    def extraction_sentences(self) -> List[Tuple[int, int]]:
+        """Sentences the extraction stages scan"""
+        return self.sentences if self.scan_sentences is None else self.scan_sentences
+
+    def span_text(self, start: int, end: int) -> str:
+        return self.lower[start:end]
+
+    def scanned(self, start: int, end: int) -> bool:
+        """Whether a whole-text match is extracted: not if it lies inside a sentence a copy-forward analysis carries"""
+        if self.scan_sentences is None:
+            return True
+        i = bisect_right(self.sentences, (start, float("inf"))) - 1
+        return i < 0 or end > self.sentences[i][1] or self.sentences[i] in self._scan_set
+
+    @cached_property
+    def _scan_set(self) -> set:
+        return set(self.scan_sentences or ())
+
+class PipelineStage:
+    """A single analysis step; subclasses read earlier annotations and return their own"""
+    name = ""
+
+    def is_enabled(self, options: AnalysisOptions) -> bool:
+        return True
+
+    def run(self, doc: Document, options: AnalysisOptions) -> Any:
+        raise NotImplementedError
+
+def dictionary_version() -> str:
+    """Version tag of the term dictionary the dictionary stage searches"""
+    from fast_medical_db import get_fast_medical_db
+
+    return get_fast_medical_db().get_dictionary_version()
+
+def extract_dictionary_spans(sentences: List[str], options: AnalysisOptions) -> List[Tuple]:
+    """Dictionary hits for each lowered sentence as relative spans
+
+    Each result is a tuple of (start, end, label, source, confidence %, rank), rank
+    being the term's search_ranked_terms sort key. Results are memoized per sentence
+    (keyed by sentence hash and dictionary version); a single database scan covers
+    all sentences missing from the memo. Every term found is kept (dictionary_limit
+    applies to a whole document, see DictionaryStage), except the few that could
+    match across a sentence boundary, which are searched for in the whole text.
+    """
+    from fast_medical_db import get_fast_medical_db
+
+    db_manager = get_fast_medical_db()
+    version = db_manager.get_dictionary_version()
+
+    results = []
+    missed = []
+    for sentence in sentences:
+        key = ("dictionary", SentenceMemo.sentence_key(sentence), version, options.categories)
+        found = SENTENCE_MEMO.get(key)
+        if found is None:
+            missed.append((len(results), key, sentence))
+        results.append(found)
+
+    if missed:
+        # One database scan for every sentence not already in the memo
+        batch_text = "\n".join(sentence for _, _, sentence in missed)
+        ranked = db_manager.search_ranked_terms(batch_text, limit=None, categories=options.requested_labels)
+        terms = [(term, term.lower(), category, source_db, rank) for term, category, source_db, rank in ranked
+                 if not term_crosses_sentences(term)]
+        for index, key, sentence in missed:
+            found = _term_spans(sentence, terms)
+            SENTENCE_MEMO.put(key, found)
+            results[index] = found
+
+    return results
+
+def extract_boundary_term_spans(text: str, options: AnalysisOptions) -> Tuple:
+    """Hits, in a lowered text, of the dictionary terms that could match across a sentence boundary"""
+    from fast_medical_db import get_fast_medical_db
+
+    db_manager = get_fast_medical_db()
+    key = ("boundary_terms", db_manager.get_dictionary_version(), options.categories)
+    terms = SENTENCE_MEMO.get(key)
+    if terms is None:
+        terms = tuple((term, term.lower(), category, source_db, rank)
+                      for term, category, source_db, rank in db_manager.boundary_terms(options.requested_labels)
+                      if term_crosses_sentences(term))
+        SENTENCE_MEMO.put(key, terms)
+    return _term_spans(text, terms)
+
+def _term_spans(text: str, terms) -> Tuple:
+    return tuple(
+        (match.start(), match.end(), category, source_db, 90 + hash(term) % 10, rank)
+        for term, term_lower, category, source_db, rank in terms
+        if term_lower in text
+        for match in re.finditer(re.escape(term), text, re.IGNORECASE)
+    )
+
+def extract_pattern_spans(sentence: str, options: AnalysisOptions) -> Tuple:
+    """Hits of the SENTENCE_PATTERNS families in a lowered sentence as (pattern index, start, end, label), memoized"""
+    key = ("patterns", SentenceMemo.sentence_key(sentence), options.categories)
+    found = SENTENCE_MEMO.get(key)
+    if found is None:
+        found = match_patterns(sentence, options, SENTENCE_PATTERNS)
+        SENTENCE_MEMO.put(key, found)
+    return found
+
+def match_patterns(text: str, options: AnalysisOptions, patterns: List[Tuple]) -> Tuple:
+    """Hits of the given pattern families in a lowered text as (pattern index, start, end, label)"""
+    return tuple(
+        (index, match.start(), match.end(), label)
+        for index, label, compiled in patterns
+        if options.wants_label(label)
+        for match in compiled.finditer(text)
+    )
+
+class DictionaryStage(PipelineStage):
+    """Medical database lookup - (start, end, label, source, confidence %) candidates"""
+    name = "dictionary"
+
+    def is_enabled(self, options: AnalysisOptions) -> bool:
+        return options.settings["dictionary"]
+
+    def run(self, doc: Document, options: AnalysisOptions) -> List[Tuple[int, int, str, str, int]]:
+        sentences = doc.extraction_sentences
+        per_sentence = extract_dictionary_spans([doc.lower[start:end] for start, end in sentences], options)
+        hits = [
+            (rank, offset + rel_start, offset + rel_end, category, source_db, confidence)
+            for (offset, _), found in zip(sentences, per_sentence)
+            for rel_start, rel_end, category, source_db, confidence, rank in found
+        ]
+        hits.extend(
+            (rank, start, end, category, source_db, confidence)
+            for start, end, category, source_db, confidence, rank in extract_boundary_term_spans(doc.lower, options)
+            if doc.scanned(start, end)
+        )
+
+        # dictionary_limit keeps the document's best ranked terms, as one search of the whole text would
+        kept = set(sorted({hit[0] for hit in hits})[:options.settings["dictionary_limit"]])
+
+        # In the database's ranking (longest terms first), then by position
+        return [
+            (start, end, category, source_db, confidence)
+            for rank, start, end, category, source_db, confidence in sorted(hits)
+            if rank in kept
+        ]
+
+class PatternStage(PipelineStage):
+    """Regex pattern families for the requested labels - (start, end, label) candidates"""
+    name = "patterns"
+
+    def run(self, doc: Document, options: AnalysisOptions) -> List[Tuple[int, int, str]]:
+        candidates = []
+        for offset, end in doc.extraction_sentences:
+            candidates.extend((index, offset + rel_start, offset + rel_end, label)
+                              for index, rel_start, rel_end, label in extract_pattern_spans(doc.lower[offset:end], options))
+        # Families that can match across sentences run over the whole text
+        candidates.extend(hit for hit in match_patterns(doc.lower, options, TEXT_PATTERNS) if doc.scanned(hit[1], hit[2]))
+
+        # Family order, then position - the order a whole-text scan would produce
+        candidates.sort()
+        return [(start, end, label) for _, start, end, label in candidates]
+
+class MeasurementStage(PipelineStage):
+    """Numeric lab and vital sign values - (start, end, analyte, value, raw value, raw unit)"""
+    name = "measurements"
+
+    def is_enabled(self, options: AnalysisOptions) -> bool:
+        return options.wants_label("LAB_VALUES") or options.wants_label("VITAL_SIGNS")
+
+    def run(self, doc: Document, options: AnalysisOptions) -> List[Tuple[int, int, str, float, str, str]]:
+        found = [
+            (offset + rel_start, offset + rel_end, analyte, *rest)
+            for offset, end in doc.extraction_sentences
+            for rel_start, rel_end, analyte, *rest in extract_measurement_spans(doc.lower[offset:end])
+            if options.wants_label(ANALYTES[analyte][0])
+        ]
+        if doc.carried_measurements:
+            # Stable by position: a blood pressure's systolic / diastolic pair keeps its order
+            return sorted(found + doc.carried_measurements, key=lambda span: span[0])
+        return found
+
+class MergeStage(PipelineStage):
+    """Combine dictionary and pattern hits into a position-sorted EntityStore
+
+    Output: {"store": EntityStore, "categorized": {category: row indexes}}
+    """
+    name = "merge"
+
+    def run(self, doc: Document, options: AnalysisOptions) -> Dict[str, Any]:
+        rows = []
+        found_starts: Dict[str, List[int]] = {}
+        seen_entities: Dict[Tuple[str, str], int] = {}  # (text, label) -> index in rows
+        entity_id = 1
+
+        def add(start: int, end: int, label: str, source: str, confidence: int, key: str):
+            # Only the first (text, label) pair survives de-duplication
+            entity_key = (key, label)
+            if entity_key not in seen_entities:
+                seen_entities[entity_key] = len(rows)
+                rows.append((entity_id, start, end, LABELS.intern(label), SOURCES.intern(source), confidence))
+            found_starts.setdefault(key, []).append(start)
+
+        for start, end, label, source, confidence in doc.annotations.get("dictionary", []):
+            add(start, end, label, source, confidence, doc.span_text(start, end).lower())
+            entity_id += 1
+
+        for start, end, label in doc.annotations.get("patterns", []):
+            text = doc.span_text(start, end)
+            key = text.lower()
+            # Skip hits already found nearby (by the database or an earlier pattern)
+            if any(abs(s - start) < 5 for s in found_starts.get(key, ())):
+                continue
+            add(start, end, label, "Pattern", 85 + hash(text) % 15, key)
+            entity_id += 1
+
+        # Entities carried from the note this one was copied from (their sentences were not
+        # scanned): the earlier of a carried and a new (text, label) occurrence survives, as
+        # it would in a full analysis
+        for start, end, label, source, confidence in doc.carried_entities:
+            entity_key = (doc.span_text(start, end), label)
+            index = seen_entities.get(entity_key)
+            if index is None or start < rows[index][1]:
+                if index is not None:
+                    rows[index] = None
+                seen_entities[entity_key] = len(rows)
+                rows.append((entity_id, start, end, LABELS.intern(label), SOURCES.intern(source), confidence))
+            entity_id += 1
+        if doc.carried_entities:
+            rows = [row for row in rows if row is not None]
+
+        rows.sort(key=lambda row: row[1])
+        store = EntityStore.from_rows(doc.lower, rows)
+
+        # Categorize as row indexes instead of copying entities
+        rows_by_label = store.rows_by_label()
+        categorized = {
+            category: rows_by_label.get(LABELS.lookup(label), ())
+            for category, label in ENTITY_CATEGORIES.items()
+        }
+        return {"store": store, "categorized": categorized}
+
+class SummaryStage(PipelineStage):
+    name = "summary"
+
+    def is_enabled(self, options: AnalysisOptions) -> bool:
+        return options.settings["summary"]
+
+    def run(self, doc: Document, options: AnalysisOptions) -> str:
+        merged = doc.annotations["merge"]
+        store, categorized = merged["store"], merged["categorized"]
+        summary_parts = []
+        for category, prefix, limit in (
+            ("symptoms", "Patient presents with", 5),
+            ("conditions", "Medical history includes", 5),
+            ("medications", "Current medications", 5),
+            ("vital_signs", "Vital signs noted", 3),
+            ("lab_values", "Laboratory values", 3)
+        ):
+            if categorized[category]:
+                texts = ', '.join(store.entity_text(row) for row in categorized[category][:limit])
+                summary_parts.append(f"{prefix}: {texts}")
+        return ". ".join(summary_parts)
+
+class DifferentialStage(PipelineStage):
+    """Simplified differential diagnosis - driven by symptoms only"""
+    name = "differential"
+
+    def is_enabled(self, options: AnalysisOptions) -> bool:
+        return options.settings["differential"] and "symptoms" in options.requested_categories
+
+    def run(self, doc: Document, options: AnalysisOptions) -> List[Dict[str, Any]]:
+        merged = doc.annotations["merge"]
+        store = merged["store"]
+        symptom_texts = [store.entity_text(row).lower() for row in merged["categorized"]["symptoms"]]
+        differential_diagnosis = []
+
+        if any("chest pain" in s for s in symptom_texts):
+            differential_diagnosis.extend([
+                {"condition": "Myocardial Infarction", "confidence": 0.75, "reasoning": "Chest pain is a cardinal symptom"},
+                {"condition": "Angina Pectoris", "confidence": 0.68, "reasoning": "Chest pain with possible cardiac origin"},
+                {"condition": "Pulmonary Embolism", "confidence": 0.45, "reasoning": "Chest pain with respiratory symptoms"}
+            ])
+
+        if any("shortness of breath" in s for s in symptom_texts):
+            differential_diagnosis.extend([
+                {"condition": "Heart Failure", "confidence": 0.72, "reasoning": "Dyspnea is a common presentation"},
+                {"condition": "Asthma Exacerbation", "confidence": 0.58, "reasoning": "Respiratory symptoms present"}
+            ])
+
+        # Remove duplicates, then sort by confidence
+        seen_conditions = set()
+        unique_differential = []
+        for dx in differential_diagnosis:
+            if dx["condition"] not in seen_conditions:
+                seen_conditions.add(dx["condition"])
+                unique_differential.append(dx)
+
+        unique_differential.sort(key=lambda x: x["confidence"], reverse=True)
+        return unique_differential[:options.settings["differential_limit"]]
+
+class CriticalFindingsStage(PipelineStage):
+    """Critical findings alerts - only symptoms and conditions can be critical"""
+    name = "critical_findings"
+
+    def is_enabled(self, options: AnalysisOptions) -> bool:
+        return options.settings["critical_findings"] and (
+            options.wants_label("SYMPTOM") or options.wants_label("CONDITION")
+        )
+
+    def run(self, doc: Document, options: AnalysisOptions) -> List[Dict[str, Any]]:
+        return find_critical_findings(doc.annotations["merge"]["store"])
+
+def find_critical_findings(store: EntityStore) -> List[Dict[str, Any]]:
+    critical_terms = CRITICAL_SYMPTOMS + CRITICAL_CONDITIONS
+    critical_findings = []
+    for row in range(len(store)):
+        text = store.entity_text(row)
+        lowered = text.lower()
+        if any(critical in lowered for critical in critical_terms):
+            critical_findings.append({
+                "text": text,
+                "category": store.label(row),
+                "severity": "HIGH",
+                "reason": "Critical symptom or condition detected"
+            })
+    return critical_findings
+
+class AnalysisPipeline:
+    """Runs stages in order, timing each and caching its output on the document"""
+
+    def __init__(self, stages: List[PipelineStage]):
+        self.stages = stages
+
+    def run(self, doc: Document, options: AnalysisOptions) -> Document:
+        for stage in self.stages:
+            if not stage.is_enabled(options):
+                doc.annotations.pop(stage.name, None)
+                doc.stages_skipped.append(stage.name)
+                continue
+
+            cache_key = (stage.name, options)
+            if cache_key in doc._stage_cache:
+                doc.annotations[stage.name] = doc._stage_cache[cache_key]
+                continue
+
+            start = time.perf_counter()
+            output = stage.run(doc, options)
+            doc.stage_timings[stage.name] = round((time.perf_counter() - start) * 1000, 3)
+            doc._stage_cache[cache_key] = output
+            doc.annotations[stage.name] = output
+        return doc
+
+def default_stages() -> List[PipelineStage]:
+    return [
+        DictionaryStage(),
+        PatternStage(),
+        MeasurementStage(),
+        MergeStage(),
+        SummaryStage(),
+        DifferentialStage(),
+        CriticalFindingsStage()
+    ]
+
+_default_pipeline = AnalysisPipeline(default_stages())
+
+def build_analysis_response(doc: Document, options: AnalysisOptions) -> Dict[str, Any]:
+    """Assemble the analysis JSON from a document the pipeline has annotated
+
+    This is the only place entity dicts are materialized; the categorized lists
+    reference the same dicts as medical_entities.
+    """
+    merged = doc.annotations["merge"]
+    store = merged["store"]
+    unique_entities = store.to_dicts()
+    categorized_entities = {
+        category: [unique_entities[row] for row in rows]
+        for category, rows in merged["categorized"].items()
+    }
+    critical_findings = doc.annotations.get("critical_findings", [])
+
+    # Calculate overall confidence
+    avg_confidence = store.mean_confidence() if len(store) else 0.5
+
+    # Enhanced entity summary with counts
+    entity_counts = {
+        "symptoms": len(categorized_entities["symptoms"]),
+        "conditions": len(categorized_entities["conditions"]),
+        "medications": len(categorized_entities["medications"]),
+        "vital_signs": len(categorized_entities["vital_signs"]),
+        "lab_values": len(categorized_entities["lab_values"]),
+        "procedures": len(categorized_entities["procedures"]),
+        "allergies": len(categorized_entities["allergies"]),
+        "family_history": len(categorized_entities["family_history"]),
+        "social_history": len(categorized_entities["social_history"]),
+        "total_entities": len(unique_entities)
+    }
+
+    return {
+        "extracted_text": doc.text,
+        "medical_entities": unique_entities,
+        "categorized_entities": categorized_entities,
+        "entity_counts": entity_counts,
+        "summary": doc.annotations.get("summary") or "Medical text analyzed.",
+        "critical_findings": critical_findings,
+        "measurements": measurement_dicts(doc.text, doc.annotations.get("measurements", [])),
+        "differential_diagnosis": doc.annotations.get("differential", []),  # Top suggestions
+        "confidence_score": round(avg_confidence, 2),
+        "analysis_type": "enhanced_medical_ner",
+        "processing_metadata": {
+            "text_length": len(doc.text),
+            "entities_found": len(unique_entities),
+            "categories_detected": len([k for k, v in categorized_entities.items() if v]),
+            "has_critical_findings": len(critical_findings) > 0,
+            "analysis_profile": options.profile,
+            "categories_requested": options.requested_categories,
+            "dictionary_version": dictionary_version(),
+            "stages_skipped": doc.stages_skipped
+        }
+    }
+
+def run_analysis(text: str, analysis_profile: str = DEFAULT_ANALYSIS_PROFILE,
+                 categories: Optional[List[str]] = None) -> Tuple[Document, Dict[str, Any]]:
+    """Analyze text with the default stages; returns the annotated document and response JSON"""
+    return analyze_document(Document(text), analysis_profile, categories)
+
+def analyze_document(doc: Document, analysis_profile: str = DEFAULT_ANALYSIS_PROFILE,
+                     categories: Optional[List[str]] = None) -> Tuple[Document, Dict[str, Any]]:
+    """run_analysis for a Document the caller prepared (e.g. with carried copy-forward results)"""
+    options = AnalysisOptions(analysis_profile, tuple(categories) if categories else None)
+    doc = _default_pipeline.run(doc, options)
+    return doc, build_analysis_response(doc, options)
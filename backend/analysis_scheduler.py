@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Analysis Scheduler - priority classes and weighted fair sharing of analysis work
+Every analysis runs in an execution slot. Requests are grouped into flows by
+priority class (interactive, upload, bulk) and tenant (user or patient), and
+waiting requests are granted slots in start-time fair queueing order: each
+request is tagged max(virtual time, the flow's previous finish tag) and the flow's
+finish tag advances by cost / class weight. A flow with a long backlog (a bulk
+backfill of one patient) therefore cannot hold back a flow that just arrived
+(an urgent upload), and flows of the same class share slots evenly.
+
+One slot is reserved for interactive requests, so an interactive analysis never
+waits for a long upload or bulk document to finish; it only shares the CPU with
+the background analyses already running.
+
+The same tags order queued analysis_jobs (see job_queue.py), so the queue and the
+in-process slots agree on what runs next.
+"""
+import asyncio
+import heapq
+import itertools
+import threading
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+PRIORITY_CLASSES = ("interactive", "upload", "bulk")
+PRIORITY_WEIGHTS = {
+    "interactive": 16.0,
+    "upload": 4.0,
+    "bulk": 1.0
+}
+
+DEFAULT_SLOTS = 2                 # Concurrent analyses per process
+RESERVED_INTERACTIVE_SLOTS = 1    # Of those, usable only by interactive requests
+MAX_IDLE_FLOWS = 10000            # Flows kept before caught-up ones are forgotten
+
+class FairClock:
+    """Start-time fair queueing tags per (priority, tenant) flow"""
+
+    def __init__(self):
+        self.virtual_time = 0.0
+        self.finish_tags: Dict[Tuple[str, str], float] = {}
+
+    def tag(self, priority: str, tenant: str, cost: float = 1.0) -> float:
+        """Start tag for one request of the flow; advances the flow's finish tag"""
+        flow = (priority, tenant)
+        start = max(self.virtual_time, self.finish_tags.get(flow, 0.0))
+        self.finish_tags[flow] = start + cost / PRIORITY_WEIGHTS[priority]
+        return start
+
+    def advance(self, start: float):
+        """A request with this start tag began running"""
+        self.virtual_time = max(self.virtual_time, start)
+        if len(self.finish_tags) > MAX_IDLE_FLOWS:
+            # A flow that has caught up with virtual time would start there anyway
+            self.finish_tags = {flow: tag for flow, tag in self.finish_tags.items() if tag > self.virtual_time}
+
+class _Waiter:
+    __slots__ = ("start", "rank", "seq", "priority", "loop", "future", "granted", "cancelled")
+
+    def __init__(self, start: float, seq: int, priority: str, loop: asyncio.AbstractEventLoop):
+        self.start = start
+        self.rank = PRIORITY_CLASSES.index(priority)
+        self.seq = seq
+        self.priority = priority
+        self.loop = loop
+        self.future = loop.create_future()
+        self.granted = False
+        self.cancelled = False
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.start, self.rank, self.seq) < (other.start, other.rank, other.seq)
+
+def _deliver(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+class AnalysisScheduler:
+    """Execution slots for analyses, shared by the event loop and the job worker threads"""
+
+    def __init__(self, slots: int = DEFAULT_SLOTS, reserved: int = RESERVED_INTERACTIVE_SLOTS):
+        self.slots = slots
+        self.reserved = min(reserved, slots - 1)
+        self.clock = FairClock()
+        self.lock = threading.Lock()
+        self.sequence = itertools.count()
+        # Interactive and background waiters are kept apart so the reserved slot can skip the latter
+        self.interactive: List[_Waiter] = []
+        self.background: List[_Waiter] = []
+        self.running = dict.fromkeys(PRIORITY_CLASSES, 0)
+
+    def configure(self, slots: int, reserved: int = RESERVED_INTERACTIVE_SLOTS):
+        with self.lock:
+            self.slots = slots
+            self.reserved = min(reserved, slots - 1)
+            self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, priority: str, tenant: str, cost: float = 1.0):
+        """Hold an execution slot for the body; waits in fair order while all slots are busy"""
+        await self.acquire(priority, tenant, cost)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+    async def acquire(self, priority: str, tenant: str, cost: float = 1.0):
+        with self.lock:
+            start = self.clock.tag(priority, tenant, cost)
+            waiter = _Waiter(start, next(self.sequence), priority, asyncio.get_running_loop())
+            heapq.heappush(self.interactive if priority == "interactive" else self.background, waiter)
+            self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self.lock:
+                if waiter.granted:
+                    self._release(priority)
+                else:
+                    waiter.cancelled = True
+            raise
+
+    def release(self, priority: str):
+        with self.lock:
+            self._release(priority)
+
+    def _release(self, priority: str):
+        self.running[priority] -= 1
+        self._dispatch()
+
+    def _next(self, heap: List[_Waiter]) -> Optional[_Waiter]:
+        while heap and heap[0].cancelled:
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    def _dispatch(self):
+        """Grant free slots to waiters in tag order (called with the lock held)"""
+        while sum(self.running.values()) < self.slots:
+            interactive = self._next(self.interactive)
+            background = self._next(self.background)
+            background_running = sum(self.running.values()) - self.running["interactive"]
+            if background is not None and background_running >= self.slots - self.reserved:
+                background = None
+            if interactive is None and background is None:
+                return
+            if background is None or (interactive is not None and interactive < background):
+                waiter = heapq.heappop(self.interactive)
+            else:
+                waiter = heapq.heappop(self.background)
+            waiter.granted = True
+            self.running[waiter.priority] += 1
+            self.clock.advance(waiter.start)
+            waiter.loop.call_soon_threadsafe(_deliver, waiter.future)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            waiting = dict.fromkeys(PRIORITY_CLASSES, 0)
+            for waiter in self.interactive + self.background:
+                if not waiter.cancelled:
+                    waiting[waiter.priority] += 1
+            return {
+                "slots": self.slots,
+                "reserved_interactive_slots": self.reserved,
+                "running": dict(self.running),
+                "waiting": waiting,
+                "virtual_time": round(self.clock.virtual_time, 3)
+            }
+
+ANALYSIS_SCHEDULER = AnalysisScheduler()
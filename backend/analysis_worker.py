@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""
+Standalone Analysis Worker
+Claims document analysis jobs from the shared analysis_jobs table without serving
+the API, so analysis can be spread over extra processes or hosts. Run API servers
+with ANALYSIS_WORKERS=0 to leave all analysis to these workers.
+Run from the backend directory: python analysis_worker.py [--workers N]
+"""
+import logging
+import signal
+import sys
+import threading
+
+from job_queue import DEFAULT_WORKERS, JobQueue
+from main import init_database, process_document_job
+
+def run_worker(workers: int = DEFAULT_WORKERS, db_path: str = 'dip_analysis.db'):
+    """Process jobs until SIGINT / SIGTERM; the leases of unfinished jobs expire and are reclaimed"""
+    init_database()
+    queue = JobQueue(db_path)
+    done = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: done.set())
+    signal.signal(signal.SIGINT, lambda *_: done.set())
+
+    queue.start(process_document_job, workers)
+    print(f"🛠️  Analysis worker {queue.node} running {workers} worker threads on {db_path}")
+    done.wait()
+    print("Stopping analysis worker...")
+    queue.stop()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = sys.argv[1:]
+    workers = int(args[args.index("--workers") + 1]) if "--workers" in args else DEFAULT_WORKERS
+    run_worker(workers)
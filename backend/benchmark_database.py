@@ -0,0 +1,1132 @@
+#!/usr/bin/env python3
+"""
+Patient Database Benchmark
+Builds synthetic patient databases in a temporary directory and times the
+patient management endpoints against them.
+Run from the backend directory: python benchmark_database.py [sizes...]
+e.g. python benchmark_database.py 10000 100000 1000000
+"""
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+import zipfile
+from typing import Dict, List
+
+from fastapi import Response, UploadFile
+from starlette.datastructures import Headers
+from starlette.requests import Request
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BACKEND_DIR)
+
+import main
+from analysis_pipeline import run_analysis, split_sentences
+from benchmark_analysis import SAMPLE_NOTE, _percentile
+from cohort_index import COHORT_INDEX, index_document_entities
+from document_text import DOCX_TYPE
+from entity_analytics import ENTITY_ANALYTICS
+from hl7_listener import HL7_BATCH_SIZE, HL7Listener
+from hl7_sender import send_messages, synthetic_messages
+from job_queue import JobQueue, enqueue_document_job, job_counts
+from search_index import index_document
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+DIRECTORY_DOCUMENTS = 500
+SEARCH_DOCUMENTS = 100000
+COHORT_DOCUMENTS = 1000000
+ANALYTICS_ANALYSES = 1340000   # ~10M entity rows
+LAB_PATIENTS = 100000
+TIMELINE_DOCUMENTS = 500
+TREE_SIZES = [10, 100, 500]
+BATCH_SIZES = [10, 100, 500]
+HISTORY_ROWS = 1000000
+UPLOAD_PAGES = 100
+WORKER_JOBS = 200
+WORKER_PROCESSES = [1, 2, 4]
+WORKER_JOB_SECONDS = 0.05   # Fixed per-job latency for the queue-only run
+BACKFILL_DOCUMENTS = 400    # Bulk documents queued for one patient in the isolation scenario
+BACKFILL_PAGES = 5
+BACKFILL_WORKERS = 4
+INTERACTIVE_REQUESTS = 100
+RESUMABLE_UPLOAD_MB = 300
+INGEST_DOCUMENTS = 500
+INGEST_DUPLICATE_RATIO = 0.1   # Share of archive entries the patient already has
+EXPORT_PATIENTS = 20000
+EXPORT_LEGACY_SAMPLE = 200      # Patients fetched the per-request way (the total is extrapolated)
+HL7_MESSAGES = 10000
+HL7_CONNECTIONS = 4
+HL7_PATIENTS = 500
+DOCUMENT_TEXT_PAGES = 200
+
+def build_synthetic_database(work_dir: str, patients: int, docs_per_patient: int = 2) -> str:
+    """Create dip_analysis.db in work_dir with the given number of patients"""
+    os.chdir(work_dir)
+    if os.path.exists("dip_analysis.db"):
+        os.remove("dip_analysis.db")
+    main.init_database()
+
+    rng = random.Random(patients)
+    conn = sqlite3.connect("dip_analysis.db")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA journal_mode=MEMORY")
+
+    batch_size = 10000
+    for batch_start in range(0, patients, batch_size):
+        patient_rows, directory_rows, document_rows = [], [], []
+        for n in range(batch_start, min(patients, batch_start + batch_size)):
+            patient_id = str(uuid.UUID(int=rng.getrandbits(128)))
+            stamp = f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}"
+            patient_rows.append((patient_id, f"Patient {n:07d}", "1970-01-01", stamp, stamp,
+                                 json.dumps({"mrn": f"MRN{n:07d}"})))
+            directory_id = str(uuid.UUID(int=rng.getrandbits(128)))
+            directory_rows.append((directory_id, "Clinical Notes", patient_id))
+            for d in range(docs_per_patient):
+                document_rows.append((str(uuid.UUID(int=rng.getrandbits(128))), f"note_{d}.txt", "text/plain",
+                                      1024, f"uploads/{patient_id}/note_{d}.txt", directory_id, patient_id, stamp))
+        conn.executemany("INSERT INTO patients (id, name, date_of_birth, created_at, updated_at, metadata) VALUES (?, ?, ?, ?, ?, ?)", patient_rows)
+        conn.executemany("INSERT INTO directories (id, name, type, patient_id) VALUES (?, ?, 'default', ?)", directory_rows)
+        conn.executemany("""INSERT INTO patient_documents (id, name, file_type, file_size, file_path, directory_id, patient_id, uploaded_at, tags)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, '[]')""", document_rows)
+        conn.commit()
+
+    conn.execute("ANALYZE")
+    conn.close()
+    return os.path.join(work_dir, "dip_analysis.db")
+
+def _timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, (time.perf_counter() - start) * 1000
+
+def _legacy_patient_listing() -> List[Dict]:
+    """The previous GET /patients: GROUP BY over every patient and document"""
+    conn = sqlite3.connect("dip_analysis.db")
+    rows = conn.execute("""
+        SELECT p.id, p.name, p.date_of_birth, p.created_at, p.updated_at, p.metadata,
+               COUNT(pd.id), MAX(pd.uploaded_at)
+        FROM patients p
+        LEFT JOIN patient_documents pd ON p.id = pd.patient_id
+        GROUP BY p.id, p.name, p.date_of_birth, p.created_at, p.updated_at, p.metadata
+        ORDER BY p.updated_at DESC
+    """).fetchall()
+    conn.close()
+    return [main.patient_list_row(row) for row in rows]
+
+def _peak_memory_mb(fn) -> float:
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1024 / 1024
+
+def benchmark_patient_listing(work_dir: str, size: int) -> Dict[str, float]:
+    print(f"\n📋 GET /patients with {size:,} patients")
+    print("-" * 60)
+
+    def page(cursor=None):
+        return asyncio.run(main.get_patients(limit=100, cursor=cursor, sort="updated_desc",
+                                             stream=False, include_total=False, fields=None))
+
+    first, first_ms = _timed(page)
+
+    # Build a cursor half way through the table to time a deep page
+    conn = sqlite3.connect("dip_analysis.db")
+    middle = conn.execute("SELECT updated_at, id FROM patients ORDER BY updated_at DESC, id DESC LIMIT 1 OFFSET ?",
+                          (size // 2,)).fetchone()
+    conn.close()
+    _, deep_ms = _timed(lambda: page(main.encode_cursor(list(middle))))
+
+    def consume_stream():
+        total_bytes = 0
+        for chunk in main.stream_patients("updated_at", "DESC"):
+            total_bytes += len(chunk)
+        return total_bytes
+
+    stream_bytes, stream_ms = _timed(consume_stream)
+    stream_peak = _peak_memory_mb(consume_stream)
+
+    results = {"first_page_ms": first_ms, "deep_page_ms": deep_ms,
+               "stream_ms": stream_ms, "stream_peak_mb": stream_peak}
+    print(f"  keyset first page (100)       {first_ms:10.2f} ms")
+    print(f"  keyset page at 50% depth      {deep_ms:10.2f} ms")
+    print(f"  streamed export               {stream_ms:10.2f} ms  {stream_bytes / 1024 / 1024:8.1f} MB  peak {stream_peak:7.1f} MB")
+
+    if size <= 100000:
+        legacy, legacy_ms = _timed(_legacy_patient_listing)
+        legacy_peak = _peak_memory_mb(_legacy_patient_listing)
+        results.update({"legacy_ms": legacy_ms, "legacy_peak_mb": legacy_peak})
+        print(f"  legacy full listing           {legacy_ms:10.2f} ms  peak {legacy_peak:7.1f} MB")
+    else:
+        print("  legacy full listing           skipped above 100k patients")
+    return results
+
+def benchmark_directory_listing(work_dir: str, documents: int, analysis_results: Dict) -> Dict[str, float]:
+    """Documents listing for one directory: light default vs the full analysis payload"""
+    build_synthetic_database(work_dir, 1, docs_per_patient=0)
+    conn = sqlite3.connect("dip_analysis.db")
+    patient_id, directory_id = conn.execute("SELECT patient_id, id FROM directories").fetchone()
+    results_json = json.dumps(analysis_results)
+    for n in range(documents):
+        analysis_id = conn.execute("""INSERT INTO analysis_results (user_id, file_name, file_type, analysis_type, results, confidence_score)
+                                      VALUES (?, ?, 'text/plain', 'patient_document', ?, ?)""",
+                                   (f"patient_{patient_id}", f"note_{n}.txt", results_json,
+                                    analysis_results.get("confidence_score", 0))).lastrowid
+        conn.execute("""INSERT INTO patient_documents (id, name, file_type, file_size, file_path, directory_id, patient_id, analysis_id, tags)
+                        VALUES (?, ?, 'text/plain', ?, ?, ?, ?, ?, '[]')""",
+                     (str(uuid.uuid4()), f"note_{n}.txt", len(SAMPLE_NOTE), f"uploads/note_{n}.txt",
+                      directory_id, patient_id, analysis_id))
+    conn.commit()
+    conn.close()
+
+    print(f"\n📁 GET /patients/{{id}}/directories/{{id}}/documents with {documents} documents")
+    print("-" * 60)
+    variants = [
+        ("default (light columns)", None, None),
+        ("fields=id,name,uploaded_at", "id,name,uploaded_at", None),
+        ("include=confidence_score", None, "confidence_score"),
+        ("include=analysis_results", None, "analysis_results")
+    ]
+    results = {}
+    for label, fields, include in variants:
+        call = lambda: asyncio.run(main.get_directory_documents(patient_id, directory_id, fields=fields, include=include))
+        call()  # warm the page cache
+        timings = []
+        for _ in range(5):
+            response, elapsed = _timed(call)
+            timings.append(elapsed)
+        payload = len(json.dumps(response).encode())
+        results[label] = min(timings)
+        print(f"  {label:30} {min(timings):10.2f} ms  {payload / 1024:10.1f} KB")
+    return results
+
+def benchmark_document_search(work_dir: str, documents: int, iterations: int = 20) -> Dict[str, Dict[str, float]]:
+    """FTS5 query latency over synthetic notes built from the sample note's sentences"""
+    patients = max(1, documents // 100)
+    build_synthetic_database(work_dir, patients, docs_per_patient=0)
+    sentences = [SAMPLE_NOTE[start:end] for start, end in split_sentences(SAMPLE_NOTE)]
+    rng = random.Random(documents)
+
+    conn = sqlite3.connect("dip_analysis.db")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA cache_size=-262144")
+    directories = conn.execute("SELECT id, patient_id FROM directories").fetchall()
+    documents_rows, texts = [], []
+    for n in range(documents):
+        directory_id, patient_id = directories[n % len(directories)]
+        # Every note also names one of 500 rare drugs so selective queries can be timed
+        text = " ".join(rng.choice(sentences) for _ in range(8)) + f" Started drug{rng.randrange(500)}mab."
+        documents_rows.append((str(uuid.uuid4()), f"note_{n}.txt", len(text), f"uploads/note_{n}.txt",
+                               directory_id, patient_id, n + 1))
+        texts.append((n + 1, patient_id, f"note_{n}.txt", text))
+    conn.executemany("""INSERT INTO analysis_results (id, user_id, file_name, file_type, analysis_type, results, confidence_score)
+                        VALUES (?, 'benchmark', ?, 'text/plain', 'patient_document', '{}', 0.9)""",
+                     [(row[6], row[1]) for row in documents_rows])
+    conn.executemany("""INSERT INTO patient_documents (id, name, file_type, file_size, file_path, directory_id, patient_id, analysis_id, tags)
+                        VALUES (?, ?, 'text/plain', ?, ?, ?, ?, ?, '[]')""", documents_rows)
+    start = time.perf_counter()
+    cursor = conn.cursor()
+    for analysis_id, patient_id, name, text in texts:
+        index_document(cursor, analysis_id, patient_id, name, text, {})
+    conn.commit()
+    index_ms = (time.perf_counter() - start) * 1000
+    conn.close()
+
+    print(f"\n🔎 GET /search/documents over {documents:,} documents (indexed in {index_ms / 1000:.1f} s)")
+    print("-" * 60)
+    scoped_patient = directories[0][1]
+    queries = [
+        ("common term", {"q": "pain"}),
+        ("two terms", {"q": "chest metformin"}),
+        ("prefix", {"q": "hyperten"}),
+        ("rare term", {"q": "drug17mab"}),
+        ("phrase (raw)", {"q": '"shortness of breath"', "raw": True}),
+        ("common term, one patient", {"q": "pain", "patient_id": scoped_patient}),
+        ("common term, page 10", {"q": "pain", "offset": 200})
+    ]
+    results = {}
+    for label, params in queries:
+        call = lambda: asyncio.run(main.search_patient_documents(
+            q=params["q"], patient_id=params.get("patient_id"), limit=20,
+            offset=params.get("offset", 0), raw=params.get("raw", False)))
+        call()
+        samples = [_timed(call)[1] for _ in range(iterations)]
+        results[label] = {"p50_ms": _percentile(samples, 50), "p95_ms": _percentile(samples, 95)}
+        print(f"  {label:28} p50 {results[label]['p50_ms']:8.2f} ms   p95 {results[label]['p95_ms']:8.2f} ms")
+    return results
+
+def benchmark_cohort_queries(work_dir: str, documents: int, iterations: int = 20) -> Dict[str, Dict[str, float]]:
+    """Bitset cohort queries over synthetic postings (8 entities per document, Zipf-distributed terms)"""
+    patients = max(1, documents // 10)
+    build_synthetic_database(work_dir, 0)
+    rng = random.Random(documents)
+
+    vocabulary = [("metformin", "MEDICATION"), ("insulin", "MEDICATION"), ("hba1c", "LAB_VALUES"),
+                  ("hypertension", "CONDITION"), ("diabetes", "CONDITION")]
+    vocabulary += [(f"term{n}", "CONDITION") for n in range(5000 - len(vocabulary))]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+
+    conn = sqlite3.connect("dip_analysis.db")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA cache_size=-262144")
+    conn.executemany("INSERT INTO entity_terms (id, entity_norm, label) VALUES (?, ?, ?)",
+                     [(n + 1, norm, label) for n, (norm, label) in enumerate(vocabulary)])
+    conn.executemany("INSERT INTO patient_keys (id, patient_id) VALUES (?, ?)",
+                     [(n + 1, f"patient-{n}") for n in range(patients)])
+    start = time.perf_counter()
+    for batch_start in range(0, documents, 100000):
+        document_rows, posting_rows = [], []
+        for analysis_id in range(batch_start + 1, min(documents, batch_start + 100000) + 1):
+            key = rng.randrange(patients) + 1
+            document_rows.append((analysis_id, key))
+            for term_id in set(rng.choices(range(1, len(vocabulary) + 1), weights, k=8)):
+                posting_rows.append((term_id, analysis_id, key))
+        conn.executemany("INSERT INTO indexed_documents (analysis_id, patient_key) VALUES (?, ?)", document_rows)
+        # Sorted to match the (term_id, analysis_id) clustering of entity_postings
+        posting_rows.sort()
+        conn.executemany("INSERT INTO entity_postings (term_id, analysis_id, patient_key) VALUES (?, ?, ?)", posting_rows)
+    conn.commit()
+    postings = conn.execute("SELECT COUNT(*) FROM entity_postings").fetchone()[0]
+    build_ms = (time.perf_counter() - start) * 1000
+
+    print(f"\n🧬 GET /cohorts/query over {documents:,} documents, {postings:,} postings (built in {build_ms / 1000:.1f} s)")
+    print("-" * 60)
+    queries = [
+        ("metformin AND hba1c AND NOT insulin", "patient"),
+        ("metformin AND hba1c AND NOT insulin", "document"),
+        ("(diabetes OR hypertension) AND NOT term4000", "patient"),
+        ("term100 OR term200 OR term300", "document")
+    ]
+    call = lambda q, level: asyncio.run(main.query_cohort(q=q, level=level, limit=100, offset=0))
+    results = {}
+    for q, level in queries:
+        COHORT_INDEX._reset()
+        cold = _timed(lambda: call(q, level))[1]
+        samples = [_timed(lambda: call(q, level))[1] for _ in range(iterations)]
+        evaluation = call(q, level)["evaluation_ms"]
+        total = call(q, level)["total"]
+        label = f"{q} [{level}]"
+        results[label] = {"cold_ms": cold, "p50_ms": _percentile(samples, 50), "evaluation_ms": evaluation}
+        print(f"  {label}")
+        print(f"      {total:>9,} matches   cold {cold:8.1f} ms   warm p50 {results[label]['p50_ms']:6.2f} ms   (bitsets {evaluation:.2f} ms)")
+
+    # New documents are folded into the cached bitsets on the next query
+    call(queries[0][0], "patient")
+    cursor = conn.cursor()
+    for analysis_id in range(documents + 1, documents + 1001):
+        index_document_entities(cursor, analysis_id, f"patient-{rng.randrange(patients)}",
+                                [{"text": "metformin", "label": "MEDICATION"}, {"text": "hba1c", "label": "LAB_VALUES"}])
+    conn.commit()
+    conn.close()
+    refresh_ms = _timed(lambda: call(queries[0][0], "patient"))[1]
+    print(f"  first query after 1,000 new documents        {refresh_ms:8.2f} ms")
+    return results
+
+def benchmark_entity_analytics(work_dir: str, analyses: int, analysis_results: Dict,
+                               iterations: int = 20) -> Dict[str, Dict[str, float]]:
+    """Analytics endpoints over a synthetic snapshot (up to 8 entities per analysis, Zipf-distributed, 24 months)"""
+    import numpy as np
+    build_synthetic_database(work_dir, 0)
+    rng = np.random.default_rng(analyses)
+    labels = ["CONDITION", "MEDICATION", "SYMPTOM", "LAB_VALUES"]
+    vocabulary = [("diabetes", "CONDITION"), ("metformin", "MEDICATION"), ("hypertension", "CONDITION")]
+    vocabulary += [(f"term{n}", labels[n % len(labels)]) for n in range(5000 - len(vocabulary))]
+
+    start = time.perf_counter()
+    snapshot = ENTITY_ANALYTICS
+    snapshot._reset()
+    term_ids = np.array([snapshot._term_id(norm, snapshot._label_code(label)) for norm, label in vocabulary])
+    weights = 1 / np.arange(1, len(vocabulary) + 1)
+    for batch_start in range(0, analyses, 250000):
+        batch = min(analyses, batch_start + 250000) - batch_start
+        # 8 draws per analysis, duplicates within an analysis dropped
+        draws = term_ids[rng.choice(len(vocabulary), size=batch * 8, p=weights / weights.sum())]
+        pairs = np.unique(np.repeat(np.arange(batch, dtype=np.int64), 8) * len(vocabulary) + draws)
+        snapshot.append_analyses(np.arange(batch_start + 1, batch_start + batch + 1),
+                                 rng.integers(2024 * 12, 2026 * 12, size=batch),
+                                 np.bincount(pairs // len(vocabulary), minlength=batch),
+                                 pairs % len(vocabulary))
+    build_ms = (time.perf_counter() - start) * 1000
+
+    print(f"\n📊 /analytics/entities over {snapshot.rows:,} entity rows (built in {build_ms / 1000:.1f} s)")
+    print("-" * 60)
+    queries = [
+        ("top conditions", lambda: main.get_top_entities(label="conditions", since=None, until=None, limit=20)),
+        ("top medications, last 12 months", lambda: main.get_top_entities(label="medications", since="2025-01",
+                                                                          until=None, limit=20)),
+        ("monthly, top 5 medications", lambda: main.get_entity_monthly_frequency(label="medications", entities=None,
+                                                                                 since=None, until=None, limit=5)),
+        ("co-occurrence with diabetes", lambda: main.get_entity_cooccurrence(entity="diabetes", label=None,
+                                                                             partner_label="medications", since=None,
+                                                                             until=None, limit=20, by_month=False)),
+        ("co-occurrence, by month", lambda: main.get_entity_cooccurrence(entity="term400", label=None,
+                                                                         partner_label=None, since="2025-01",
+                                                                         until=None, limit=10, by_month=True))
+    ]
+    results = {}
+    for label, query in queries:
+        call = lambda: asyncio.run(query())
+        call()
+        samples = [_timed(call)[1] for _ in range(iterations)]
+        results[label] = {"p50_ms": _percentile(samples, 50), "p95_ms": _percentile(samples, 95)}
+        print(f"  {label:34} p50 {results[label]['p50_ms']:8.2f} ms   p95 {results[label]['p95_ms']:8.2f} ms")
+
+    # New analyses are loaded from analysis_results on the next request
+    for _ in range(1000):
+        main.save_analysis_result("benchmark", "note.txt", "text", "medical_text", analysis_results, 0.9)
+    refresh_ms = _timed(lambda: asyncio.run(queries[0][1]()))[1]
+    print(f"  {'first query after 1,000 analyses':34}     {refresh_ms:8.2f} ms")
+    return results
+
+def benchmark_lab_queries(work_dir: str, patients: int, per_patient: int = 30,
+                          iterations: int = 20) -> Dict[str, Dict[str, float]]:
+    """Lab range queries and trends over synthetic observations (3 years, 6 analytes)"""
+    build_synthetic_database(work_dir, patients, docs_per_patient=0)
+    rng = random.Random(patients)
+    analytes = [("hba1c", "%", 7.0, 1.5), ("glucose", "mg/dL", 130, 40), ("creatinine", "mg/dL", 1.1, 0.4),
+                ("systolic_bp", "mmHg", 135, 18), ("diastolic_bp", "mmHg", 82, 10), ("heart_rate", "bpm", 78, 14)]
+
+    conn = sqlite3.connect("dip_analysis.db")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA cache_size=-262144")
+    patient_ids = [row[0] for row in conn.execute("SELECT id FROM patients")]
+    start = time.perf_counter()
+    for batch_start in range(0, len(patient_ids), 10000):
+        rows = []
+        for patient_id in patient_ids[batch_start:batch_start + 10000]:
+            for n in range(per_patient):
+                analyte, unit, mean, spread = analytes[n % len(analytes)]
+                stamp = f"{rng.randint(2023, 2025)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} 09:00:00"
+                rows.append((patient_id, n // len(analytes) + 1, analyte, round(rng.gauss(mean, spread), 1),
+                             unit, n, stamp))
+        conn.executemany("""INSERT INTO lab_observations (patient_id, analysis_id, analyte, value, unit, position, observed_at)
+                            VALUES (?, ?, ?, ?, ?, ?, ?)""", rows)
+    conn.commit()
+    conn.execute("ANALYZE")
+    observations = conn.execute("SELECT COUNT(*) FROM lab_observations").fetchone()[0]
+    conn.close()
+    build_ms = (time.perf_counter() - start) * 1000
+
+    print(f"\n🧪 Lab queries over {observations:,} observations, {patients:,} patients (built in {build_ms / 1000:.1f} s)")
+    print("-" * 60)
+    patient_id = patient_ids[len(patient_ids) // 2]
+    queries = [
+        ("HbA1c > 8 in 2025, first page", lambda: main.find_patients_by_lab_value(
+            analyte="hba1c", above=8, below=None, since="2025-01-01", until=None, limit=100, offset=0)),
+        ("HbA1c > 12 (rare), all time", lambda: main.find_patients_by_lab_value(
+            analyte="hba1c", above=12, below=None, since=None, until=None, limit=100, offset=0)),
+        ("systolic 140-160 in Q1 2025", lambda: main.find_patients_by_lab_value(
+            analyte="systolic_bp", above=140, below=160, since="2025-01-01", until="2025-03-31", limit=100, offset=0)),
+        ("one patient's HbA1c trend", lambda: main.get_patient_lab_trend(patient_id, "hba1c", since=None, until=None)),
+        ("one patient's latest labs", lambda: main.get_patient_labs(patient_id))
+    ]
+    results = {}
+    for label, query in queries:
+        call = lambda: asyncio.run(query())
+        call()
+        samples = [_timed(call)[1] for _ in range(iterations)]
+        results[label] = {"p50_ms": _percentile(samples, 50), "p95_ms": _percentile(samples, 95)}
+        print(f"  {label:34} p50 {results[label]['p50_ms']:8.2f} ms   p95 {results[label]['p95_ms']:8.2f} ms")
+    return results
+
+def benchmark_patient_timeline(work_dir: str, documents: int, analysis_results: Dict,
+                               iterations: int = 20) -> Dict[str, Dict[str, float]]:
+    """Opening one patient: stored timeline rollup vs directories plus every document's analysis"""
+    build_synthetic_database(work_dir, 10000)
+    conn = sqlite3.connect("dip_analysis.db")
+    cursor = conn.cursor()
+    patient_id = conn.execute("SELECT id FROM patients ORDER BY id LIMIT 1").fetchone()[0]
+    directory_id = conn.execute("SELECT id FROM directories WHERE patient_id = ?", (patient_id,)).fetchone()[0]
+    results_json = json.dumps(analysis_results)
+    for n in range(documents):
+        analysis_id = cursor.execute("""INSERT INTO analysis_results (user_id, file_name, file_type, analysis_type, results, confidence_score)
+                                        VALUES (?, ?, 'text/plain', 'patient_document', ?, ?)""",
+                                     (f"patient_{patient_id}", f"note_{n}.txt", results_json,
+                                      analysis_results.get("confidence_score", 0))).lastrowid
+        cursor.execute("""INSERT INTO patient_documents (id, name, file_type, file_size, file_path, directory_id, patient_id, analysis_id, uploaded_at, tags)
+                          VALUES (?, ?, 'text/plain', ?, ?, ?, ?, ?, datetime('2024-01-01', ?), '[]')""",
+                       (str(uuid.uuid4()), f"note_{n}.txt", len(SAMPLE_NOTE), f"uploads/note_{n}.txt",
+                        directory_id, patient_id, analysis_id, f"+{n} days"))
+        main.record_observations(cursor, analysis_id, patient_id, analysis_results.get("measurements", []))
+        main.record_document_event(cursor, analysis_id, patient_id, analysis_results)
+    _, rebuild_ms = _timed(lambda: main.build_patient_rollup(cursor, patient_id))
+    conn.commit()
+    conn.close()
+
+    def legacy_page():
+        patient = asyncio.run(main.get_patient(patient_id, fields=None))["patient"]
+        return [asyncio.run(main.get_directory_documents(patient_id, directory["id"], fields=None,
+                                                         include="analysis_results"))
+                for directory in patient["directories"]]
+
+    print(f"\n🗓️  Opening a patient with {documents} analyzed documents (rollup rebuild {rebuild_ms:.1f} ms)")
+    print("-" * 60)
+    variants = [
+        ("directories + full analyses", legacy_page),
+        ("GET /patients/{id}/timeline", lambda: asyncio.run(main.get_patient_timeline(patient_id, cursor=None, limit=50)))
+    ]
+    results = {}
+    for label, call in variants:
+        response = call()
+        samples = [_timed(call)[1] for _ in range(iterations)]
+        payload = len(json.dumps(response).encode())
+        results[label] = {"p50_ms": _percentile(samples, 50), "p95_ms": _percentile(samples, 95)}
+        print(f"  {label:30} p50 {results[label]['p50_ms']:8.2f} ms   p95 {results[label]['p95_ms']:8.2f} ms"
+              f"   {payload / 1024:8.1f} KB")
+    return results
+
+def _legacy_subtree_counts(patient_id: str) -> Dict[str, int]:
+    """Flat directory list, then one subtree count query per directory (the old client-side path)"""
+    conn = sqlite3.connect("dip_analysis.db")
+    ids = [row[0] for row in conn.execute("SELECT id FROM directories WHERE patient_id = ? ORDER BY sort_order, name",
+                                          (patient_id,))]
+    counts = {}
+    for directory_id in ids:
+        counts[directory_id] = conn.execute("""
+            WITH RECURSIVE subtree(id) AS (
+                SELECT ? UNION SELECT d.id FROM directories d JOIN subtree s ON d.parent_id = s.id
+            )
+            SELECT COUNT(*) FROM patient_documents WHERE directory_id IN (SELECT id FROM subtree)
+        """, (directory_id,)).fetchone()[0]
+    conn.close()
+    return counts
+
+def benchmark_directory_tree(work_dir: str, sizes: List[int], iterations: int = 20) -> Dict[int, Dict[str, float]]:
+    """GET /patients/{id} with nested directories: one recursive CTE vs per-directory subtree counts"""
+    build_synthetic_database(work_dir, 10000)
+    rng = random.Random(len(sizes))
+    conn = sqlite3.connect("dip_analysis.db")
+    patient_ids = [row[0] for row in conn.execute("SELECT id FROM patients ORDER BY id LIMIT ?", (len(sizes),))]
+    for patient_id, size in zip(patient_ids, sizes):
+        directory_ids = [conn.execute("SELECT id FROM directories WHERE patient_id = ?", (patient_id,)).fetchone()[0]]
+        for n in range(size - 1):
+            directory_id = str(uuid.UUID(int=rng.getrandbits(128)))
+            conn.execute("INSERT INTO directories (id, name, type, parent_id, patient_id, sort_order) VALUES (?, ?, 'custom', ?, ?, ?)",
+                         (directory_id, f"Folder {n:04d}", rng.choice(directory_ids), patient_id, n))
+            directory_ids.append(directory_id)
+        conn.executemany("""INSERT INTO patient_documents (id, name, file_type, file_size, file_path, directory_id, patient_id, tags)
+                            VALUES (?, 'note.txt', 'text/plain', 1024, 'uploads/note.txt', ?, ?, '[]')""",
+                         [(str(uuid.UUID(int=rng.getrandbits(128))), rng.choice(directory_ids), patient_id)
+                          for _ in range(size * 4)])
+    conn.commit()
+    conn.close()
+
+    print(f"\n🌳 GET /patients/{{id}} with nested directories (4 documents per directory)")
+    print("-" * 60)
+    results = {}
+    for patient_id, size in zip(patient_ids, sizes):
+        tree_call = lambda: asyncio.run(main.get_patient(patient_id, fields=None))
+        legacy_call = lambda: _legacy_subtree_counts(patient_id)
+        tree_call()
+        legacy_call()
+        tree = [_timed(tree_call)[1] for _ in range(iterations)]
+        legacy = [_timed(legacy_call)[1] for _ in range(iterations)]
+        results[size] = {"tree_p50_ms": _percentile(tree, 50), "legacy_p50_ms": _percentile(legacy, 50)}
+        print(f"  {size:4} directories   recursive CTE p50 {results[size]['tree_p50_ms']:7.2f} ms"
+              f"   per-directory counts p50 {results[size]['legacy_p50_ms']:8.2f} ms")
+    return results
+
+def benchmark_analysis_batch(work_dir: str, analysis_results: Dict, sizes: List[int],
+                             iterations: int = 10) -> Dict[int, Dict[str, float]]:
+    """Fetching N analyses: N calls to /analysis/{id} vs one GET /analysis?ids="""
+    build_synthetic_database(work_dir, 1, docs_per_patient=0)
+    conn = sqlite3.connect("dip_analysis.db")
+    results_json = json.dumps(analysis_results)
+    conn.executemany("""INSERT INTO analysis_results (user_id, file_name, file_type, analysis_type, results, confidence_score)
+                        VALUES ('bench', ?, 'text/plain', 'text_analysis', ?, 0.9)""",
+                     [(f"note_{n}.txt", results_json) for n in range(max(sizes))])
+    conn.commit()
+    conn.close()
+
+    print(f"\n📦 Fetching N analyses (fields=id,file_name,results.summary)")
+    print("-" * 60)
+    fields = "id,file_name,results.summary"
+    results = {}
+    for size in sizes:
+        ids = list(range(1, size + 1))
+        single = lambda: [asyncio.run(main.get_analysis_result(analysis_id, fields=fields)) for analysis_id in ids]
+        batch = lambda: asyncio.run(main.get_analysis_results(",".join(map(str, ids)), fields=fields))
+        single_ms = min(_timed(single)[1] for _ in range(iterations))
+        batch_ms = min(_timed(batch)[1] for _ in range(iterations))
+        results[size] = {"single_ms": single_ms, "batch_ms": batch_ms}
+        print(f"  {size:4} analyses   one call each {single_ms:8.2f} ms   batched {batch_ms:7.2f} ms")
+    return results
+
+def benchmark_history(work_dir: str, rows: int, iterations: int = 20) -> Dict[str, Dict[str, float]]:
+    """GET /history filters and deep keyset pages over a large analysis_results table"""
+    build_synthetic_database(work_dir, 1, docs_per_patient=0)
+    rng = random.Random(rows)
+    analysis_types = ["advanced_medical_ner"] * 6 + ["patient_document"] * 3 + ["direct_text_analysis", "chest_xray"]
+    file_types = {"chest_xray": "image/png", "direct_text_analysis": "text/plain"}
+    # A realistically sized results blob; history summaries must never read it
+    results_json = json.dumps({"summary": "Medical text analyzed. " * 10,
+                               "medical_entities": [{"text": f"entity {n}", "label": "CONDITION"} for n in range(20)]})
+    users = [f"user_{n:05d}" for n in range(rows // 200)]
+    conn = sqlite3.connect("dip_analysis.db")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA journal_mode=MEMORY")
+    start = time.perf_counter()
+    for batch_start in range(0, rows, 50000):
+        batch = []
+        for n in range(batch_start, min(rows, batch_start + 50000)):
+            analysis_type = rng.choice(analysis_types)
+            file_type = file_types.get(analysis_type) or rng.choice(["application/pdf", "text/plain"])
+            stamp = f"{rng.randint(2024, 2025)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}"
+            batch.append((rng.choice(users), f"report_{n}.pdf", file_type, analysis_type, results_json,
+                          round(rng.uniform(0.3, 1.0), 2), stamp))
+        conn.executemany("""INSERT INTO analysis_results (user_id, file_name, file_type, analysis_type, results, confidence_score, created_at)
+                            VALUES (?, ?, ?, ?, ?, ?, ?)""", batch)
+        conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+    build_ms = (time.perf_counter() - start) * 1000
+
+    def history(**params):
+        query = dict(user_id=None, analysis_type=None, file_type=None, since=None, until=None,
+                     min_confidence=None, limit=50, cursor=None)
+        query.update(params)
+        return asyncio.run(main.get_analysis_history(**query))
+
+    # Cursor 100 pages into the unfiltered listing
+    deep_cursor = None
+    for _ in range(100):
+        deep_cursor = history(cursor=deep_cursor)["next_cursor"]
+
+    print(f"\n📜 GET /history over {rows:,} analyses (built in {build_ms / 1000:.1f} s)")
+    print("-" * 60)
+    queries = [
+        ("first page, no filters", dict()),
+        ("page 101 via cursor", dict(cursor=deep_cursor)),
+        ("one user", dict(user_id=users[len(users) // 2])),
+        ("chest_xray in March 2025", dict(analysis_type="chest_xray", since="2025-03-01", until="2025-03-31")),
+        ("file_type=application/pdf", dict(file_type="application/pdf")),
+        ("min_confidence=0.99", dict(min_confidence=0.99)),
+        ("user + type + min_confidence", dict(user_id=users[0], analysis_type="patient_document", min_confidence=0.8))
+    ]
+    results = {}
+    for label, params in queries:
+        call = lambda: history(**params)
+        call()
+        samples = [_timed(call)[1] for _ in range(iterations)]
+        results[label] = {"p50_ms": _percentile(samples, 50), "p95_ms": _percentile(samples, 95)}
+        print(f"  {label:30} p50 {results[label]['p50_ms']:8.2f} ms   p95 {results[label]['p95_ms']:8.2f} ms")
+    return results
+
+def _upload(patient_id: str, directory_id: str, text: str, priority: str = "upload") -> Dict:
+    upload = UploadFile(file=io.BytesIO(text.encode()), filename="chart.txt",
+                        headers=Headers({"content-type": "text/plain"}))
+    return asyncio.run(main.upload_patient_document(patient_id, directory_id, upload, priority))
+
+def benchmark_upload_queue(work_dir: str, pages: int) -> Dict[str, float]:
+    """Upload response time for a long chart: queued (202) vs analyzing inline"""
+    build_synthetic_database(work_dir, 1, docs_per_patient=0)
+    conn = sqlite3.connect("dip_analysis.db")
+    patient_id, directory_id = conn.execute("SELECT patient_id, id FROM directories").fetchone()
+    conn.close()
+    # Tag every sentence with its chart and page so nothing is served from the sentence memo
+    def chart(name: str) -> str:
+        return "\n\n".join(SAMPLE_NOTE.replace(". ", f" ({name} page {n}). ") for n in range(pages))
+
+    main.JOB_QUEUE.start(main.process_document_job, 1)
+    try:
+        response, accepted_ms = _timed(lambda: _upload(patient_id, directory_id, chart("queued")))
+        start = time.perf_counter()
+        conn = sqlite3.connect("dip_analysis.db")
+        while main.get_job(conn.cursor(), response["job_id"])["status"] in ("queued", "running"):
+            time.sleep(0.05)
+        conn.close()
+        completed_ms = accepted_ms + (time.perf_counter() - start) * 1000
+    finally:
+        main.JOB_QUEUE.stop()
+
+    # The previous upload path: the same work before the response
+    response = _upload(patient_id, directory_id, chart("inline"))
+    conn = sqlite3.connect("dip_analysis.db")
+    job = conn.execute("UPDATE analysis_jobs SET status = 'running' WHERE id = ? RETURNING id, document_id, patient_id, file_path, file_name, file_type, priority",
+                       (response["job_id"],)).fetchone()
+    job = dict(zip(["id", "document_id", "patient_id", "file_path", "file_name", "file_type", "priority"], job))
+    inline_ms = accepted_ms + _timed(lambda: main.process_document_job(conn.cursor(), job))[1]
+    conn.rollback()
+    conn.close()
+
+    print(f"\n📤 Uploading a {pages}-page chart ({len(chart('size')) / 1024:.0f} KB of text)")
+    print("-" * 60)
+    print(f"  analyzed inline (old)       response after {inline_ms:9.1f} ms")
+    print(f"  queued (202 Accepted)       response after {accepted_ms:9.1f} ms   analysis done after {completed_ms:9.1f} ms")
+    return {"inline_ms": inline_ms, "accepted_ms": accepted_ms, "completed_ms": completed_ms}
+
+def _latency_job(cursor, job: Dict) -> None:
+    """Stand-in handler: a fixed wait instead of analysis, so only the queue is measured"""
+    time.sleep(WORKER_JOB_SECONDS)
+    return None
+
+def _warm_analysis():
+    asyncio.run(main.analyze_medical_text_advanced(SAMPLE_NOTE))
+
+def _queue_worker(handler, warmup, ready, stop):
+    """One worker process with a single worker thread; starts once every process is warmed up"""
+    if warmup:
+        warmup()
+    ready.wait()
+    queue = JobQueue("dip_analysis.db")
+    queue.start(handler, 1)
+    stop.wait()
+    queue.stop()
+
+def _run_worker_processes(processes: int, handler, warmup, total: int) -> float:
+    """Seconds for `processes` worker processes to finish `total` queued jobs"""
+    context = multiprocessing.get_context("fork")
+    ready, stop = context.Barrier(processes + 1), context.Event()
+    workers = [context.Process(target=_queue_worker, args=(handler, warmup, ready, stop)) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    conn = sqlite3.connect("dip_analysis.db", timeout=30)
+    ready.wait()
+    start = time.perf_counter()
+    while True:
+        counts = job_counts(conn.cursor())
+        if counts["completed"] + counts["failed"] >= total:
+            break
+        time.sleep(0.02)
+    elapsed = time.perf_counter() - start
+    conn.close()
+    stop.set()
+    for worker in workers:
+        worker.join()
+    return elapsed
+
+def benchmark_job_workers(work_dir: str, jobs: int, process_counts: List[int]) -> Dict[str, Dict[int, float]]:
+    """Job throughput with 1..N worker processes sharing analysis_jobs through leases"""
+    def enqueue(run: str):
+        # A fresh database per run, one document per patient so every run does the same work
+        build_synthetic_database(work_dir, jobs, docs_per_patient=0)
+        os.makedirs("uploads", exist_ok=True)
+        conn = sqlite3.connect("dip_analysis.db")
+        cursor = conn.cursor()
+        directories = cursor.execute("SELECT patient_id, id FROM directories GROUP BY patient_id").fetchall()
+        for n, (patient_id, directory_id) in enumerate(directories):
+            document_id = str(uuid.uuid4())
+            file_path = f"uploads/{document_id}.txt"
+            with open(file_path, "w") as f:
+                f.write(SAMPLE_NOTE.replace(". ", f" ({run} job {n}). "))
+            cursor.execute("""INSERT INTO patient_documents (id, name, file_type, file_size, file_path, directory_id, patient_id, tags)
+                              VALUES (?, ?, 'text/plain', ?, ?, ?, ?, '[]')""",
+                           (document_id, f"note_{n}.txt", len(SAMPLE_NOTE), file_path, directory_id, patient_id))
+            enqueue_document_job(cursor, document_id, patient_id, directory_id, file_path, f"note_{n}.txt", "text/plain")
+        conn.commit()
+        conn.close()
+
+    print(f"\n🧵 {jobs} analysis jobs drained by worker processes ({os.cpu_count()} CPUs)")
+    print("-" * 60)
+    results = {}
+    for label, handler, warmup in [(f"{WORKER_JOB_SECONDS * 1000:.0f} ms fixed-latency jobs", _latency_job, None),
+                                   ("full document analysis", main.process_document_job, _warm_analysis)]:
+        results[label] = {}
+        for processes in process_counts:
+            enqueue(f"{label} {processes}")
+            elapsed = _run_worker_processes(processes, handler, warmup, jobs)
+            results[label][processes] = jobs / elapsed
+            speedup = results[label][processes] / results[label][process_counts[0]]
+            print(f"  {label:32} {processes} processes {jobs / elapsed:8.1f} jobs/s   x{speedup:4.2f}")
+    return results
+
+def _interactive_latencies(requests: int, tag: str) -> List[float]:
+    """Sequential interactive analyses (the /analyze/* execution path) of one clinician, 20 ms apart"""
+    samples = []
+    for n in range(requests):
+        text = SAMPLE_NOTE.replace(". ", f" ({tag} {n}). ")
+        samples.append(_timed(lambda: asyncio.run(main.analyze_medical_text_advanced(
+            text, priority="interactive", tenant="ed_clinician")))[1])
+        time.sleep(0.02)
+    return samples
+
+def benchmark_priority_isolation(work_dir: str, backfill_documents: int, requests: int) -> Dict[str, Dict[str, float]]:
+    """
+    A bulk backfill of one patient's records running while a clinician uses /analyze/*
+    and uploads one urgent document for another patient. Compared with the previous
+    behaviour: jobs claimed in upload order and no limit on concurrent analyses.
+    """
+    print(f"\n🚦 Bulk backfill of {backfill_documents} documents vs interactive analysis and one urgent upload")
+    print("-" * 60)
+    idle = _interactive_latencies(requests, "idle")
+    results = {"idle": {"p50_ms": _percentile(idle, 50), "p99_ms": _percentile(idle, 99)}}
+    print(f"  {'no background work':26} interactive p50 {results['idle']['p50_ms']:7.1f} ms  p99 {results['idle']['p99_ms']:7.1f} ms")
+
+    for label, scheduled in [("FIFO, unlimited slots", False), ("priority + fair share", True)]:
+        build_synthetic_database(work_dir, 2, docs_per_patient=0)
+        os.makedirs("uploads", exist_ok=True)
+        conn = sqlite3.connect("dip_analysis.db")
+        cursor = conn.cursor()
+        (backfill_patient, backfill_directory), (urgent_patient, urgent_directory) = cursor.execute(
+            "SELECT patient_id, id FROM directories GROUP BY patient_id").fetchall()
+        chart = "\n\n".join([SAMPLE_NOTE] * BACKFILL_PAGES)
+        for n in range(backfill_documents):
+            document_id = str(uuid.uuid4())
+            file_path = f"uploads/{document_id}.txt"
+            with open(file_path, "w") as f:
+                f.write(chart.replace(". ", f" ({label} backfill {n}). "))
+            cursor.execute("""INSERT INTO patient_documents (id, name, file_type, file_size, file_path, directory_id, patient_id, tags)
+                              VALUES (?, ?, 'text/plain', ?, ?, ?, ?, '[]')""",
+                           (document_id, f"history_{n}.txt", len(chart), file_path, backfill_directory, backfill_patient))
+            enqueue_document_job(cursor, document_id, backfill_patient, backfill_directory, file_path,
+                                 f"history_{n}.txt", "text/plain", "bulk")
+        conn.commit()
+
+        if not scheduled:
+            # Previous claim order: oldest job first
+            cursor.execute("UPDATE analysis_jobs SET fair_tag = id")
+            cursor.execute("""CREATE TRIGGER fifo_claim_order AFTER INSERT ON analysis_jobs
+                              BEGIN UPDATE analysis_jobs SET fair_tag = NEW.id WHERE id = NEW.id; END""")
+            conn.commit()
+
+        main.ANALYSIS_SCHEDULER.configure(main.ANALYSIS_SLOTS if scheduled else 64, 1 if scheduled else 0)
+        main.JOB_QUEUE.start(main.process_document_job, BACKFILL_WORKERS)
+        started = time.perf_counter()
+        time.sleep(0.5)
+        urgent_job = _upload(urgent_patient, urgent_directory, SAMPLE_NOTE.replace(". ", f" ({label} urgent). "))["job_id"]
+        uploaded = time.perf_counter()
+        urgent_done = []
+
+        def watch_urgent():
+            watch = sqlite3.connect("dip_analysis.db", timeout=30)
+            while main.get_job(watch.cursor(), urgent_job)["status"] in ("queued", "running"):
+                time.sleep(0.01)
+            urgent_done.append(time.perf_counter())
+            watch.close()
+
+        watcher = threading.Thread(target=watch_urgent)
+        watcher.start()
+        latencies = _interactive_latencies(requests, label)
+        watcher.join()
+        urgent_ms = (urgent_done[0] - uploaded) * 1000
+        backfilled = cursor.execute("SELECT COUNT(*) FROM analysis_jobs WHERE priority = 'bulk' AND status = 'completed'").fetchone()[0]
+        bulk_rate = backfilled / (time.perf_counter() - started)
+        main.JOB_QUEUE.stop(timeout=60)
+        conn.close()
+
+        results[label] = {"p50_ms": _percentile(latencies, 50), "p99_ms": _percentile(latencies, 99),
+                          "urgent_upload_ms": urgent_ms, "bulk_documents_per_s": bulk_rate}
+        print(f"  {label:26} interactive p50 {results[label]['p50_ms']:7.1f} ms  p99 {results[label]['p99_ms']:7.1f} ms"
+              f"   urgent upload analyzed after {urgent_ms / 1000:6.2f} s   backfill {bulk_rate:5.1f} docs/s")
+    main.ANALYSIS_SCHEDULER.configure(main.ANALYSIS_SLOTS)
+    return results
+
+def _body_request(pieces, disconnect_after: int = None) -> Request:
+    """A request whose body arrives piece by piece, optionally dropping the connection"""
+    pieces = iter(pieces)
+    sent = 0
+
+    async def receive():
+        nonlocal sent
+        piece = next(pieces, None)
+        if disconnect_after is not None and sent >= disconnect_after:
+            return {"type": "http.disconnect"}
+        if piece is None:
+            return {"type": "http.request", "body": b"", "more_body": False}
+        sent += len(piece)
+        return {"type": "http.request", "body": piece, "more_body": True}
+
+    return Request({"type": "http", "method": "PATCH", "path": "/upload-sessions", "headers": []}, receive)
+
+def benchmark_resumable_upload(work_dir: str, size_mb: int) -> Dict[str, float]:
+    """A size_mb chart export through /upload-sessions, dropped once mid-chunk and resumed"""
+    build_synthetic_database(work_dir, 1, docs_per_patient=0)
+    conn = sqlite3.connect("dip_analysis.db")
+    patient_id, directory_id = conn.execute("SELECT patient_id, id FROM directories").fetchone()
+    conn.close()
+
+    block = (SAMPLE_NOTE + "\n").encode() * (64 * 1024 // (len(SAMPLE_NOTE) + 1))
+    size = size_mb * 1024 * 1024 // len(block) * len(block)
+    chunk_blocks = main.CHUNK_SIZE // len(block)
+    file_digest = hashlib.sha256()
+    for _ in range(size // len(block)):
+        file_digest.update(block)
+
+    def chunk(offset: int):
+        return [block] * min(chunk_blocks, (size - offset) // len(block))
+
+    def upload():
+        session = asyncio.run(main.create_upload_session({
+            "patient_id": patient_id, "directory_id": directory_id, "file_name": "chart_export.txt",
+            "file_type": "text/plain", "size": size,
+            "checksum": "sha256 " + base64.b64encode(file_digest.digest()).decode()
+        }, Response()))
+        offset, dropped = 0, False
+        while offset < size:
+            pieces = chunk(offset)
+            digest = hashlib.sha256()
+            for piece in pieces:
+                digest.update(piece)
+            checksum = "sha256 " + base64.b64encode(digest.digest()).decode()
+            if not dropped and offset >= size // 2:
+                # The connection drops halfway through a chunk; ask for the offset and go on
+                dropped = True
+                try:
+                    asyncio.run(main.upload_chunk(session["upload_id"], _body_request(pieces, len(block) * 3),
+                                                  Response(), offset, checksum))
+                except main.HTTPException:
+                    pass
+                offset = asyncio.run(main.get_upload_session(session["upload_id"], Response()))["offset"]
+                continue
+            offset = asyncio.run(main.upload_chunk(session["upload_id"], _body_request(pieces),
+                                                   Response(), offset, checksum))["offset"]
+        return asyncio.run(main.finalize_upload(session["upload_id"]))
+
+    start = time.perf_counter()
+    peak_mb = _peak_memory_mb(upload)
+    elapsed = time.perf_counter() - start
+
+    # The single-request upload holds the whole file, up to its 10 MB cap
+    legacy = SAMPLE_NOTE.encode() * (10 * 1024 * 1024 // len(SAMPLE_NOTE))
+    legacy_peak_mb = _peak_memory_mb(lambda: _upload(patient_id, directory_id, legacy.decode()))
+
+    print(f"\n📦 Resumable upload of a {size / 1024 / 1024:.0f} MB chart export ({main.CHUNK_SIZE // (1024 * 1024)} MB chunks, one dropped connection)")
+    print("-" * 60)
+    print(f"  single request, 10 MB cap       peak Python memory {legacy_peak_mb:7.1f} MB")
+    print(f"  /upload-sessions, {size / 1024 / 1024:.0f} MB         peak Python memory {peak_mb:7.1f} MB   "
+          f"{size / 1024 / 1024 / elapsed:6.1f} MB/s incl. checksums")
+    return {"peak_mb": peak_mb, "legacy_peak_mb": legacy_peak_mb, "mb_per_s": size / 1024 / 1024 / elapsed}
+
+def benchmark_bulk_ingest(work_dir: str, documents: int, duplicate_ratio: float) -> Dict[str, float]:
+    """Filing a patient's records: one upload request per document vs one archive ingest"""
+    build_synthetic_database(work_dir, 2, docs_per_patient=0)
+    conn = sqlite3.connect("dip_analysis.db")
+    directories = conn.execute("SELECT patient_id, id FROM directories GROUP BY patient_id").fetchall()
+    conn.close()
+    notes = [SAMPLE_NOTE.replace(". ", f" (record {n}). ") for n in range(documents)]
+
+    (patient_id, directory_id), (bulk_patient_id, bulk_directory_id) = directories
+    _, uploads_ms = _timed(lambda: [_upload(patient_id, directory_id, note, "bulk") for note in notes])
+
+    # The second patient already has some of the records; the archive repeats them
+    known = int(documents * duplicate_ratio)
+    for note in notes[:known]:
+        _upload(bulk_patient_id, bulk_directory_id, note, "bulk")
+    archive_path = os.path.join(work_dir, "records.zip")
+    with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED) as archive:
+        for n, note in enumerate(notes):
+            archive.writestr(f"records/record_{n}.txt", note)
+
+    def ingest():
+        with zipfile.ZipFile(archive_path) as archive:
+            entries = main.zip_entries(archive)
+            ingest = main.start_ingest(uuid.uuid4().hex, bulk_patient_id, bulk_directory_id, archive_path,
+                                       "bulk", len(entries))
+            return main.run_ingest(ingest["id"], entries)
+    result, ingest_ms = _timed(ingest)
+
+    print(f"\n🗂️  Filing {documents} records into one patient directory ({known} already on file)")
+    print("-" * 60)
+    print(f"  one upload per document     {uploads_ms:9.1f} ms   ({documents / uploads_ms * 1000:6.1f} docs/s)")
+    print(f"  bulk ingest of a ZIP        {ingest_ms:9.1f} ms   ({documents / ingest_ms * 1000:6.1f} docs/s)   "
+          f"{result['added']} added, {result['duplicates']} duplicates")
+    return {"uploads_ms": uploads_ms, "ingest_ms": ingest_ms, "added": result["added"],
+            "duplicates": result["duplicates"]}
+
+def benchmark_fhir_export(work_dir: str, patients: int, analysis_results: Dict, legacy_sample: int) -> Dict[str, float]:
+    """Handing every record to a downstream system: FHIR $export vs per-patient requests"""
+    build_synthetic_database(work_dir, patients)
+    conn = sqlite3.connect("dip_analysis.db")
+    conn.execute("PRAGMA synchronous=OFF")
+    results_json = json.dumps(analysis_results)
+    documents = conn.execute("SELECT id, patient_id FROM patient_documents").fetchall()
+    for document_id, patient_id in documents:
+        analysis_id = conn.execute("""INSERT INTO analysis_results (user_id, file_name, file_type, analysis_type, results, confidence_score)
+                                      VALUES (?, 'note.txt', 'text/plain', 'patient_document', ?, 0.9)""",
+                                   (f"patient_{patient_id}", results_json)).lastrowid
+        conn.execute("UPDATE patient_documents SET analysis_id = ? WHERE id = ?", (analysis_id, document_id))
+    conn.commit()
+    sample = [row[0] for row in conn.execute("SELECT id FROM patients LIMIT ?", (legacy_sample,))]
+    conn.close()
+
+    def legacy_patient(patient_id: str):
+        patient = asyncio.run(main.get_patient(patient_id, fields=None))["patient"]
+        return [asyncio.run(main.get_directory_documents(patient_id, directory["id"], fields=None,
+                                                         include="analysis_results"))
+                for directory in patient["directories"]]
+    _, legacy_ms = _timed(lambda: [legacy_patient(patient_id) for patient_id in sample])
+    legacy_ms *= patients / len(sample)
+
+    def write() -> float:
+        writer = sqlite3.connect("dip_analysis.db", timeout=5)
+        _, write_ms = _timed(lambda: (writer.execute("UPDATE patients SET updated_at = updated_at WHERE rowid = 1"),
+                                      writer.commit()))
+        writer.close()
+        return write_ms
+
+    def export(compress: bool):
+        chunks = main.export_resources(sqlite3.connect("dip_analysis.db", check_same_thread=False),
+                                       list(main.FHIR_RESOURCE_TYPES))
+        stats = {"bytes": 0, "resources": 0, "write_ms": 0.0}
+
+        def counted():
+            for chunk in chunks:
+                stats["resources"] += chunk.count(b"\n")
+                yield chunk
+        for n, chunk in enumerate(main.gzip_stream(counted()) if compress else counted()):
+            stats["bytes"] += len(chunk)
+            if n == 10:
+                # A writer commits while the export is between batches
+                stats["write_ms"] = write()
+        return stats
+
+    idle_write_ms = min(write() for _ in range(3))
+    stats, export_ms = _timed(lambda: export(False))
+    gzip_stats, gzip_ms = _timed(lambda: export(True))
+    peak_mb = _peak_memory_mb(lambda: export(True))
+
+    print(f"\n🏥 FHIR export of {patients:,} patients, {len(documents):,} analyzed documents")
+    print("-" * 60)
+    print(f"  per-patient requests (est.)   {legacy_ms / 1000:8.1f} s")
+    print(f"  /fhir/$export NDJSON          {export_ms / 1000:8.1f} s   {stats['resources']:,} resources "
+          f"({stats['resources'] / export_ms * 1000:,.0f}/s)   {stats['bytes'] / 1024 / 1024:6.1f} MB")
+    print(f"  /fhir/$export gzip            {gzip_ms / 1000:8.1f} s   {gzip_stats['bytes'] / 1024 / 1024:6.1f} MB   "
+          f"peak Python memory {peak_mb:5.1f} MB")
+    print(f"  writer commit during export   {stats['write_ms']:8.1f} ms   (idle {idle_write_ms:.1f} ms)")
+    return {"legacy_ms": legacy_ms, "export_ms": export_ms, "gzip_ms": gzip_ms, "resources": stats["resources"],
+            "bytes": stats["bytes"], "gzip_bytes": gzip_stats["bytes"], "peak_mb": peak_mb,
+            "write_ms": stats["write_ms"]}
+
+def benchmark_hl7_feed(work_dir: str, messages: int, connections: int) -> Dict[str, Dict[str, float]]:
+    """An interface engine's feed into the MLLP listener: commit per message vs group commit, ACK window 1 vs 32"""
+    build_synthetic_database(work_dir, 0)
+
+    async def run(batch_size: int, window: int, seed: int) -> Dict[str, float]:
+        listener = HL7Listener(main.store_hl7_messages, batch_size=batch_size)
+        port = await listener.start("127.0.0.1", 0)
+        # Fresh control ids for every run, so none is acknowledged as a resend
+        result = await send_messages("127.0.0.1", port, synthetic_messages(messages, HL7_PATIENTS, seed),
+                                     connections, window)
+        result["batches"] = listener.stats()["batches"]
+        await listener.stop()
+        return result
+
+    print(f"\n📨 HL7 feed of {messages:,} messages over {connections} MLLP connections")
+    print("-" * 60)
+    results = {}
+    for seed, (label, batch_size, window) in enumerate([
+        ("commit per message, window 1", 1, 1),
+        ("commit per message, window 32", 1, 32),
+        ("group commit, window 1", HL7_BATCH_SIZE, 1),
+        ("group commit, window 32", HL7_BATCH_SIZE, 32)
+    ], 1):
+        result = asyncio.run(run(batch_size, window, seed))
+        results[label] = result
+        print(f"  {label:30} {result['messages_per_second']:8.0f} msg/s   ACK p50 {result['ack_p50_ms']:6.1f} ms   "
+              f"p99 {result['ack_p99_ms']:6.1f} ms   {result['batches']:5} transactions")
+    return results
+
+def _note_lines(pages: int) -> List[str]:
+    lines = [line for line in SAMPLE_NOTE.strip().splitlines() if line]
+    return [f"{lines[n % len(lines)]} (page {n // 50 + 1})" for n in range(pages * 50)]
+
+def _pdf_document(lines: List[str]) -> bytes:
+    """A minimal text PDF, 50 lines per page (no PDF writer needed)"""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for start in range(0, len(lines), 50):
+        text = b"".join(b"(" + line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)").encode("latin-1")
+                        + b") Tj T* " for line in lines[start:start + 50])
+        stream = b"BT /F1 9 Tf 11 TL 30 810 Td " + text + b"ET"
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents %d 0 R "
+                       b"/Resources << /Font << /F1 3 0 R >> >> >>" % len(objects))
+        page_ids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % n for n in page_ids), len(page_ids))
+    pdf, offsets = bytearray(b"%PDF-1.4\n"), []
+    for n, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (n, body)
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(pdf)
+
+def _docx_document(lines: List[str]) -> bytes:
+    paragraphs = "".join(f'<w:p><w:pPr><w:pStyle w:val="Normal"/></w:pPr><w:r><w:rPr><w:sz w:val="20"/></w:rPr>'
+                         f'<w:t xml:space="preserve">{line.replace("&", "&amp;").replace("<", "&lt;")}</w:t></w:r></w:p>'
+                         for line in lines)
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as docx:
+        docx.writestr("[Content_Types].xml", '<?xml version="1.0"?><Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types"/>')
+        docx.writestr("word/document.xml", '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                      '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+                      f'<w:body>{paragraphs}<w:sectPr/></w:body></w:document>')
+    return archive.getvalue()
+
+def _rtf_document(lines: List[str]) -> bytes:
+    body = "".join("\\pard\\f0\\fs20 " + line.replace("\\", "\\\\").replace("{", "\\{").replace("}", "\\}") + "\\par\n"
+                   for line in lines)
+    return ("{\\rtf1\\ansi\\ansicpg1252\\deff0{\\fonttbl{\\f0\\fswiss Arial;}}{\\colortbl;\\red0\\green0\\blue0;}\n"
+            + body + "}").encode("latin-1")
+
+def benchmark_document_text(work_dir: str, pages: int) -> Dict[str, Dict[str, float]]:
+    """Text extraction of the same clinical note as PDF, DOCX, RTF and plain text"""
+    lines = _note_lines(pages)
+    documents = {
+        "pdf": ("application/pdf", _pdf_document(lines)),
+        "docx": (DOCX_TYPE, _docx_document(lines)),
+        "rtf": ("application/rtf", _rtf_document(lines)),
+        "txt": ("text/plain", "\n".join(lines).encode())
+    }
+    expected = len("\n".join(lines))
+
+    print(f"\n📄 Text extraction of a {pages}-page note ({expected / 1024:.0f} KB of text)")
+    print("-" * 60)
+    results = {}
+    for name, (file_type, content) in documents.items():
+        path = os.path.join(work_dir, f"note.{name}")
+        with open(path, "wb") as f:
+            f.write(content)
+        text, extract_ms = _timed(lambda: main.extract_document_text(path, file_type))
+        peak_mb = _peak_memory_mb(lambda: main.extract_document_text(path, file_type))
+        # The analyze endpoint only keeps the first 50k characters
+        _, first_ms = _timed(lambda: main.read_document_text(io.BytesIO(content), file_type, 50000))
+        results[name] = {"file_kb": len(content) / 1024, "extract_ms": extract_ms, "peak_mb": peak_mb,
+                         "first_50k_ms": first_ms, "chars": len(text)}
+        print(f"  {name:5} {len(content) / 1024:8.0f} KB file   {extract_ms:8.1f} ms   "
+              f"({expected / 1024 / 1024 / extract_ms * 1000:6.2f} MB text/s)   peak {peak_mb:6.1f} MB   "
+              f"first 50k chars {first_ms:6.1f} ms   {len(text) / expected:5.0%} of the text")
+    return results
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    print("🗄️  PATIENT DATABASE BENCHMARK")
+    print("=" * 60)
+    # Analyze the sample note before leaving the backend directory (needs fast_medical.db)
+    _, sample_results = run_analysis(SAMPLE_NOTE)
+    with tempfile.TemporaryDirectory() as work_dir:
+        for size in sizes:
+            _, build_ms = _timed(lambda: build_synthetic_database(work_dir, size))
+            print(f"\n🏗️  Built {size:,} patients in {build_ms / 1000:.1f} s")
+            benchmark_patient_listing(work_dir, size)
+        benchmark_directory_listing(work_dir, DIRECTORY_DOCUMENTS, sample_results)
+        benchmark_directory_tree(work_dir, TREE_SIZES)
+        benchmark_analysis_batch(work_dir, sample_results, BATCH_SIZES)
+        benchmark_history(work_dir, HISTORY_ROWS)
+        benchmark_upload_queue(work_dir, UPLOAD_PAGES)
+        benchmark_job_workers(work_dir, WORKER_JOBS, WORKER_PROCESSES)
+        benchmark_priority_isolation(work_dir, BACKFILL_DOCUMENTS, INTERACTIVE_REQUESTS)
+        benchmark_resumable_upload(work_dir, RESUMABLE_UPLOAD_MB)
+        benchmark_bulk_ingest(work_dir, INGEST_DOCUMENTS, INGEST_DUPLICATE_RATIO)
+        benchmark_fhir_export(work_dir, EXPORT_PATIENTS, sample_results, EXPORT_LEGACY_SAMPLE)
+        benchmark_hl7_feed(work_dir, HL7_MESSAGES, HL7_CONNECTIONS)
+        benchmark_document_text(work_dir, DOCUMENT_TEXT_PAGES)
+        benchmark_document_search(work_dir, SEARCH_DOCUMENTS)
+        benchmark_cohort_queries(work_dir, COHORT_DOCUMENTS)
+        if main.ENTITY_ANALYTICS is not None:
+            benchmark_entity_analytics(work_dir, ANALYTICS_ANALYSES, sample_results)
+        benchmark_lab_queries(work_dir, LAB_PATIENTS)
+        benchmark_patient_timeline(work_dir, TIMELINE_DOCUMENTS, sample_results)
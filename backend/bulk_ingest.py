@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Bulk Ingest - a ZIP archive or a local folder of documents into one patient directory
+Entries are read one at a time, straight out of the archive (nothing is extracted
+up front or held in memory), and copied into the patient document store while
+their SHA-256 is computed. An entry whose content the patient already has - from
+an earlier upload, an earlier ingest or another entry of the same archive - is
+recorded as a duplicate of that document and its copy removed. The others become
+patient documents with their analysis jobs, INGEST_BATCH_SIZE entries per
+transaction, so the job workers start on the first batch while later entries are
+still being copied.
+
+Each ingest has an ingest_batches row with running counters and one
+ingest_entries row per entry (added, duplicate or skipped, and why); the progress
+stream reads those together with the entries' analysis jobs.
+
+Run from the backend directory:
+    python bulk_ingest.py <patient_id> <directory_id> <folder or .zip> [--priority upload|bulk] [--wait]
+"""
+import hashlib
+import os
+import zipfile
+import zlib
+from dataclasses import dataclass
+from typing import IO, Any, Callable, Dict, List, Optional, Tuple
+
+from upload_sessions import COPY_BUFFER_BYTES, MAX_UPLOAD_BYTES
+
+INGEST_DIR = "ingests"              # Uploaded archives waiting to be ingested
+INGEST_BATCH_SIZE = 50              # Entries per transaction
+MAX_INGEST_ENTRIES = 10000          # Files per archive or folder
+MAX_ENTRY_BYTES = MAX_UPLOAD_BYTES  # Same cap as a resumable upload
+MAX_COMPRESSION_RATIO = 200         # Larger ratios are treated as zip bombs and skipped
+
+# Patient document types by file extension (the archive carries no content types)
+DOCUMENT_EXTENSIONS = {
+    ".pdf": "application/pdf",
+    ".txt": "text/plain",
+    ".doc": "application/msword",
+    ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    ".rtf": "application/rtf"
+}
+
+# Raised while reading a corrupt, encrypted or unsupported archive entry; the entry is skipped
+UNREADABLE_ENTRY_ERRORS = (zipfile.BadZipFile, zlib.error, EOFError, NotImplementedError, RuntimeError, ValueError)
+
+INGEST_STATUSES = ("running", "completed", "failed")
+ENTRY_STATUSES = ("added", "duplicate", "skipped")
+INGEST_COLUMNS = ["id", "patient_id", "directory_id", "source", "priority", "status", "total", "processed",
+                  "added", "duplicates", "skipped", "error", "created_at", "finished_at"]
+ENTRY_COLUMNS = ["seq", "entry_name", "status", "document_id", "job_id", "detail"]
+
+@dataclass(frozen=True)
+class IngestEntry:
+    """One file of an archive or folder; open() returns a binary stream of its content"""
+    name: str
+    size: int
+    open: Callable[[], IO[bytes]]
+    compressed_size: Optional[int] = None
+
+def create_ingest_tables(cursor) -> bool:
+    """Create the ingest tables; returns True if they were created by this call"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ingest_batches'")
+    exists = cursor.fetchone() is not None
+
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS ingest_batches (
+            id TEXT PRIMARY KEY,
+            patient_id TEXT NOT NULL,
+            directory_id TEXT NOT NULL,
+            source TEXT NOT NULL,
+            priority TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running' CHECK(status IN ({", ".join(f"'{s}'" for s in INGEST_STATUSES)})),
+            total INTEGER NOT NULL,
+            processed INTEGER NOT NULL DEFAULT 0,
+            added INTEGER NOT NULL DEFAULT 0,
+            duplicates INTEGER NOT NULL DEFAULT 0,
+            skipped INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS ingest_entries (
+            ingest_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            entry_name TEXT NOT NULL,
+            status TEXT NOT NULL CHECK(status IN ({", ".join(f"'{s}'" for s in ENTRY_STATUSES)})),
+            document_id TEXT,
+            job_id INTEGER,
+            detail TEXT,
+            PRIMARY KEY (ingest_id, seq)
+        ) WITHOUT ROWID
+    ''')
+    # Content dedupe within a patient
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_patient_documents_patient_hash
+        ON patient_documents(patient_id, content_hash)
+    ''')
+    return not exists
+
+def backfill_content_hashes(cursor) -> int:
+    """Hash the stored files of documents from before content_hash existed"""
+    cursor.execute('SELECT id, file_path FROM patient_documents WHERE content_hash IS NULL')
+    hashed = 0
+    for document_id, file_path in cursor.fetchall():
+        if not os.path.exists(file_path):
+            continue
+        with open(file_path, "rb") as f:
+            cursor.execute('UPDATE patient_documents SET content_hash = ? WHERE id = ?', (file_sha256(f), document_id))
+        hashed += 1
+    return hashed
+
+def file_sha256(stream: IO[bytes]) -> str:
+    digest = hashlib.sha256()
+    while piece := stream.read(COPY_BUFFER_BYTES):
+        digest.update(piece)
+    return digest.hexdigest()
+
+def document_type(name: str) -> Optional[str]:
+    return DOCUMENT_EXTENSIONS.get(os.path.splitext(name)[1].lower())
+
+def _ignored(name: str) -> bool:
+    """Directories and the metadata files archivers and file browsers leave behind"""
+    parts = name.replace("\\", "/").split("/")
+    return name.endswith("/") or any(part.startswith(".") or part == "__MACOSX" for part in parts)
+
+def zip_entries(archive: zipfile.ZipFile) -> List[IngestEntry]:
+    """The archive's files in archive order (raises ValueError for too many entries)"""
+    infos = [info for info in archive.infolist() if not _ignored(info.filename)]
+    if len(infos) > MAX_INGEST_ENTRIES:
+        raise ValueError(f"Archive has {len(infos)} files (max {MAX_INGEST_ENTRIES})")
+    return [IngestEntry(info.filename, info.file_size, (lambda info=info: archive.open(info)), info.compress_size)
+            for info in infos]
+
+def folder_entries(folder: str) -> List[IngestEntry]:
+    """The folder's files, recursively and sorted by path (raises ValueError for too many files)"""
+    entries = []
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = sorted(d for d in dirs if not _ignored(d))
+        for file_name in sorted(files):
+            path = os.path.join(root, file_name)
+            name = os.path.relpath(path, folder)
+            if _ignored(name) or not os.path.isfile(path):
+                continue
+            entries.append(IngestEntry(name, os.path.getsize(path), (lambda path=path: open(path, "rb"))))
+            if len(entries) > MAX_INGEST_ENTRIES:
+                raise ValueError(f"Folder has more than {MAX_INGEST_ENTRIES} files")
+    return entries
+
+def skip_reason(entry: IngestEntry) -> Optional[str]:
+    """Why an entry is not ingested, judged from its name and sizes alone"""
+    if document_type(entry.name) is None:
+        return "Unsupported file type"
+    if entry.size == 0:
+        return "Empty file"
+    if entry.size > MAX_ENTRY_BYTES:
+        return f"File too large (max {MAX_ENTRY_BYTES // (1024 * 1024)}MB)"
+    if entry.compressed_size and entry.size / entry.compressed_size > MAX_COMPRESSION_RATIO:
+        return "Suspicious compression ratio"
+    return None
+
+def copy_entry(entry: IngestEntry, file_path: str) -> Tuple[int, str]:
+    """Stream an entry into file_path; returns (bytes written, SHA-256 hex)
+
+    Stops with ValueError if the content runs past the size the archive declared.
+    """
+    digest = hashlib.sha256()
+    written = 0
+    with entry.open() as source, open(file_path, "wb") as target:
+        while piece := source.read(COPY_BUFFER_BYTES):
+            written += len(piece)
+            if written > entry.size:
+                raise ValueError("Content is larger than the archive declares")
+            digest.update(piece)
+            target.write(piece)
+    return written, digest.hexdigest()
+
+def find_duplicate(cursor, patient_id: str, content_hash: str) -> Optional[str]:
+    """A document of the patient with this content, including ones inserted in the open transaction"""
+    cursor.execute('SELECT id FROM patient_documents WHERE patient_id = ? AND content_hash = ? LIMIT 1',
+                   (patient_id, content_hash))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def create_ingest(cursor, ingest_id: str, patient_id: str, directory_id: str, source: str,
+                  priority: str, total: int) -> Dict[str, Any]:
+    cursor.execute('''
+        INSERT INTO ingest_batches (id, patient_id, directory_id, source, priority, total)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (ingest_id, patient_id, directory_id, source, priority, total))
+    return get_ingest(cursor, ingest_id)
+
+def get_ingest(cursor, ingest_id: str) -> Optional[Dict[str, Any]]:
+    cursor.execute(f'SELECT {", ".join(INGEST_COLUMNS)} FROM ingest_batches WHERE id = ?', (ingest_id,))
+    row = cursor.fetchone()
+    return dict(zip(INGEST_COLUMNS, row)) if row else None
+
+def record_entry(cursor, ingest_id: str, seq: int, entry_name: str, status: str,
+                 document_id: Optional[str] = None, job_id: Optional[int] = None, detail: Optional[str] = None):
+    """Add an entry's outcome and count it on the ingest"""
+    cursor.execute('''
+        INSERT INTO ingest_entries (ingest_id, seq, entry_name, status, document_id, job_id, detail)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (ingest_id, seq, entry_name, status, document_id, job_id, detail))
+    counter = {"added": "added", "duplicate": "duplicates", "skipped": "skipped"}[status]
+    cursor.execute(f'UPDATE ingest_batches SET processed = processed + 1, {counter} = {counter} + 1 WHERE id = ?',
+                   (ingest_id,))
+
+def finish_ingest(cursor, ingest_id: str, status: str, error: Optional[str] = None):
+    cursor.execute('''
+        UPDATE ingest_batches SET status = ?, error = ?, finished_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+    ''', (status, error, ingest_id))
+
+def ingest_entries(cursor, ingest_id: str, after_seq: int = 0, limit: int = 1000) -> List[Dict[str, Any]]:
+    cursor.execute(f'''
+        SELECT {", ".join(ENTRY_COLUMNS)} FROM ingest_entries
+        WHERE ingest_id = ? AND seq > ?
+        ORDER BY seq
+        LIMIT ?
+    ''', (ingest_id, after_seq, limit))
+    return [dict(zip(ENTRY_COLUMNS, row)) for row in cursor.fetchall()]
+
+def ingest_progress(cursor, ingest_id: str) -> Optional[Dict[str, Any]]:
+    """The ingest's counters plus the analysis jobs of its added documents by status"""
+    ingest = get_ingest(cursor, ingest_id)
+    if ingest is None:
+        return None
+    cursor.execute('''
+        SELECT j.status, COUNT(*) FROM ingest_entries e
+        JOIN analysis_jobs j ON j.id = e.job_id
+        WHERE e.ingest_id = ? AND e.status = 'added'
+        GROUP BY j.status
+    ''', (ingest_id,))
+    analysis = {"queued": 0, "running": 0, "completed": 0, "failed": 0}
+    analysis.update(cursor.fetchall())
+    ingest["analysis"] = analysis
+    ingest["done"] = ingest["status"] != "running" and analysis["queued"] + analysis["running"] == 0
+    return ingest
+
+def stage_archive(ingest_id: str, stream: IO[bytes], limit: int) -> str:
+    """Copy an uploaded archive to INGEST_DIR so it outlives the request; returns its path
+
+    Raises ValueError as soon as more than `limit` bytes have been read; nothing is
+    left behind in INGEST_DIR then.
+    """
+    os.makedirs(INGEST_DIR, exist_ok=True)
+    path = os.path.join(INGEST_DIR, f"{ingest_id}.zip")
+    written = 0
+    try:
+        with open(path, "wb") as f:
+            while piece := stream.read(COPY_BUFFER_BYTES):
+                written += len(piece)
+                if written > limit:
+                    raise ValueError(f"Archive too large (max {limit // (1024 * 1024)}MB)")
+                f.write(piece)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+if __name__ == "__main__":
+    import logging
+    import sqlite3
+    import sys
+    import time
+    import uuid
+
+    from main import init_database, resolve_priority, run_ingest, start_ingest
+
+    logging.basicConfig(level=logging.INFO)
+    args = sys.argv[1:]
+    if len(args) < 3:
+        print(__doc__)
+        sys.exit(1)
+    patient_id, directory_id, source = args[:3]
+    priority = resolve_priority(args[args.index("--priority") + 1] if "--priority" in args else None, "bulk")
+
+    init_database()
+    archive = zipfile.ZipFile(source) if zipfile.is_zipfile(source) else None
+    entries = zip_entries(archive) if archive else folder_entries(source)
+    ingest = start_ingest(uuid.uuid4().hex, patient_id, directory_id, os.path.abspath(source), priority, len(entries))
+    if ingest is None:
+        print(f"Directory {directory_id} of patient {patient_id} not found")
+        sys.exit(1)
+    print(f"📥 Ingest {ingest['id']}: {len(entries)} files from {source} into directory {directory_id}")
+    try:
+        result = run_ingest(ingest["id"], entries)
+    finally:
+        if archive:
+            archive.close()
+    print(f"   {result['added']} added, {result['duplicates']} duplicates, {result['skipped']} skipped ({result['status']})")
+    conn = sqlite3.connect('dip_analysis.db')
+    for entry in ingest_entries(conn.cursor(), ingest["id"]):
+        if entry["status"] != "added":
+            print(f"   {entry['status']:9} {entry['entry_name']}: {entry['detail']}")
+
+    # Analysis runs in the API's workers or analysis_worker.py processes
+    while "--wait" in args:
+        progress = ingest_progress(conn.cursor(), ingest["id"])
+        analysis = progress["analysis"]
+        print(f"   analyzed {analysis['completed'] + analysis['failed']}/{progress['added']} "
+              f"({analysis['failed']} failed, {analysis['running']} running)")
+        if progress["done"]:
+            break
+        time.sleep(2)
+    conn.close()
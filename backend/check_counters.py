@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Document Counter Consistency Check
+Compares the trigger-maintained patients.document_count / last_activity and
+directories.document_count columns against patient_documents.
+Run from the backend directory: python check_counters.py [--fix]
+"""
+import sqlite3
+import sys
+
+from main import backfill_document_counters
+
+def find_patient_drift(cursor):
+    cursor.execute('''
+        SELECT p.id, p.name, p.document_count, p.last_activity, actual.count, actual.last_activity
+        FROM patients p
+        LEFT JOIN (
+            SELECT patient_id, COUNT(*) as count, MAX(uploaded_at) as last_activity
+            FROM patient_documents
+            GROUP BY patient_id
+        ) actual ON actual.patient_id = p.id
+        WHERE p.document_count != COALESCE(actual.count, 0)
+           OR p.last_activity IS NOT actual.last_activity
+    ''')
+    return cursor.fetchall()
+
+def find_directory_drift(cursor):
+    cursor.execute('''
+        SELECT d.id, d.name, d.document_count, COALESCE(actual.count, 0)
+        FROM directories d
+        LEFT JOIN (
+            SELECT directory_id, COUNT(*) as count
+            FROM patient_documents
+            GROUP BY directory_id
+        ) actual ON actual.directory_id = d.id
+        WHERE d.document_count != COALESCE(actual.count, 0)
+    ''')
+    return cursor.fetchall()
+
+def check_counters(db_path: str = 'dip_analysis.db', fix: bool = False) -> bool:
+    """Report counter drift; with fix=True recompute every counter. Returns True if consistent"""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    print("🔍 Checking document counters...")
+    patient_drift = find_patient_drift(cursor)
+    directory_drift = find_directory_drift(cursor)
+
+    for patient_id, name, count, last_activity, actual_count, actual_last in patient_drift:
+        print(f"  ❌ Patient {name} ({patient_id}): document_count {count} vs {actual_count or 0}, "
+              f"last_activity {last_activity} vs {actual_last}")
+    for directory_id, name, count, actual_count in directory_drift:
+        print(f"  ❌ Directory {name} ({directory_id}): document_count {count} vs {actual_count}")
+
+    consistent = not patient_drift and not directory_drift
+    if consistent:
+        print("✅ All counters match patient_documents")
+    elif fix:
+        backfill_document_counters(cursor)
+        conn.commit()
+        print(f"🔧 Recomputed counters ({len(patient_drift)} patients, {len(directory_drift)} directories were off)")
+    else:
+        print(f"⚠️  {len(patient_drift)} patients and {len(directory_drift)} directories out of step. Re-run with --fix")
+
+    conn.close()
+    return consistent
+
+if __name__ == "__main__":
+    ok = check_counters(fix="--fix" in sys.argv[1:])
+    sys.exit(0 if ok or "--fix" in sys.argv[1:] else 1)
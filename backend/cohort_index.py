@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+"""
+Cohort Index - entity posting lists with in-memory bitset evaluation
+Every analyzed patient document adds one posting per distinct (entity, label) to
+entity_postings. Cohort queries such as "metformin AND hba1c AND NOT insulin" load
+the posting list of each term once as a Python int bitset (bit n = patient key n
+or analysis id n) and combine them with &, | and ~. Cached bitsets are brought up
+to date from documents indexed since the last query.
+
+entity_postings is clustered by (term_id, analysis_id), so loading a term is one
+contiguous range read; NumPy, when installed, turns it into a bitset in a single
+vectorized step.
+"""
+import json
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from analysis_pipeline import ENTITY_CATEGORIES
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+COHORT_LEVELS = ("patient", "document")
+MAX_QUERY_TERMS = 32
+
+WHITESPACE = re.compile(r'\s+')
+QUERY_TOKEN = re.compile(r'\s*(?:(\()|(\))|"([^"]*)"|([A-Za-z_]+):"([^"]*)"|([^\s()"]+))')
+
+# ("term", entity_norm, label or None) | ("and", [nodes]) | ("or", [nodes]) | ("not", node)
+QueryNode = Tuple[Any, ...]
+
+def normalize_entity(text: str) -> str:
+    return WHITESPACE.sub(' ', text.strip().lower())
+
+def create_cohort_tables(cursor) -> bool:
+    """Create the posting tables; returns True if they were created by this call"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'entity_postings'")
+    exists = cursor.fetchone() is not None
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS entity_terms (
+            id INTEGER PRIMARY KEY,
+            entity_norm TEXT NOT NULL,
+            label TEXT NOT NULL,
+            UNIQUE(entity_norm, label)
+        )
+    ''')
+    # Small dense integer per patient so patient bitsets stay compact
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS patient_keys (
+            id INTEGER PRIMARY KEY,
+            patient_id TEXT NOT NULL UNIQUE
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS indexed_documents (
+            id INTEGER PRIMARY KEY,
+            analysis_id INTEGER NOT NULL UNIQUE,
+            patient_key INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS entity_postings (
+            term_id INTEGER NOT NULL,
+            analysis_id INTEGER NOT NULL,
+            patient_key INTEGER NOT NULL,
+            PRIMARY KEY (term_id, analysis_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_entity_postings_analysis ON entity_postings(analysis_id)')
+
+    # Bumped whenever postings are removed, so cached bitsets are rebuilt
+    # (additions never need this: bitsets only ever gain bits from them)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS entity_index_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            generation INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO entity_index_state (id, generation) VALUES (1, 0)')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_patient_documents_delete_postings
+        AFTER DELETE ON patient_documents
+        WHEN OLD.analysis_id IS NOT NULL
+        BEGIN
+            DELETE FROM entity_postings WHERE analysis_id = OLD.analysis_id;
+            DELETE FROM indexed_documents WHERE analysis_id = OLD.analysis_id;
+            UPDATE entity_index_state SET generation = generation + 1 WHERE id = 1;
+        END
+    ''')
+    return not exists
+
+def patient_key(cursor, patient_id: str) -> int:
+    cursor.execute('INSERT OR IGNORE INTO patient_keys (patient_id) VALUES (?)', (patient_id,))
+    cursor.execute('SELECT id FROM patient_keys WHERE patient_id = ?', (patient_id,))
+    return cursor.fetchone()[0]
+
+def index_document_entities(cursor, analysis_id: int, patient_id: str, entities: Iterable[Dict[str, Any]]):
+    """Add postings for one analyzed patient document (one per distinct entity and label)"""
+    key = patient_key(cursor, patient_id)
+    cursor.execute('INSERT OR IGNORE INTO indexed_documents (analysis_id, patient_key) VALUES (?, ?)',
+                   (analysis_id, key))
+    if cursor.rowcount == 0:
+        return  # already indexed
+
+    terms = set()
+    for entity in entities:
+        norm = normalize_entity(entity.get("text", ""))
+        # Measurements ("110 bpm") are values, not cohort concepts
+        if norm and not norm[0].isdigit():
+            terms.add((norm, entity.get("label", "")))
+    if not terms:
+        return
+
+    cursor.executemany('INSERT OR IGNORE INTO entity_terms (entity_norm, label) VALUES (?, ?)', terms)
+    term_ids = []
+    for norm, label in terms:
+        cursor.execute('SELECT id FROM entity_terms WHERE entity_norm = ? AND label = ?', (norm, label))
+        term_ids.append(cursor.fetchone()[0])
+    cursor.executemany('INSERT INTO entity_postings (term_id, analysis_id, patient_key) VALUES (?, ?, ?)',
+                       [(term_id, analysis_id, key) for term_id in term_ids])
+
+def backfill_cohort_index(cursor) -> int:
+    """Index every analyzed patient document from its stored analysis results"""
+    cursor.execute('''
+        SELECT pd.analysis_id, pd.patient_id, json_extract(ar.results, '$.medical_entities')
+        FROM patient_documents pd
+        JOIN analysis_results ar ON ar.id = pd.analysis_id
+        WHERE json_valid(ar.results)
+        ORDER BY pd.analysis_id
+    ''')
+    rows = cursor.fetchall()
+    for analysis_id, patient_id, entities in rows:
+        index_document_entities(cursor, analysis_id, patient_id, json.loads(entities) if entities else [])
+    return len(rows)
+
+def parse_cohort_query(query: str) -> QueryNode:
+    """Parse AND / OR / NOT / parentheses over entity terms.
+
+    Adjacent terms are ANDed. A term is a word, a "quoted phrase", or label:term
+    where label is an entity label (MEDICATION) or category (medications).
+    Raises ValueError on malformed queries.
+    """
+    tokens = []
+    position = 0
+    query = query.strip()
+    while position < len(query):
+        match = QUERY_TOKEN.match(query, position)
+        if not match or match.end() == position:
+            raise ValueError(f"Unexpected character at position {position}")
+        position = match.end()
+        open_paren, close_paren, phrase, label, label_phrase, word = match.groups()
+        if open_paren:
+            tokens.append(("(",))
+        elif close_paren:
+            tokens.append((")",))
+        elif phrase is not None:
+            tokens.append(("term", normalize_entity(phrase), None))
+        elif label is not None:
+            tokens.append(("term", normalize_entity(label_phrase), _label(label)))
+        elif word.upper() in ("AND", "OR", "NOT"):
+            tokens.append((word.upper(),))
+        elif ":" in word:
+            label_part, _, term = word.partition(":")
+            tokens.append(("term", normalize_entity(term), _label(label_part)))
+        else:
+            tokens.append(("term", normalize_entity(word), None))
+
+    if not tokens:
+        raise ValueError("Empty cohort query")
+    if sum(1 for token in tokens if token[0] == "term") > MAX_QUERY_TERMS:
+        raise ValueError(f"Too many terms (max {MAX_QUERY_TERMS})")
+
+    parser = _Parser(tokens)
+    node = parser.parse_or()
+    if parser.position != len(tokens):
+        raise ValueError(f"Unexpected '{tokens[parser.position][0]}'")
+    return node
+
+def _label(name: str) -> str:
+    return ENTITY_CATEGORIES.get(name.lower(), name.upper())
+
+class _Parser:
+    def __init__(self, tokens: List[Tuple]):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self) -> Optional[str]:
+        return self.tokens[self.position][0] if self.position < len(self.tokens) else None
+
+    def parse_or(self) -> QueryNode:
+        nodes = [self.parse_and()]
+        while self.peek() == "OR":
+            self.position += 1
+            nodes.append(self.parse_and())
+        return nodes[0] if len(nodes) == 1 else ("or", nodes)
+
+    def parse_and(self) -> QueryNode:
+        nodes = [self.parse_unary()]
+        while self.peek() in ("AND", "NOT", "term", "("):
+            if self.peek() == "AND":
+                self.position += 1
+            nodes.append(self.parse_unary())
+        return nodes[0] if len(nodes) == 1 else ("and", nodes)
+
+    def parse_unary(self) -> QueryNode:
+        token = self.peek()
+        if token == "NOT":
+            self.position += 1
+            return ("not", self.parse_unary())
+        if token == "(":
+            self.position += 1
+            node = self.parse_or()
+            if self.peek() != ")":
+                raise ValueError("Missing ')'")
+            self.position += 1
+            return node
+        if token == "term":
+            node = self.tokens[self.position]
+            self.position += 1
+            if not node[1]:
+                raise ValueError("Empty term")
+            return node
+        raise ValueError(f"Expected a term, got '{token or 'end of query'}'")
+
+def query_terms(node: QueryNode) -> List[Tuple[str, Optional[str]]]:
+    if node[0] == "term":
+        return [(node[1], node[2])]
+    if node[0] == "not":
+        return query_terms(node[1])
+    return [term for child in node[1] for term in query_terms(child)]
+
+def _has_not(node: QueryNode) -> bool:
+    if node[0] == "not":
+        return True
+    return node[0] in ("and", "or") and any(_has_not(child) for child in node[1])
+
+def bitset_from_csv(values: Optional[str]) -> int:
+    """Bitset from a group_concat() list of ids"""
+    if not values:
+        return 0
+    if NUMPY_AVAILABLE:
+        ids = np.fromstring(values, dtype=np.int64, sep=',')
+        bits = np.zeros(int(ids.max()) + 1, dtype=np.uint8)
+        bits[ids] = 1
+        return int.from_bytes(np.packbits(bits, bitorder='little').tobytes(), 'little')
+    return bitset_from_ids(map(int, values.split(',')))
+
+def bitset_from_ids(ids: Iterable[int]) -> int:
+    buffer = bytearray()
+    for value in ids:
+        index = value >> 3
+        if index >= len(buffer):
+            buffer.extend(bytes(index - len(buffer) + 1))
+        buffer[index] |= 1 << (value & 7)
+    return int.from_bytes(buffer, "little")
+
+def iter_bits(bitset: int) -> Iterator[int]:
+    """Set bit positions in ascending order"""
+    data = bitset.to_bytes((bitset.bit_length() + 7) // 8, "little")
+    for index, byte in enumerate(data):
+        while byte:
+            low = byte & -byte
+            yield (index << 3) + low.bit_length() - 1
+            byte ^= low
+
+class CohortIndex:
+    """Process-wide cache of per-term posting bitsets, refreshed incrementally"""
+
+    def __init__(self, max_terms: int = 512):
+        self.max_terms = max_terms
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self, generation: int = -1):
+        self.generation = generation
+        self.last_document: Optional[int] = None
+        # Loaded on first use by a NOT
+        self.universe: Dict[str, Optional[int]] = {level: None for level in COHORT_LEVELS}
+        self._terms: "OrderedDict[Tuple[int, str], int]" = OrderedDict()
+
+    def refresh(self, cursor):
+        """Fold documents indexed since the last call into the cached bitsets"""
+        cursor.execute('SELECT generation FROM entity_index_state WHERE id = 1')
+        generation = cursor.fetchone()[0]
+        if generation != self.generation:
+            self._reset(generation)
+
+        if self.last_document is None:
+            # Nothing cached yet; later loads read the table directly
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM indexed_documents')
+            self.last_document = cursor.fetchone()[0]
+            return
+
+        cursor.execute('SELECT id, analysis_id, patient_key FROM indexed_documents WHERE id > ? ORDER BY id',
+                       (self.last_document,))
+        documents = cursor.fetchall()
+        if not documents:
+            return
+        self.last_document = documents[-1][0]
+        for level, column in (("document", 1), ("patient", 2)):
+            if self.universe[level] is not None:
+                self.universe[level] |= bitset_from_ids(row[column] for row in documents)
+
+        if self._terms:
+            cursor.execute('''
+                SELECT p.term_id, p.analysis_id, p.patient_key
+                FROM indexed_documents d
+                JOIN entity_postings p ON p.analysis_id = d.analysis_id
+                WHERE d.id > ? AND d.id <= ?
+            ''', (documents[0][0] - 1, self.last_document))
+            additions: Dict[Tuple[int, str], List[int]] = {}
+            for term_id, analysis_id, key in cursor.fetchall():
+                if (term_id, "document") in self._terms:
+                    additions.setdefault((term_id, "document"), []).append(analysis_id)
+                if (term_id, "patient") in self._terms:
+                    additions.setdefault((term_id, "patient"), []).append(key)
+            for cache_key, ids in additions.items():
+                self._terms[cache_key] |= bitset_from_ids(ids)
+
+    def level_universe(self, cursor, level: str) -> int:
+        """Every indexed document (or patient with an indexed document)"""
+        if self.universe[level] is None:
+            column = "patient_key" if level == "patient" else "analysis_id"
+            cursor.execute(f'SELECT group_concat({column}) FROM indexed_documents')
+            self.universe[level] = bitset_from_csv(cursor.fetchone()[0])
+        return self.universe[level]
+
+    def resolve_terms(self, cursor, terms: List[Tuple[str, Optional[str]]]) -> Dict[Tuple[str, Optional[str]], List[int]]:
+        resolved = {}
+        for norm, label in terms:
+            if label:
+                cursor.execute('SELECT id FROM entity_terms WHERE entity_norm = ? AND label = ?', (norm, label))
+            else:
+                cursor.execute('SELECT id FROM entity_terms WHERE entity_norm = ?', (norm,))
+            resolved[(norm, label)] = [row[0] for row in cursor.fetchall()]
+        return resolved
+
+    def term_bitset(self, cursor, term_id: int, level: str) -> int:
+        cache_key = (term_id, level)
+        bitset = self._terms.get(cache_key)
+        if bitset is not None:
+            self._terms.move_to_end(cache_key)
+            return bitset
+        column = "patient_key" if level == "patient" else "analysis_id"
+        cursor.execute(f'SELECT group_concat({column}) FROM entity_postings WHERE term_id = ?', (term_id,))
+        bitset = bitset_from_csv(cursor.fetchone()[0])
+        self._terms[cache_key] = bitset
+        while len(self._terms) > self.max_terms:
+            self._terms.popitem(last=False)
+        return bitset
+
+    def evaluate(self, cursor, node: QueryNode, level: str) -> Tuple[int, Dict[str, int]]:
+        """Bitset of matching patient keys / analysis ids, plus per-term match counts"""
+        with self._lock:
+            self.refresh(cursor)
+            resolved = self.resolve_terms(cursor, query_terms(node))
+            term_sets: Dict[Tuple[str, Optional[str]], int] = {}
+            for term, term_ids in resolved.items():
+                bitset = 0
+                for term_id in term_ids:
+                    bitset |= self.term_bitset(cursor, term_id, level)
+                term_sets[term] = bitset
+            universe = self.level_universe(cursor, level) if _has_not(node) else 0
+
+        def walk(n: QueryNode) -> int:
+            kind = n[0]
+            if kind == "term":
+                return term_sets[(n[1], n[2])]
+            if kind == "not":
+                return universe & ~walk(n[1])
+            children = [walk(child) for child in n[1]]
+            result = children[0]
+            for child in children[1:]:
+                result = result & child if kind == "and" else result | child
+            return result
+
+        term_counts = {
+            (f"{label}:{norm}" if label else norm): bitset.bit_count()
+            for (norm, label), bitset in term_sets.items()
+        }
+        return walk(node), term_counts
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "cached_terms": len(self._terms),
+                "max_terms": self.max_terms,
+                "cached_bytes": sum((b.bit_length() + 7) // 8 for b in self._terms.values()),
+                "last_document": self.last_document,
+                "generation": self.generation
+            }
+
+# Shared by every cohort query in the process
+COHORT_INDEX = CohortIndex()
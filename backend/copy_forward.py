@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Copy-Forward Notes - near-duplicate detection and incremental re-analysis
+Progress notes are usually yesterday's note with a few lines changed, so an
+exact content hash never matches them. Each analyzed patient document gets a
+MinHash signature of its word shingles (MINHASH_PERMUTATIONS minimums, one per
+hash function) and the signature is split into LSH_BANDS bands whose hashes go
+into document_lsh_buckets. A new document is compared only with the patient's
+documents that share at least one band bucket, and the closest one whose
+estimated Jaccard similarity reaches NEAR_DUPLICATE_SIMILARITY is the note it
+was copied from.
+
+For a copy-forward note the earlier note's sentences are aligned with the new
+ones (difflib over the sentence texts). Entities and measurements in sentences
+that were copied unchanged are carried over at their new offsets; only the
+sentences that changed go through extraction again. Entities are de-duplicated
+per text and label, keeping the earliest occurrence: one the earlier analysis
+reported in a sentence that is gone makes the unchanged sentences mentioning it
+scanned again too (nothing is carried from a scanned sentence), and a carried
+entity gives way to a new occurrence earlier in the note. The result matches a
+full analysis as long as neither run reaches the profile's dictionary_limit.
+"""
+import difflib
+import hashlib
+import re
+from array import array
+from bisect import bisect_right
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from analysis_pipeline import (
+    DEFAULT_ANALYSIS_PROFILE,
+    ENTITY_CATEGORIES,
+    Document,
+    analyze_document,
+    dictionary_version,
+    split_sentences
+)
+
+SHINGLE_WORDS = 4                 # Words per shingle
+MINHASH_PERMUTATIONS = 128        # Signature length (32-bit minimums)
+LSH_BANDS = 32                    # Bands of LSH_ROWS minimums; candidates share a whole band
+LSH_ROWS = MINHASH_PERMUTATIONS // LSH_BANDS
+NEAR_DUPLICATE_SIMILARITY = 0.7   # Estimated Jaccard similarity of the shingle sets
+MAX_CANDIDATES = 20               # Candidates (most shared bands first) whose signatures are compared
+SHINGLE_BATCH = 1024              # Shingles hashed per min() pass, bounding memory for long documents
+
+WORD = re.compile(r"\w+")
+
+def shingles(text: str) -> Set[bytes]:
+    """Lowercased SHINGLE_WORDS-word sequences (the whole text if it is shorter)"""
+    words = WORD.findall(text.lower())
+    if len(words) <= SHINGLE_WORDS:
+        return {" ".join(words).encode()} if words else set()
+    return {" ".join(words[i:i + SHINGLE_WORDS]).encode() for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+def minhash_signature(text: str) -> Optional[array]:
+    """MinHash signature of the text's shingles; None for a text without words
+
+    One SHAKE-128 digest per shingle supplies all MINHASH_PERMUTATIONS 32-bit hash
+    values at once, and the per-position minimums are taken in C (map(min, ...)).
+    """
+    pending = list(shingles(text))
+    if not pending:
+        return None
+    signature = None
+    for start in range(0, len(pending), SHINGLE_BATCH):
+        hashed = [array("I", hashlib.shake_128(shingle).digest(4 * MINHASH_PERMUTATIONS))
+                  for shingle in pending[start:start + SHINGLE_BATCH]]
+        if signature is not None:
+            hashed.append(signature)
+        signature = array("I", map(min, *hashed)) if len(hashed) > 1 else hashed[0]
+    return signature
+
+def signature_similarity(a: array, b: array) -> float:
+    """Estimated Jaccard similarity: the share of positions where the minimums agree"""
+    return sum(x == y for x, y in zip(a, b)) / MINHASH_PERMUTATIONS
+
+def lsh_buckets(signature: array) -> List[Tuple[int, int]]:
+    """(band, bucket) for each band: a 64-bit hash of its LSH_ROWS minimums"""
+    return [
+        (band, int.from_bytes(hashlib.blake2b(signature[band * LSH_ROWS:(band + 1) * LSH_ROWS].tobytes(),
+                                              digest_size=8).digest(), "big", signed=True))
+        for band in range(LSH_BANDS)
+    ]
+
+def create_copy_forward_tables(cursor) -> bool:
+    """Create the signature and LSH bucket tables; returns True if they were created by this call"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'document_signatures'")
+    exists = cursor.fetchone() is not None
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS document_signatures (
+            document_id TEXT PRIMARY KEY,
+            patient_id TEXT NOT NULL,
+            signature BLOB NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS document_lsh_buckets (
+            patient_id TEXT NOT NULL,
+            band INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            document_id TEXT NOT NULL,
+            PRIMARY KEY (patient_id, band, bucket, document_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_patient_documents_signature_delete
+        AFTER DELETE ON patient_documents
+        BEGIN
+            DELETE FROM document_lsh_buckets
+            WHERE patient_id = OLD.patient_id AND document_id = OLD.id;
+            DELETE FROM document_signatures WHERE document_id = OLD.id;
+        END
+    ''')
+    return not exists
+
+def record_signature(cursor, document_id: str, patient_id: str, signature: array):
+    cursor.execute('INSERT OR REPLACE INTO document_signatures (document_id, patient_id, signature) VALUES (?, ?, ?)',
+                   (document_id, patient_id, signature.tobytes()))
+    cursor.executemany('''
+        INSERT OR IGNORE INTO document_lsh_buckets (patient_id, band, bucket, document_id) VALUES (?, ?, ?, ?)
+    ''', [(patient_id, band, bucket, document_id) for band, bucket in lsh_buckets(signature)])
+
+def find_near_duplicates(cursor, patient_id: str, signature: array,
+                         exclude: Optional[str] = None) -> List[Tuple[str, float]]:
+    """The patient's documents at least NEAR_DUPLICATE_SIMILARITY similar, most similar first"""
+    buckets = lsh_buckets(signature)
+    cursor.execute(f'''
+        SELECT document_id, COUNT(*) AS shared
+        FROM document_lsh_buckets
+        WHERE patient_id = ? AND ({" OR ".join(["(band = ? AND bucket = ?)"] * len(buckets))})
+        GROUP BY document_id
+        ORDER BY shared DESC
+        LIMIT ?
+    ''', (patient_id, *(value for bucket in buckets for value in bucket), MAX_CANDIDATES + 1))
+    candidates = [document_id for document_id, _ in cursor.fetchall() if document_id != exclude]
+    if not candidates:
+        return []
+
+    cursor.execute(f'''
+        SELECT document_id, signature FROM document_signatures
+        WHERE document_id IN ({", ".join("?" * len(candidates))})
+    ''', candidates)
+    matches = []
+    for document_id, blob in cursor.fetchall():
+        similarity = signature_similarity(signature, array("I", blob))
+        if similarity >= NEAR_DUPLICATE_SIMILARITY:
+            matches.append((document_id, similarity))
+    matches.sort(key=lambda match: -match[1])
+    return matches
+
+def backfill_signatures(cursor, batch_size: int = 500) -> int:
+    """Signatures for patient documents analyzed before this index existed"""
+    read = cursor.connection.cursor()
+    read.execute('''
+        SELECT pd.id, pd.patient_id, json_extract(ar.results, '$.extracted_text')
+        FROM patient_documents pd
+        JOIN analysis_results ar ON ar.id = pd.analysis_id
+    ''')
+    count = 0
+    while rows := read.fetchmany(batch_size):
+        for document_id, patient_id, text in rows:
+            signature = minhash_signature(text or "")
+            if signature is not None:
+                record_signature(cursor, document_id, patient_id, signature)
+                count += 1
+    return count
+
+def prior_analysis(results: Dict[str, Any], analysis_profile: str, categories: Optional[List[str]]) -> bool:
+    """Whether an earlier document's results can be carried into an analysis with these options
+
+    The earlier analysis must also have searched the current term dictionary.
+    """
+    metadata = results.get("processing_metadata") or {}
+    return (isinstance(results.get("extracted_text"), str)
+            and metadata.get("analysis_profile") == analysis_profile
+            and metadata.get("categories_requested") == (list(categories) if categories else list(ENTITY_CATEGORIES))
+            and metadata.get("dictionary_version") == dictionary_version())
+
+def run_copy_forward_analysis(text: str, prior: Dict[str, Any], analysis_profile: str = DEFAULT_ANALYSIS_PROFILE,
+                              categories: Optional[List[str]] = None) -> Tuple[Document, Dict[str, Any]]:
+    """
+    Analyze a note copied forward from an earlier one, re-extracting only what changed
+
+    prior holds the earlier document's analysis results (extracted_text,
+    medical_entities, measurements). Returns the same as run_analysis; the
+    response's copy_forward block says how much was carried over.
+    """
+    doc = Document(text)
+    prior_text = prior["extracted_text"]
+    prior_lower = prior_text.lower()
+    prior_sentences = split_sentences(prior_text)
+    new_keys = [doc.lower[start:end] for start, end in doc.sentences]
+
+    # The new sentence each earlier sentence that was copied unchanged became
+    copied: Dict[int, int] = {}
+    matcher = difflib.SequenceMatcher(None, [prior_lower[start:end] for start, end in prior_sentences],
+                                      new_keys, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            copied.update(zip(range(i1, i2), range(j1, j2)))
+
+    prior_starts = [start for start, _ in prior_sentences]
+
+    def prior_sentence(start: int, end: int) -> Optional[int]:
+        i = bisect_right(prior_starts, start) - 1
+        return i if i >= 0 and end <= prior_sentences[i][1] else None
+
+    entities = [(entity, prior_sentence(entity["start_pos"], entity["end_pos"]))
+                for entity in prior.get("medical_entities") or []]
+    measurements = [(measurement, prior_sentence(measurement["start"], measurement["end"]))
+                    for measurement in prior.get("measurements") or []]
+    lost = {entity["text"].lower() for entity, i in entities if i not in copied}
+    unchanged = set(copied.values())
+    scanned = {j for j in range(len(doc.sentences)) if j not in unchanged or any(text in new_keys[j] for text in lost)}
+    doc.scan_sentences = [span for j, span in enumerate(doc.sentences) if j in scanned]
+
+    # Nothing is carried from a sentence that is scanned again
+    shifts = {i: doc.sentences[j][0] - prior_sentences[i][0] for i, j in copied.items() if j not in scanned}
+    for entity, i in entities:
+        if i in shifts:
+            delta = shifts[i]
+            doc.carried_entities.append((entity["start_pos"] + delta, entity["end_pos"] + delta, entity["label"],
+                                         entity["source"], round(entity["confidence"] * 100)))
+    for measurement, i in measurements:
+        if i in shifts:
+            delta = shifts[i]
+            doc.carried_measurements.append((measurement["start"] + delta, measurement["end"] + delta,
+                                             measurement["analyte"], measurement["value"], "", ""))
+
+    doc, response = analyze_document(doc, analysis_profile, categories)
+    response["copy_forward"] = {
+        "sentences": len(doc.sentences),
+        "sentences_analyzed": len(doc.scan_sentences),
+        "entities_carried": len(doc.carried_entities),
+        "measurements_carried": len(doc.carried_measurements)
+    }
+    return doc, response
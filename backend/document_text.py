@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Document Text - plain text out of DOCX and RTF files without an office stack
+Both readers stream: a DOCX's word/document.xml is inflated straight out of the
+archive in READ_CHUNK_BYTES pieces into an expat parser, whose callbacks keep
+the paragraph text and nothing else (no element tree); an RTF file is tokenized
+chunk by chunk. Memory stays bounded by the text kept (at most max_chars), not
+by the size of the file, and reading stops once max_chars characters are out.
+
+The declared content type is only a hint: browsers send application/msword for
+RTF saved as .doc, and DOCX files arrive as octet-stream, so the first bytes of
+the file decide which reader runs (sniff_format).
+"""
+import codecs
+import re
+import zipfile
+from typing import IO, List, Optional
+from xml.parsers import expat
+
+READ_CHUNK_BYTES = 64 * 1024
+RTF_TOKEN_LOOKAHEAD = 64         # Longest control word (32 letters) + parameter + delimiter, with room to spare
+
+DOCX_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+RTF_TYPES = ("application/rtf", "text/rtf")
+DOCX_BODY = "word/document.xml"
+W = "http://schemas.openxmlformats.org/wordprocessingml/2006/main "   # expat's namespace prefix of tag names
+W_PARAGRAPH, W_RUN, W_TEXT, W_TAB = f"{W}p", f"{W}r", f"{W}t", f"{W}tab"
+W_BREAKS = (f"{W}br", f"{W}cr")
+
+class DocumentTextError(ValueError):
+    """The file is not a readable document of its format"""
+
+def sniff_format(head: bytes, file_type: Optional[str] = None) -> str:
+    """pdf, docx, rtf, doc (legacy binary Word) or text, from the file's first bytes"""
+    if head.startswith(b"%PDF"):
+        return "pdf"
+    if head.startswith(b"PK\x03\x04"):
+        return "docx"
+    if head.lstrip(b"\xef\xbb\xbf \t\r\n").startswith(b"{\\rtf"):
+        return "rtf"
+    if head.startswith(b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"):
+        return "doc"
+    return "pdf" if file_type == "application/pdf" else "text"
+
+def docx_text(source, max_chars: int) -> str:
+    """Text of a DOCX (path or binary file object): one line per paragraph, tabs and breaks kept"""
+    try:
+        archive = zipfile.ZipFile(source)
+    except zipfile.BadZipFile as e:
+        raise DocumentTextError(f"Not a DOCX file: {str(e)}")
+    with archive:
+        try:
+            body = archive.open(DOCX_BODY)
+        except KeyError:
+            raise DocumentTextError(f"Not a DOCX file: no {DOCX_BODY}")
+        lines: List[str] = []
+        paragraph: List[str] = []
+        state = {"length": 0, "runs": 0, "text": False}
+
+        def start(tag, attributes):
+            if tag == W_TEXT:
+                state["text"] = True
+            elif tag == W_RUN:
+                state["runs"] += 1
+            elif state["runs"]:
+                # A w:tab outside a run is a tab stop definition, not text
+                if tag == W_TAB:
+                    paragraph.append("\t")
+                elif tag in W_BREAKS:
+                    paragraph.append("\n")
+
+        def end(tag):
+            if tag == W_TEXT:
+                state["text"] = False
+            elif tag == W_RUN:
+                state["runs"] -= 1
+            elif tag == W_PARAGRAPH:
+                lines.append("".join(paragraph))
+                state["length"] += len(lines[-1]) + 1
+                paragraph.clear()
+
+        def characters(data):
+            if state["text"]:
+                paragraph.append(data)
+
+        # expat callbacks instead of an element tree: nothing but the text is kept
+        parser = expat.ParserCreate(namespace_separator=" ")
+        parser.buffer_text = True
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = characters
+        try:
+            with body:
+                while state["length"] < max_chars:
+                    chunk = body.read(READ_CHUNK_BYTES)
+                    parser.Parse(chunk, not chunk)
+                    if not chunk:
+                        break
+        except (expat.ExpatError, zipfile.BadZipFile, EOFError, OSError) as e:
+            raise DocumentTextError(f"Unreadable DOCX file: {str(e)}")
+    return "\n".join(lines)[:max_chars]
+
+# Groups whose content is not document text (fonts, styles, metadata, pictures, embedded objects...)
+RTF_SKIPPED_DESTINATIONS = {
+    "fonttbl", "colortbl", "stylesheet", "listtable", "listoverridetable", "info", "pict", "object", "objdata",
+    "themedata", "colorschememapping", "datastore", "latentstyles", "rsidtbl", "generator", "xmlnstbl",
+    "header", "headerl", "headerr", "headerf", "footer", "footerl", "footerr", "footerf", "fldinst",
+    "filetbl", "revtbl", "mmathPr", "pgdsctbl", "shppict", "nonshppict", "bkmkstart", "bkmkend"
+}
+RTF_CONTROL_TEXT = {"par": "\n", "line": "\n", "sect": "\n", "page": "\n", "row": "\n", "cell": "\t",
+                    "tab": "\t", "emdash": "\u2014", "endash": "\u2013", "bullet": "\u2022",
+                    "lquote": "\u2018", "rquote": "\u2019", "ldblquote": "\u201c", "rdblquote": "\u201d",
+                    "emspace": " ", "enspace": " "}
+RTF_SYMBOL_TEXT = {"~": "\u00a0", "_": "\u2011", "-": "", "\\": "\\", "{": "{", "}": "}",
+                   "\n": "\n", "\r": "\n", "\t": "\t"}
+_RTF_TOKEN = re.compile(
+    rb"\\([a-zA-Z]{1,32})(-?\d{1,10})? ?"   # Control word with optional parameter
+    rb"|\\'([0-9a-fA-F]{2})"                 # Byte in the document's code page
+    rb"|\\(.)"                               # Control symbol
+    rb"|([{}])"
+    rb"|[\r\n]+"                             # Line breaks in the source are not text
+    rb"|([^\\{}\r\n]{1,4096})",
+    re.S)
+
+def rtf_text(stream: IO[bytes], max_chars: int) -> str:
+    """Text of an RTF file read chunk by chunk: formatting, tables of fonts / styles and pictures stripped"""
+    out: List[str] = []
+    length = 0
+    skip = False              # Inside a skipped destination group
+    uc = 1                    # Fallback characters following each \\uN
+    stack = []
+    fallback = 0              # Fallback characters still to drop after a \\uN
+    pending = bytearray()     # \\'hh bytes, decoded together so multi-byte code pages work
+    decoder = codecs.getincrementaldecoder("cp1252")(errors="replace")
+    expect_destination = False  # The previous token was \\*: an unknown destination to skip
+    buffer = b""
+    binary = 0                # Raw bytes of a \\binN still to skip
+    eof = False
+
+    def emit(text: str):
+        nonlocal length
+        if not skip and text:
+            out.append(text)
+            length += len(text)
+
+    def flush():
+        if pending:
+            emit(decoder.decode(bytes(pending)))
+            pending.clear()
+
+    while length < max_chars:
+        if not eof:
+            chunk = stream.read(READ_CHUNK_BYTES)
+            eof = not chunk
+            buffer += chunk
+        if binary:
+            skipped = min(binary, len(buffer))
+            buffer, binary = buffer[skipped:], binary - skipped
+        limit = len(buffer) if eof else len(buffer) - RTF_TOKEN_LOOKAHEAD
+        pos = 0
+        resume = False            # Scan again after the raw bytes of a \\binN
+        for match in _RTF_TOKEN.finditer(buffer):
+            if match.end() > limit and not eof or length >= max_chars:
+                break
+            pos = match.end()
+            word, parameter, hex_byte, symbol, brace, plain = match.groups()
+            if hex_byte is not None:
+                if fallback:
+                    fallback -= 1
+                else:
+                    pending.append(int(hex_byte, 16))
+                continue
+            flush()
+            if word is not None:
+                word = word.decode()
+                if expect_destination:
+                    expect_destination = False
+                    skip = True
+                if word in RTF_SKIPPED_DESTINATIONS:
+                    skip = True
+                elif word == "u" and parameter is not None:
+                    code = int(parameter)
+                    emit(chr(code + 65536 if code < 0 else code))
+                    fallback = uc
+                elif word == "uc" and parameter is not None:
+                    uc = int(parameter)
+                elif word == "ansicpg" and parameter is not None:
+                    try:
+                        decoder = codecs.getincrementaldecoder(f"cp{int(parameter)}")(errors="replace")
+                    except LookupError:
+                        pass
+                elif word == "bin" and parameter is not None:
+                    binary = int(parameter)
+                    resume = True
+                    break
+                elif word in RTF_CONTROL_TEXT:
+                    emit(RTF_CONTROL_TEXT[word])
+                    fallback = 0
+            elif symbol is not None:
+                if symbol == b"*":
+                    expect_destination = True
+                elif fallback:
+                    fallback -= 1
+                else:
+                    emit(RTF_SYMBOL_TEXT.get(symbol.decode("latin-1"), ""))
+            elif brace == b"{":
+                stack.append((skip, uc))
+            elif brace == b"}":
+                if stack:
+                    skip, uc = stack.pop()
+                fallback = 0
+            elif plain is not None:
+                text = plain.decode("latin-1")
+                if fallback:
+                    dropped = min(fallback, len(text))
+                    text, fallback = text[dropped:], fallback - dropped
+                emit(text)
+        buffer = buffer[pos:]
+        if eof and not resume:
+            break
+    flush()
+    return "".join(out)[:max_chars]
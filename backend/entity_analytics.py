@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+"""
+Entity Analytics - columnar snapshot of entity occurrences for dashboard queries
+Every analysis in analysis_results contributes one row per distinct (entity, label)
+it found. Rows are held as NumPy arrays: a term id per row, plus analysis id, month
+and row range per analysis. Alongside them a month x term count cube is kept up to
+date as rows arrive, so top-N and month-by-month frequency are slices of the cube,
+and co-occurrence is one masked bincount over the rows.
+
+New analyses are appended to analysis_results, so the snapshot loads only analyses
+with an id above the last one it has seen. Deleting patient documents (and so
+patients) leaves their analyses in place but bumps the cohort index generation;
+the snapshot is then rebuilt without the analyses of deleted documents.
+"""
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from analysis_pipeline import ENTITY_CATEGORIES
+from cohort_index import normalize_entity
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+REFRESH_BATCH = 5000          # analyses per json_each pass
+REINDEX_FRACTION = 0.1        # rebuild the inverted index once this share of analyses is newer than it
+INITIAL_CAPACITY = 1 << 16
+
+def entity_label(name: str) -> str:
+    """Entity label from a label (MEDICATION) or category (medications)"""
+    return ENTITY_CATEGORIES.get(name.lower(), name.upper())
+
+def month_code(value: str) -> int:
+    """'2024-03...' -> months since year 0; raises ValueError on anything else"""
+    if len(value) < 7 or value[4] != "-" or not (value[0:4] + value[5:7]).isdigit():
+        raise ValueError(f"Expected YYYY-MM, got '{value}'")
+    year, month = int(value[0:4]), int(value[5:7])
+    if not 1 <= month <= 12:
+        raise ValueError(f"Expected YYYY-MM, got '{value}'")
+    return year * 12 + month - 1
+
+def month_name(code: int) -> str:
+    return f"{code // 12:04d}-{code % 12 + 1:02d}"
+
+class EntitySnapshot:
+    """Process-wide columnar copy of entity occurrences, refreshed incrementally"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self, generation: int = -1):
+        self.generation = generation
+        self.last_analysis = 0
+        # One row per (analysis, term)
+        self.rows = 0
+        self.term = np.zeros(INITIAL_CAPACITY, dtype=np.int32)
+        # One entry per analysis with at least one row; its rows are contiguous
+        self.documents = 0
+        self.doc_analysis = np.zeros(INITIAL_CAPACITY, dtype=np.int32)
+        self.doc_month = np.zeros(INITIAL_CAPACITY, dtype=np.int16)
+        self.doc_start = np.zeros(INITIAL_CAPACITY, dtype=np.int64)
+        self.doc_length = np.zeros(INITIAL_CAPACITY, dtype=np.int32)
+        # Vocabulary: term id -> (entity, label code)
+        self.terms: Dict[Tuple[str, int], int] = {}
+        self.term_names: List[str] = []
+        self.term_label = np.zeros(1024, dtype=np.int16)
+        self.by_name: Dict[str, List[int]] = {}
+        self.labels: List[str] = []
+        self.label_codes: Dict[str, int] = {}
+        # Aggregates by month (row 0 = base_month): rows per term, analyses per label, analyses
+        self.base_month = 0
+        self.term_counts = np.zeros((0, 1024), dtype=np.int32)
+        self.label_analyses = np.zeros((0, 64), dtype=np.int32)
+        self.month_analyses = np.zeros(0, dtype=np.int64)
+        # Term -> analyses inverted index over the first _indexed_documents analyses (built on demand)
+        self._indexed_documents = 0
+        self._posting_offsets = None
+        self._posting_documents = None
+
+    def _label_code(self, label: str) -> int:
+        code = self.label_codes.get(label)
+        if code is None:
+            code = self.label_codes[label] = len(self.labels)
+            self.labels.append(label)
+        return code
+
+    def _term_id(self, norm: str, label_code: int) -> int:
+        term_id = self.terms.get((norm, label_code))
+        if term_id is None:
+            term_id = self.terms[(norm, label_code)] = len(self.term_names)
+            self.term_names.append(norm)
+            self.by_name.setdefault(norm, []).append(term_id)
+            self.term_label = _grow(self.term_label, term_id + 1, term_id)
+            self.term_label[term_id] = label_code
+        return term_id
+
+    def _fit_aggregates(self, first_month: int, last_month: int):
+        """Widen the month range and term / label columns of the aggregates as needed"""
+        span = len(self.month_analyses)
+        base = min(self.base_month, first_month) if span else first_month
+        end = max(self.base_month + span, last_month + 1) if span else last_month + 1
+        term_columns = self.term_counts.shape[1]
+        while term_columns < len(self.term_names):
+            term_columns *= 2
+        label_columns = self.label_analyses.shape[1]
+        while label_columns < len(self.labels):
+            label_columns *= 2
+        if (base, end, term_columns, label_columns) == (self.base_month, self.base_month + span,
+                                                        self.term_counts.shape[1], self.label_analyses.shape[1]):
+            return
+        offset = self.base_month - base
+        term_counts = np.zeros((end - base, term_columns), dtype=np.int32)
+        term_counts[offset:offset + span, :self.term_counts.shape[1]] = self.term_counts
+        label_analyses = np.zeros((end - base, label_columns), dtype=np.int32)
+        label_analyses[offset:offset + span, :self.label_analyses.shape[1]] = self.label_analyses
+        month_analyses = np.zeros(end - base, dtype=np.int64)
+        month_analyses[offset:offset + span] = self.month_analyses
+        self.base_month, self.term_counts = base, term_counts
+        self.label_analyses, self.month_analyses = label_analyses, month_analyses
+
+    def append_analyses(self, analysis_ids, months, lengths, terms):
+        """Append analyses given as arrays: one entry per analysis in the first three,
+        and their term ids back to back in terms (lengths[i] of them for analysis i)"""
+        analysis_ids = np.asarray(analysis_ids, dtype=np.int32)
+        months = np.asarray(months, dtype=np.int16)
+        lengths = np.asarray(lengths, dtype=np.int32)
+        terms = np.asarray(terms, dtype=np.int32)
+        if not len(analysis_ids):
+            return
+
+        documents = self.documents + len(analysis_ids)
+        for name in ("doc_analysis", "doc_month", "doc_start", "doc_length"):
+            setattr(self, name, _grow(getattr(self, name), documents, self.documents))
+        self.doc_analysis[self.documents:documents] = analysis_ids
+        self.doc_month[self.documents:documents] = months
+        self.doc_length[self.documents:documents] = lengths
+        self.doc_start[self.documents:documents] = self.rows + np.cumsum(lengths) - lengths
+        self.documents = documents
+
+        rows = self.rows + len(terms)
+        self.term = _grow(self.term, rows, self.rows)
+        self.term[self.rows:rows] = terms
+        self.rows = rows
+
+        self._fit_aggregates(int(months.min()), int(months.max()))
+        month_index = months.astype(np.int64) - self.base_month
+        np.add.at(self.term_counts, (np.repeat(month_index, lengths), terms), 1)
+        np.add.at(self.month_analyses, month_index, 1)
+        # Distinct labels per analysis
+        label_columns = self.label_analyses.shape[1]
+        pairs = np.unique(np.repeat(np.arange(len(lengths), dtype=np.int64), lengths) * label_columns
+                          + self.term_label[terms])
+        np.add.at(self.label_analyses, (month_index[pairs // label_columns], pairs % label_columns), 1)
+
+    def _entity_terms(self, entities: Iterable[Tuple[str, str]]) -> List[int]:
+        """Distinct term ids for (text, label) entity pairs"""
+        term_ids = set()
+        for text, label in entities:
+            norm = normalize_entity(text or "")
+            # Measurements ("110 bpm") are values, not concepts to count
+            if norm and not norm[0].isdigit():
+                term_ids.add(self._term_id(norm, self._label_code(label or "")))
+        return sorted(term_ids)
+
+    def refresh(self, cursor):
+        """Load analyses stored since the last call"""
+        cursor.execute('SELECT generation FROM entity_index_state WHERE id = 1')
+        generation = cursor.fetchone()[0]
+        cursor.execute('SELECT COALESCE(MAX(id), 0) FROM analysis_results')
+        latest = cursor.fetchone()[0]
+        if generation != self.generation or latest < self.last_analysis:
+            self._reset(generation)  # documents were deleted, or the database was replaced
+        while self.last_analysis < latest:
+            upper = min(latest, self.last_analysis + REFRESH_BATCH)
+            cursor.execute('''
+                SELECT ar.id, ar.created_at, json_extract(e.value, '$.text'), json_extract(e.value, '$.label')
+                FROM analysis_results ar,
+                     json_each(CASE WHEN json_valid(ar.results) THEN ar.results ELSE '{}' END,
+                               '$.medical_entities') e
+                WHERE ar.id > ? AND ar.id <= ?
+                  AND (ar.analysis_type IS NOT 'patient_document'
+                       OR EXISTS (SELECT 1 FROM patient_documents pd WHERE pd.analysis_id = ar.id))
+                ORDER BY ar.id
+            ''', (self.last_analysis, upper))
+            grouped: Dict[int, Tuple[str, List[Tuple[str, str]]]] = {}
+            for analysis_id, created_at, text, label in cursor.fetchall():
+                grouped.setdefault(analysis_id, (created_at, []))[1].append((text, label))
+
+            analysis_ids, months, lengths, terms = [], [], [], []
+            for analysis_id, (created_at, entities) in grouped.items():
+                try:
+                    month = month_code(created_at or "")
+                except ValueError:
+                    continue
+                term_ids = self._entity_terms(entities)
+                if term_ids:
+                    analysis_ids.append(analysis_id)
+                    months.append(month)
+                    lengths.append(len(term_ids))
+                    terms.extend(term_ids)
+            self.append_analyses(analysis_ids, months, lengths, terms)
+            self.last_analysis = upper
+
+    def _window(self, since: Optional[int], until: Optional[int]) -> Optional[slice]:
+        """Aggregate rows covering [since, until], or None when nothing can match"""
+        first = 0 if since is None else max(since - self.base_month, 0)
+        last = len(self.month_analyses) - 1 if until is None else min(until - self.base_month,
+                                                                      len(self.month_analyses) - 1)
+        return slice(first, last + 1) if first <= last else None
+
+    def _window_counts(self, window: slice):
+        return self.term_counts[window, :len(self.term_names)].sum(axis=0)
+
+    def _only_label(self, counts, label: Optional[str]):
+        if label is None:
+            return counts
+        return np.where(self.term_label[:len(counts)] == self.label_codes[label], counts, 0)
+
+    def _documents_with(self, target: List[int]):
+        """Flag per analysis: does it mention any of the target terms"""
+        if self.documents - self._indexed_documents > REINDEX_FRACTION * self.documents:
+            documents = np.repeat(np.arange(self.documents, dtype=np.int32), self.doc_length[:self.documents])
+            order = np.argsort(self.term[:self.rows], kind="stable")
+            self._posting_documents = documents[order]
+            self._posting_offsets = np.concatenate(([0], np.cumsum(np.bincount(
+                self.term[:self.rows], minlength=len(self.term_names)))))
+            self._indexed_documents = self.documents
+
+        flags = np.zeros(self.documents, dtype=bool)
+        for t in target:
+            if t + 1 < len(self._posting_offsets):
+                flags[self._posting_documents[self._posting_offsets[t]:self._posting_offsets[t + 1]]] = True
+        # Analyses added since the index was built
+        if self._indexed_documents < self.documents:
+            first_row = int(self.doc_start[self._indexed_documents])
+            tail = self.term[first_row:self.rows]
+            mentions = tail == target[0] if len(target) == 1 else np.isin(tail, target)
+            flags[self._indexed_documents:] = np.logical_or.reduceat(
+                mentions, self.doc_start[self._indexed_documents:self.documents] - first_row)
+        return flags
+
+    def _term_ids(self, entity: str, label: Optional[str]) -> List[int]:
+        code = self.label_codes.get(label) if label else None
+        return [t for t in self.by_name.get(normalize_entity(entity), [])
+                if label is None or self.term_label[t] == code]
+
+    def _describe(self, term_id: int, count: int) -> Dict[str, Any]:
+        return {"entity": self.term_names[term_id], "label": self.labels[self.term_label[term_id]],
+                "analyses": int(count)}
+
+    def _top(self, counts, limit: int) -> List[int]:
+        candidates = np.flatnonzero(counts)
+        if len(candidates) > limit:
+            candidates = candidates[np.argpartition(-counts[candidates], limit - 1)[:limit]]
+        # Most frequent first, ties by term id so pages are stable
+        return sorted(candidates.tolist(), key=lambda t: (-counts[t], t))
+
+    def _months(self, window: slice) -> List[str]:
+        return [month_name(self.base_month + m) for m in range(window.start, window.stop)]
+
+    def top_entities(self, label: Optional[str], since: Optional[int], until: Optional[int],
+                     limit: int) -> Dict[str, Any]:
+        window = self._window(since, until)
+        if window is None or (label is not None and label not in self.label_codes):
+            return {"analyses": 0, "entities": []}
+        counts = self._only_label(self._window_counts(window), label)
+        if label is None:
+            analyses = self.month_analyses[window].sum()
+        else:
+            analyses = self.label_analyses[window, self.label_codes[label]].sum()
+        return {"analyses": int(analyses),
+                "entities": [self._describe(t, counts[t]) for t in self._top(counts, limit)]}
+
+    def monthly_frequency(self, label: Optional[str], entities: List[str], since: Optional[int],
+                          until: Optional[int], limit: int) -> Dict[str, Any]:
+        window = self._window(since, until)
+        if window is None or (label is not None and label not in self.label_codes):
+            return {"months": [], "entities": []}
+        if entities:
+            term_ids = [t for entity in entities for t in self._term_ids(entity, label)]
+        else:
+            term_ids = self._top(self._only_label(self._window_counts(window), label), limit)
+        grid = self.term_counts[window][:, term_ids]
+        return {"months": self._months(window), "entities": [
+            dict(self._describe(t, grid[:, column].sum()), monthly=grid[:, column].tolist())
+            for column, t in enumerate(term_ids)
+        ]}
+
+    def cooccurrence(self, entity: str, entity_label_filter: Optional[str], partner_label: Optional[str],
+                     since: Optional[int], until: Optional[int], limit: int, by_month: bool) -> Dict[str, Any]:
+        target = self._term_ids(entity, entity_label_filter)
+        window = self._window(since, until)
+        if not target or window is None:
+            return {"analyses": 0, "entities": []}
+        term = self.term[:self.rows]
+        lengths = self.doc_length[:self.documents]
+        months = self.doc_month[:self.documents]
+
+        # Analyses in the window that mention the entity
+        has_entity = self._documents_with(target)
+        in_window = np.ones(self.documents, dtype=bool)
+        if since is not None:
+            in_window &= months >= since
+        if until is not None:
+            in_window &= months <= until
+        has_entity &= in_window
+        analyses = int(has_entity.sum())
+        if not analyses:
+            return {"analyses": 0, "entities": []}
+
+        # Count over whichever side of the split is smaller; the window totals give the rest
+        complement = analyses * 2 > int(self.month_analyses[window].sum())
+        selected = in_window & ~has_entity if complement else has_entity
+        terms = term[np.repeat(selected, lengths)]
+        vocabulary = len(self.term_names)
+        if by_month:
+            month_index = months[selected].astype(np.int64) - (self.base_month + window.start)
+            span = window.stop - window.start
+            grid = np.bincount(np.repeat(month_index * vocabulary, lengths[selected]) + terms,
+                               minlength=span * vocabulary).reshape(span, vocabulary)
+            if complement:
+                grid = self.term_counts[window, :vocabulary] - grid
+            counts = grid.sum(axis=0)
+        else:
+            counts = np.bincount(terms, minlength=vocabulary)
+            if complement:
+                counts = self._window_counts(window) - counts
+        counts[target] = 0
+        if partner_label is not None:
+            if partner_label not in self.label_codes:
+                return {"analyses": analyses, "entities": []}
+            counts = self._only_label(counts, partner_label)
+
+        partners = self._top(counts, limit)
+        results = [dict(self._describe(t, counts[t]), share=round(int(counts[t]) / analyses, 4))
+                   for t in partners]
+        response = {"analyses": analyses, "entities": results}
+        if by_month and partners:
+            response["months"] = self._months(window)
+            for t, result in zip(partners, results):
+                result["monthly"] = grid[:, t].tolist()
+        return response
+
+    def query(self, cursor, method: str, *args) -> Dict[str, Any]:
+        """Refresh from cursor, then run one of the query methods under the lock"""
+        with self._lock:
+            self.refresh(cursor)
+            return getattr(self, method)(*args)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            arrays = (self.term, self.doc_analysis, self.doc_month, self.doc_start, self.doc_length,
+                      self.term_label, self.term_counts, self.label_analyses, self.month_analyses)
+            return {
+                "rows": self.rows,
+                "analyses": self.documents,
+                "terms": len(self.term_names),
+                "labels": list(self.labels),
+                "months": len(self.month_analyses),
+                "last_analysis": self.last_analysis,
+                "generation": self.generation,
+                "memory_bytes": int(sum(array.nbytes for array in arrays))
+            }
+
+def _grow(column, needed: int, used: int):
+    """column, or a copy with doubled capacity holding its first `used` entries"""
+    if needed <= len(column):
+        return column
+    capacity = len(column)
+    while capacity < needed:
+        capacity *= 2
+    grown = np.zeros(capacity, dtype=column.dtype)
+    grown[:used] = column[:used]
+    return grown
+
+# Shared by every analytics request in the process (None without NumPy)
+ENTITY_ANALYTICS = EntitySnapshot() if NUMPY_AVAILABLE else None
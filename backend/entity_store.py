@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Compact Entity Store
+Entities are kept as parallel typed arrays of (id, start, end, label_id, source_id,
+confidence) with interned label and source strings. Entity text is a slice of the
+document's lowered text, so no per-entity strings or dicts are held until the
+results are serialized.
+"""
+from array import array
+from typing import Any, Dict, Iterable, List, Tuple
+
+class InternTable:
+    """Maps strings to small integer ids and back"""
+    __slots__ = ("_values", "_index")
+
+    def __init__(self):
+        self._values: List[str] = []
+        self._index: Dict[str, int] = {}
+
+    def intern(self, value: str) -> int:
+        value_id = self._index.get(value)
+        if value_id is None:
+            value_id = len(self._values)
+            self._values.append(value)
+            self._index[value] = value_id
+        return value_id
+
+    def lookup(self, value: str) -> int:
+        """Id of an already interned value, or -1"""
+        return self._index.get(value, -1)
+
+    def value(self, value_id: int) -> str:
+        return self._values[value_id]
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+# Shared across stores so every analysis in the process uses the same ids
+LABELS = InternTable()
+SOURCES = InternTable()
+
+# (id, start, end, label_id, source_id, confidence in hundredths)
+EntityRow = Tuple[int, int, int, int, int, int]
+
+class EntityStore:
+    """Column-oriented entity storage for one document"""
+    __slots__ = ("text", "ids", "starts", "ends", "label_ids", "source_ids", "confidences")
+
+    def __init__(self, text: str):
+        self.text = text  # lowered document text the spans point into
+        self.ids = array('I')
+        self.starts = array('I')
+        self.ends = array('I')
+        self.label_ids = array('H')
+        self.source_ids = array('H')
+        self.confidences = array('B')  # hundredths, 0-100
+
+    @classmethod
+    def from_rows(cls, text: str, rows: Iterable[EntityRow]) -> "EntityStore":
+        store = cls(text)
+        for row in rows:
+            store.append(*row)
+        return store
+
+    def append(self, entity_id: int, start: int, end: int, label_id: int, source_id: int, confidence: int):
+        self.ids.append(entity_id)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.label_ids.append(label_id)
+        self.source_ids.append(source_id)
+        self.confidences.append(confidence)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def entity_text(self, row: int) -> str:
+        return self.text[self.starts[row]:self.ends[row]]
+
+    def label(self, row: int) -> str:
+        return LABELS.value(self.label_ids[row])
+
+    def rows_by_label(self) -> Dict[int, array]:
+        """Row indexes grouped by label id, in document order"""
+        groups: Dict[int, array] = {}
+        for row, label_id in enumerate(self.label_ids):
+            rows = groups.get(label_id)
+            if rows is None:
+                rows = groups[label_id] = array('I')
+            rows.append(row)
+        return groups
+
+    def label_counts(self) -> Dict[int, int]:
+        counts: Dict[int, int] = {}
+        for label_id in self.label_ids:
+            counts[label_id] = counts.get(label_id, 0) + 1
+        return counts
+
+    def mean_confidence(self) -> float:
+        return sum(c / 100 for c in self.confidences) / len(self.confidences)
+
+    def to_dict(self, row: int) -> Dict[str, Any]:
+        return {
+            "id": self.ids[row],
+            "text": self.entity_text(row),
+            "label": LABELS.value(self.label_ids[row]),
+            "start_pos": self.starts[row],
+            "end_pos": self.ends[row],
+            "confidence": self.confidences[row] / 100,
+            "source": SOURCES.value(self.source_ids[row])
+        }
+
+    def to_dicts(self) -> List[Dict[str, Any]]:
+        """Materialize every entity as the JSON-facing dict"""
+        return [self.to_dict(row) for row in range(len(self))]
+
+    def memory_bytes(self) -> int:
+        """Approximate bytes held by the column arrays"""
+        return sum(
+            column.buffer_info()[1] * column.itemsize
+            for column in (self.ids, self.starts, self.ends, self.label_ids, self.source_ids, self.confidences)
+        )
@@ -508,6 +508,17 @@ class MedicalDatabaseExpander:
             ("ast normal", "LAB_VALUES", "10-40 U/L"),
             ("bilirubin normal", "LAB_VALUES", "0.3-1.2 mg/dL"),
             ("albumin normal", "LAB_VALUES", "3.5-5.0 g/dL"),
+            
+            # Diabetes
+            ("hba1c normal", "LAB_VALUES", "<5.7%"),
+            
+            # Vital signs
+            ("heart rate normal", "VITAL_SIGNS", "60-100 bpm"),
+            ("respiratory rate normal", "VITAL_SIGNS", "12-20 breaths/min"),
+            ("systolic blood pressure normal", "VITAL_SIGNS", "90-120 mmHg"),
+            ("diastolic blood pressure normal", "VITAL_SIGNS", "60-80 mmHg"),
+            ("temperature normal", "VITAL_SIGNS", "36.1-37.2 °C"),
+            ("oxygen saturation normal", "VITAL_SIGNS", "95-100%"),
         ]
         
         batch = []
@@ -7,12 +7,13 @@ import sqlite3
 import json
 import time
 import os
-from typing import List, Tuple, Dict, Any
+from typing import List, Tuple, Dict, Any, Iterable, Optional
 
 class FastMedicalDatabase:
     def __init__(self, db_path: str = "fast_medical.db"):
         self.db_path = db_path
         self.conn = None
+        self._version_cache = None
         self._initialize_database()
     
     def _initialize_database(self):
@@ -66,31 +67,68 @@ class FastMedicalDatabase:
         print("Database not populated. Please run expand_medical_db.py first!")
         return
     
-    def search_terms(self, text: str, limit: int = 100) -> List[Tuple[str, str, str]]:
-        """Fast search for medical terms in text"""
+    def search_terms(self, text: str, limit: int = 100,
+                     categories: Optional[Iterable[str]] = None) -> List[Tuple[str, str, str]]:
+        """Fast search for medical terms in text
+
+        categories restricts the search to those term categories; the filter is part
+        of the query, so the limit counts only terms of the requested categories.
+        """
+        return [(term, category, source_db)
+                for term, category, source_db, _ in self.search_ranked_terms(text, limit, categories)]
+    
+    def search_ranked_terms(self, text: str, limit: Optional[int] = 100,
+                            categories: Optional[Iterable[str]] = None) -> List[Tuple[str, str, str, Tuple]]:
+        """search_terms with each term's rank: a sort key giving the same order in any search
+
+        Terms rank longest first, then by confidence, then by their first row in the
+        dictionary (the order ties came out in), so hits from separate searches can be
+        merged back into the order of a single search. limit=None returns every term.
+        """
+        return self._ranked_terms("? LIKE '%' || term_lower || '%'", [text.lower()], limit, categories)
+    
+    def boundary_terms(self, categories: Optional[Iterable[str]] = None) -> List[Tuple[str, str, str, Tuple]]:
+        """Ranked terms containing sentence punctuation or a line break, or with surrounding whitespace
+
+        Only these can match across a sentence boundary.
+        """
+        return self._ranked_terms("(term GLOB '*[.!?]*' OR instr(term, char(10)) OR instr(term, char(13)) "
+                                  "OR term != trim(term))", [], None, categories)
+    
+    def _ranked_terms(self, condition: str, params: List[Any], limit: Optional[int],
+                      categories: Optional[Iterable[str]]) -> List[Tuple[str, str, str, Tuple]]:
         if not self.conn:
             return []
         
-        # Split text into words for searching
-        words = text.lower().split()
-        results = []
-        
-        # Search for exact matches and partial matches
         cursor = self.conn.cursor()
+        category_filter = ""
+        params = list(params)
+        if categories is not None:
+            categories = sorted(categories)
+            category_filter = f"AND category IN ({', '.join('?' * len(categories))})"
+            params.extend(categories)
         
-        # First, search for exact phrase matches
-        cursor.execute("""
-            SELECT DISTINCT term, category, source_db, confidence
+        cursor.execute(f"""
+            SELECT term, category, source_db, confidence, MIN(id)
             FROM medical_terms 
-            WHERE ? LIKE '%' || term_lower || '%'
-            ORDER BY LENGTH(term) DESC, confidence DESC
+            WHERE {condition} {category_filter}
+            GROUP BY term, category, source_db, confidence
+            ORDER BY LENGTH(term) DESC, confidence DESC, MIN(id)
             LIMIT ?
-        """, (text.lower(), limit))
+        """, (*params, -1 if limit is None else limit))
         
-        for row in cursor.fetchall():
-            results.append((row[0], row[1], row[2]))
-        
-        return results[:limit]
+        return [(term, category, source_db, (-len(term), -(confidence or 0), first_id))
+                for term, category, source_db, confidence, first_id in cursor.fetchall()]
+    
+    def get_dictionary_version(self) -> str:
+        """Version tag for the term dictionary - changes whenever medical_terms is modified"""
+        # data_version only moves when another connection commits, so the
+        # COUNT/MAX query runs once per change rather than once per call
+        data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if self._version_cache is None or self._version_cache[0] != data_version:
+            total, max_id = self.conn.execute("SELECT COUNT(*), MAX(id) FROM medical_terms").fetchone()
+            self._version_cache = (data_version, f"{total}:{max_id or 0}")
+        return self._version_cache[1]
     
     def get_database_stats(self) -> Dict[str, Any]:
         """Get database statistics"""
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+FHIR Bulk Export - patients, documents and analysis findings as NDJSON FHIR R4 resources
+One resource per line, grouped by type in FHIR_RESOURCE_TYPES order:
+
+    Patient               from patients
+    DocumentReference     from patient_documents
+    Observation           from the measurements of each document's analysis
+    Condition             from the conditions the analysis found (verificationStatus unconfirmed)
+    MedicationStatement   from the medications the analysis found (status unknown)
+
+Rows are read in short keyset batches (key > last key ... LIMIT EXPORT_BATCH_SIZE)
+rather than through one long-running statement: an open statement keeps the
+database's read lock while a slow client downloads, and that would block every
+writer until the export finished. Memory stays at one batch whatever the size of
+the export, and only the analysis JSON paths a resource needs are extracted in
+SQL (never the extracted text).
+
+An incremental export (since) returns patients updated, documents uploaded or
+analyzed, and findings of analyses made at or after that time. Timestamps are
+the database's CURRENT_TIMESTAMP values, which are UTC and have one-second
+precision: the comparison is inclusive so that a change made in the same second
+as the previous export's transaction time is not lost, at the cost of sending
+again what changed in that second.
+"""
+import json
+import zlib
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from cohort_index import normalize_entity
+from lab_values import ANALYTES
+
+FHIR_RESOURCE_TYPES = ("Patient", "DocumentReference", "Observation", "Condition", "MedicationStatement")
+EXPORT_BATCH_SIZE = 500
+GZIP_LEVEL = 6
+
+OBSERVATION_CATEGORY_SYSTEM = "http://terminology.hl7.org/CodeSystem/observation-category"
+INTERPRETATION_SYSTEM = "http://terminology.hl7.org/CodeSystem/v3-ObservationInterpretation"
+CONDITION_VERIFICATION_SYSTEM = "http://terminology.hl7.org/CodeSystem/condition-ver-status"
+LOINC_SYSTEM = "http://loinc.org"
+
+# LOINC codes of the analytes lab_values.py extracts (analytes without one are exported with code.text only)
+LOINC_CODES = {
+    "glucose": ("2345-7", "Glucose [Mass/volume] in Serum or Plasma"),
+    "hba1c": ("4548-4", "Hemoglobin A1c/Hemoglobin.total in Blood"),
+    "creatinine": ("2160-0", "Creatinine [Mass/volume] in Serum or Plasma"),
+    "bun": ("3094-0", "Urea nitrogen [Mass/volume] in Serum or Plasma"),
+    "sodium": ("2951-2", "Sodium [Moles/volume] in Serum or Plasma"),
+    "potassium": ("2823-3", "Potassium [Moles/volume] in Serum or Plasma"),
+    "chloride": ("2075-0", "Chloride [Moles/volume] in Serum or Plasma"),
+    "total_cholesterol": ("2093-3", "Cholesterol [Mass/volume] in Serum or Plasma"),
+    "hdl": ("2085-9", "Cholesterol in HDL [Mass/volume] in Serum or Plasma"),
+    "ldl": ("2089-1", "Cholesterol in LDL [Mass/volume] in Serum or Plasma"),
+    "triglycerides": ("2571-8", "Triglyceride [Mass/volume] in Serum or Plasma"),
+    "hemoglobin": ("718-7", "Hemoglobin [Mass/volume] in Blood"),
+    "hematocrit": ("4544-3", "Hematocrit [Volume Fraction] of Blood by Automated count"),
+    "wbc": ("6690-2", "Leukocytes [#/volume] in Blood by Automated count"),
+    "platelets": ("777-3", "Platelets [#/volume] in Blood by Automated count"),
+    "alt": ("1742-6", "Alanine aminotransferase [Enzymatic activity/volume] in Serum or Plasma"),
+    "ast": ("1920-8", "Aspartate aminotransferase [Enzymatic activity/volume] in Serum or Plasma"),
+    "bilirubin": ("1975-2", "Bilirubin.total [Mass/volume] in Serum or Plasma"),
+    "albumin": ("1751-7", "Albumin [Mass/volume] in Serum or Plasma"),
+    "tsh": ("3016-3", "Thyrotropin [Units/volume] in Serum or Plasma"),
+    "crp": ("1988-5", "C reactive protein [Mass/volume] in Serum or Plasma"),
+    "systolic_bp": ("8480-6", "Systolic blood pressure"),
+    "diastolic_bp": ("8462-4", "Diastolic blood pressure"),
+    "heart_rate": ("8867-4", "Heart rate"),
+    "respiratory_rate": ("9279-1", "Respiratory rate"),
+    "temperature": ("8310-5", "Body temperature"),
+    "spo2": ("59408-5", "Oxygen saturation in Arterial blood by Pulse oximetry"),
+    "weight": ("29463-7", "Body weight"),
+    "height": ("8302-2", "Body height"),
+    "bmi": ("39156-5", "Body mass index (BMI) [Ratio]")
+}
+
+INTERPRETATIONS = {
+    "high": ("H", "High"),
+    "low": ("L", "Low"),
+    "normal": ("N", "Normal")
+}
+
+PATIENT_GENDERS = ("male", "female", "other", "unknown")
+
+# Where each finding type comes from in analysis_results.results
+FINDING_PATHS = {
+    "Observation": "$.measurements",
+    "Condition": "$.categorized_entities.conditions",
+    "MedicationStatement": "$.categorized_entities.medications"
+}
+
+def parse_since(value: str) -> str:
+    """A FHIR instant or date ("2025-03-01T00:00:00Z", "2025-03-01") as a UTC database timestamp"""
+    try:
+        moment = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    except ValueError:
+        raise ValueError("_since must be an ISO 8601 instant, e.g. 2025-03-01T00:00:00Z")
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment.strftime("%Y-%m-%d %H:%M:%S")
+
+def fhir_instant(timestamp: Optional[str]) -> Optional[str]:
+    """A database timestamp (UTC) as a FHIR instant"""
+    if not timestamp:
+        return None
+    return timestamp.replace(" ", "T")[:19] + "Z"
+
+def fhir_id(*parts: Any) -> str:
+    """Resource id from parts; FHIR ids only allow letters, digits, '-' and '.'"""
+    return "-".join(str(part) for part in parts).replace("_", "-")
+
+def reference(resource_type: str, resource_id: str) -> Dict[str, str]:
+    return {"reference": f"{resource_type}/{resource_id}"}
+
+def patient_resource(row) -> Dict[str, Any]:
+    patient_id, name, date_of_birth, updated_at, metadata = row
+    metadata = json.loads(metadata) if metadata else {}
+    resource = {
+        "resourceType": "Patient",
+        "id": patient_id,
+        "meta": {"lastUpdated": fhir_instant(updated_at)},
+        "name": [{"text": name}]
+    }
+    if date_of_birth:
+        resource["birthDate"] = date_of_birth
+    gender = str(metadata.get("gender", "")).lower() if isinstance(metadata, dict) else ""
+    if gender in PATIENT_GENDERS:
+        resource["gender"] = gender
+    return resource
+
+def document_reference(row) -> Dict[str, Any]:
+    document_id, patient_id, name, file_type, file_size, file_path, uploaded_at, analyzed_at, directory = row
+    resource = {
+        "resourceType": "DocumentReference",
+        "id": document_id,
+        "meta": {"lastUpdated": fhir_instant(max(filter(None, (uploaded_at, analyzed_at))))},
+        "status": "current",
+        "docStatus": "final" if analyzed_at else "preliminary",
+        "subject": reference("Patient", patient_id),
+        "date": fhir_instant(uploaded_at),
+        "description": name,
+        "content": [{
+            "attachment": {
+                "contentType": file_type,
+                "url": f"/{file_path}",
+                "size": file_size,
+                "title": name,
+                "creation": fhir_instant(uploaded_at)
+            }
+        }]
+    }
+    if directory:
+        resource["category"] = [{"text": directory}]
+    return resource
+
+def observation_resources(analysis_id: int, document_id: str, patient_id: str, uploaded_at: str,
+                          analyzed_at: str, measurements: List[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    for m in measurements:
+        label = ANALYTES[m["analyte"]][0] if m["analyte"] in ANALYTES else m.get("label")
+        code = {"text": m["analyte"].replace("_", " ")}
+        if m["analyte"] in LOINC_CODES:
+            loinc, display = LOINC_CODES[m["analyte"]]
+            code["coding"] = [{"system": LOINC_SYSTEM, "code": loinc, "display": display}]
+        category = "vital-signs" if label == "VITAL_SIGNS" else "laboratory"
+        resource = {
+            "resourceType": "Observation",
+            "id": fhir_id(analysis_id, m["start"], m["analyte"]),
+            "meta": {"lastUpdated": fhir_instant(analyzed_at)},
+            "status": "final",
+            "category": [{"coding": [{"system": OBSERVATION_CATEGORY_SYSTEM, "code": category}]}],
+            "code": code,
+            "subject": reference("Patient", patient_id),
+            "effectiveDateTime": fhir_instant(uploaded_at),
+            "valueQuantity": {"value": m["value"], "unit": m["unit"]},
+            "derivedFrom": [reference("DocumentReference", document_id)],
+            "note": [{"text": m["text"]}]
+        }
+        if m.get("flag") in INTERPRETATIONS:
+            interpretation, display = INTERPRETATIONS[m["flag"]]
+            resource["interpretation"] = [{"coding": [{"system": INTERPRETATION_SYSTEM, "code": interpretation,
+                                                       "display": display}]}]
+        bounds = {bound: {"value": value, "unit": m["unit"]}
+                  for bound, value in (m.get("reference_range") or {}).items() if value is not None}
+        if bounds:
+            resource["referenceRange"] = [bounds]
+        yield resource
+
+def _distinct_entities(entities: List[Dict[str, Any]]) -> List[str]:
+    """Display names of the distinct entities, in document order"""
+    names = {}
+    for entity in entities:
+        norm = normalize_entity(entity.get("text", ""))
+        if norm and norm not in names:
+            names[norm] = entity["text"].strip()
+    return list(names.values())
+
+def condition_resources(analysis_id: int, document_id: str, patient_id: str, uploaded_at: str,
+                        analyzed_at: str, conditions: List[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    for n, name in enumerate(_distinct_entities(conditions)):
+        yield {
+            "resourceType": "Condition",
+            "id": fhir_id(analysis_id, n),
+            "meta": {"lastUpdated": fhir_instant(analyzed_at)},
+            "verificationStatus": {"coding": [{"system": CONDITION_VERIFICATION_SYSTEM, "code": "unconfirmed"}]},
+            "code": {"text": name},
+            "subject": reference("Patient", patient_id),
+            "recordedDate": fhir_instant(uploaded_at),
+            "evidence": [{"detail": [reference("DocumentReference", document_id)]}]
+        }
+
+def medication_statement_resources(analysis_id: int, document_id: str, patient_id: str, uploaded_at: str,
+                                   analyzed_at: str, medications: List[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    for n, name in enumerate(_distinct_entities(medications)):
+        yield {
+            "resourceType": "MedicationStatement",
+            "id": fhir_id(analysis_id, n),
+            "meta": {"lastUpdated": fhir_instant(analyzed_at)},
+            "status": "unknown",
+            "medicationCodeableConcept": {"text": name},
+            "subject": reference("Patient", patient_id),
+            "dateAsserted": fhir_instant(uploaded_at),
+            "derivedFrom": [reference("DocumentReference", document_id)]
+        }
+
+FINDING_BUILDERS = {
+    "Observation": observation_resources,
+    "Condition": condition_resources,
+    "MedicationStatement": medication_statement_resources
+}
+
+def keyset_batches(cursor, sql: str, params: List[Any], batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[List[Tuple]]:
+    """Rows of sql in batches, one short query each
+
+    sql selects the integer key first and ends with "key > ? ORDER BY key LIMIT ?".
+    """
+    last_key = -1
+    while True:
+        cursor.execute(sql, params + [last_key, batch_size])
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        yield rows
+        if len(rows) < batch_size:
+            return
+        last_key = rows[-1][0]
+
+def _filters(conditions: List[Tuple[str, Any]]) -> Tuple[str, List[Any]]:
+    """WHERE terms for the conditions whose value is set, ending ready for the keyset term"""
+    used = [(condition, value) for condition, value in conditions if value is not None]
+    return "".join(f"{condition} AND " for condition, _ in used), [value for _, value in used]
+
+def _ndjson(resources) -> bytes:
+    return "".join(json.dumps(resource, separators=(",", ":")) + "\n" for resource in resources).encode()
+
+def export_patients(cursor, since: Optional[str], patient_id: Optional[str]) -> Iterator[bytes]:
+    where, params = _filters([("updated_at >= ?", since), ("id = ?", patient_id)])
+    for rows in keyset_batches(cursor, f'''
+        SELECT rowid, id, name, date_of_birth, updated_at, metadata FROM patients
+        WHERE {where}rowid > ? ORDER BY rowid LIMIT ?
+    ''', params):
+        yield _ndjson(patient_resource(row[1:]) for row in rows)
+
+def export_documents(cursor, since: Optional[str], patient_id: Optional[str]) -> Iterator[bytes]:
+    # A document changes when it is uploaded and again when its analysis is stored
+    where, params = _filters([("MAX(pd.uploaded_at, COALESCE(ar.created_at, '')) >= ?", since),
+                              ("pd.patient_id = ?", patient_id)])
+    for rows in keyset_batches(cursor, f'''
+        SELECT pd.rowid, pd.id, pd.patient_id, pd.name, pd.file_type, pd.file_size, pd.file_path,
+               pd.uploaded_at, ar.created_at, d.name
+        FROM patient_documents pd
+        LEFT JOIN analysis_results ar ON ar.id = pd.analysis_id
+        LEFT JOIN directories d ON d.id = pd.directory_id
+        WHERE {where}pd.rowid > ? ORDER BY pd.rowid LIMIT ?
+    ''', params):
+        yield _ndjson(document_reference(row[1:]) for row in rows)
+
+def export_findings(cursor, resource_type: str, since: Optional[str], patient_id: Optional[str]) -> Iterator[bytes]:
+    """Observations, Conditions or MedicationStatements of every analyzed document"""
+    where, params = _filters([("ar.created_at >= ?", since), ("pd.patient_id = ?", patient_id)])
+    build = FINDING_BUILDERS[resource_type]
+    for rows in keyset_batches(cursor, f'''
+        SELECT pd.analysis_id, pd.id, pd.patient_id, pd.uploaded_at, ar.created_at,
+               json_extract(ar.results, '{FINDING_PATHS[resource_type]}')
+        FROM patient_documents pd
+        JOIN analysis_results ar ON ar.id = pd.analysis_id
+        WHERE {where}json_valid(ar.results) AND pd.analysis_id > ? ORDER BY pd.analysis_id LIMIT ?
+    ''', params):
+        yield _ndjson(resource for row in rows if row[5]
+                      for resource in build(*row[:5], json.loads(row[5])))
+
+def export_resources(conn, resource_types: List[str], since: Optional[str] = None,
+                     patient_id: Optional[str] = None) -> Iterator[bytes]:
+    """NDJSON of the requested resource types, a batch of resources per chunk"""
+    try:
+        cursor = conn.cursor()
+        for resource_type in FHIR_RESOURCE_TYPES:
+            if resource_type not in resource_types:
+                continue
+            if resource_type == "Patient":
+                chunks = export_patients(cursor, since, patient_id)
+            elif resource_type == "DocumentReference":
+                chunks = export_documents(cursor, since, patient_id)
+            else:
+                chunks = export_findings(cursor, resource_type, since, patient_id)
+            for chunk in chunks:
+                if chunk:
+                    yield chunk
+    finally:
+        conn.close()
+
+def gzip_stream(chunks: Iterator[bytes], level: int = GZIP_LEVEL) -> Iterator[bytes]:
+    """Compress a chunk stream into one gzip member as it goes"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+"""
+HL7 v2 Listener - MLLP server feeding lab, document and ADT messages into X-NOSIS
+Interface engines send HL7 v2 messages framed by MLLP (<VT> message <FS><CR>) over
+long-lived TCP connections. Each connection's bytes go through an incremental
+framer, every complete message is parsed as it arrives, and the parsed messages
+of all connections are stored together:
+
+    ORU (lab results)       -> a Lab Reports document with one line per OBX result
+    MDM (clinical document) -> a Clinical Notes document with the TX/FT report text
+    ADT (admit / update)    -> patient demographics only
+
+Patients are matched on their PID-3 identifier and assigning authority
+(hl7_patient_ids) and created on first sight. Documents are queued for analysis
+like uploads.
+
+Storing is group committed: while one batch is being written, newly arrived
+messages wait and become the next batch (up to HL7_BATCH_SIZE), so a busy feed
+costs one transaction per batch instead of one per message, and an idle feed is
+written immediately. An ACK (AA) is only sent once its message is committed; a
+message that cannot be parsed is rejected (AR) and one that fails to store is
+answered AE so the sender retries. ACKs go out in the order the messages came in
+on their connection. A message re-sent with the same MSH-10 control id (its ACK
+was lost) is acknowledged again without storing it twice.
+
+Run from the backend directory: python hl7_listener.py [--host 0.0.0.0] [--port 2575]
+(analysis then runs in analysis_worker.py processes or an API started with workers)
+"""
+import asyncio
+import logging
+import re
+import uuid
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+MLLP_START = b"\x0b"
+MLLP_END = b"\x1c\x0d"
+MAX_MESSAGE_BYTES = 16 * 1024 * 1024
+DEFAULT_HL7_PORT = 2575
+HL7_BATCH_SIZE = 500            # Messages per transaction at most
+
+SUPPORTED_MESSAGE_TYPES = ("ORU", "MDM", "ADT")
+# HL7 table 0357 error codes used in ERR-3
+ERROR_CODES = {
+    "segment": ("100", "Segment sequence error"),
+    "required": ("101", "Required field missing"),
+    "unsupported": ("200", "Unsupported message type"),
+    "internal": ("207", "Application internal error")
+}
+PATIENT_GENDERS = {"M": "male", "F": "female", "O": "other", "U": "unknown", "A": "other"}
+ABNORMAL_FLAGS = {"H": "high", "HH": "critically high", "L": "low", "LL": "critically low", "A": "abnormal",
+                  "AA": "critically abnormal", "N": "normal"}
+TEXT_VALUE_TYPES = ("TX", "FT", "ST", "CE", "CWE")
+
+class HL7Error(Exception):
+    """A message that is rejected (AR) rather than stored"""
+
+    def __init__(self, message: str, error: str = "segment"):
+        super().__init__(message)
+        self.error = error
+
+class MLLPFramer:
+    """Incremental MLLP decoder: feed it bytes as they arrive, get back complete messages"""
+
+    def __init__(self, max_bytes: int = MAX_MESSAGE_BYTES):
+        self.buffer = bytearray()
+        self.max_bytes = max_bytes
+
+    def feed(self, data: bytes) -> List[bytes]:
+        self.buffer += data
+        messages = []
+        while True:
+            start = self.buffer.find(MLLP_START)
+            if start < 0:
+                self.buffer.clear()   # Noise between frames
+                return messages
+            end = self.buffer.find(MLLP_END, start + 1)
+            if end < 0:
+                if start:
+                    del self.buffer[:start]
+                if len(self.buffer) > self.max_bytes:
+                    raise ValueError(f"MLLP frame exceeds {self.max_bytes} bytes")
+                return messages
+            messages.append(bytes(self.buffer[start + 1:end]))
+            del self.buffer[:end + len(MLLP_END)]
+
+def frame(message: bytes) -> bytes:
+    return MLLP_START + message + MLLP_END
+
+_ESCAPES = re.compile(r"\\(F|S|T|R|E|\.br|X[0-9A-Fa-f]*|H|N)\\")
+
+class HL7Message:
+    """One HL7 v2 message split into segments and fields, with its own delimiters from MSH"""
+
+    def __init__(self, raw: bytes):
+        text = raw.decode("utf-8", errors="replace")
+        if not text.startswith("MSH") or len(text) < 8:
+            raise HL7Error("Message does not start with an MSH segment")
+        self.field_sep = text[3]
+        encoding = text[4:8]
+        self.component_sep, self.repetition_sep, self.escape_char, self.subcomponent_sep = encoding
+        self.segments: List[Tuple[str, List[str]]] = []
+        for line in re.split(r"\r\n|\r|\n", text):
+            if line:
+                fields = line.split(self.field_sep)
+                if fields[0] == "MSH":
+                    # MSH-1 is the field separator itself, so MSH-n is fields[n] like every other segment
+                    fields.insert(1, self.field_sep)
+                self.segments.append((fields[0], fields))
+
+    def all(self, name: str) -> List[List[str]]:
+        return [fields for segment, fields in self.segments if segment == name]
+
+    def first(self, name: str) -> Optional[List[str]]:
+        return next((fields for segment, fields in self.segments if segment == name), None)
+
+    def field(self, fields: Optional[List[str]], n: int, component: int = 1, repetition: int = 0) -> str:
+        """Field n (1-based) of a segment, one component of one repetition, unescaped"""
+        if not fields or n >= len(fields):
+            return ""
+        repetitions = fields[n].split(self.repetition_sep)
+        if repetition >= len(repetitions):
+            return ""
+        components = repetitions[repetition].split(self.component_sep)
+        return self.unescape(components[component - 1]) if component <= len(components) else ""
+
+    def unescape(self, value: str) -> str:
+        if self.escape_char not in value:
+            return value
+        replacements = {"F": self.field_sep, "S": self.component_sep, "T": self.subcomponent_sep,
+                        "R": self.repetition_sep, "E": self.escape_char, ".br": "\n", "H": "", "N": ""}
+        pattern = _ESCAPES if self.escape_char == "\\" else re.compile(
+            re.escape(self.escape_char) + r"(F|S|T|R|E|\.br|X[0-9A-Fa-f]*|H|N)" + re.escape(self.escape_char))
+
+        def replace(match):
+            code = match.group(1)
+            if code.startswith("X"):
+                try:
+                    return bytes.fromhex(code[1:]).decode("latin-1")
+                except ValueError:
+                    return ""
+            return replacements[code]
+        return pattern.sub(replace, value)
+
+def hl7_date(value: str) -> Optional[str]:
+    """YYYYMMDD[HHMM[SS]] as YYYY-MM-DD, None if it is not a valid date"""
+    try:
+        return datetime.strptime(value[:8], "%Y%m%d").strftime("%Y-%m-%d")
+    except ValueError:
+        return None
+
+def hl7_datetime(value: str) -> Optional[str]:
+    """YYYYMMDD[HHMM[SS]][+ZZZZ] as YYYY-MM-DD HH:MM, the date alone if no time is given"""
+    date = hl7_date(value)
+    digits = re.match(r"\d*", value).group()
+    if date is None or len(digits) < 12:
+        return date
+    return f"{date} {digits[8:10]}:{digits[10:12]}"
+
+def _patient(message: HL7Message, sending_facility: str) -> Dict[str, Any]:
+    pid = message.first("PID")
+    if pid is None:
+        raise HL7Error("PID segment missing", "required")
+    identifier = message.field(pid, 3)
+    if not identifier:
+        raise HL7Error("PID-3 patient identifier missing", "required")
+    family, given, middle = (message.field(pid, 5, n) for n in (1, 2, 3))
+    # name, date_of_birth and gender are None when the message does not carry them
+    name = " ".join(part for part in (given, middle, family) if part)
+    return {
+        "identifier": identifier,
+        "authority": message.field(pid, 3, 4) or sending_facility,
+        "name": name[:100] or None,
+        "date_of_birth": hl7_date(message.field(pid, 7)),
+        "gender": PATIENT_GENDERS.get(message.field(pid, 8).upper())
+    }
+
+def _result_line(message: HL7Message, obx: List[str]) -> str:
+    """One OBX as a line of text ("Glucose: 182 mg/dL (reference 70-99) high")"""
+    name = message.field(obx, 3, 2) or message.field(obx, 3, 1)
+    value_type = message.field(obx, 2)
+    repetitions = len(obx[5].split(message.repetition_sep)) if len(obx) > 5 else 0
+    values = []
+    for n in range(repetitions):
+        if value_type in ("CE", "CWE"):
+            # Coded values: the text component, the code if there is no text
+            values.append(message.field(obx, 5, 2, n) or message.field(obx, 5, 1, n))
+        else:
+            values.append(message.field(obx, 5, 1, n))
+    value = ("\n" if value_type in ("TX", "FT") else " ").join(v for v in values if v)
+    if value_type in ("TX", "FT") or not name:
+        return value
+    line = f"{name}: {value}"
+    units = message.field(obx, 6)
+    if units:
+        line += f" {units}"
+    reference_range = message.field(obx, 7)
+    if reference_range:
+        line += f" (reference {reference_range})"
+    flag = ABNORMAL_FLAGS.get(message.field(obx, 8).upper())
+    if flag and flag != "normal":
+        line += f" {flag}"
+    return line
+
+def _notes(message: HL7Message) -> List[str]:
+    return [message.field(nte, 3) for nte in message.all("NTE") if message.field(nte, 3)]
+
+def _lab_document(message: HL7Message) -> Dict[str, Any]:
+    obr = message.first("OBR")
+    title = message.field(obr, 4, 2) or message.field(obr, 4, 1) or "Lab results"
+    observed_at = hl7_datetime(message.field(obr, 7)) or hl7_datetime(message.field(message.first("MSH"), 7))
+    lines = [f"{title} ({observed_at})" if observed_at else title]
+    for obx in message.all("OBX"):
+        line = _result_line(message, obx)
+        if line:
+            lines.append(line)
+    if len(lines) == 1:
+        raise HL7Error("ORU message has no OBX results", "required")
+    lines.extend(_notes(message))
+    return {"title": title, "directory": "Lab Reports", "observed_at": observed_at, "text": "\n".join(lines)}
+
+def _clinical_document(message: HL7Message) -> Dict[str, Any]:
+    txa = message.first("TXA")
+    if txa is None:
+        raise HL7Error("TXA segment missing", "required")
+    title = message.field(txa, 2, 2) or message.field(txa, 2, 1) or "Clinical document"
+    observed_at = hl7_datetime(message.field(txa, 4)) or hl7_datetime(message.field(message.first("MSH"), 7))
+    lines = [_result_line(message, obx) for obx in message.all("OBX")]
+    text = "\n".join(line for line in lines + _notes(message) if line)
+    if not text:
+        raise HL7Error("MDM message has no document text in OBX", "required")
+    return {"title": title, "directory": "Clinical Notes", "observed_at": observed_at, "text": text}
+
+def parse_message(raw: bytes) -> Dict[str, Any]:
+    """The parts of an ORU, MDM or ADT message X-NOSIS stores; raises HL7Error to reject it"""
+    message = HL7Message(raw)
+    msh = message.first("MSH")
+    message_type = message.field(msh, 9, 1)
+    parsed = {
+        "control_id": message.field(msh, 10),
+        "message_type": message_type,
+        "trigger": message.field(msh, 9, 2),
+        "sending_application": message.field(msh, 3),
+        "sending_facility": message.field(msh, 4),
+        "version": message.field(msh, 12) or "2.5.1",
+        "document": None
+    }
+    if not parsed["control_id"]:
+        raise HL7Error("MSH-10 message control id missing", "required")
+    if message_type not in SUPPORTED_MESSAGE_TYPES:
+        raise HL7Error(f"Unsupported message type {message_type or '(none)'}", "unsupported")
+    parsed["patient"] = _patient(message, parsed["sending_facility"])
+    if message_type == "ORU":
+        parsed["document"] = _lab_document(message)
+    elif message_type == "MDM":
+        parsed["document"] = _clinical_document(message)
+    return parsed
+
+def ack_message(raw_or_parsed: Any, code: str, text: str = "", error: Optional[str] = None) -> bytes:
+    """ACK for a message: AA accepted, AE application error (send again), AR rejected"""
+    if isinstance(raw_or_parsed, dict):
+        header = raw_or_parsed
+    else:
+        # A rejected message: echo what can still be read from its MSH
+        try:
+            message = HL7Message(raw_or_parsed)
+            msh = message.first("MSH")
+            header = {"control_id": message.field(msh, 10), "trigger": message.field(msh, 9, 2),
+                      "sending_application": message.field(msh, 3), "sending_facility": message.field(msh, 4),
+                      "version": message.field(msh, 12) or "2.5.1"}
+        except HL7Error:
+            header = {"control_id": "", "trigger": "", "sending_application": "", "sending_facility": "",
+                      "version": "2.5.1"}
+    segments = [
+        "|".join(["MSH", "^~\\&", "XNOSIS", "XNOSIS", header["sending_application"], header["sending_facility"],
+                  datetime.now().strftime("%Y%m%d%H%M%S"), "", f"ACK^{header['trigger']}^ACK",
+                  uuid.uuid4().hex[:20], "P", header["version"]]),
+        "|".join(["MSA", code, header["control_id"], text.replace("|", " ")[:80]])
+    ]
+    if error:
+        error_code, error_text = ERROR_CODES[error]
+        segments.append("|".join(["ERR", "", "", f"{error_code}^{error_text}^HL70357", "E"]))
+    return ("\r".join(segments) + "\r").encode()
+
+def ack_code(ack: bytes) -> str:
+    """MSA-1 of an ACK (what a sender checks)"""
+    for segment in ack.split(b"\r"):
+        if segment.startswith(b"MSA|"):
+            return segment.split(b"|")[1].decode()
+    return ""
+
+def create_hl7_tables(cursor):
+    """Patient identifiers per assigning authority, and every stored message by control id"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS hl7_patient_ids (
+            authority TEXT NOT NULL,
+            identifier TEXT NOT NULL,
+            patient_id TEXT NOT NULL,
+            PRIMARY KEY (authority, identifier)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_hl7_patient_ids_patient ON hl7_patient_ids(patient_id)')
+    # A deleted patient's identifiers create a new patient on the next message
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_patients_delete_hl7_ids
+        AFTER DELETE ON patients
+        BEGIN
+            DELETE FROM hl7_patient_ids WHERE patient_id = OLD.id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS hl7_messages (
+            sending_facility TEXT NOT NULL,
+            control_id TEXT NOT NULL,
+            message_type TEXT NOT NULL,
+            patient_id TEXT NOT NULL,
+            document_id TEXT,
+            job_id INTEGER,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (sending_facility, control_id)
+        ) WITHOUT ROWID
+    ''')
+
+def stored_message(cursor, parsed: Dict[str, Any]) -> bool:
+    """True if a message with this facility and control id was stored before (a resend)"""
+    cursor.execute('SELECT 1 FROM hl7_messages WHERE sending_facility = ? AND control_id = ?',
+                   (parsed["sending_facility"], parsed["control_id"]))
+    return cursor.fetchone() is not None
+
+def find_hl7_patient(cursor, patient: Dict[str, Any]) -> Optional[str]:
+    cursor.execute('SELECT patient_id FROM hl7_patient_ids WHERE authority = ? AND identifier = ?',
+                   (patient["authority"], patient["identifier"]))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def record_hl7_patient(cursor, patient: Dict[str, Any], patient_id: str):
+    cursor.execute('INSERT INTO hl7_patient_ids (authority, identifier, patient_id) VALUES (?, ?, ?)',
+                   (patient["authority"], patient["identifier"], patient_id))
+
+def record_hl7_message(cursor, parsed: Dict[str, Any], patient_id: str, document_id: Optional[str] = None,
+                       job_id: Optional[int] = None):
+    cursor.execute('''
+        INSERT INTO hl7_messages (sending_facility, control_id, message_type, patient_id, document_id, job_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (parsed["sending_facility"], parsed["control_id"], f"{parsed['message_type']}^{parsed['trigger']}",
+          patient_id, document_id, job_id))
+
+def document_file_name(document: Dict[str, Any]) -> str:
+    """A .txt file name for a message's document ("Basic metabolic panel 2026-10-19.txt")"""
+    title = re.sub(r"[^\w\- ]+", "", document["title"]).strip()[:80] or "HL7 document"
+    date = (document["observed_at"] or "")[:10]
+    return f"{title} {date}.txt" if date else f"{title}.txt"
+
+# store(messages) writes a batch of parsed messages and returns an (ACK code, text) per message
+HL7Store = Callable[[List[Dict[str, Any]]], List[Tuple[str, str]]]
+
+class HL7Listener:
+    """asyncio MLLP server with group-committed storage and in-order ACKs per connection"""
+
+    def __init__(self, store: HL7Store, batch_size: int = HL7_BATCH_SIZE, notify: Optional[Callable[[], None]] = None):
+        self.store = store
+        self.batch_size = batch_size
+        self.notify = notify
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.pending: List[Tuple[Dict[str, Any], asyncio.Future]] = []
+        self.wakeup: Optional[asyncio.Event] = None
+        self.writer_task: Optional[asyncio.Task] = None
+        self.counts = {"connections": 0, "received": 0, "accepted": 0, "errors": 0, "rejected": 0, "batches": 0}
+
+    async def start(self, host: str = "0.0.0.0", port: int = DEFAULT_HL7_PORT) -> int:
+        """Start listening; returns the bound port (useful with port 0)"""
+        self.wakeup = asyncio.Event()
+        self.writer_task = asyncio.create_task(self._write_batches())
+        self.server = await asyncio.start_server(self._connection, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.writer_task:
+            self.writer_task.cancel()
+            try:
+                await self.writer_task
+            except asyncio.CancelledError:
+                pass
+        self.server = None
+        self.writer_task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.counts, "queued": len(self.pending), "listening": self.server is not None}
+
+    def submit(self, raw: bytes) -> asyncio.Future:
+        """Parse a message and queue it for storing; the future resolves to its ACK"""
+        future = asyncio.get_running_loop().create_future()
+        self.counts["received"] += 1
+        try:
+            parsed = parse_message(raw)
+        except HL7Error as e:
+            self.counts["rejected"] += 1
+            future.set_result(ack_message(raw, "AR", str(e), e.error))
+            return future
+        self.pending.append((parsed, future))
+        self.wakeup.set()
+        return future
+
+    async def _write_batches(self):
+        """Store queued messages, one batch per transaction, while any are waiting"""
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while self.pending:
+                batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+                messages = [parsed for parsed, _ in batch]
+                try:
+                    results = await asyncio.to_thread(self.store, messages)
+                except Exception as e:
+                    logging.error(f"Storing {len(batch)} HL7 messages failed: {str(e)}")
+                    results = [("AE", "Could not store the message, send it again")] * len(batch)
+                self.counts["batches"] += 1
+                for (parsed, future), (code, text) in zip(batch, results):
+                    self.counts["accepted" if code == "AA" else "errors"] += 1
+                    if not future.done():
+                        future.set_result(ack_message(parsed, code, text, None if code == "AA" else "internal"))
+                if self.notify:
+                    self.notify()
+
+    async def _connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.counts["connections"] += 1
+        acks: asyncio.Queue = asyncio.Queue()
+        sender = asyncio.create_task(self._send_acks(acks, writer))
+        framer = MLLPFramer()
+        try:
+            while data := await reader.read(65536):
+                for raw in framer.feed(data):
+                    acks.put_nowait(self.submit(raw))
+        except (ValueError, ConnectionError) as e:
+            logging.warning(f"HL7 connection dropped: {str(e)}")
+        finally:
+            acks.put_nowait(None)
+            await sender
+            writer.close()
+            self.counts["connections"] -= 1
+
+    async def _send_acks(self, acks: asyncio.Queue, writer: asyncio.StreamWriter):
+        """Write each message's ACK once it is ready, in arrival order"""
+        while (future := await acks.get()) is not None:
+            ack = await future
+            if writer.is_closing():
+                continue
+            writer.write(frame(ack))
+            if acks.empty():
+                try:
+                    await writer.drain()
+                except ConnectionError:
+                    pass
+
+if __name__ == "__main__":
+    import sys
+
+    from main import init_database, store_hl7_messages
+
+    logging.basicConfig(level=logging.INFO)
+    args = sys.argv[1:]
+    host = args[args.index("--host") + 1] if "--host" in args else "0.0.0.0"
+    port = int(args[args.index("--port") + 1]) if "--port" in args else DEFAULT_HL7_PORT
+
+    async def serve():
+        init_database()
+        listener = HL7Listener(store_hl7_messages)
+        bound = await listener.start(host, port)
+        print(f"🏥 HL7 MLLP listener on {host}:{bound}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await listener.stop()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        print("Stopping HL7 listener...")
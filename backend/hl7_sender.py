@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+HL7 Sender - a stand-in interface engine for load testing the MLLP listener
+Generates synthetic ORU^R01 lab results, MDM^T02 clinical notes and ADT^A08
+patient updates for a pool of patients and sends them over several MLLP
+connections. Each connection keeps up to `window` messages in flight (1 is the
+classic send / wait for ACK interface engine) and records the time to each ACK.
+
+Run from the backend directory:
+    python hl7_sender.py [--host localhost] [--port 2575] [--messages 10000] [--connections 4]
+                         [--window 32] [--patients 500]
+"""
+import asyncio
+import random
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+from hl7_listener import DEFAULT_HL7_PORT, MLLPFramer, ack_code, frame
+
+SENDING_FACILITY = "LOADTEST"
+FAMILY_NAMES = ["Smith", "Garcia", "Okafor", "Nguyen", "Kowalski", "Haddad", "Tanaka", "Silva", "Moreau", "Patel"]
+GIVEN_NAMES = ["Alex", "Maria", "Chen", "Amina", "Jonas", "Priya", "Luis", "Sofia", "Kwame", "Noor"]
+# (code, name, units, reference range, low, high)
+LAB_TESTS = [
+    ("2345-7", "Glucose", "mg/dL", "70-99", 60, 240),
+    ("4548-4", "Hemoglobin A1c", "%", "4.0-5.6", 4.5, 11.0),
+    ("2093-3", "Cholesterol", "mg/dL", "<200", 130, 300),
+    ("2160-0", "Creatinine", "mg/dL", "0.6-1.3", 0.5, 2.8),
+    ("718-7", "Hemoglobin", "g/dL", "12.0-17.5", 8.0, 18.0),
+    ("6690-2", "White blood cells", "10*3/uL", "4.5-11.0", 2.0, 18.0)
+]
+NOTE_SENTENCES = [
+    "Patient reports improved energy since the last visit.",
+    "Blood pressure remains elevated despite current medication.",
+    "Continue metformin 500 mg twice daily and review in three months.",
+    "No chest pain, shortness of breath or palpitations.",
+    "Advised a low sodium diet and regular walking.",
+    "Family history of type 2 diabetes and hypertension."
+]
+
+def _header(message_type: str, control_id: str, sent_at: datetime) -> str:
+    return "|".join(["MSH", "^~\\&", "LOADGEN", SENDING_FACILITY, "XNOSIS", "XNOSIS",
+                     sent_at.strftime("%Y%m%d%H%M%S"), "", message_type, control_id, "P", "2.5.1"])
+
+def _pid(rng: random.Random, patient: int) -> str:
+    family = FAMILY_NAMES[patient % len(FAMILY_NAMES)]
+    given = GIVEN_NAMES[(patient // len(FAMILY_NAMES)) % len(GIVEN_NAMES)]
+    born = datetime(1940, 1, 1) + timedelta(days=(patient * 7919) % 25000)
+    return "|".join(["PID", "1", "", f"MRN{patient:06d}^^^{SENDING_FACILITY}^MR", "", f"{family}^{given}",
+                     "", born.strftime("%Y%m%d"), "FM"[patient % 2]])
+
+def lab_result(rng: random.Random, control_id: str, patient: int, sent_at: datetime) -> str:
+    obx = []
+    for n, (code, name, units, reference, low, high) in enumerate(rng.sample(LAB_TESTS, rng.randint(2, 5)), 1):
+        value = round(rng.uniform(low, high), 1)
+        obx.append("|".join(["OBX", str(n), "NM", f"{code}^{name}^LN", "", str(value), units, reference,
+                             "", "", "", "F"]))
+    return "\r".join([
+        _header("ORU^R01^ORU_R01", control_id, sent_at), _pid(rng, patient),
+        "|".join(["OBR", "1", "", control_id, "24323-8^Comprehensive metabolic panel^LN", "", "",
+                  sent_at.strftime("%Y%m%d%H%M")]),
+        *obx
+    ]) + "\r"
+
+def clinical_note(rng: random.Random, control_id: str, patient: int, sent_at: datetime) -> str:
+    text = " ".join(rng.sample(NOTE_SENTENCES, 3))
+    return "\r".join([
+        _header("MDM^T02^MDM_T02", control_id, sent_at), _pid(rng, patient),
+        "|".join(["TXA", "1", "11506-3^Progress note^LN", "TX", sent_at.strftime("%Y%m%d%H%M")]),
+        "|".join(["OBX", "1", "TX", "11506-3^Progress note^LN", "", text, "", "", "", "", "", "F"])
+    ]) + "\r"
+
+def patient_update(rng: random.Random, control_id: str, patient: int, sent_at: datetime) -> str:
+    return "\r".join([
+        _header("ADT^A08^ADT_A01", control_id, sent_at), _pid(rng, patient),
+        "|".join(["PV1", "1", "O"])
+    ]) + "\r"
+
+def synthetic_messages(count: int, patients: int = 500, seed: int = 7) -> List[bytes]:
+    """count messages for `patients` patients: 60% lab results, 30% notes, 10% ADT updates"""
+    rng = random.Random(seed)
+    run = f"{seed}{int(time.time())}"
+    start = datetime.now() - timedelta(days=365)
+    messages = []
+    for n in range(count):
+        kind = rng.random()
+        build = lab_result if kind < 0.6 else clinical_note if kind < 0.9 else patient_update
+        sent_at = start + timedelta(minutes=n)
+        messages.append(build(rng, f"{run}-{n}", rng.randrange(patients), sent_at).encode())
+    return messages
+
+async def _send_connection(host: str, port: int, messages: List[bytes], window: int,
+                           latencies: List[float], codes: Counter):
+    reader, writer = await asyncio.open_connection(host, port)
+    sent_at: List[float] = []
+    in_flight = asyncio.Semaphore(window)
+    framer = MLLPFramer()
+
+    async def receive():
+        received = 0
+        while received < len(messages):
+            data = await reader.read(65536)
+            if not data:
+                raise ConnectionError(f"Listener closed the connection after {received} ACKs")
+            for ack in framer.feed(data):
+                latencies.append(time.perf_counter() - sent_at[received])
+                codes[ack_code(ack)] += 1
+                received += 1
+                in_flight.release()
+
+    receiver = asyncio.create_task(receive())
+    for message in messages:
+        await in_flight.acquire()
+        sent_at.append(time.perf_counter())
+        writer.write(frame(message))
+        await writer.drain()
+    await receiver
+    writer.close()
+
+async def send_messages(host: str, port: int, messages: List[bytes], connections: int = 4,
+                        window: int = 32) -> Dict[str, Any]:
+    """Send messages spread over the connections; returns throughput, ACK latencies and ACK codes"""
+    latencies: List[float] = []
+    codes: Counter = Counter()
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        _send_connection(host, port, messages[n::connections], window, latencies, codes)
+        for n in range(connections)
+    ))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "messages": len(messages),
+        "seconds": round(elapsed, 3),
+        "messages_per_second": round(len(messages) / elapsed, 1),
+        "ack_p50_ms": round(latencies[len(latencies) // 2] * 1000, 2),
+        "ack_p99_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 2),
+        "ack_codes": dict(codes)
+    }
+
+if __name__ == "__main__":
+    import sys
+
+    args = sys.argv[1:]
+
+    def option(name: str, default):
+        return type(default)(args[args.index(name) + 1]) if name in args else default
+
+    messages = synthetic_messages(option("--messages", 10000), option("--patients", 500))
+    result = asyncio.run(send_messages(option("--host", "localhost"), option("--port", DEFAULT_HL7_PORT), messages,
+                                       option("--connections", 4), option("--window", 32)))
+    print(f"📨 {result['messages']} messages in {result['seconds']}s "
+          f"({result['messages_per_second']} msg/s), ACK p50 {result['ack_p50_ms']} ms, "
+          f"p99 {result['ack_p99_ms']} ms, codes {result['ack_codes']}")
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+Analysis Job Queue - persistent SQLite-backed queue for patient document analysis
+An upload stores the file and the document row, enqueues a job in the same
+transaction and returns. Workers - threads of the API process and/or standalone
+analysis_worker.py processes on any host that sees the database - claim jobs with
+one atomic UPDATE ... RETURNING, run the handler (text extraction, analysis and
+indexing) and record the outcome.
+
+A claim is a lease: the job records its lease_owner and lease_expires_at, and a
+heartbeat thread keeps extending the leases its process holds. A job whose lease
+ran out (its worker crashed or hung) is claimed again by the next idle worker.
+Results commit only while the lease is still held, so a worker that lost its job
+discards its writes instead of racing the new owner. Failed jobs are retried with
+exponential backoff until max_attempts, then marked failed.
+
+Queued jobs are claimed in fair_tag order: the start-time fair queueing tags of
+analysis_scheduler.py, kept per (priority, patient) flow in job_flows with the
+virtual time in job_clock. An upload therefore goes ahead of a bulk backfill's
+backlog instead of behind it, and concurrent backfills of different patients
+interleave.
+
+Lease and retry times are Unix epoch seconds from the worker's clock; leases are
+long enough that ordinary clock skew between hosts does not matter.
+
+Every finished job takes the next completion_seq. Per-patient completion streams
+read jobs in that order, which is also what lets an SSE client resume from its
+Last-Event-ID.
+"""
+import logging
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from analysis_scheduler import PRIORITY_CLASSES, PRIORITY_WEIGHTS
+
+JOB_STATUSES = ("queued", "running", "completed", "failed")
+JOB_COLUMNS = ["id", "document_id", "patient_id", "directory_id", "file_path", "file_name", "file_type",
+               "status", "priority", "fair_tag", "analysis_id", "error", "attempts", "max_attempts", "next_attempt_at",
+               "lease_owner", "lease_expires_at", "heartbeat_at", "created_at", "started_at", "finished_at",
+               "completion_seq"]
+
+DEFAULT_WORKERS = 2
+IDLE_POLL_SECONDS = 1.0     # Idle workers re-check the table this often (a local enqueue also wakes them)
+LEASE_SECONDS = 60.0        # A claim is good for this long unless renewed
+HEARTBEAT_SECONDS = 15.0    # Held leases are renewed this often
+MAX_ATTEMPTS = 3            # Claims per job before it is marked failed
+RETRY_BASE_SECONDS = 5.0    # Backoff before retry n is RETRY_BASE_SECONDS * 2**(n-1), plus jitter
+RETRY_MAX_SECONDS = 600.0
+
+# Columns added after the first release of analysis_jobs
+ADDED_COLUMNS = {
+    "priority": "TEXT NOT NULL DEFAULT 'upload' CHECK(priority IN (%s))" % ", ".join(f"'{p}'" for p in PRIORITY_CLASSES),
+    "fair_tag": "REAL NOT NULL DEFAULT 0",
+    "max_attempts": f"INTEGER NOT NULL DEFAULT {MAX_ATTEMPTS}",
+    "next_attempt_at": "REAL NOT NULL DEFAULT 0",
+    "lease_owner": "TEXT",
+    "lease_expires_at": "REAL",
+    "heartbeat_at": "REAL"
+}
+
+class PermanentJobError(Exception):
+    """Raised by a handler for failures a retry cannot fix"""
+
+def create_job_tables(cursor) -> bool:
+    """Create (or migrate) analysis_jobs; returns True if it was created by this call"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'analysis_jobs'")
+    exists = cursor.fetchone() is not None
+
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS analysis_jobs (
+            id INTEGER PRIMARY KEY,
+            document_id TEXT NOT NULL,
+            patient_id TEXT NOT NULL,
+            directory_id TEXT NOT NULL,
+            file_path TEXT NOT NULL,
+            file_name TEXT NOT NULL,
+            file_type TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued' CHECK(status IN ({", ".join(f"'{s}'" for s in JOB_STATUSES)})),
+            analysis_id INTEGER,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            completion_seq INTEGER UNIQUE,
+            {", ".join(f"{column} {definition}" for column, definition in ADDED_COLUMNS.items())}
+        )
+    ''')
+    if exists:
+        cursor.execute('PRAGMA table_info(analysis_jobs)')
+        columns = {row[1] for row in cursor.fetchall()}
+        for column, definition in ADDED_COLUMNS.items():
+            if column not in columns:
+                cursor.execute(f'ALTER TABLE analysis_jobs ADD COLUMN {column} {definition}')
+        # Jobs a lease-less worker left running: expired leases, so they are claimed again
+        cursor.execute("UPDATE analysis_jobs SET lease_expires_at = 0 WHERE status = 'running' AND lease_expires_at IS NULL")
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS job_flows (
+            priority TEXT NOT NULL,
+            tenant TEXT NOT NULL,
+            finish_tag REAL NOT NULL,
+            PRIMARY KEY (priority, tenant)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS job_clock (
+            id INTEGER PRIMARY KEY CHECK(id = 1),
+            virtual_time REAL NOT NULL
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO job_clock (id, virtual_time) VALUES (1, 0)')
+
+    # Claiming ready jobs, reclaiming expired leases, document status lookups, per-patient completion streams
+    cursor.execute('DROP INDEX IF EXISTS idx_analysis_jobs_status')
+    cursor.execute('DROP INDEX IF EXISTS idx_analysis_jobs_queued')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_analysis_jobs_fair
+        ON analysis_jobs(status, fair_tag, id, next_attempt_at)
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_analysis_jobs_lease ON analysis_jobs(status, lease_expires_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_analysis_jobs_document ON analysis_jobs(document_id)')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_analysis_jobs_patient_completion
+        ON analysis_jobs(patient_id, completion_seq)
+    ''')
+    return not exists
+
+def fair_tag(cursor, priority: str, tenant: str, cost: float = 1.0) -> float:
+    """Start tag for the next job of a (priority, tenant) flow; advances the flow's finish tag"""
+    step = cost / PRIORITY_WEIGHTS[priority]
+    cursor.execute('''
+        INSERT INTO job_flows (priority, tenant, finish_tag)
+        VALUES (?, ?, (SELECT virtual_time FROM job_clock) + ?)
+        ON CONFLICT (priority, tenant) DO UPDATE
+        SET finish_tag = MAX(finish_tag, (SELECT virtual_time FROM job_clock)) + ?
+        RETURNING finish_tag
+    ''', (priority, tenant, step, step))
+    return cursor.fetchone()[0] - step
+
+def enqueue_document_job(cursor, document_id: str, patient_id: str, directory_id: str,
+                         file_path: str, file_name: str, file_type: str, priority: str = "upload") -> int:
+    """Queue analysis of a stored patient document; commits with the caller's transaction"""
+    cursor.execute('''
+        INSERT INTO analysis_jobs (document_id, patient_id, directory_id, file_path, file_name, file_type,
+                                   priority, fair_tag)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (document_id, patient_id, directory_id, file_path, file_name, file_type,
+          priority, fair_tag(cursor, priority, patient_id)))
+    return cursor.lastrowid
+
+def job_row(row) -> Dict[str, Any]:
+    return dict(zip(JOB_COLUMNS, row))
+
+def get_job(cursor, job_id: int) -> Optional[Dict[str, Any]]:
+    cursor.execute(f'SELECT {", ".join(JOB_COLUMNS)} FROM analysis_jobs WHERE id = ?', (job_id,))
+    row = cursor.fetchone()
+    return job_row(row) if row else None
+
+def finished_jobs(cursor, patient_id: str, after_seq: int = 0, limit: int = 100) -> List[Dict[str, Any]]:
+    """A patient's finished jobs with completion_seq > after_seq, in completion order"""
+    cursor.execute(f'''
+        SELECT {", ".join(JOB_COLUMNS)} FROM analysis_jobs
+        WHERE patient_id = ? AND completion_seq > ?
+        ORDER BY completion_seq
+        LIMIT ?
+    ''', (patient_id, after_seq, limit))
+    return [job_row(row) for row in cursor.fetchall()]
+
+def latest_completion_seq(cursor, patient_id: str) -> int:
+    cursor.execute('SELECT MAX(completion_seq) FROM analysis_jobs WHERE patient_id = ?', (patient_id,))
+    return cursor.fetchone()[0] or 0
+
+def job_counts(cursor) -> Dict[str, int]:
+    cursor.execute('SELECT status, COUNT(*) FROM analysis_jobs GROUP BY status')
+    counts = dict.fromkeys(JOB_STATUSES, 0)
+    counts.update(cursor.fetchall())
+    return counts
+
+def queued_by_priority(cursor) -> Dict[str, int]:
+    cursor.execute("SELECT priority, COUNT(*) FROM analysis_jobs WHERE status = 'queued' GROUP BY priority")
+    counts = dict.fromkeys(PRIORITY_CLASSES, 0)
+    counts.update(cursor.fetchall())
+    return counts
+
+def active_leases(cursor) -> List[Dict[str, Any]]:
+    """Running jobs by lease owner, with whether each lease has expired"""
+    cursor.execute('''
+        SELECT lease_owner, COUNT(*), MAX(heartbeat_at), SUM(lease_expires_at < ?)
+        FROM analysis_jobs INDEXED BY idx_analysis_jobs_lease
+        WHERE status = 'running'
+        GROUP BY lease_owner
+        ORDER BY lease_owner
+    ''', (time.time(),))
+    return [{
+        "owner": row[0],
+        "jobs": row[1],
+        "last_heartbeat_at": row[2],
+        "expired": row[3]
+    } for row in cursor.fetchall()]
+
+def retry_delay(attempts: int) -> float:
+    """Backoff before the next claim of a job that has failed `attempts` times"""
+    delay = min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS)
+    return delay + random.uniform(0, RETRY_BASE_SECONDS)
+
+# handler(cursor, job) does the work and the writes for one job and returns its analysis id;
+# the worker commits those writes together with the job's completion
+JobHandler = Callable[[sqlite3.Cursor, Dict[str, Any]], int]
+
+class JobQueue:
+    """Worker threads draining analysis_jobs through a handler, holding leases on what they run"""
+
+    def __init__(self, db_path: str = 'dip_analysis.db'):
+        self.db_path = db_path
+        self.handler: Optional[JobHandler] = None
+        self.node = ""
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.threads: List[threading.Thread] = []
+        self.heartbeat_thread: Optional[threading.Thread] = None
+        # job id -> lease owner, for the jobs this process is running
+        self.held: Dict[int, str] = {}
+        self.held_lock = threading.Lock()
+
+    def start(self, handler: JobHandler, workers: int = DEFAULT_WORKERS):
+        if workers <= 0:
+            return
+        self.handler = handler
+        self.node = f"{socket.gethostname()}:{os.getpid()}"
+        self.stopping.clear()
+        for n in range(workers):
+            thread = threading.Thread(target=self._work, args=(f"{self.node}/{n}",),
+                                      name=f"analysis-worker-{n}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        self.heartbeat_thread = threading.Thread(target=self._heartbeat, name="analysis-heartbeat", daemon=True)
+        self.heartbeat_thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self.stopping.set()
+        self.wakeup.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        if self.heartbeat_thread:
+            self.heartbeat_thread.join(timeout)
+        self.threads = []
+        self.heartbeat_thread = None
+
+    def notify(self):
+        """Wake idle workers after a job was committed"""
+        self.wakeup.set()
+
+    def claim(self, cursor, owner: str) -> Optional[Dict[str, Any]]:
+        """Atomically lease the next job: an expired lease first, else the ready job with the lowest fair tag"""
+        now = time.time()
+        cursor.execute(f'''
+            UPDATE analysis_jobs
+            SET status = 'running', lease_owner = ?, lease_expires_at = ?, heartbeat_at = ?,
+                started_at = CURRENT_TIMESTAMP, attempts = attempts + 1
+            WHERE id = COALESCE(
+                (SELECT id FROM analysis_jobs INDEXED BY idx_analysis_jobs_lease
+                 WHERE status = 'running' AND lease_expires_at < ? ORDER BY lease_expires_at LIMIT 1),
+                (SELECT id FROM analysis_jobs INDEXED BY idx_analysis_jobs_fair
+                 WHERE status = 'queued' AND next_attempt_at <= ? ORDER BY fair_tag, id LIMIT 1)
+            )
+            RETURNING {", ".join(JOB_COLUMNS)}
+        ''', (owner, now + LEASE_SECONDS, now, now, now))
+        row = cursor.fetchone()
+        if row:
+            cursor.execute('UPDATE job_clock SET virtual_time = MAX(virtual_time, ?)',
+                           (row[JOB_COLUMNS.index("fair_tag")],))
+        cursor.connection.commit()
+        return job_row(row) if row else None
+
+    def finish(self, cursor, job: Dict[str, Any], status: str, analysis_id: Optional[int] = None,
+               error: Optional[str] = None) -> bool:
+        """Record the outcome if the lease is still ours; False means another worker took the job"""
+        cursor.execute('''
+            UPDATE analysis_jobs
+            SET status = ?, analysis_id = ?, error = ?, finished_at = CURRENT_TIMESTAMP,
+                lease_owner = NULL, lease_expires_at = NULL,
+                completion_seq = (SELECT COALESCE(MAX(completion_seq), 0) + 1 FROM analysis_jobs)
+            WHERE id = ? AND status = 'running' AND lease_owner = ?
+        ''', (status, analysis_id, error, job["id"], job["lease_owner"]))
+        return cursor.rowcount == 1
+
+    def retry(self, cursor, job: Dict[str, Any], error: str) -> bool:
+        """Release the lease and queue the job again after a backoff"""
+        cursor.execute('''
+            UPDATE analysis_jobs
+            SET status = 'queued', error = ?, next_attempt_at = ?, lease_owner = NULL, lease_expires_at = NULL
+            WHERE id = ? AND status = 'running' AND lease_owner = ?
+        ''', (error, time.time() + retry_delay(job["attempts"]), job["id"], job["lease_owner"]))
+        return cursor.rowcount == 1
+
+    def run_job(self, conn: sqlite3.Connection, job: Dict[str, Any]):
+        cursor = conn.cursor()
+        if job["attempts"] > job["max_attempts"]:
+            # Every earlier claim ended with an expired lease (the worker died running it)
+            self.finish(cursor, job, "failed", error=job["error"] or "Worker lease expired on every attempt")
+            conn.commit()
+            return
+        try:
+            analysis_id = self.handler(cursor, job)
+            if not self.finish(cursor, job, "completed", analysis_id):
+                conn.rollback()
+                logging.warning(f"Analysis job {job['id']} lost its lease; results discarded")
+                return
+        except Exception as e:
+            conn.rollback()
+            if isinstance(e, PermanentJobError) or job["attempts"] >= job["max_attempts"]:
+                logging.error(f"Analysis job {job['id']} failed: {str(e)}")
+                self.finish(cursor, job, "failed", error=str(e))
+            else:
+                logging.warning(f"Analysis job {job['id']} failed (attempt {job['attempts']}), retrying: {str(e)}")
+                self.retry(cursor, job, str(e))
+        conn.commit()
+
+    def _work(self, owner: str):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            while not self.stopping.is_set():
+                try:
+                    job = self.claim(conn.cursor(), owner)
+                except sqlite3.Error as e:
+                    conn.rollback()
+                    logging.error(f"Claiming an analysis job failed: {str(e)}")
+                    self.stopping.wait(IDLE_POLL_SECONDS)
+                    continue
+                if job is None:
+                    self.wakeup.wait(IDLE_POLL_SECONDS)
+                    self.wakeup.clear()
+                    continue
+                with self.held_lock:
+                    self.held[job["id"]] = owner
+                try:
+                    self.run_job(conn, job)
+                finally:
+                    with self.held_lock:
+                        self.held.pop(job["id"], None)
+        finally:
+            conn.close()
+
+    def _heartbeat(self):
+        """Renew the leases of the jobs this process is running"""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            while not self.stopping.wait(HEARTBEAT_SECONDS):
+                with self.held_lock:
+                    held = list(self.held.items())
+                if not held:
+                    continue
+                now = time.time()
+                try:
+                    conn.executemany('''
+                        UPDATE analysis_jobs SET heartbeat_at = ?, lease_expires_at = ?
+                        WHERE id = ? AND status = 'running' AND lease_owner = ?
+                    ''', [(now, now + LEASE_SECONDS, job_id, owner) for job_id, owner in held])
+                    conn.commit()
+                except sqlite3.Error as e:
+                    conn.rollback()
+                    logging.error(f"Renewing analysis job leases failed: {str(e)}")
+        finally:
+            conn.close()
+
+JOB_QUEUE = JobQueue()
@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+"""
+Lab Values - numeric lab and vital sign extraction
+Pulls (analyte, value, unit) out of note text ("HbA1c 8.2%", "glucose: 10.1 mmol/L",
+"BP 150/95", "HR 110 bpm"), converts each value to the analyte's canonical unit and
+flags it against the Lab-Reference ranges in the medical database.
+
+Values from patient documents are kept in lab_observations, keyed by patient,
+analyte and time, for range queries across patients and per-patient trends.
+"""
+import re
+import sqlite3
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+from sentence_memo import SENTENCE_MEMO, SentenceMemo
+
+Conversion = Union[float, Callable[[float], float]]
+
+# analyte: (entity label, canonical unit, aliases, {normalized unit: conversion to canonical})
+ANALYTES: Dict[str, Tuple[str, str, Tuple[str, ...], Dict[str, Conversion]]] = {
+    # Chemistry
+    "glucose": ("LAB_VALUES", "mg/dL", ("glucose", "blood glucose", "blood sugar", "fasting glucose"),
+                {"mg/dl": 1, "mmol/l": 18.016}),
+    "hba1c": ("LAB_VALUES", "%", ("hba1c", "hemoglobin a1c", "a1c", "glycated hemoglobin"),
+              {"%": 1, "mmol/mol": lambda v: v / 10.929 + 2.15}),
+    "creatinine": ("LAB_VALUES", "mg/dL", ("creatinine", "cr"), {"mg/dl": 1, "umol/l": 1 / 88.42}),
+    "bun": ("LAB_VALUES", "mg/dL", ("bun", "blood urea nitrogen"), {"mg/dl": 1, "mmol/l": 2.801}),
+    "sodium": ("LAB_VALUES", "mEq/L", ("sodium", "na"), {"meq/l": 1, "mmol/l": 1}),
+    "potassium": ("LAB_VALUES", "mEq/L", ("potassium",), {"meq/l": 1, "mmol/l": 1}),
+    "chloride": ("LAB_VALUES", "mEq/L", ("chloride", "cl"), {"meq/l": 1, "mmol/l": 1}),
+    "bicarbonate": ("LAB_VALUES", "mEq/L", ("bicarbonate", "hco3", "co2"), {"meq/l": 1, "mmol/l": 1}),
+    "egfr": ("LAB_VALUES", "mL/min/1.73m2", ("egfr", "estimated glomerular filtration rate"),
+             {"ml/min/1.73m2": 1, "ml/min": 1}),
+    # Lipids
+    "total_cholesterol": ("LAB_VALUES", "mg/dL", ("total cholesterol", "cholesterol"), {"mg/dl": 1, "mmol/l": 38.67}),
+    "ldl": ("LAB_VALUES", "mg/dL", ("ldl", "ldl cholesterol"), {"mg/dl": 1, "mmol/l": 38.67}),
+    "hdl": ("LAB_VALUES", "mg/dL", ("hdl", "hdl cholesterol"), {"mg/dl": 1, "mmol/l": 38.67}),
+    "triglycerides": ("LAB_VALUES", "mg/dL", ("triglycerides", "tg"), {"mg/dl": 1, "mmol/l": 88.57}),
+    # Hematology
+    "hemoglobin": ("LAB_VALUES", "g/dL", ("hemoglobin", "hgb", "hb"), {"g/dl": 1, "g/l": 0.1, "mmol/l": 1.611}),
+    "hematocrit": ("LAB_VALUES", "%", ("hematocrit", "hct"), {"%": 1}),
+    "wbc": ("LAB_VALUES", "K/uL", ("white blood cell", "white blood cells", "white count", "wbc"),
+            {"k/ul": 1, "/ul": 0.001}),
+    "platelets": ("LAB_VALUES", "K/uL", ("platelet", "platelets", "platelet count", "plt"), {"k/ul": 1, "/ul": 0.001}),
+    "inr": ("LAB_VALUES", "", ("inr",), {"": 1}),
+    # Liver
+    "alt": ("LAB_VALUES", "U/L", ("alt", "sgpt"), {"u/l": 1}),
+    "ast": ("LAB_VALUES", "U/L", ("ast", "sgot"), {"u/l": 1}),
+    "bilirubin": ("LAB_VALUES", "mg/dL", ("bilirubin", "total bilirubin"), {"mg/dl": 1, "umol/l": 1 / 17.1}),
+    "albumin": ("LAB_VALUES", "g/dL", ("albumin",), {"g/dl": 1, "g/l": 0.1}),
+    # Other
+    "tsh": ("LAB_VALUES", "mIU/L", ("tsh", "thyroid stimulating hormone"), {"miu/l": 1, "uiu/ml": 1}),
+    "troponin": ("LAB_VALUES", "ng/mL", ("troponin",), {"ng/ml": 1, "ng/l": 0.001}),
+    "crp": ("LAB_VALUES", "mg/L", ("crp", "c-reactive protein"), {"mg/l": 1, "mg/dl": 10}),
+    # Vital signs ("blood pressure" / "bp" produce both systolic and diastolic)
+    "systolic_bp": ("VITAL_SIGNS", "mmHg", ("systolic blood pressure", "systolic bp", "systolic"), {"mmhg": 1}),
+    "diastolic_bp": ("VITAL_SIGNS", "mmHg", ("diastolic blood pressure", "diastolic bp", "diastolic"), {"mmhg": 1}),
+    "heart_rate": ("VITAL_SIGNS", "bpm", ("heart rate", "pulse rate", "pulse", "hr"), {"bpm": 1, "/min": 1}),
+    "respiratory_rate": ("VITAL_SIGNS", "breaths/min", ("respiratory rate", "resp rate", "rr"),
+                         {"breaths/min": 1, "/min": 1}),
+    "temperature": ("VITAL_SIGNS", "°C", ("temperature", "temp"), {"c": 1, "f": lambda v: (v - 32) / 1.8}),
+    "spo2": ("VITAL_SIGNS", "%", ("oxygen saturation", "o2 saturation", "o2 sat", "spo2", "sao2"), {"%": 1}),
+    "weight": ("VITAL_SIGNS", "kg", ("weight", "wt"), {"kg": 1, "lb": 0.45359}),
+    "height": ("VITAL_SIGNS", "cm", ("height", "ht"), {"cm": 1, "m": 100, "in": 2.54}),
+    "bmi": ("VITAL_SIGNS", "kg/m2", ("bmi", "body mass index"), {"kg/m2": 1}),
+}
+
+BLOOD_PRESSURE_ALIASES = ("blood pressure", "bp")
+ALIAS_TO_ANALYTE = {alias: analyte for analyte, (_, _, aliases, _) in ANALYTES.items() for alias in aliases}
+
+# Unit spellings as written, longest first so "mmol/mol" wins over "mmol/l"
+UNIT_SPELLINGS = sorted([
+    "mg/dl", "mmol/l", "mmol/mol", "g/dl", "g/l", "mg/l", "ng/ml", "ng/l", "meq/l", "u/l", "iu/l", "miu/l",
+    "uiu/ml", "µiu/ml", "umol/l", "µmol/l", "k/ul", "k/µl", "x10^3/ul", "10^3/ul", "x10^9/l", "10^9/l",
+    "/ul", "/µl", "%", "mm hg", "mmhg", "bpm", "beats/min", "breaths/min", "/min", "°f", "°c", "f", "c",
+    "kg", "lbs", "lb", "pounds", "cm", "m", "inches", "inch", "in", "kg/m2", "kg/m²", "ml/min/1.73m2", "ml/min/1.73 m2", "ml/min"
+], key=len, reverse=True)
+
+UNIT_ALIASES = {
+    "iu/l": "u/l", "µiu/ml": "uiu/ml", "µmol/l": "umol/l", "k/µl": "k/ul", "x10^3/ul": "k/ul",
+    "10^3/ul": "k/ul", "x10^9/l": "k/ul", "10^9/l": "k/ul", "/µl": "/ul", "mm hg": "mmhg",
+    "beats/min": "bpm", "°f": "f", "°c": "c", "lbs": "lb", "pounds": "lb", "inches": "in", "inch": "in", "kg/m²": "kg/m2", "ml/min/1.73 m2": "ml/min/1.73m2"
+}
+
+_ALIASES = "|".join(re.escape(alias) for alias in sorted(
+    list(ALIAS_TO_ANALYTE) + list(BLOOD_PRESSURE_ALIASES), key=len, reverse=True))
+_UNITS = "|".join(re.escape(unit) for unit in UNIT_SPELLINGS)
+
+# Matched against lowered sentence text
+MEASUREMENT = re.compile(
+    rf'\b(?P<analyte>{_ALIASES})\b'
+    r'(?:[\s:=(]|\b(?:is|was|were|of|at|levels?|values?|measured|reading|result)\b)*'
+    r'(?P<value>\d+(?:\.\d+)?(?:\s*/\s*\d+)?)'
+    rf'(?:\s*(?P<unit>{_UNITS})(?![a-z]))?'
+)
+
+# Values recognizable by their unit alone ("110 bpm", "101.2°f")
+UNIT_ONLY_MEASUREMENTS = [
+    ("blood_pressure", re.compile(r'\b(?P<value>\d{2,3}\s*/\s*\d{2,3})\s*(?P<unit>mm\s?hg)\b')),
+    ("heart_rate", re.compile(r'\b(?P<value>\d{2,3})\s*(?P<unit>bpm|beats/min)\b')),
+    ("respiratory_rate", re.compile(r'\b(?P<value>\d{1,2})\s*(?P<unit>breaths/min)')),
+    ("temperature", re.compile(r'\b(?P<value>\d{2,3}(?:\.\d+)?)\s*(?P<unit>°\s?[fc])\b')),
+    ("spo2", re.compile(r'\b(?P<value>\d{2,3})\s*(?P<unit>%)\s*(?:o2|on room air|on ra|ra\b|spo2|sat)')),
+]
+
+# Units none of the analytes is measured in: a value written in one has no canonical value ("height 5 ft 10 in")
+OTHER_UNIT = re.compile(r'\s*(?:ft|feet|foot|oz|ounces?|mcg|[µu]g|mg|g|mm|ml|dl|l|[mµu]?mol|meq|iu|units?|u|[\'"′″])(?![a-z])')
+# "in" starting a phrase rather than giving inches ("glucose 180 in the morning")
+PROSE_UNIT = re.compile(r'in\s+[a-z]')
+
+# Cap on the rows counted when choosing how to run a cross-patient range query
+RANGE_PROBE_ROWS = 20000
+
+REFERENCE_RANGE = re.compile(r'^\s*(?:(?P<bound>[<>])\s*(?P<limit>\d+(?:\.\d+)?)|'
+                             r'(?P<low>\d+(?:\.\d+)?)\s*-\s*(?P<high>\d+(?:\.\d+)?))\s*(?P<unit>.*?)\s*$')
+
+# (start, end, analyte, canonical value, raw value, raw unit) relative to a sentence
+MeasurementSpan = Tuple[int, int, str, float, str, str]
+
+def normalize_unit(unit: Optional[str]) -> str:
+    unit = (unit or "").strip().lower().replace("μ", "µ")
+    unit = UNIT_ALIASES.get(unit, unit)
+    return unit.replace("° ", "").replace("°", "")
+
+def to_canonical(analyte: str, value: float, unit: Optional[str]) -> Optional[float]:
+    """value converted to the analyte's canonical unit; None for a unit the analyte is not measured in"""
+    label, canonical_unit, _, conversions = ANALYTES[analyte]
+    normalized = normalize_unit(unit) or normalize_unit(canonical_unit)
+    conversion = conversions.get(normalized)
+    if conversion is None:
+        return None
+    return conversion(value) if callable(conversion) else value * conversion
+
+def _measurement(analyte: str, start: int, end: int, value_end: int,
+                 raw_value: str, raw_unit: str, prose_unit: bool = False) -> List[MeasurementSpan]:
+    if analyte == "blood_pressure":
+        if "/" not in raw_value:
+            return []
+        systolic, diastolic = (part.strip() for part in raw_value.split("/"))
+        # Dates and fractions are not pressures
+        if not (50 <= float(systolic) <= 300 and 20 <= float(diastolic) <= 200):
+            return []
+        if normalize_unit(raw_unit) != "mmhg":
+            end, raw_unit = value_end, ""
+        return [(start, end, "systolic_bp", float(systolic), systolic, raw_unit),
+                (start, end, "diastolic_bp", float(diastolic), diastolic, raw_unit)]
+    if "/" in raw_value:
+        return []
+    value = to_canonical(analyte, float(raw_value), raw_unit)
+    if value is None and prose_unit:
+        # The word after the number was not a unit at all ("glucose 180 in the morning")
+        end, raw_unit = value_end, ""
+        value = to_canonical(analyte, float(raw_value), raw_unit)
+    if value is None:
+        # A unit the analyte is not measured in: no value rather than a wrong one
+        return []
+    return [(start, end, analyte, round(value, 3), raw_value, raw_unit)]
+
+def extract_measurement_spans(sentence: str) -> Tuple[MeasurementSpan, ...]:
+    """Measurements in a lowered sentence, memoized per sentence"""
+    key = ("measurements", SentenceMemo.sentence_key(sentence))
+    found = SENTENCE_MEMO.get(key)
+    if found is not None:
+        return found
+
+    spans: List[MeasurementSpan] = []
+    covered: List[Tuple[int, int]] = []
+    for match in MEASUREMENT.finditer(sentence):
+        alias = match.group("analyte")
+        analyte = "blood_pressure" if alias in BLOOD_PRESSURE_ALIASES else ALIAS_TO_ANALYTE[alias]
+        unit = match.group("unit") or ""
+        if not unit and OTHER_UNIT.match(sentence, match.end("value")):
+            continue
+        found_here = _measurement(analyte, match.start(), match.end(), match.end("value"),
+                                  match.group("value"), unit,
+                                  bool(unit) and PROSE_UNIT.match(sentence, match.start("unit")) is not None)
+        if found_here:
+            spans.extend(found_here)
+            covered.append(match.span("value"))
+    for analyte, pattern in UNIT_ONLY_MEASUREMENTS:
+        for match in pattern.finditer(sentence):
+            if any(start < match.end() and match.start() < end for start, end in covered):
+                continue
+            found_here = _measurement(analyte, match.start(), match.end(), match.end("value"),
+                                      match.group("value"), match.group("unit"))
+            if found_here:
+                spans.extend(found_here)
+                covered.append(match.span())
+
+    found = tuple(sorted(spans))
+    SENTENCE_MEMO.put(key, found)
+    return found
+
+def parse_reference_range(analyte: str, text: str) -> Optional[Tuple[Optional[float], Optional[float]]]:
+    """'70-100 mg/dL', '<200 mg/dL', '>40 mg/dL' -> (low, high) in the analyte's canonical unit"""
+    match = REFERENCE_RANGE.match(text or "")
+    if not match:
+        return None
+    if match.group("bound"):
+        limit = to_canonical(analyte, float(match.group("limit")), match.group("unit"))
+        if limit is None:
+            return None
+        return (limit, None) if match.group("bound") == ">" else (None, limit)
+    low = to_canonical(analyte, float(match.group("low")), match.group("unit"))
+    high = to_canonical(analyte, float(match.group("high")), match.group("unit"))
+    return None if low is None or high is None else (low, high)
+
+_reference_cache: Tuple[Optional[str], Dict[str, Tuple[Optional[float], Optional[float]]]] = (None, {})
+
+def reference_ranges() -> Dict[str, Tuple[Optional[float], Optional[float]]]:
+    """Normal ranges by analyte from the medical database's Lab-Reference terms ("glucose normal")"""
+    global _reference_cache
+    from fast_medical_db import get_fast_medical_db
+
+    try:
+        db_manager = get_fast_medical_db()
+        version = db_manager.get_dictionary_version()
+        if _reference_cache[0] == version:
+            return _reference_cache[1]
+        rows = db_manager.conn.execute(
+            "SELECT term_lower, code FROM medical_terms WHERE source_db = 'Lab-Reference'").fetchall()
+    except sqlite3.Error:
+        return {}
+
+    ranges = {}
+    for term, code in rows:
+        analyte = ALIAS_TO_ANALYTE.get(re.sub(r'\s+normal$', '', term))
+        parsed = parse_reference_range(analyte, code) if analyte else None
+        if parsed:
+            ranges[analyte] = parsed
+    _reference_cache = (version, ranges)
+    return ranges
+
+def reference_flag(value: float, reference: Optional[Tuple[Optional[float], Optional[float]]]) -> Optional[str]:
+    if reference is None:
+        return None
+    low, high = reference
+    if low is not None and value < low:
+        return "low"
+    if high is not None and value > high:
+        return "high"
+    return "normal"
+
+def measurement_dicts(text: str, spans: List[MeasurementSpan]) -> List[Dict[str, Any]]:
+    """Response form of document-level measurement spans, flagged against reference ranges"""
+    ranges = reference_ranges()
+    measurements = []
+    for start, end, analyte, value, raw_value, raw_unit in spans:
+        label, unit, _, _ = ANALYTES[analyte]
+        reference = ranges.get(analyte)
+        measurements.append({
+            "analyte": analyte,
+            "label": label,
+            "value": value,
+            "unit": unit,
+            "text": text[start:end],
+            "start": start,
+            "end": end,
+            "reference_range": {"low": reference[0], "high": reference[1]} if reference else None,
+            "flag": reference_flag(value, reference)
+        })
+    return measurements
+
+def create_lab_tables(cursor) -> bool:
+    """Create lab_observations and its delete trigger; returns True if created by this call"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'lab_observations'")
+    exists = cursor.fetchone() is not None
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS lab_observations (
+            id INTEGER PRIMARY KEY,
+            patient_id TEXT NOT NULL,
+            analysis_id INTEGER NOT NULL,
+            analyte TEXT NOT NULL,
+            value REAL NOT NULL,
+            unit TEXT NOT NULL,
+            ref_low REAL,
+            ref_high REAL,
+            flag TEXT,
+            position INTEGER NOT NULL,
+            observed_at TIMESTAMP NOT NULL
+        )
+    ''')
+    # Range queries across patients by time or by value (covering), per-patient trends, and deletes
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_lab_observations_analyte
+        ON lab_observations(analyte, observed_at, value, patient_id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_lab_observations_value
+        ON lab_observations(analyte, value, observed_at, patient_id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_lab_observations_patient
+        ON lab_observations(patient_id, analyte, observed_at)
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_lab_observations_analysis ON lab_observations(analysis_id)')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_patient_documents_delete_labs
+        AFTER DELETE ON patient_documents
+        WHEN OLD.analysis_id IS NOT NULL
+        BEGIN
+            DELETE FROM lab_observations WHERE analysis_id = OLD.analysis_id;
+        END
+    ''')
+    return not exists
+
+def record_observations(cursor, analysis_id: int, patient_id: str, measurements: List[Dict[str, Any]]):
+    """Store a patient document's measurements, timed by the document's upload time"""
+    cursor.executemany('''
+        INSERT INTO lab_observations (patient_id, analysis_id, analyte, value, unit, ref_low, ref_high,
+                                      flag, position, observed_at)
+        SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?, uploaded_at FROM patient_documents WHERE analysis_id = ?
+    ''', [(
+        patient_id, analysis_id, m["analyte"], m["value"], m["unit"],
+        m["reference_range"]["low"] if m["reference_range"] else None,
+        m["reference_range"]["high"] if m["reference_range"] else None,
+        m["flag"], m["start"], analysis_id
+    ) for m in measurements])
+
+def parse_measurements(text: str) -> List[Dict[str, Any]]:
+    """Measurements in a whole text (what the pipeline's measurements stage produces)"""
+    from analysis_pipeline import split_sentences
+
+    lowered = text.lower()
+    spans = [(offset + start, offset + end, *rest)
+             for offset, stop in split_sentences(text)
+             for start, end, *rest in extract_measurement_spans(lowered[offset:stop])]
+    return measurement_dicts(text, spans)
+
+def backfill_lab_observations(cursor) -> int:
+    """Parse the stored text of every analyzed patient document"""
+    cursor.execute('''
+        SELECT pd.analysis_id, pd.patient_id, json_extract(ar.results, '$.extracted_text')
+        FROM patient_documents pd
+        JOIN analysis_results ar ON ar.id = pd.analysis_id
+        WHERE json_valid(ar.results)
+    ''')
+    rows = cursor.fetchall()
+    for analysis_id, patient_id, text in rows:
+        if text:
+            record_observations(cursor, analysis_id, patient_id, parse_measurements(text))
+    return len(rows)
+
+def resolve_analyte(name: str) -> Optional[str]:
+    """Canonical analyte for a name or alias ("HbA1c", "a1c", "systolic_bp")"""
+    lowered = name.strip().lower()
+    return lowered if lowered in ANALYTES else ALIAS_TO_ANALYTE.get(lowered)
+
+def _range_index(cursor, analyte: str, bounds: Dict[str, List[Tuple[str, Any]]]) -> str:
+    """Pick the index to drive a cross-patient range query.
+
+    Walking patients in id order finds a page quickly when matches are common, but reads
+    every patient's rows when they are rare. A capped count of each bounded range tells
+    the two apart: a range shorter than RANGE_PROBE_ROWS is cheaper to read whole and
+    group, and the shorter of the two wins.
+    """
+    best, best_rows = "idx_lab_observations_patient", RANGE_PROBE_ROWS
+    for index, conditions in bounds.items():
+        if not conditions:
+            continue
+        cursor.execute(f'''
+            SELECT COUNT(*) FROM (
+                SELECT 1 FROM lab_observations INDEXED BY {index}
+                WHERE analyte = ? AND {" AND ".join(condition for condition, _ in conditions)} LIMIT ?
+            )
+        ''', [analyte] + [value for _, value in conditions] + [best_rows])
+        rows = cursor.fetchone()[0]
+        if rows < best_rows:
+            best, best_rows = index, rows
+    return best
+
+def find_patients_in_range(cursor, analyte: str, above: Optional[float] = None, below: Optional[float] = None,
+                           since: Optional[str] = None, until: Optional[str] = None,
+                           limit: int = 100, offset: int = 0) -> Tuple[List[Dict[str, Any]], bool]:
+    """Patients with at least one observation strictly inside (above, below) in [since, until]"""
+    bounds = {
+        "idx_lab_observations_analyte": [(condition, value) for condition, value in
+                                         (("observed_at >= ?", since), ("observed_at <= ?", until))
+                                         if value is not None],
+        "idx_lab_observations_value": [(condition, value) for condition, value in
+                                       (("value > ?", above), ("value < ?", below)) if value is not None]
+    }
+    conditions = [condition for index_bounds in bounds.values() for condition, _ in index_bounds]
+    params = [value for index_bounds in bounds.values() for _, value in index_bounds]
+    cursor.execute(f'''
+        SELECT m.patient_id, p.name, m.observations, m.min_value, m.max_value, m.first_at, m.last_at
+        FROM (
+            SELECT patient_id, COUNT(*) AS observations, MIN(value) AS min_value, MAX(value) AS max_value,
+                   MIN(observed_at) AS first_at, MAX(observed_at) AS last_at
+            FROM lab_observations INDEXED BY {_range_index(cursor, analyte, bounds)}
+            WHERE {" AND ".join(["analyte = ?"] + conditions)}
+            GROUP BY patient_id
+            ORDER BY patient_id
+            LIMIT ? OFFSET ?
+        ) m
+        JOIN patients p ON p.id = m.patient_id
+        ORDER BY m.patient_id
+    ''', [analyte] + params + [limit + 1, offset])
+    rows = cursor.fetchall()
+    return [{
+        "patient_id": row[0],
+        "name": row[1],
+        "matching_observations": row[2],
+        "min_value": row[3],
+        "max_value": row[4],
+        "first_observed_at": row[5],
+        "last_observed_at": row[6]
+    } for row in rows[:limit]], len(rows) > limit
+
+def patient_trend(cursor, patient_id: str, analyte: str, since: Optional[str] = None,
+                  until: Optional[str] = None) -> List[Dict[str, Any]]:
+    """One patient's observations of an analyte in time order"""
+    conditions, params = ["o.patient_id = ?", "o.analyte = ?"], [patient_id, analyte]
+    for condition, value in (("o.observed_at >= ?", since), ("o.observed_at <= ?", until)):
+        if value is not None:
+            conditions.append(condition)
+            params.append(value)
+    cursor.execute(f'''
+        SELECT o.observed_at, o.value, o.unit, o.flag, o.ref_low, o.ref_high, o.analysis_id, pd.id, pd.name
+        FROM lab_observations o
+        LEFT JOIN patient_documents pd ON pd.analysis_id = o.analysis_id
+        WHERE {" AND ".join(conditions)}
+        ORDER BY o.observed_at, o.analysis_id, o.position
+    ''', params)
+    return [{
+        "observed_at": row[0],
+        "value": row[1],
+        "unit": row[2],
+        "flag": row[3],
+        "reference_range": {"low": row[4], "high": row[5]} if row[4] is not None or row[5] is not None else None,
+        "analysis_id": row[6],
+        "document_id": row[7],
+        "document_name": row[8]
+    } for row in cursor.fetchall()]
+
+def latest_patient_values(cursor, patient_id: str) -> List[Dict[str, Any]]:
+    """Most recent observation of every analyte recorded for a patient"""
+    cursor.execute('''
+        SELECT analyte, value, unit, flag, observed_at, observations
+        FROM (
+            SELECT analyte, value, unit, flag, observed_at,
+                   COUNT(*) OVER (PARTITION BY analyte) AS observations,
+                   ROW_NUMBER() OVER (PARTITION BY analyte
+                                      ORDER BY observed_at DESC, analysis_id DESC, position DESC) AS recency
+            FROM lab_observations
+            WHERE patient_id = ?
+        )
+        WHERE recency = 1
+        ORDER BY analyte
+    ''', (patient_id,))
+    return [{
+        "analyte": row[0],
+        "label": ANALYTES[row[0]][0] if row[0] in ANALYTES else None,
+        "value": row[1],
+        "unit": row[2],
+        "flag": row[3],
+        "observed_at": row[4],
+        "observations": row[5]
+    } for row in cursor.fetchall()]
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Live (incremental) Medical Text Analysis
+A LiveDocument holds the text being typed in a session. Each edit re-splits and
+re-extracts only the sentences around the edited range, and the caller gets
+back entity add/remove diffs instead of a full analysis.
+"""
+import time
+from bisect import bisect_left, bisect_right
+from typing import Any, Dict, List, Tuple
+
+from analysis_pipeline import (
+    TEXT_PATTERNS,
+    AnalysisOptions,
+    extract_boundary_term_spans,
+    extract_dictionary_spans,
+    extract_pattern_spans,
+    match_patterns,
+    split_sentences
+)
+
+MAX_LIVE_TEXT_LENGTH = 50000
+
+# (relative start, relative end, label, source, confidence %, entity id)
+LiveEntity = Tuple[int, int, str, str, int, int]
+
+class LiveSentence:
+    __slots__ = ("start", "end", "entities")
+
+    def __init__(self, start: int, end: int, entities: List[LiveEntity]):
+        self.start = start
+        self.end = end
+        self.entities = entities
+
+class LiveDocument:
+    """Per-session document that is re-analyzed one edited region at a time"""
+
+    def __init__(self, options: AnalysisOptions):
+        self.options = options
+        self.text = ""
+        self.sentences: List[LiveSentence] = []
+        self.version = 0
+        self._next_id = 1
+
+    def reset(self, text: str) -> Dict[str, Any]:
+        """Replace the whole text; returns a snapshot of every entity"""
+        if len(text) > MAX_LIVE_TEXT_LENGTH:
+            raise ValueError(f"Text too long (max {MAX_LIVE_TEXT_LENGTH:,} characters)")
+        start_time = time.perf_counter()
+        self.text = text
+        self.sentences = self._analyze_spans(split_sentences(text))
+        self.version += 1
+        return {
+            "type": "snapshot",
+            "version": self.version,
+            "entities": self.entities(),
+            "elapsed_ms": round((time.perf_counter() - start_time) * 1000, 3)
+        }
+
+    def apply_edit(self, start: int, end: int, replacement: str) -> Dict[str, Any]:
+        """Replace text[start:end] with replacement; returns the entity diff"""
+        if not 0 <= start <= end <= len(self.text):
+            raise ValueError(f"Edit range {start}-{end} outside document of length {len(self.text)}")
+        if len(self.text) - (end - start) + len(replacement) > MAX_LIVE_TEXT_LENGTH:
+            raise ValueError(f"Text too long (max {MAX_LIVE_TEXT_LENGTH:,} characters)")
+
+        start_time = time.perf_counter()
+        delta = len(replacement) - (end - start)
+
+        # Affected sentences plus one neighbour each side, since an edit at a
+        # boundary can merge or split sentences
+        first = bisect_left(self.sentences, start, key=lambda s: s.end)
+        last = bisect_right(self.sentences, end, key=lambda s: s.start) - 1
+        lo = max(0, min(first, last) - 1)
+        hi = min(len(self.sentences) - 1, max(first, last) + 1)
+
+        region_start = self.sentences[lo].start if lo > 0 else 0
+        region_end = self.sentences[hi].end if 0 <= hi < len(self.sentences) - 1 else len(self.text)
+        replaced = self.sentences[lo:hi + 1] if self.sentences else []
+
+        self.text = self.text[:start] + replacement + self.text[end:]
+        region_text = self.text[region_start:region_end + delta]
+        new_sentences = self._analyze_spans(split_sentences(region_text, region_start))
+
+        for sentence in self.sentences[hi + 1:]:
+            sentence.start += delta
+            sentence.end += delta
+
+        # Old entities in the region, moved to new coordinates; anything the
+        # edit touched is dropped
+        previous = {}
+        for sentence in replaced:
+            for rel_start, rel_end, label, source, confidence, entity_id in sentence.entities:
+                abs_start, abs_end = sentence.start + rel_start, sentence.start + rel_end
+                if abs_end <= start:
+                    previous[(abs_start, abs_end, label, source)] = entity_id
+                elif abs_start >= end:
+                    previous[(abs_start + delta, abs_end + delta, label, source)] = entity_id
+
+        added = []
+        kept_ids = set()
+        for sentence in new_sentences:
+            for index, (rel_start, rel_end, label, source, confidence, entity_id) in enumerate(sentence.entities):
+                position = (sentence.start + rel_start, sentence.start + rel_end, label, source)
+                old_id = previous.get(position)
+                if old_id is not None and old_id not in kept_ids:
+                    kept_ids.add(old_id)
+                    sentence.entities[index] = (rel_start, rel_end, label, source, confidence, old_id)
+                else:
+                    added.append(self._entity_dict(sentence, sentence.entities[index]))
+
+        removed = [
+            entity[5]
+            for sentence in replaced
+            for entity in sentence.entities
+            if entity[5] not in kept_ids
+        ]
+
+        self.sentences[lo:hi + 1] = new_sentences
+        self.version += 1
+        return {
+            "type": "diff",
+            "version": self.version,
+            "added": added,
+            "removed": removed,
+            "shift": {"from": end, "delta": delta},
+            "sentences_analyzed": len(new_sentences),
+            "elapsed_ms": round((time.perf_counter() - start_time) * 1000, 3)
+        }
+
+    def entities(self) -> List[Dict[str, Any]]:
+        return [self._entity_dict(sentence, entity) for sentence in self.sentences for entity in sentence.entities]
+
+    def _entity_dict(self, sentence: LiveSentence, entity: LiveEntity) -> Dict[str, Any]:
+        rel_start, rel_end, label, source, confidence, entity_id = entity
+        return {
+            "id": entity_id,
+            "text": self.text[sentence.start + rel_start:sentence.start + rel_end].lower(),
+            "label": label,
+            "start_pos": sentence.start + rel_start,
+            "end_pos": sentence.start + rel_end,
+            "confidence": confidence / 100,
+            "source": source
+        }
+
+    def _analyze_spans(self, spans: List[Tuple[int, int]]) -> List[LiveSentence]:
+        """Extract entities for each sentence span (memoized per sentence)
+
+        Unlike a full analysis, nothing is matched across a sentence boundary:
+        an edit only re-extracts the sentences around it.
+        """
+        lowered = [self.text[s:e].lower() for s, e in spans]
+        if self.options.settings["dictionary"] and lowered:
+            dictionary_hits = [found + extract_boundary_term_spans(sentence, self.options)
+                               for sentence, found in zip(lowered, extract_dictionary_spans(lowered, self.options))]
+        else:
+            dictionary_hits = [()] * len(lowered)
+
+        sentences = []
+        for (start, end), sentence, dictionary in zip(spans, lowered, dictionary_hits):
+            entities = []
+            found_starts: Dict[str, List[int]] = {}
+            seen = set()
+
+            def add(rel_start: int, rel_end: int, label: str, source: str, confidence: int):
+                if (rel_start, rel_end, label) in seen:
+                    return
+                seen.add((rel_start, rel_end, label))
+                found_starts.setdefault(sentence[rel_start:rel_end], []).append(rel_start)
+                entities.append((rel_start, rel_end, label, source, confidence, self._new_id()))
+
+            for rel_start, rel_end, label, source, confidence, _ in sorted(dictionary, key=lambda d: (d[5], d[0])):
+                add(rel_start, rel_end, label, source, confidence)
+            patterns = extract_pattern_spans(sentence, self.options) + match_patterns(sentence, self.options, TEXT_PATTERNS)
+            for _, rel_start, rel_end, label in sorted(patterns):
+                text = sentence[rel_start:rel_end]
+                if any(abs(s - rel_start) < 5 for s in found_starts.get(text, ())):
+                    continue
+                add(rel_start, rel_end, label, "Pattern", 85 + hash(text) % 15)
+
+            entities.sort(key=lambda e: e[0])
+            sentences.append(LiveSentence(start, end, entities))
+        return sentences
+
+    def _new_id(self) -> int:
+        entity_id = self._next_id
+        self._next_id += 1
+        return entity_id
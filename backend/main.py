@@ -1,16 +1,135 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, Query, Header, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from starlette.requests import ClientDisconnect
 import pdfplumber
 import asyncio
 import logging
-from typing import Optional, Dict, Any
+from typing import IO, Optional, Dict, Any, List, Tuple
 import sqlite3
 import json
+import base64
+import io
+import hashlib
+import re
+import threading
+import zipfile
 from datetime import datetime
 import os
 
+from analysis_pipeline import (
+    ANALYSIS_PROFILES,
+    DEFAULT_ANALYSIS_PROFILE,
+    ENTITY_CATEGORIES,
+    AnalysisOptions,
+    run_analysis
+)
+from cohort_index import (
+    COHORT_INDEX,
+    COHORT_LEVELS,
+    backfill_cohort_index,
+    create_cohort_tables,
+    index_document_entities,
+    iter_bits,
+    parse_cohort_query
+)
+from analysis_scheduler import ANALYSIS_SCHEDULER, DEFAULT_SLOTS, PRIORITY_CLASSES
+from bulk_ingest import (
+    INGEST_BATCH_SIZE,
+    UNREADABLE_ENTRY_ERRORS,
+    IngestEntry,
+    backfill_content_hashes,
+    copy_entry,
+    create_ingest,
+    create_ingest_tables,
+    document_type,
+    find_duplicate,
+    finish_ingest,
+    get_ingest,
+    ingest_entries,
+    ingest_progress,
+    record_entry,
+    skip_reason,
+    stage_archive,
+    zip_entries
+)
+from copy_forward import (
+    backfill_signatures,
+    create_copy_forward_tables,
+    find_near_duplicates,
+    minhash_signature,
+    prior_analysis,
+    record_signature,
+    run_copy_forward_analysis
+)
+from document_text import RTF_TYPES, DocumentTextError, docx_text, rtf_text, sniff_format
+from entity_analytics import ENTITY_ANALYTICS, entity_label, month_code
+from lab_values import (
+    ANALYTES,
+    backfill_lab_observations,
+    create_lab_tables,
+    find_patients_in_range,
+    latest_patient_values,
+    patient_trend,
+    record_observations,
+    reference_ranges,
+    resolve_analyte
+)
+from fhir_export import FHIR_RESOURCE_TYPES, export_resources, gzip_stream, parse_since
+from hl7_listener import (
+    HL7Listener,
+    create_hl7_tables,
+    document_file_name,
+    find_hl7_patient,
+    record_hl7_message,
+    record_hl7_patient,
+    stored_message
+)
+from job_queue import (
+    DEFAULT_WORKERS,
+    JOB_QUEUE,
+    PermanentJobError,
+    active_leases,
+    create_job_tables,
+    enqueue_document_job,
+    finished_jobs,
+    get_job,
+    job_counts,
+    latest_completion_seq,
+    queued_by_priority
+)
+from live_analysis import LiveDocument
+from patient_timeline import (
+    backfill_timeline,
+    build_patient_rollup,
+    create_timeline_tables,
+    event_rows,
+    events_by_date,
+    patient_rollup,
+    record_document_event
+)
+from search_index import backfill_search_index, build_match_query, create_search_index, index_document, search_documents
+from sentence_memo import SENTENCE_MEMO
+from upload_sessions import (
+    CHUNK_SIZE,
+    MAX_CHUNK_BYTES,
+    MAX_UPLOAD_BYTES,
+    ChecksumMismatch,
+    advance_session,
+    claim_chunk,
+    create_session,
+    create_upload_tables,
+    finish_session,
+    get_session,
+    parse_checksum,
+    part_path,
+    purge_expired_sessions,
+    release_chunk,
+    verify_part,
+    write_chunk
+)
+
 # AI Model imports (will be loaded lazily)
 try:
     from transformers import AutoTokenizer
@@ -54,6 +173,17 @@ app.add_middleware(
 os.makedirs("uploads", exist_ok=True)
 app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
 
+# Set by init_database once the FTS5 document index exists
+SEARCH_INDEX_AVAILABLE = False
+
+# Background analysis workers started with the app (0 = leave jobs to other processes)
+ANALYSIS_WORKERS = int(os.environ.get("ANALYSIS_WORKERS", DEFAULT_WORKERS))
+# Concurrent analyses per process (one of them reserved for interactive requests)
+ANALYSIS_SLOTS = int(os.environ.get("ANALYSIS_SLOTS", DEFAULT_SLOTS))
+# Port of the HL7 v2 MLLP listener started with the app (unset = no listener)
+HL7_LISTENER_PORT = os.environ.get("HL7_LISTENER_PORT")
+HL7_LISTENER: Optional[HL7Listener] = None
+
 # Global model storage (lazy loading)
 models = {
     "clinical_bert": None,
@@ -141,243 +271,245 @@ def init_database():
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_patients_name ON patients(name)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_directories_patient ON directories(patient_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_directories_parent ON directories(parent_id)')
+    # Child lookups for the directory tree; parent_id alone is mostly NULL (root directories)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_directories_patient_parent ON directories(patient_id, parent_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_patient_documents_patient ON patient_documents(patient_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_patient_documents_directory ON patient_documents(directory_id)')
     
+    # Keyset pagination indexes for GET /patients (one per sort option)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patients_updated_id ON patients(updated_at, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patients_created_id ON patients(created_at, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patients_name_id ON patients(name, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patient_documents_patient_uploaded ON patient_documents(patient_id, uploaded_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patient_documents_directory_uploaded ON patient_documents(directory_id, uploaded_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patient_documents_analysis ON patient_documents(analysis_id)')
+    
+    # GET /history: newest-first pages, optionally narrowed to one user / type / file type
+    # (see HISTORY_INDEXES); confidence_score rides along so min_confidence is checked in the index
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_analysis_results_created ON analysis_results(created_at, id, confidence_score)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_analysis_results_user_created ON analysis_results(user_id, created_at, id, confidence_score)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_analysis_results_type_created ON analysis_results(analysis_type, created_at, id, confidence_score)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_analysis_results_file_type_created ON analysis_results(file_type, created_at, id, confidence_score)')
+    
+    # Denormalized document counters, kept current by the triggers below
+    added = add_column_if_missing(cursor, 'patients', 'document_count', 'INTEGER NOT NULL DEFAULT 0')
+    added |= add_column_if_missing(cursor, 'patients', 'last_activity', 'TIMESTAMP')
+    added |= add_column_if_missing(cursor, 'directories', 'document_count', 'INTEGER NOT NULL DEFAULT 0')
+    create_document_counter_triggers(cursor)
+    if added:
+        backfill_document_counters(cursor)
+    
+    # Foreign keys are not enabled on these connections, so the ON DELETE CASCADE clauses
+    # never run: deleting a patient removes its documents here instead, which fires the
+    # patient_documents delete triggers of every index (postings, labs, search, signatures...)
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'trg_patients_delete_documents'")
+    cascade_exists = cursor.fetchone() is not None
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_patients_delete_documents
+        AFTER DELETE ON patients
+        BEGIN
+            DELETE FROM patient_documents WHERE patient_id = OLD.id;
+            DELETE FROM directories WHERE patient_id = OLD.id;
+        END
+    ''')
+    
+    # Entity posting lists for cohort queries
+    if create_cohort_tables(cursor):
+        backfill_cohort_index(cursor)
+    
+    # Numeric lab / vital sign values from patient documents
+    if create_lab_tables(cursor):
+        backfill_lab_observations(cursor)
+    
+    # Background analysis jobs for uploaded documents (leased by workers in any process)
+    create_job_tables(cursor)
+    
+    # Resumable (chunked) uploads
+    create_upload_tables(cursor)
+    
+    # Content hashes for deduplication, and bulk ingests of archives / folders
+    hashes_added = add_column_if_missing(cursor, 'patient_documents', 'content_hash', 'TEXT')
+    create_ingest_tables(cursor)
+    if hashes_added:
+        backfill_content_hashes(cursor)
+    
+    # Patients and messages received from HL7 v2 feeds
+    create_hl7_tables(cursor)
+    
+    # MinHash signatures / LSH buckets for spotting notes copied forward from an earlier one
+    add_column_if_missing(cursor, 'patient_documents', 'copy_forward_of', 'TEXT')
+    if create_copy_forward_tables(cursor):
+        backfill_signatures(cursor)
+    
+    # Per-patient timeline rollups (after labs, which the rollup reads)
+    if create_timeline_tables(cursor):
+        backfill_timeline(cursor)
+    
+    # Full-text search over patient documents (needs SQLite built with FTS5)
+    global SEARCH_INDEX_AVAILABLE
+    try:
+        if create_search_index(cursor):
+            backfill_search_index(cursor)
+        SEARCH_INDEX_AVAILABLE = True
+    except sqlite3.OperationalError as e:
+        SEARCH_INDEX_AVAILABLE = False
+        logging.warning(f"Document search disabled, FTS5 not available: {str(e)}")
+    
+    # Documents left behind by patients deleted before the cascade trigger existed
+    # (after every index's delete trigger is in place)
+    if not cascade_exists:
+        cursor.execute('DELETE FROM patient_documents WHERE patient_id NOT IN (SELECT id FROM patients)')
+        cursor.execute('DELETE FROM directories WHERE patient_id NOT IN (SELECT id FROM patients)')
+    
     conn.commit()
     conn.close()
 
-async def analyze_medical_text_advanced(text: str) -> Dict[str, Any]:
-    """
-    Advanced medical text analysis using Bio_ClinicalBERT and comprehensive medical databases
+def add_column_if_missing(cursor, table: str, column: str, definition: str) -> bool:
+    """ALTER TABLE migration for existing databases; returns True if the column was added"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column in [row[1] for row in cursor.fetchall()]:
+        return False
+    cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return True
+
+def create_document_counter_triggers(cursor):
+    """Keep patients.document_count/last_activity and directories.document_count in step with patient_documents"""
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_patient_documents_insert_counters
+        AFTER INSERT ON patient_documents
+        BEGIN
+            UPDATE patients
+            SET document_count = document_count + 1,
+                last_activity = CASE WHEN last_activity IS NULL OR NEW.uploaded_at > last_activity
+                                     THEN NEW.uploaded_at ELSE last_activity END
+            WHERE id = NEW.patient_id;
+            UPDATE directories SET document_count = document_count + 1 WHERE id = NEW.directory_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_patient_documents_delete_counters
+        AFTER DELETE ON patient_documents
+        BEGIN
+            UPDATE patients
+            SET document_count = document_count - 1,
+                last_activity = (SELECT MAX(uploaded_at) FROM patient_documents WHERE patient_id = OLD.patient_id)
+            WHERE id = OLD.patient_id;
+            UPDATE directories SET document_count = document_count - 1 WHERE id = OLD.directory_id;
+        END
+    ''')
+    # Moving a document between directories (or patients) shifts both counters
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_patient_documents_move_counters
+        AFTER UPDATE OF patient_id, directory_id, uploaded_at ON patient_documents
+        WHEN OLD.patient_id IS NOT NEW.patient_id
+          OR OLD.directory_id IS NOT NEW.directory_id
+          OR OLD.uploaded_at IS NOT NEW.uploaded_at
+        BEGIN
+            UPDATE patients SET document_count = document_count - 1 WHERE id = OLD.patient_id;
+            UPDATE patients SET document_count = document_count + 1 WHERE id = NEW.patient_id;
+            UPDATE patients
+            SET last_activity = (SELECT MAX(uploaded_at) FROM patient_documents WHERE patient_id = patients.id)
+            WHERE id IN (OLD.patient_id, NEW.patient_id);
+            UPDATE directories SET document_count = document_count - 1 WHERE id = OLD.directory_id;
+            UPDATE directories SET document_count = document_count + 1 WHERE id = NEW.directory_id;
+        END
+    ''')
+
+def backfill_document_counters(cursor):
+    """Recompute every counter from patient_documents (one-off backfill / repair)"""
+    cursor.execute('''
+        UPDATE patients
+        SET document_count = (SELECT COUNT(*) FROM patient_documents pd WHERE pd.patient_id = patients.id),
+            last_activity = (SELECT MAX(pd.uploaded_at) FROM patient_documents pd WHERE pd.patient_id = patients.id)
+    ''')
+    cursor.execute('''
+        UPDATE directories
+        SET document_count = (SELECT COUNT(*) FROM patient_documents pd WHERE pd.directory_id = directories.id)
+    ''')
+
+def resolve_analysis_options(analysis_profile: Optional[str] = None,
+                             categories: Optional[Any] = None) -> Tuple[str, Optional[List[str]]]:
+    """Validate an analysis profile name and an optional category filter.
+
+    Categories may be given as a comma separated string or a list. Returns the
+    profile name and the requested categories in canonical order (None = all).
     """
-    import re
-    from fast_medical_db import get_fast_medical_db
-    
-    # Initialize fast medical database for instant lookup
-    db_manager = get_fast_medical_db()
-    
-    # Enhanced medical entity patterns for comprehensive analysis
-    medical_patterns = {
-        "SYMPTOM": [
-            r'\b(?:chest pain|shortness of breath|dyspnea|headache|nausea|vomiting|dizziness|fatigue|fever|cough|abdominal pain|back pain|joint pain|muscle pain|difficulty breathing|palpitations|sweating|weakness|numbness|tingling|blurred vision|confusion|memory loss|seizure|syncope|edema|swelling|rash|itching|burning|cramping|stiffness|soreness|aching|throbbing|sharp pain|dull pain|radiating pain|intermittent pain|chronic pain|acute pain|severe pain|mild pain|moderate pain)\b',
-            r'\b(?:difficulty swallowing|dysphagia|loss of appetite|weight loss|weight gain|night sweats|chills|shivering|tremor|spasms|twitching|restlessness|insomnia|drowsiness|lethargy|malaise|irritability|mood changes|anxiety|depression|panic|fear|stress|tension)\b',
-            r'\b(?:bleeding|bruising|discharge|drainage|swelling|inflammation|redness|warmth|tenderness|sensitivity|pressure|fullness|bloating|distension|constipation|diarrhea|incontinence|urgency|frequency|hesitancy|retention)\b'
-        ],
-        "CONDITION": [
-            r'\b(?:hypertension|high blood pressure|diabetes|type 1 diabetes|type 2 diabetes|heart disease|coronary artery disease|myocardial infarction|heart attack|stroke|cerebrovascular accident|pneumonia|asthma|copd|chronic obstructive pulmonary disease|cancer|tumor|malignancy|depression|anxiety|arthritis|osteoporosis|kidney disease|liver disease|thyroid disease|anemia|infection|sepsis|pneumothorax|pleural effusion|atrial fibrillation|heart failure|cardiomyopathy)\b',
-            r'\b(?:bronchitis|emphysema|tuberculosis|tb|hepatitis|cirrhosis|pancreatitis|gastritis|ulcer|gastroesophageal reflux|gerd|irritable bowel syndrome|ibs|crohn\'s disease|ulcerative colitis|diverticulitis|appendicitis|cholecystitis|nephritis|cystitis|prostatitis|endometriosis|fibromyalgia|lupus|rheumatoid arthritis|osteoarthritis|gout|migraine|epilepsy|parkinson\'s disease|alzheimer\'s disease|dementia)\b',
-            r'\b(?:hyperthyroidism|hypothyroidism|hyperlipidemia|obesity|metabolic syndrome|sleep apnea|chronic fatigue syndrome|fibromyalgia|multiple sclerosis|muscular dystrophy|cerebral palsy|spina bifida|down syndrome|autism|adhd|bipolar disorder|schizophrenia|ptsd|eating disorder|substance abuse|alcoholism|smoking|tobacco use)\b'
-        ],
-        "MEDICATION": [
-            r'\b(?:aspirin|acetylsalicylic acid|metformin|lisinopril|atorvastatin|amlodipine|metoprolol|hydrochlorothiazide|hctz|omeprazole|levothyroxine|warfarin|insulin|prednisone|albuterol|furosemide|gabapentin|tramadol|ibuprofen|acetaminophen|tylenol|morphine|oxycodone|amoxicillin|azithromycin|ciprofloxacin|doxycycline)\b',
-            r'\b(?:simvastatin|rosuvastatin|crestor|lipitor|losartan|valsartan|enalapril|captopril|diltiazem|nifedipine|propranolol|atenolol|carvedilol|spironolactone|digoxin|clopidogrel|plavix|rivaroxaban|apixaban|dabigatran|heparin|enoxaparin)\b',
-            r'\b(?:sertraline|fluoxetine|paroxetine|citalopram|escitalopram|venlafaxine|duloxetine|bupropion|trazodone|mirtazapine|lorazepam|alprazolam|clonazepam|diazepam|zolpidem|eszopiclone|quetiapine|risperidone|olanzapine|aripiprazole)\b',
-            r'\b(?:methotrexate|hydroxychloroquine|sulfasalazine|adalimumab|etanercept|infliximab|rituximab|cyclophosphamide|azathioprine|mycophenolate|tacrolimus|cyclosporine|sirolimus|everolimus)\b'
-        ],
-        "VITAL_SIGNS": [
-            r'\b(?:blood pressure|bp|systolic|diastolic|heart rate|hr|pulse rate|temperature|temp|respiratory rate|rr|breathing rate|oxygen saturation|o2 sat|spo2|pulse|weight|height|bmi|body mass index)\b',
-            r'\b(?:\d+/\d+\s*mmhg|\d+\s*bpm|\d+\.\d+°[cf]|\d+°[cf]|\d+\s*kg|\d+\s*lbs|\d+\s*cm|\d+\s*ft|\d+\'\d+"|\d+\s*%\s*o2|\d+\s*breaths/min)\b'
-        ],
-        "LAB_VALUES": [
-            r'\b(?:glucose|blood sugar|cholesterol|total cholesterol|triglycerides|hdl|ldl|hemoglobin|hgb|hematocrit|hct|white blood cell|wbc|red blood cell|rbc|platelet|plt|creatinine|bun|blood urea nitrogen|sodium|potassium|chloride|co2|bicarbonate|ast|alt|bilirubin|albumin|protein|inr|pt|ptt|aptt)\b',
-            r'\b(?:thyroid stimulating hormone|tsh|free t4|free t3|vitamin d|vitamin b12|folate|iron|ferritin|transferrin|c-reactive protein|crp|erythrocyte sedimentation rate|esr|troponin|ck-mb|bnp|nt-probnp|psa|cea|ca 19-9|ca 125|afp)\b',
-            r'\b(?:hba1c|hemoglobin a1c|microalbumin|egfr|estimated glomerular filtration rate|lipase|amylase|lactate|lactic acid|arterial blood gas|abg|ph|pco2|po2|base excess|anion gap)\b'
-        ],
-        "ANATOMY": [
-            r'\b(?:heart|cardiac|lung|pulmonary|liver|hepatic|kidney|renal|brain|cerebral|stomach|gastric|intestine|bowel|colon|colonic|pancreas|pancreatic|gallbladder|spleen|splenic|thyroid|prostate|breast|mammary|uterus|uterine|ovary|ovarian|bladder|vesical|skin|dermal|bone|osseous|muscle|muscular|joint|articular|artery|arterial|vein|venous|nerve|neural|spine|spinal|chest|thoracic|abdomen|abdominal|pelvis|pelvic|extremities)\b',
-            r'\b(?:head|neck|shoulder|arm|elbow|wrist|hand|finger|thumb|back|hip|thigh|knee|leg|ankle|foot|toe|eye|ear|nose|mouth|throat|esophagus|trachea|bronchi|alveoli|atrium|ventricle|valve|aorta|carotid|jugular|femoral|portal|hepatic|renal|cerebral|coronary)\b'
-        ],
-        "PROCEDURES": [
-            r'\b(?:x-ray|ct scan|mri|ultrasound|echocardiogram|ekg|ecg|stress test|colonoscopy|endoscopy|bronchoscopy|biopsy|surgery|operation|procedure|catheterization|angioplasty|stent|pacemaker|defibrillator|dialysis|chemotherapy|radiation therapy|physical therapy|occupational therapy)\b',
-            r'\b(?:blood test|urine test|stool test|culture|sensitivity|pathology|histology|cytology|mammogram|bone scan|pet scan|nuclear medicine|fluoroscopy|angiography|venography|arthrography|myelography)\b'
-        ],
-        "ALLERGIES": [
-            r'\b(?:allergic to|allergy to|allergies|hypersensitive to|intolerant to|adverse reaction to|penicillin allergy|sulfa allergy|latex allergy|food allergy|drug allergy|environmental allergy|seasonal allergy|pollen allergy|dust allergy|mold allergy|pet allergy|shellfish allergy|nut allergy)\b'
-        ],
-        "FAMILY_HISTORY": [
-            r'\b(?:family history|familial|hereditary|genetic|mother had|father had|sibling had|parent had|grandmother had|grandfather had|runs in family|family member|relative had)\b'
-        ],
-        "SOCIAL_HISTORY": [
-            r'\b(?:smoking|tobacco|cigarettes|alcohol|drinking|drug use|substance use|occupation|work|exercise|diet|lifestyle|married|single|divorced|widowed|lives alone|lives with|social support|insurance|medicare|medicaid)\b'
-        ]
-    }
-    
-    # Extract entities using comprehensive database lookup + pattern matching
-    medical_entities = []
-    entity_id = 1
-    
-    # First, use fast database lookup for comprehensive coverage
-    db_results = db_manager.search_terms(text)
-    for term, category, source_db in db_results:
-        # Find all occurrences of this term in the text
-        pattern = re.escape(term)
-        matches = re.finditer(pattern, text.lower(), re.IGNORECASE)
-        for match in matches:
-            entity = {
-                "id": entity_id,
-                "text": match.group(),
-                "label": category,
-                "start_pos": match.start(),
-                "end_pos": match.end(),
-                "confidence": round(0.90 + (hash(term) % 10) / 100, 2),  # Higher confidence for DB matches
-                "source": source_db
-            }
-            medical_entities.append(entity)
-            entity_id += 1
-    
-    # Then, use pattern matching for additional coverage
-    for label, patterns in medical_patterns.items():
-        for pattern in patterns:
-            matches = re.finditer(pattern, text.lower(), re.IGNORECASE)
-            for match in matches:
-                # Check if this entity is already found by database lookup
-                already_found = any(
-                    abs(e["start_pos"] - match.start()) < 5 and e["text"].lower() == match.group().lower()
-                    for e in medical_entities
-                )
-                
-                if not already_found:
-                    entity = {
-                        "id": entity_id,
-                        "text": match.group(),
-                        "label": label,
-                        "start_pos": match.start(),
-                        "end_pos": match.end(),
-                        "confidence": round(0.85 + (hash(match.group()) % 15) / 100, 2),
-                        "source": "Pattern"
-                    }
-                    medical_entities.append(entity)
-                    entity_id += 1
-    
-    # Remove duplicates and sort by position
-    seen_entities = set()
-    unique_entities = []
-    for entity in medical_entities:
-        entity_key = (entity["text"].lower(), entity["label"])
-        if entity_key not in seen_entities:
-            seen_entities.add(entity_key)
-            unique_entities.append(entity)
-    
-    unique_entities.sort(key=lambda x: x["start_pos"])
-    
-    # Categorize extracted entities for better organization
-    categorized_entities = {
-        "symptoms": [e for e in unique_entities if e["label"] == "SYMPTOM"],
-        "conditions": [e for e in unique_entities if e["label"] == "CONDITION"],
-        "medications": [e for e in unique_entities if e["label"] == "MEDICATION"],
-        "vital_signs": [e for e in unique_entities if e["label"] == "VITAL_SIGNS"],
-        "lab_values": [e for e in unique_entities if e["label"] == "LAB_VALUES"],
-        "anatomy": [e for e in unique_entities if e["label"] == "ANATOMY"],
-        "procedures": [e for e in unique_entities if e["label"] == "PROCEDURES"],
-        "allergies": [e for e in unique_entities if e["label"] == "ALLERGIES"],
-        "family_history": [e for e in unique_entities if e["label"] == "FAMILY_HISTORY"],
-        "social_history": [e for e in unique_entities if e["label"] == "SOCIAL_HISTORY"]
-    }
-    
-    # Generate comprehensive medical summary
-    summary_parts = []
-    if categorized_entities["symptoms"]:
-        symptoms_text = ', '.join([e["text"] for e in categorized_entities["symptoms"][:5]])
-        summary_parts.append(f"Patient presents with: {symptoms_text}")
+    profile = (analysis_profile or DEFAULT_ANALYSIS_PROFILE).strip().lower()
+    if profile not in ANALYSIS_PROFILES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown analysis_profile '{analysis_profile}'. Use one of: {', '.join(ANALYSIS_PROFILES)}"
+        )
     
-    if categorized_entities["conditions"]:
-        conditions_text = ', '.join([e["text"] for e in categorized_entities["conditions"][:5]])
-        summary_parts.append(f"Medical history includes: {conditions_text}")
+    if categories is None or categories == "" or categories == []:
+        return profile, None
     
-    if categorized_entities["medications"]:
-        medications_text = ', '.join([e["text"] for e in categorized_entities["medications"][:5]])
-        summary_parts.append(f"Current medications: {medications_text}")
+    if isinstance(categories, str):
+        requested = [c.strip().lower() for c in categories.split(',') if c.strip()]
+    elif isinstance(categories, list):
+        requested = [str(c).strip().lower() for c in categories if str(c).strip()]
+    else:
+        raise HTTPException(status_code=400, detail="categories must be a list or comma separated string")
     
-    if categorized_entities["vital_signs"]:
-        vitals_text = ', '.join([e["text"] for e in categorized_entities["vital_signs"][:3]])
-        summary_parts.append(f"Vital signs noted: {vitals_text}")
+    unknown = [c for c in requested if c not in ENTITY_CATEGORIES]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown categories: {', '.join(unknown)}. Use any of: {', '.join(ENTITY_CATEGORIES)}"
+        )
     
-    if categorized_entities["lab_values"]:
-        labs_text = ', '.join([e["text"] for e in categorized_entities["lab_values"][:3]])
-        summary_parts.append(f"Laboratory values: {labs_text}")
+    return profile, [c for c in ENTITY_CATEGORIES if c in requested]
+
+def resolve_projection(value: Optional[str], allowed: List[str], default: List[str],
+                       param_name: str = "fields") -> List[str]:
+    """Validate a comma separated fields=/include= list against the allowed names.
+
+    Returns the requested names in the order of allowed (default when not given).
+    """
+    if value is None or not value.strip():
+        return list(default)
     
-    summary = ". ".join(summary_parts) if summary_parts else "Medical text analyzed."
+    requested = [f.strip() for f in value.split(',') if f.strip()]
+    unknown = [f for f in requested if f not in allowed]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown {param_name}: {', '.join(unknown)}. Use any of: {', '.join(allowed)}"
+        )
     
-    # Calculate overall confidence
-    if unique_entities:
-        avg_confidence = sum(e["confidence"] for e in unique_entities) / len(unique_entities)
-    else:
-        avg_confidence = 0.5
-    
-    # Generate differential diagnosis suggestions (simplified)
-    differential_diagnosis = []
-    symptom_texts = [e["text"].lower() for e in categorized_entities["symptoms"]]
-    
-    if any("chest pain" in s for s in symptom_texts):
-        differential_diagnosis.extend([
-            {"condition": "Myocardial Infarction", "confidence": 0.75, "reasoning": "Chest pain is a cardinal symptom"},
-            {"condition": "Angina Pectoris", "confidence": 0.68, "reasoning": "Chest pain with possible cardiac origin"},
-            {"condition": "Pulmonary Embolism", "confidence": 0.45, "reasoning": "Chest pain with respiratory symptoms"}
-        ])
-    
-    if any("shortness of breath" in s for s in symptom_texts):
-        differential_diagnosis.extend([
-            {"condition": "Heart Failure", "confidence": 0.72, "reasoning": "Dyspnea is a common presentation"},
-            {"condition": "Asthma Exacerbation", "confidence": 0.58, "reasoning": "Respiratory symptoms present"}
-        ])
-    
-    # Remove duplicates from differential diagnosis
-    seen_conditions = set()
-    unique_differential = []
-    for dx in differential_diagnosis:
-        if dx["condition"] not in seen_conditions:
-            seen_conditions.add(dx["condition"])
-            unique_differential.append(dx)
-    
-    # Sort by confidence
-    unique_differential.sort(key=lambda x: x["confidence"], reverse=True)
-    
-    # Create critical findings alert system
-    critical_findings = []
-    critical_symptoms = ["chest pain", "shortness of breath", "severe pain", "difficulty breathing", "seizure", "syncope"]
-    critical_conditions = ["myocardial infarction", "heart attack", "stroke", "sepsis", "pneumothorax"]
-    
-    for entity in unique_entities:
-        if any(critical in entity["text"].lower() for critical in critical_symptoms + critical_conditions):
-            critical_findings.append({
-                "text": entity["text"],
-                "category": entity["label"],
-                "severity": "HIGH",
-                "reason": "Critical symptom or condition detected"
-            })
-    
-    # Enhanced entity summary with counts
-    entity_counts = {
-        "symptoms": len(categorized_entities["symptoms"]),
-        "conditions": len(categorized_entities["conditions"]),
-        "medications": len(categorized_entities["medications"]),
-        "vital_signs": len(categorized_entities["vital_signs"]),
-        "lab_values": len(categorized_entities["lab_values"]),
-        "procedures": len(categorized_entities["procedures"]),
-        "allergies": len(categorized_entities["allergies"]),
-        "family_history": len(categorized_entities["family_history"]),
-        "social_history": len(categorized_entities["social_history"]),
-        "total_entities": len(unique_entities)
-    }
+    return [f for f in allowed if f in requested]
+
+def resolve_priority(priority: Optional[str], default: str) -> str:
+    """Validate an analysis priority class name (interactive | upload | bulk)"""
+    name = (priority or default).strip().lower()
+    if name not in PRIORITY_CLASSES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown priority '{priority}'. Use one of: {', '.join(PRIORITY_CLASSES)}"
+        )
+    return name
+
+async def analyze_medical_text_advanced(text: str, analysis_profile: str = DEFAULT_ANALYSIS_PROFILE,
+                                        categories: Optional[List[str]] = None,
+                                        priority: str = "interactive", tenant: str = "demo_user",
+                                        prior: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Advanced medical text analysis using Bio_ClinicalBERT and comprehensive medical databases
     
-    return {
-        "extracted_text": text,
-        "medical_entities": unique_entities,
-        "categorized_entities": categorized_entities,
-        "entity_counts": entity_counts,
-        "summary": summary,
-        "critical_findings": critical_findings,
-        "differential_diagnosis": unique_differential[:5],  # Top 5 suggestions
-        "confidence_score": round(avg_confidence, 2),
-        "analysis_type": "enhanced_medical_ner",
-        "processing_metadata": {
-            "text_length": len(text),
-            "entities_found": len(unique_entities),
-            "categories_detected": len([k for k, v in categorized_entities.items() if v]),
-            "has_critical_findings": len(critical_findings) > 0
-        }
-    }
+    Runs the staged pipeline in analysis_pipeline.py. analysis_profile selects which
+    stages run (see ANALYSIS_PROFILES) and categories restricts the output to the
+    given entity categories; stages whose output was not requested are skipped.
+    The analysis waits for a slot of ANALYSIS_SCHEDULER in its priority class,
+    sharing it fairly with the other users / patients (tenant) of that class.
+    prior is the analysis of an earlier note this text was copied forward from:
+    only the sentences that differ from it are analyzed again (copy_forward.py).
+    """
+    async with ANALYSIS_SCHEDULER.slot(priority, tenant):
+        if prior is not None:
+            _, analysis_results = run_copy_forward_analysis(text, prior, analysis_profile, categories)
+        else:
+            _, analysis_results = run_analysis(text, analysis_profile, categories)
+    return analysis_results
 
 async def load_models():
     """Lazy load AI models to improve startup time"""
@@ -410,18 +542,19 @@ async def load_models():
 
 def save_analysis_result(user_id: str, file_name: str, file_type: str, 
                         analysis_type: str, results: Dict[str, Any], 
-                        confidence_score: float) -> int:
-    """Save analysis results to database"""
-    conn = sqlite3.connect('dip_analysis.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT INTO analysis_results 
-        (user_id, file_name, file_type, analysis_type, results, confidence_score)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (user_id, file_name, file_type, analysis_type, json.dumps(results), confidence_score))
+                        confidence_score: float, cursor=None) -> int:
+    """Save analysis results to database (within the caller's transaction if a cursor is given)"""
+    if cursor is not None:
+        cursor.execute('''
+            INSERT INTO analysis_results 
+            (user_id, file_name, file_type, analysis_type, results, confidence_score)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (user_id, file_name, file_type, analysis_type, json.dumps(results), confidence_score))
+        return cursor.lastrowid
     
-    analysis_id = cursor.lastrowid
+    conn = sqlite3.connect('dip_analysis.db')
+    analysis_id = save_analysis_result(user_id, file_name, file_type, analysis_type, results,
+                                       confidence_score, conn.cursor())
     conn.commit()
     conn.close()
     
@@ -429,10 +562,23 @@ def save_analysis_result(user_id: str, file_name: str, file_type: str,
 
 @app.on_event("startup")
 async def startup_event():
-    """Initialize database and prepare models on startup"""
+    """Initialize database, start the analysis workers and prepare models on startup"""
     init_database()
+    ANALYSIS_SCHEDULER.configure(ANALYSIS_SLOTS)
+    JOB_QUEUE.start(process_document_job, ANALYSIS_WORKERS)
+    if HL7_LISTENER_PORT:
+        global HL7_LISTENER
+        HL7_LISTENER = HL7Listener(store_hl7_messages, notify=JOB_QUEUE.notify)
+        port = await HL7_LISTENER.start("0.0.0.0", int(HL7_LISTENER_PORT))
+        logging.info(f"HL7 MLLP listener on port {port}")
     logging.info("X-NOSIS DIP API started successfully!")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    if HL7_LISTENER:
+        await HL7_LISTENER.stop()
+    JOB_QUEUE.stop()
+
 @app.get("/")
 async def root():
     return {"message": "X-NOSIS Diagnostic Intelligence Platform API", "version": "1.0.0"}
@@ -465,16 +611,26 @@ async def health_check():
     }
 
 @app.post("/analyze/text")
-async def analyze_medical_text(file: UploadFile = File(...)):
+async def analyze_medical_text(file: UploadFile = File(...),
+                               analysis_profile: Optional[str] = Query(None),
+                               categories: Optional[str] = Query(None),
+                               priority: Optional[str] = Query(None),
+                               x_user_id: Optional[str] = Header(None)):
     """
     Analyze medical text using Bio_ClinicalBERT and advanced NER
     
-    Accepts: PDF, TXT, DOC files
+    Accepts: PDF, TXT, DOCX, RTF files (and DOC files that are really DOCX or RTF)
+    Query: analysis_profile (fast | standard | deep), categories (comma separated, e.g. medications,vital_signs),
+           priority (interactive | upload | bulk, default interactive)
+    Header: X-User-Id, the user whose fair share of analysis slots this request uses
     Returns: Structured medical analysis with entities, diagnosis, and summary
     """
     start_time = datetime.now()
     
     try:
+        profile, requested_categories = resolve_analysis_options(analysis_profile, categories)
+        priority_class = resolve_priority(priority, "interactive")
+        
         # Validate file
         if not file.filename:
             raise HTTPException(status_code=400, detail="No file provided")
@@ -493,31 +649,31 @@ async def analyze_medical_text(file: UploadFile = File(...)):
         # Reset file pointer
         await file.seek(0)
         
-        # Load models if not already loaded
-        await load_models()
+        # Load models if not already loaded (skipped by profiles without a model tier)
+        if ANALYSIS_PROFILES[profile]["models"]:
+            await load_models()
         
         # Extract text based on file type
         text = ""
         file_extension = file.filename.lower().split('.')[-1] if '.' in file.filename else ''
         
-        if file.content_type == "application/pdf" or file_extension == 'pdf':
+        file_type = 'application/pdf' if file_extension == 'pdf' else file.content_type
+        
+        if file_type == "application/pdf":
             try:
-                with pdfplumber.open(file.file) as pdf:
-                    text = "\n".join(page.extract_text() or "" for page in pdf.pages)
+                text = read_document_text(io.BytesIO(content), file_type, 50000)
             except Exception as e:
                 raise HTTPException(status_code=400, detail=f"PDF processing failed: {str(e)}")
         
-        elif file.content_type.startswith("text/") or file_extension in ['txt', 'doc', 'docx']:
+        elif (file_type or "").startswith("text/") or file_type in PATIENT_DOCUMENT_TYPES \
+                or file_extension in ['txt', 'doc', 'docx', 'rtf']:
             try:
-                text = content.decode("utf-8")
-            except UnicodeDecodeError:
-                try:
-                    text = content.decode("latin-1")
-                except UnicodeDecodeError:
-                    raise HTTPException(status_code=400, detail="Unable to decode text file")
+                text = read_document_text(io.BytesIO(content), file_type, 50000)
+            except DocumentTextError as e:
+                raise HTTPException(status_code=400, detail=str(e))
         
         else:
-            raise HTTPException(status_code=400, detail="Unsupported file type. Use PDF, TXT, or DOC files")
+            raise HTTPException(status_code=400, detail="Unsupported file type. Use PDF, TXT, DOCX or RTF files")
         
         # Validate extracted text
         if not text.strip():
@@ -528,7 +684,8 @@ async def analyze_medical_text(file: UploadFile = File(...)):
             logging.warning(f"Text truncated to 50k characters for file: {file.filename}")
         
         # Perform advanced medical analysis
-        analysis_results = await analyze_medical_text_advanced(text)
+        analysis_results = await analyze_medical_text_advanced(text, profile, requested_categories,
+                                                               priority_class, x_user_id or "demo_user")
         
         # Calculate processing time
         processing_time = (datetime.now() - start_time).total_seconds()
@@ -577,23 +734,32 @@ async def analyze_medical_text(file: UploadFile = File(...)):
         }
 
 @app.post("/analyze/batch")
-async def analyze_multiple_texts(files: list[UploadFile] = File(...)):
+async def analyze_multiple_texts(files: list[UploadFile] = File(...),
+                                 analysis_profile: Optional[str] = Query(None),
+                                 categories: Optional[str] = Query(None),
+                                 priority: Optional[str] = Query(None),
+                                 x_user_id: Optional[str] = Header(None)):
     """
     Analyze multiple medical text files in batch
     
-    Accepts: Multiple PDF, TXT, DOC files
+    Accepts: Multiple PDF, TXT, DOCX, RTF files
+    Query: analysis_profile, categories and priority, applied to every file
     Returns: Array of analysis results
     """
     if len(files) > 10:
         raise HTTPException(status_code=400, detail="Maximum 10 files allowed per batch")
     
+    # Validate once up front so a bad option fails the whole batch with a 400
+    resolve_analysis_options(analysis_profile, categories)
+    resolve_priority(priority, "interactive")
+    
     results = []
     start_time = datetime.now()
     
     for i, file in enumerate(files):
         try:
             # Analyze each file individually
-            result = await analyze_medical_text(file)
+            result = await analyze_medical_text(file, analysis_profile, categories, priority, x_user_id)
             result["batch_index"] = i
             results.append(result)
             
@@ -673,14 +839,20 @@ async def analyze_medical_image(file: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail=f"Analysis failed: {str(e)}")
 
 @app.post("/analyze/text-direct")
-async def analyze_text_direct(request: dict):
+async def analyze_text_direct(request: dict, x_user_id: Optional[str] = Header(None)):
     """
     Analyze medical text directly without file upload
     
-    Body: {"text": "medical text to analyze"}
+    Body: {"text": "medical text to analyze", "analysis_profile": "fast", "categories": ["medications"],
+           "priority": "interactive"}
+    Header: X-User-Id, the user whose fair share of analysis slots this request uses
     Returns: Structured medical analysis
     """
     try:
+        profile, requested_categories = resolve_analysis_options(
+            request.get("analysis_profile"), request.get("categories")
+        )
+        priority_class = resolve_priority(request.get("priority"), "interactive")
         text = request.get("text", "").strip()
         
         if not text:
@@ -691,11 +863,13 @@ async def analyze_text_direct(request: dict):
         
         start_time = datetime.now()
         
-        # Load models if not already loaded
-        await load_models()
+        # Load models if not already loaded (skipped by profiles without a model tier)
+        if ANALYSIS_PROFILES[profile]["models"]:
+            await load_models()
         
         # Perform analysis
-        analysis_results = await analyze_medical_text_advanced(text)
+        analysis_results = await analyze_medical_text_advanced(text, profile, requested_categories,
+                                                               priority_class, x_user_id or "demo_user")
         
         # Calculate processing time
         processing_time = (datetime.now() - start_time).total_seconds()
@@ -734,15 +908,238 @@ async def analyze_text_direct(request: dict):
         logging.error(error_msg)
         raise HTTPException(status_code=500, detail=error_msg)
 
+@app.websocket("/ws/analyze")
+async def live_text_analysis(websocket: WebSocket):
+    """
+    Incremental analysis for live typing in the chat and analysis pages
+    
+    Client messages:
+      {"type": "init", "text": "...", "analysis_profile": "fast", "categories": ["medications"]}
+      {"type": "edit", "start": 10, "end": 12, "text": "replacement"}
+      {"type": "save"}  - run the full analysis and store it; nothing else is persisted
+    Server messages: snapshot (all entities), diff (added entities, removed ids,
+    position shift), saved, error
+    """
+    await websocket.accept()
+    document = None
+    profile, requested_categories = "fast", None
+    
+    try:
+        while True:
+            message = await websocket.receive_json()
+            message_type = message.get("type")
+            
+            try:
+                if message_type == "init":
+                    profile, requested_categories = resolve_analysis_options(
+                        message.get("analysis_profile") or "fast", message.get("categories")
+                    )
+                    document = LiveDocument(AnalysisOptions(
+                        profile, tuple(requested_categories) if requested_categories else None
+                    ))
+                    await websocket.send_json(document.reset(message.get("text", "")))
+                
+                elif document is None:
+                    await websocket.send_json({"type": "error", "error": "Send an init message first"})
+                
+                elif message_type == "edit":
+                    diff = document.apply_edit(int(message["start"]), int(message["end"]), message.get("text", ""))
+                    await websocket.send_json(diff)
+                
+                elif message_type == "save":
+                    if not document.text.strip():
+                        raise ValueError("No text to save")
+                    
+                    start_time = datetime.now()
+                    analysis_results = await analyze_medical_text_advanced(document.text, profile, requested_categories)
+                    analysis_results["processing_time"] = round((datetime.now() - start_time).total_seconds(), 3)
+                    analysis_results["text_info"] = {
+                        "text_length": len(document.text),
+                        "word_count": len(document.text.split()),
+                        "input_method": "live_session"
+                    }
+                    
+                    analysis_id = save_analysis_result(
+                        user_id="demo_user",
+                        file_name="live_session_input",
+                        file_type="text",
+                        analysis_type="direct_text_analysis",
+                        results=analysis_results,
+                        confidence_score=analysis_results["confidence_score"]
+                    )
+                    await websocket.send_json({
+                        "type": "saved",
+                        "version": document.version,
+                        "analysis_id": analysis_id,
+                        "results": analysis_results
+                    })
+                
+                else:
+                    await websocket.send_json({"type": "error", "error": f"Unknown message type: {message_type}"})
+            
+            except HTTPException as e:
+                await websocket.send_json({"type": "error", "error": e.detail})
+            except (KeyError, TypeError, ValueError) as e:
+                await websocket.send_json({"type": "error", "error": str(e)})
+    
+    except WebSocketDisconnect:
+        logging.info("Live analysis session closed")
+
+@app.get("/analyze/memo-stats")
+async def get_sentence_memo_stats():
+    """Hit/miss counters for the per-sentence extraction memo"""
+    return {
+        "success": True,
+        "sentence_memo": SENTENCE_MEMO.stats(),
+        "timestamp": datetime.now().isoformat()
+    }
+
+ANALYSIS_FIELDS = ["id", "user_id", "file_name", "file_type", "analysis_type", "results", "confidence_score", "created_at"]
+RESULTS_KEY = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+def analysis_projection(fields: Optional[str]) -> Tuple[List[str], List[str]]:
+    """Split fields= into analysis_results columns and results.<key> paths"""
+    if fields is None or not fields.strip():
+        return list(ANALYSIS_FIELDS), []
+    
+    requested = [f.strip() for f in fields.split(',') if f.strip()]
+    result_keys = []
+    for field in requested:
+        if field.startswith("results."):
+            key = field[len("results."):]
+            if not RESULTS_KEY.match(key):
+                raise HTTPException(status_code=400, detail=f"Invalid results field: {field}")
+            if key not in result_keys:
+                result_keys.append(key)
+    columns = resolve_projection(
+        ",".join(f for f in requested if not f.startswith("results.")) or "id",
+        ANALYSIS_FIELDS, ANALYSIS_FIELDS
+    )
+    if "results" in columns:
+        result_keys = []  # the whole blob was asked for anyway
+    return columns, result_keys
+
+def analysis_select_sql(columns: List[str], result_keys: List[str]) -> str:
+    """Select list for analysis_results; results.<key> fields use json_extract so the
+    rest of the blob never leaves SQLite"""
+    select = list(columns)
+    for key in result_keys:
+        select.append(f"json_extract(results, '$.{key}'), json_type(results, '$.{key}')")
+    return ", ".join(select)
+
+def analysis_row(row, columns: List[str], result_keys: List[str]) -> Dict[str, Any]:
+    analysis = {}
+    for column, value in zip(columns, row):
+        analysis[column] = json.loads(value) if column == "results" and value else value
+    if result_keys:
+        results = {}
+        offset = len(columns)
+        for i, key in enumerate(result_keys):
+            value, value_type = row[offset + 2 * i], row[offset + 2 * i + 1]
+            if value_type is None:
+                continue  # key not present in this analysis
+            results[key] = json.loads(value) if value_type in ("object", "array") else value
+        analysis["results"] = results
+    return analysis
+
+# Upper bound on ids per batch request (one IN list, one response)
+MAX_BATCH_IDS = 500
+
+def parse_id_list(value: Any, param_name: str = "ids") -> List[int]:
+    """Analysis ids from "1,2,3" or a JSON list, de-duplicated in request order"""
+    items = value.split(',') if isinstance(value, str) else value
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail=f"{param_name} must be a list of analysis ids")
+    ids = []
+    for item in items:
+        try:
+            analysis_id = int(item.strip() if isinstance(item, str) else item)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail=f"Invalid analysis id in {param_name}: {item!r}")
+        ids.append(analysis_id)
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        raise HTTPException(status_code=400, detail=f"{param_name} must not be empty")
+    if len(ids) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_IDS} {param_name} per request")
+    return ids
+
+def fetch_analyses(ids: List[int], fields: Optional[str]) -> Dict[str, Any]:
+    """Many analyses in one query, in the order of ids, with the ids not found listed"""
+    columns, result_keys = analysis_projection(fields)
+    # id is always selected to put rows back in request order, and dropped if not asked for
+    select_columns = columns if "id" in columns else ["id"] + columns
+    
+    conn = sqlite3.connect('dip_analysis.db')
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT {analysis_select_sql(select_columns, result_keys)} FROM analysis_results
+        WHERE id IN (SELECT value FROM json_each(?))
+    ''', (json.dumps(ids),))
+    found = {}
+    for row in cursor.fetchall():
+        analysis = analysis_row(row, select_columns, result_keys)
+        found[analysis["id"]] = analysis
+        if "id" not in columns:
+            del analysis["id"]
+    conn.close()
+    
+    return {
+        "success": True,
+        "analyses": [found[analysis_id] for analysis_id in ids if analysis_id in found],
+        "missing": [analysis_id for analysis_id in ids if analysis_id not in found],
+        "timestamp": datetime.now().isoformat()
+    }
+
+@app.get("/analysis")
+async def get_analysis_results(ids: str = Query(..., min_length=1), fields: Optional[str] = Query(None)):
+    """
+    Retrieve several analyses in one request: ids=1,2,3
+    
+    Results keep the order of ids; ids with no analysis are listed under "missing".
+    fields works as on /analysis/{analysis_id}.
+    """
+    try:
+        return fetch_analyses(parse_id_list(ids), fields)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error retrieving analyses: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Retrieval failed: {str(e)}")
+
+@app.post("/analysis/batch")
+async def get_analysis_results_batch(request: dict):
+    """Same as GET /analysis for long id lists: {"ids": [1, 2, 3], "fields": "id,results.summary"}"""
+    try:
+        fields = request.get("fields")
+        if isinstance(fields, list):
+            fields = ",".join(fields)
+        return fetch_analyses(parse_id_list(request.get("ids")), fields)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error retrieving analyses: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Retrieval failed: {str(e)}")
+
 @app.get("/analysis/{analysis_id}")
-async def get_analysis_result(analysis_id: int):
-    """Retrieve analysis results by ID"""
+async def get_analysis_result(analysis_id: int, fields: Optional[str] = Query(None)):
+    """
+    Retrieve analysis results by ID
+    
+    fields: comma separated subset of id, user_id, file_name, file_type, analysis_type,
+    results, confidence_score, created_at. results.<key> (e.g. results.summary)
+    returns just that part of the results blob.
+    """
     try:
+        columns, result_keys = analysis_projection(fields)
+        
         conn = sqlite3.connect('dip_analysis.db')
         cursor = conn.cursor()
         
-        cursor.execute('''
-            SELECT * FROM analysis_results WHERE id = ?
+        cursor.execute(f'''
+            SELECT {analysis_select_sql(columns, result_keys)} FROM analysis_results WHERE id = ?
         ''', (analysis_id,))
         
         result = cursor.fetchone()
@@ -751,29 +1148,135 @@ async def get_analysis_result(analysis_id: int):
         if not result:
             raise HTTPException(status_code=404, detail="Analysis not found")
         
-        return {
-            "id": result[0],
-            "user_id": result[1],
-            "file_name": result[2],
-            "file_type": result[3],
-            "analysis_type": result[4],
-            "results": json.loads(result[5]),
-            "confidence_score": result[6],
-            "created_at": result[7]
-        }
+        return analysis_row(result, columns, result_keys)
         
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error retrieving analysis: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Retrieval failed: {str(e)}")
 
+# Equality filters of GET /history and the index that serves each, in order of preference.
+# Every history index is (filter, created_at, id, confidence_score): pages are read in
+# created_at order straight from the index, min_confidence is checked without touching
+# the table, and only matching rows are fetched (their leading columns, never the results blob).
+HISTORY_INDEXES = [
+    ("user_id", "idx_analysis_results_user_created"),
+    ("analysis_type", "idx_analysis_results_type_created"),
+    ("file_type", "idx_analysis_results_file_type_created")
+]
+HISTORY_COLUMNS = ["id", "user_id", "file_name", "file_type", "analysis_type", "confidence_score", "created_at"]
+
+@app.get("/history")
+async def get_analysis_history(user_id: Optional[str] = None,
+                               analysis_type: Optional[str] = None,
+                               file_type: Optional[str] = None,
+                               since: Optional[str] = None,
+                               until: Optional[str] = None,
+                               min_confidence: Optional[float] = Query(None, ge=0, le=1),
+                               limit: int = Query(50, ge=1, le=500),
+                               cursor: Optional[str] = Query(None)):
+    """
+    Analysis history, newest first, as light summaries (the results blob is not read)
+    
+    Filters: user_id, analysis_type, file_type, since/until (created_at, ISO date or
+    datetime) and min_confidence. Keyset pagination: pass the returned next_cursor to
+    get the following page.
+    """
+    try:
+        since_value = parse_time_param(since, "since")
+        until_value = parse_time_param(until, "until", end_of_day=True)
+        
+        conditions, params = [], []
+        filters = {"user_id": user_id, "analysis_type": analysis_type, "file_type": file_type}
+        for column, value in filters.items():
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        for condition, value in (("created_at >= ?", since_value), ("created_at <= ?", until_value),
+                                 ("confidence_score >= ?", min_confidence)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        if cursor:
+            created_at, last_id = decode_cursor(cursor)
+            conditions.append("(created_at, id) < (?, ?)")
+            params.extend([created_at, last_id])
+        
+        index = next((name for column, name in HISTORY_INDEXES if filters[column] is not None),
+                     "idx_analysis_results_created")
+        
+        conn = sqlite3.connect('dip_analysis.db')
+        db_cursor = conn.cursor()
+        db_cursor.execute(f'''
+            SELECT {", ".join(HISTORY_COLUMNS)}
+            FROM analysis_results INDEXED BY {index}
+            {"WHERE " + " AND ".join(conditions) if conditions else ""}
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+        ''', params + [limit + 1])
+        rows = db_cursor.fetchall()
+        conn.close()
+        
+        history = [dict(zip(HISTORY_COLUMNS, row)) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = encode_cursor([history[-1]["created_at"], history[-1]["id"]])
+        
+        return {
+            "success": True,
+            "history": history,
+            "count": len(history),
+            "next_cursor": next_cursor,
+            "timestamp": datetime.now().isoformat()
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error listing analysis history: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to list history: {str(e)}")
+
 # Legacy endpoint for backward compatibility
 @app.post("/analyze")
 async def analyze_report_legacy(file: UploadFile = File(...)):
     """Legacy analyze endpoint - redirects to text analysis"""
-    return await analyze_medical_text(file)
+    return await analyze_medical_text(file, None, None, None, None)
 
 # Patient Management API Endpoints
 
+# Directories every new patient starts with
+DEFAULT_DIRECTORIES = [
+    {"name": "Imaging", "icon": "Camera", "color": "blue"},
+    {"name": "Lab Reports", "icon": "TestTube", "color": "green"},
+    {"name": "Follow-ups", "icon": "Calendar", "color": "orange"},
+    {"name": "Clinical Notes", "icon": "FileText", "color": "purple"}
+]
+
+def insert_patient(cursor, name: str, date_of_birth: Optional[str],
+                   metadata: Dict[str, Any]) -> Tuple[str, Dict[str, str]]:
+    """Store a patient with the default directories; returns (patient_id, {directory name: id})"""
+    import uuid
+    patient_id = str(uuid.uuid4())
+    cursor.execute('''
+        INSERT INTO patients (id, name, date_of_birth, metadata)
+        VALUES (?, ?, ?, ?)
+    ''', (
+        patient_id,
+        name,
+        date_of_birth,
+        json.dumps(metadata)
+    ))
+    
+    directories = {}
+    for i, dir_data in enumerate(DEFAULT_DIRECTORIES):
+        directories[dir_data["name"]] = str(uuid.uuid4())
+        cursor.execute('''
+            INSERT INTO directories (id, name, type, patient_id, icon, color, sort_order)
+            VALUES (?, ?, 'default', ?, ?, ?, ?)
+        ''', (directories[dir_data["name"]], dir_data["name"], patient_id, dir_data["icon"], dir_data["color"], i))
+    return patient_id, directories
+
 @app.post("/patients")
 async def create_patient(patient_data: dict):
     """Create a new patient"""
@@ -795,36 +1298,10 @@ async def create_patient(patient_data: dict):
             except ValueError:
                 raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
         
-        import uuid
-        patient_id = str(uuid.uuid4())
-        
         conn = sqlite3.connect('dip_analysis.db')
         cursor = conn.cursor()
         
-        cursor.execute('''
-            INSERT INTO patients (id, name, date_of_birth, metadata)
-            VALUES (?, ?, ?, ?)
-        ''', (
-            patient_id,
-            name,
-            date_of_birth,
-            json.dumps(patient_data.get('metadata', {}))
-        ))
-        
-        # Create default directories for the patient
-        default_directories = [
-            {"name": "Imaging", "icon": "Camera", "color": "blue"},
-            {"name": "Lab Reports", "icon": "TestTube", "color": "green"},
-            {"name": "Follow-ups", "icon": "Calendar", "color": "orange"},
-            {"name": "Clinical Notes", "icon": "FileText", "color": "purple"}
-        ]
-        
-        for i, dir_data in enumerate(default_directories):
-            dir_id = str(uuid.uuid4())
-            cursor.execute('''
-                INSERT INTO directories (id, name, type, patient_id, icon, color, sort_order)
-                VALUES (?, ?, 'default', ?, ?, ?, ?)
-            ''', (dir_id, dir_data["name"], patient_id, dir_data["icon"], dir_data["color"], i))
+        patient_id, _ = insert_patient(cursor, name, date_of_birth, patient_data.get('metadata', {}))
         
         conn.commit()
         conn.close()
@@ -906,97 +1383,260 @@ async def upload_patient_avatar(patient_id: str, avatar: UploadFile = File(...))
         logging.error(f"Error uploading avatar: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to upload avatar: {str(e)}")
 
-@app.get("/patients")
-async def get_patients():
-    """Get all patients with basic statistics"""
+# Sort options for GET /patients: column and direction; id breaks ties
+PATIENT_SORT_OPTIONS = {
+    "updated_desc": ("updated_at", "DESC"),
+    "updated_asc": ("updated_at", "ASC"),
+    "created_desc": ("created_at", "DESC"),
+    "created_asc": ("created_at", "ASC"),
+    "name_asc": ("name", "ASC"),
+    "name_desc": ("name", "DESC")
+}
+
+PATIENT_FIELDS = ["id", "name", "date_of_birth", "created_at", "updated_at", "metadata",
+                  "document_count", "last_activity"]
+PATIENT_DETAIL_FIELDS = PATIENT_FIELDS + ["directories", "directory_tree"]
+
+PATIENT_LIST_COLUMNS = '''
+    p.id, p.name, p.date_of_birth, p.created_at, p.updated_at, p.metadata,
+    p.document_count, p.last_activity
+'''
+
+def encode_cursor(values: List[Any]) -> str:
+    """Opaque keyset cursor for the last row of a page"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor: str) -> List[Any]:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list) or len(values) != 2:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+def patient_list_row(row, fields: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Patient dict from a PATIENT_LIST_COLUMNS row, limited to fields if given"""
+    patient = {
+        "id": row[0],
+        "name": row[1],
+        "date_of_birth": row[2],
+        "created_at": row[3],
+        "updated_at": row[4],
+        "metadata": json.loads(row[5]) if row[5] else {},
+        "document_count": row[6] or 0,
+        "last_activity": row[7]
+    }
+    if fields is None:
+        return patient
+    return {name: patient[name] for name in fields if name in patient}
+
+def stream_patients(sort_column: str, direction: str, batch_size: int = 500,
+                    fields: Optional[List[str]] = None):
+    """Yield every patient as one JSON array, a batch of rows at a time"""
+    # The generator is resumed from Starlette's thread pool, so the connection
+    # must not be pinned to the thread that opened it
+    conn = sqlite3.connect('dip_analysis.db', check_same_thread=False)
     try:
-        conn = sqlite3.connect('dip_analysis.db')
         cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT 
-                p.id, p.name, p.date_of_birth, p.created_at, p.updated_at, p.metadata,
-                COUNT(pd.id) as document_count,
-                MAX(pd.uploaded_at) as last_activity
+        cursor.execute(f'''
+            SELECT {PATIENT_LIST_COLUMNS}
             FROM patients p
-            LEFT JOIN patient_documents pd ON p.id = pd.patient_id
-            GROUP BY p.id, p.name, p.date_of_birth, p.created_at, p.updated_at, p.metadata
-            ORDER BY p.updated_at DESC
+            ORDER BY p.{sort_column} {direction}, p.id {direction}
         ''')
+        yield b"["
+        first = True
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            chunk = ",".join(json.dumps(patient_list_row(row, fields)) for row in rows)
+            yield (chunk if first else "," + chunk).encode()
+            first = False
+        yield b"]"
+    finally:
+        conn.close()
+
+@app.get("/patients")
+async def get_patients(limit: int = Query(100, ge=1, le=1000),
+                       cursor: Optional[str] = Query(None),
+                       sort: str = Query("updated_desc"),
+                       stream: bool = Query(False),
+                       include_total: bool = Query(False),
+                       fields: Optional[str] = Query(None),
+                       q: Optional[str] = Query(None)):
+    """
+    List patients with basic statistics
+    
+    Keyset pagination: pass the returned next_cursor to get the following page.
+    sort: updated_desc (default), updated_asc, created_desc, created_asc, name_asc, name_desc
+    stream=true returns every patient as a streamed JSON array (for exports).
+    fields: comma separated subset of PATIENT_FIELDS (default: all).
+    q: only patients whose name contains this text (case-insensitive), so a search
+    pages through the matches instead of the client loading every patient.
+    """
+    try:
+        names = resolve_projection(fields, PATIENT_FIELDS, PATIENT_FIELDS)
+        if sort not in PATIENT_SORT_OPTIONS:
+            raise HTTPException(status_code=400, detail=f"Unknown sort. Use one of: {', '.join(PATIENT_SORT_OPTIONS)}")
+        sort_column, direction = PATIENT_SORT_OPTIONS[sort]
+        
+        if stream:
+            return StreamingResponse(stream_patients(sort_column, direction, fields=names),
+                                     media_type="application/json")
+        
+        conn = sqlite3.connect('dip_analysis.db')
+        db_cursor = conn.cursor()
+        
+        conditions = []
+        params: List[Any] = []
+        if q and q.strip():
+            escaped = q.strip().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            conditions.append("p.name LIKE ? ESCAPE '\\'")
+            params.append(f"%{escaped}%")
+        search_params = list(params)
+        search_clause = f"WHERE {conditions[0]}" if conditions else ""
+        if cursor:
+            comparison = "<" if direction == "DESC" else ">"
+            conditions.append(f"(p.{sort_column}, p.id) {comparison} (?, ?)")
+            params.extend(decode_cursor(cursor))
+        where_clause = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        
+        # Fetch one extra row to know whether another page exists
+        db_cursor.execute(f'''
+            SELECT {PATIENT_LIST_COLUMNS}
+            FROM patients p
+            {where_clause}
+            ORDER BY p.{sort_column} {direction}, p.id {direction}
+            LIMIT ?
+        ''', params + [limit + 1])
+        rows = db_cursor.fetchall()
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        patients = [patient_list_row(row, names) for row in rows]
         
-        patients = []
-        for row in cursor.fetchall():
-            patients.append({
-                "id": row[0],
-                "name": row[1],
-                "date_of_birth": row[2],
-                "created_at": row[3],
-                "updated_at": row[4],
-                "metadata": json.loads(row[5]) if row[5] else {},
-                "document_count": row[6] or 0,
-                "last_activity": row[7]
-            })
+        sort_index = {"updated_at": 4, "created_at": 3, "name": 1}[sort_column]
+        next_cursor = encode_cursor([rows[-1][sort_index], rows[-1][0]]) if has_more else None
+        
+        total = None
+        if include_total:
+            db_cursor.execute(f'SELECT COUNT(*) FROM patients p {search_clause}', search_params)
+            total = db_cursor.fetchone()[0]
         
         conn.close()
         
-        return {
+        response = {
             "success": True,
             "patients": patients,
-            "total": len(patients),
+            "count": len(patients),
+            "next_cursor": next_cursor,
+            "has_more": has_more,
+            "sort": sort,
             "timestamp": datetime.now().isoformat()
         }
+        if total is not None:
+            response["total"] = total
+        return response
         
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error fetching patients: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to fetch patients: {str(e)}")
 
+# Deeper parent_id chains are cut off (guards the tree walk against cycles)
+MAX_DIRECTORY_DEPTH = 64
+
+def patient_directories(cursor, patient_id: str) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """A patient's directories as a flat list and as a nested tree, from one recursive query
+
+    The CTE walks down from the root directories (those without a parent of the same
+    patient) one level per step through (patient_id, parent_id), so it reads each
+    directory once. Subtree document counts are then summed bottom-up from the
+    maintained per-directory counters.
+    """
+    cursor.execute('''
+        WITH RECURSIVE tree(id, depth) AS (
+            SELECT id, 0 FROM directories
+            WHERE patient_id = ?
+              AND (parent_id IS NULL OR parent_id NOT IN (SELECT id FROM directories WHERE patient_id = ?))
+            UNION ALL
+            SELECT d.id, t.depth + 1
+            FROM tree t
+            CROSS JOIN directories d ON d.patient_id = ? AND d.parent_id = t.id
+            WHERE t.depth < ?
+        )
+        SELECT d.id, d.name, d.type, d.parent_id, d.icon, d.color, d.sort_order, d.document_count, t.depth
+        FROM tree t
+        JOIN directories d ON d.id = t.id
+        ORDER BY d.sort_order, d.name
+    ''', (patient_id, patient_id, patient_id, MAX_DIRECTORY_DEPTH))
+    
+    directories = [{
+        "id": row[0],
+        "name": row[1],
+        "type": row[2],
+        "parent_id": row[3],
+        "icon": row[4],
+        "color": row[5],
+        "sort_order": row[6],
+        "document_count": row[7],
+        "subtree_document_count": row[7],
+        "depth": row[8]
+    } for row in cursor.fetchall()]
+    
+    by_id = {directory["id"]: directory for directory in directories}
+    for directory in sorted(directories, key=lambda d: d["depth"], reverse=True):
+        if directory["depth"]:
+            by_id[directory["parent_id"]]["subtree_document_count"] += directory["subtree_document_count"]
+    
+    # Rows come sorted, so appending keeps every level in sort_order, name order
+    nodes = {directory["id"]: dict(directory, children=[]) for directory in directories}
+    tree = []
+    for directory in directories:
+        parent = nodes.get(directory["parent_id"])
+        (parent["children"] if parent is not None else tree).append(nodes[directory["id"]])
+    
+    return directories, tree
+
 @app.get("/patients/{patient_id}")
-async def get_patient(patient_id: str):
-    """Get patient details with directory structure"""
+async def get_patient(patient_id: str, fields: Optional[str] = Query(None)):
+    """
+    Get patient details with directory structure
+    
+    fields: comma separated subset of the patient fields, "directories" (flat list) and
+    "directory_tree" (nested, each node with its children) (default: everything).
+    Directories carry recursive subtree document counts; leaving out both
+    directories and directory_tree skips the directory query.
+    """
     try:
+        names = resolve_projection(fields, PATIENT_DETAIL_FIELDS, PATIENT_DETAIL_FIELDS)
+        
         conn = sqlite3.connect('dip_analysis.db')
         cursor = conn.cursor()
         
         # Get patient info
-        cursor.execute('SELECT * FROM patients WHERE id = ?', (patient_id,))
+        cursor.execute('''
+            SELECT id, name, date_of_birth, created_at, updated_at, metadata, document_count, last_activity
+            FROM patients WHERE id = ?
+        ''', (patient_id,))
         patient_row = cursor.fetchone()
         
         if not patient_row:
             raise HTTPException(status_code=404, detail="Patient not found")
         
         # Get directories
-        cursor.execute('''
-            SELECT id, name, type, parent_id, icon, color, sort_order,
-                   (SELECT COUNT(*) FROM patient_documents WHERE directory_id = d.id) as document_count
-            FROM directories d
-            WHERE patient_id = ?
-            ORDER BY sort_order, name
-        ''', (patient_id,))
-        
-        directories = []
-        for row in cursor.fetchall():
-            directories.append({
-                "id": row[0],
-                "name": row[1],
-                "type": row[2],
-                "parent_id": row[3],
-                "icon": row[4],
-                "color": row[5],
-                "sort_order": row[6],
-                "document_count": row[7]
-            })
+        if "directories" in names or "directory_tree" in names:
+            directories, tree = patient_directories(cursor, patient_id)
         
         conn.close()
         
-        patient = {
-            "id": patient_row[0],
-            "name": patient_row[1],
-            "date_of_birth": patient_row[2],
-            "created_at": patient_row[3],
-            "updated_at": patient_row[4],
-            "metadata": json.loads(patient_row[5]) if patient_row[5] else {},
-            "directories": directories
-        }
+        patient = patient_list_row(patient_row, names)
+        if "directories" in names:
+            patient["directories"] = directories
+        if "directory_tree" in names:
+            patient["directory_tree"] = tree
         
         return {
             "success": True,
@@ -1078,7 +1718,7 @@ async def delete_patient(patient_id: str):
         if not cursor.fetchone():
             raise HTTPException(status_code=404, detail="Patient not found")
         
-        # Delete patient (cascade will handle directories and documents)
+        # Delete patient (trg_patients_delete_documents removes directories, documents and their index rows)
         cursor.execute('DELETE FROM patients WHERE id = ?', (patient_id,))
         
         conn.commit()
@@ -1111,6 +1751,13 @@ async def create_directory(patient_id: str, directory_data: dict):
         if not cursor.fetchone():
             raise HTTPException(status_code=404, detail="Patient not found")
         
+        # Nested directories must hang off one of the same patient's directories
+        if directory_data.get('parent_id'):
+            cursor.execute('SELECT id FROM directories WHERE id = ? AND patient_id = ?',
+                           (directory_data['parent_id'], patient_id))
+            if not cursor.fetchone():
+                raise HTTPException(status_code=400, detail="Parent directory not found for this patient")
+        
         cursor.execute('''
             INSERT INTO directories (id, name, type, parent_id, patient_id, icon, color, sort_order)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
@@ -1141,90 +1788,57 @@ async def create_directory(patient_id: str, directory_data: dict):
         logging.error(f"Error creating directory: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to create directory: {str(e)}")
 
-@app.post("/patients/{patient_id}/directories/{directory_id}/documents")
-async def upload_patient_document(patient_id: str, directory_id: str, file: UploadFile = File(...)):
-    """Upload and store a document for a specific patient and directory"""
+PATIENT_DOCUMENT_TYPES = ['application/pdf', 'text/plain', 'application/msword',
+                          'application/vnd.openxmlformats-officedocument.wordprocessingml.document', *RTF_TYPES]
+
+@app.post("/patients/{patient_id}/directories/{directory_id}/documents", status_code=202)
+async def upload_patient_document(patient_id: str, directory_id: str, file: UploadFile = File(...),
+                                  priority: Optional[str] = Query(None)):
+    """
+    Upload a document for a specific patient and directory
+    
+    The file is stored and queued for analysis, and the response (202 Accepted) comes
+    back right away. Poll status_url, or listen on /patients/{patient_id}/jobs/events,
+    for the analysis to finish; the document's analysis_id is set when it does.
+    priority is the job's class: upload (default) or bulk for backfills of old records.
+    """
     try:
+        priority_class = resolve_priority(priority, "upload")
+        
         # Validate file type
-        allowed_types = ['application/pdf', 'text/plain', 'application/msword', 
-                        'application/vnd.openxmlformats-officedocument.wordprocessingml.document']
-        if file.content_type not in allowed_types:
+        if file.content_type not in PATIENT_DOCUMENT_TYPES:
             raise HTTPException(status_code=400, detail="Unsupported file type")
         
-        # Validate file size (max 10MB)
+        # Validate file size (max 10MB; larger files go through the resumable /upload-sessions API)
         file_content = await file.read()
         if len(file_content) > 10 * 1024 * 1024:
-            raise HTTPException(status_code=413, detail="File too large (max 10MB)")
-        
-        # Create uploads directory if it doesn't exist
-        uploads_dir = f"uploads/patients/{patient_id}/{directory_id}"
-        os.makedirs(uploads_dir, exist_ok=True)
-        
-        # Generate unique filename
-        import uuid
-        file_extension = file.filename.split('.')[-1] if '.' in file.filename else 'txt'
-        unique_filename = f"{uuid.uuid4().hex[:8]}_{file.filename}"
-        file_path = os.path.join(uploads_dir, unique_filename)
+            raise HTTPException(status_code=413, detail="File too large (max 10MB, use /upload-sessions for larger files)")
         
         # Save file to disk
+        file_path = patient_document_path(patient_id, directory_id, file.filename)
         with open(file_path, "wb") as f:
             f.write(file_content)
         
-        # Analyze the document
-        if file.content_type == 'application/pdf':
-            import pdfplumber
-            with pdfplumber.open(file_path) as pdf:
-                text = ""
-                for page in pdf.pages:
-                    text += page.extract_text() or ""
-        else:
-            # For text files
-            text = file_content.decode('utf-8', errors='ignore')
-        
-        # Perform medical analysis
-        analysis_results = await analyze_medical_text_advanced(text)
-        
-        # Save analysis to database
-        analysis_id = save_analysis_result(
-            user_id=f"patient_{patient_id}",
-            file_name=file.filename,
-            file_type=file.content_type,
-            analysis_type="patient_document",
-            results=analysis_results,
-            confidence_score=analysis_results.get("confidence_score", 0)
-        )
-        
-        # Store document in patient_documents table
-        document_id = str(uuid.uuid4())
+        # Store the document (analysis pending) and its analysis job together
         conn = sqlite3.connect('dip_analysis.db')
         cursor = conn.cursor()
         
-        cursor.execute('''
-            INSERT INTO patient_documents (
-                id, name, file_type, file_size, file_path, 
-                directory_id, patient_id, analysis_id, tags
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            document_id,
-            file.filename,
-            file.content_type,
-            len(file_content),
-            file_path,
-            directory_id,
-            patient_id,
-            analysis_id,
-            json.dumps([])  # Empty tags for now
-        ))
+        document_id, job_id = insert_patient_document(cursor, patient_id, directory_id, file.filename,
+                                                      file.content_type, len(file_content), file_path,
+                                                      priority_class, hashlib.sha256(file_content).hexdigest())
         
         conn.commit()
         conn.close()
+        JOB_QUEUE.notify()
         
         return {
             "success": True,
             "document_id": document_id,
-            "analysis_id": analysis_id,
-            "message": "Document uploaded and analyzed successfully",
-            "analysis_results": analysis_results,
+            "job_id": job_id,
+            "status": "queued",
+            "priority": priority_class,
+            "status_url": f"/jobs/{job_id}",
+            "message": "Document uploaded and queued for analysis",
             "timestamp": datetime.now().isoformat()
         }
         
@@ -1234,38 +1848,1435 @@ async def upload_patient_document(patient_id: str, directory_id: str, file: Uplo
         logging.error(f"Error uploading patient document: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to upload document: {str(e)}")
 
-@app.get("/patients/{patient_id}/directories/{directory_id}/documents")
-async def get_directory_documents(patient_id: str, directory_id: str):
-    """Get documents in a specific directory"""
+def patient_document_path(patient_id: str, directory_id: str, file_name: str) -> str:
+    """A new unique path in the patient's document store (directory created on demand)"""
+    import uuid
+    uploads_dir = f"uploads/patients/{patient_id}/{directory_id}"
+    os.makedirs(uploads_dir, exist_ok=True)
+    return os.path.join(uploads_dir, f"{uuid.uuid4().hex[:8]}_{file_name}")
+
+def insert_patient_document(cursor, patient_id: str, directory_id: str, file_name: str, file_type: str,
+                            file_size: int, file_path: str, priority: str,
+                            content_hash: Optional[str] = None) -> Tuple[str, int]:
+    """Store a patient document (analysis pending) and its analysis job; returns (document_id, job_id)"""
+    import uuid
+    document_id = str(uuid.uuid4())
+    cursor.execute('''
+        INSERT INTO patient_documents (
+            id, name, file_type, file_size, file_path, 
+            directory_id, patient_id, tags, content_hash
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        document_id,
+        file_name,
+        file_type,
+        file_size,
+        file_path,
+        directory_id,
+        patient_id,
+        json.dumps([]),  # Empty tags for now
+        content_hash
+    ))
+    job_id = enqueue_document_job(cursor, document_id, patient_id, directory_id,
+                                  file_path, file_name, file_type, priority)
+    return document_id, job_id
+
+def upload_session_response(session: Dict[str, Any], response: Response) -> Dict[str, Any]:
+    response.headers["Upload-Offset"] = str(session["received"])
+    response.headers["Upload-Length"] = str(session["size"])
+    response.headers["Cache-Control"] = "no-store"
+    return {
+        "success": True,
+        "upload_id": session["id"],
+        "offset": session["received"],
+        "size": session["size"],
+        "status": session["status"],
+        "chunk_size": CHUNK_SIZE,
+        "upload_url": f"/upload-sessions/{session['id']}",
+        "document_id": session["document_id"],
+        "job_id": session["job_id"],
+        "expires_at": session["expires_at"],
+        "timestamp": datetime.now().isoformat()
+    }
+
+@app.post("/upload-sessions", status_code=201)
+async def create_upload_session(upload: dict, response: Response):
+    """
+    Start a resumable upload of one patient document
+    
+    Body: {"patient_id": "...", "directory_id": "...", "file_name": "chart.pdf", "file_type": "application/pdf",
+           "size": 734003200, "checksum": "sha256 <base64 digest of the whole file>", "priority": "upload"}
+    Then send the bytes with PATCH (or PUT) /upload-sessions/{upload_id} in chunks, each with an
+    Upload-Offset header and optionally Upload-Checksum: "sha256 <base64 digest of the chunk>".
+    GET or HEAD /upload-sessions/{upload_id} returns the offset to resume from after a disconnect;
+    POST /upload-sessions/{upload_id}/finalize files the document and queues its analysis.
+    """
+    try:
+        patient_id = upload.get("patient_id")
+        directory_id = upload.get("directory_id")
+        file_name = os.path.basename(str(upload.get("file_name") or "").strip())
+        file_type = upload.get("file_type")
+        size = upload.get("size")
+        checksum = upload.get("checksum")
+        priority_class = resolve_priority(upload.get("priority"), "upload")
+        
+        if not patient_id or not directory_id or not file_name:
+            raise HTTPException(status_code=400, detail="patient_id, directory_id and file_name are required")
+        if file_type not in PATIENT_DOCUMENT_TYPES:
+            raise HTTPException(status_code=400, detail="Unsupported file type")
+        if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+            raise HTTPException(status_code=400, detail="size must be a positive number of bytes")
+        if size > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail=f"File too large (max {MAX_UPLOAD_BYTES // (1024 * 1024)}MB)")
+        if checksum is not None:
+            try:
+                parse_checksum(checksum)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+        
+        import uuid
+        upload_id = uuid.uuid4().hex
+        conn = sqlite3.connect('dip_analysis.db')
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT 1 FROM directories WHERE id = ? AND patient_id = ?', (directory_id, patient_id))
+        if not cursor.fetchone():
+            conn.close()
+            raise HTTPException(status_code=404, detail="Directory not found")
+        
+        purge_expired_sessions(cursor)
+        session = create_session(cursor, upload_id, patient_id, directory_id, file_name, file_type,
+                                 size, checksum, priority_class)
+        conn.commit()
+        conn.close()
+        
+        response.headers["Location"] = f"/upload-sessions/{upload_id}"
+        return upload_session_response(session, response)
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error creating upload session: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to create upload session: {str(e)}")
+
+@app.api_route("/upload-sessions/{upload_id}", methods=["GET", "HEAD"])
+async def get_upload_session(upload_id: str, response: Response):
+    """Offset (bytes received) and state of a resumable upload, also as Upload-Offset / Upload-Length headers"""
+    try:
+        conn = sqlite3.connect('dip_analysis.db')
+        session = get_session(conn.cursor(), upload_id)
+        conn.close()
+        
+        if session is None:
+            raise HTTPException(status_code=404, detail="Upload not found or expired")
+        
+        return upload_session_response(session, response)
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error getting upload {upload_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to get upload: {str(e)}")
+
+@app.patch("/upload-sessions/{upload_id}")
+@app.put("/upload-sessions/{upload_id}")
+async def upload_chunk(upload_id: str, request: Request, response: Response,
+                       upload_offset: int = Header(...),
+                       upload_checksum: Optional[str] = Header(None)):
+    """
+    Append one chunk (the raw request body) at Upload-Offset
+    
+    The offset must equal the bytes received so far (409 otherwise, with the current
+    offset in Upload-Offset), and no other request may be sending the chunk at that
+    offset (409 as well). With Upload-Checksum the chunk is only accepted if its
+    digest matches (460 otherwise); either way a cut-off chunk is not counted and can
+    be sent again from the same offset.
+    """
+    import uuid
+    writer = None
+    try:
+        algorithm, expected = None, None
+        if upload_checksum is not None:
+            try:
+                algorithm, expected = parse_checksum(upload_checksum)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+        
+        conn = sqlite3.connect('dip_analysis.db')
+        session = get_session(conn.cursor(), upload_id)
+        conn.close()
+        
+        if session is None:
+            raise HTTPException(status_code=404, detail="Upload not found or expired")
+        if session["status"] != "open":
+            raise HTTPException(status_code=409, detail=f"Upload is already {session['status']}")
+        if session["received"] == session["size"]:
+            raise HTTPException(status_code=409, detail="Upload is complete; finalize it")
+        if upload_offset != session["received"]:
+            raise HTTPException(status_code=409, detail=f"Upload-Offset {upload_offset} does not match the upload offset {session['received']}",
+                                headers={"Upload-Offset": str(session["received"])})
+        
+        # Only the request holding the claim writes into the part file
+        conn = sqlite3.connect('dip_analysis.db')
+        cursor = conn.cursor()
+        token = uuid.uuid4().hex
+        if claim_chunk(cursor, upload_id, upload_offset, token):
+            writer = token
+        conn.commit()
+        session = get_session(cursor, upload_id)
+        conn.close()
+        
+        if writer is None:
+            raise HTTPException(status_code=409, detail=f"Another chunk is being received at offset {upload_offset}",
+                                headers={"Upload-Offset": str(session["received"] if session else upload_offset)})
+        
+        # The body is streamed to disk as it arrives; nothing holds the whole chunk
+        limit = min(MAX_CHUNK_BYTES, session["size"] - upload_offset)
+        try:
+            written, digest = await write_chunk(upload_id, upload_offset, request.stream(), limit, algorithm)
+        except ValueError as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        
+        if expected is not None and digest != expected:
+            raise HTTPException(status_code=460, detail="Chunk checksum mismatch",
+                                headers={"Upload-Offset": str(upload_offset)})
+        
+        conn = sqlite3.connect('dip_analysis.db')
+        cursor = conn.cursor()
+        advanced = advance_session(cursor, upload_id, upload_offset, written, writer)
+        conn.commit()
+        session = get_session(cursor, upload_id)
+        conn.close()
+        
+        if not advanced:
+            raise HTTPException(status_code=409, detail="Another chunk was received at this offset",
+                                headers={"Upload-Offset": str(session["received"])})
+        writer = None
+        
+        return upload_session_response(session, response)
+    
+    except HTTPException:
+        raise
+    except ClientDisconnect:
+        logging.info(f"Upload {upload_id} disconnected mid-chunk at offset {upload_offset}")
+        raise HTTPException(status_code=400, detail="Client disconnected")
+    except Exception as e:
+        logging.error(f"Error receiving chunk for upload {upload_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to receive chunk: {str(e)}")
+    finally:
+        if writer is not None:
+            # The chunk was not accepted: let the client send it again right away
+            conn = sqlite3.connect('dip_analysis.db')
+            release_chunk(conn.cursor(), upload_id, writer)
+            conn.commit()
+            conn.close()
+
+@app.post("/upload-sessions/{upload_id}/finalize", status_code=202)
+async def finalize_upload(upload_id: str):
+    """
+    File a completely received upload as a patient document and queue its analysis
+    
+    Checks the whole-file checksum given at creation (460 on mismatch). Finalizing
+    again returns the same document and job; 409 while another request is still
+    finalizing it.
+    """
+    import uuid
+    writer = None
+    try:
+        conn = sqlite3.connect('dip_analysis.db')
+        cursor = conn.cursor()
+        session = get_session(cursor, upload_id)
+        
+        if session is None:
+            conn.close()
+            raise HTTPException(status_code=404, detail="Upload not found or expired")
+        if session["status"] == "aborted":
+            conn.close()
+            raise HTTPException(status_code=409, detail="Upload was aborted")
+        
+        if session["status"] == "open":
+            if session["received"] != session["size"]:
+                conn.close()
+                raise HTTPException(status_code=409, detail=f"Upload incomplete: {session['received']} of {session['size']} bytes received")
+            
+            # Only the request holding the claim verifies and files the part file
+            token = uuid.uuid4().hex
+            if claim_chunk(cursor, upload_id, session["size"], token):
+                writer = token
+            conn.commit()
+            if writer is None:
+                session = get_session(cursor, upload_id)
+                if session is None or session["status"] != "finalized":
+                    conn.close()
+                    raise HTTPException(status_code=409, detail="Upload is already being finalized")
+        
+        if writer is not None:
+            # Hashing up to MAX_UPLOAD_BYTES and the move are file I/O: keep them off the event loop
+            try:
+                content_hash = await asyncio.to_thread(verify_part, session)
+            except ChecksumMismatch as e:
+                conn.close()
+                raise HTTPException(status_code=460, detail=str(e))
+            
+            # Move the file into the document store and record it in one step
+            file_path = patient_document_path(session["patient_id"], session["directory_id"], session["file_name"])
+            await asyncio.to_thread(os.replace, part_path(upload_id), file_path)
+            try:
+                document_id, job_id = insert_patient_document(
+                    cursor, session["patient_id"], session["directory_id"], session["file_name"],
+                    session["file_type"], session["size"], file_path, session["priority"], content_hash
+                )
+                if not finish_session(cursor, upload_id, "finalized", document_id, job_id):
+                    raise HTTPException(status_code=409, detail="Upload is no longer open")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                current = get_session(cursor, upload_id)
+                if current is not None and current["status"] == "open":
+                    await asyncio.to_thread(os.replace, file_path, part_path(upload_id))
+                else:
+                    # Aborted while finalizing: nothing will file these bytes now
+                    os.remove(file_path)
+                conn.close()
+                raise
+            writer = None
+            JOB_QUEUE.notify()
+            session = get_session(cursor, upload_id)
+        conn.close()
+        
+        return {
+            "success": True,
+            "upload_id": upload_id,
+            "document_id": session["document_id"],
+            "job_id": session["job_id"],
+            "status": "queued",
+            "priority": session["priority"],
+            "status_url": f"/jobs/{session['job_id']}",
+            "message": "Upload finalized and queued for analysis",
+            "timestamp": datetime.now().isoformat()
+        }
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error finalizing upload {upload_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to finalize upload: {str(e)}")
+    finally:
+        if writer is not None:
+            # Not finalized: let the client finalize again right away
+            conn = sqlite3.connect('dip_analysis.db')
+            release_chunk(conn.cursor(), upload_id, writer)
+            conn.commit()
+            conn.close()
+
+@app.delete("/upload-sessions/{upload_id}")
+async def abort_upload(upload_id: str):
+    """Abandon a resumable upload and delete the bytes received so far"""
+    try:
+        conn = sqlite3.connect('dip_analysis.db')
+        cursor = conn.cursor()
+        session = get_session(cursor, upload_id)
+        
+        if session is None:
+            conn.close()
+            raise HTTPException(status_code=404, detail="Upload not found or expired")
+        if not finish_session(cursor, upload_id, "aborted"):
+            conn.close()
+            raise HTTPException(status_code=409, detail=f"Upload is already {session['status']}")
+        
+        conn.commit()
+        conn.close()
+        if os.path.exists(part_path(upload_id)):
+            os.remove(part_path(upload_id))
+        
+        return {
+            "success": True,
+            "message": "Upload aborted",
+            "timestamp": datetime.now().isoformat()
+        }
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error aborting upload {upload_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to abort upload: {str(e)}")
+
+def start_ingest(ingest_id: str, patient_id: str, directory_id: str, source: str, priority: str,
+                 total: int) -> Optional[Dict[str, Any]]:
+    """Record a new bulk ingest into a patient directory; None if the directory does not exist"""
+    conn = sqlite3.connect('dip_analysis.db')
+    cursor = conn.cursor()
+    cursor.execute('SELECT 1 FROM directories WHERE id = ? AND patient_id = ?', (directory_id, patient_id))
+    if not cursor.fetchone():
+        conn.close()
+        return None
+    ingest = create_ingest(cursor, ingest_id, patient_id, directory_id, source, priority, total)
+    conn.commit()
+    conn.close()
+    return ingest
+
+def ingest_entry(cursor, ingest: Dict[str, Any], seq: int, entry: IngestEntry, written: List[str]):
+    """Skip, dedupe or file one entry; files it copied are appended to written until they commit"""
+    name = os.path.basename(entry.name.replace("\\", "/"))
+    reason = skip_reason(entry)
+    if reason:
+        record_entry(cursor, ingest["id"], seq, entry.name, "skipped", detail=reason)
+        return
+    
+    file_path = patient_document_path(ingest["patient_id"], ingest["directory_id"], name)
+    try:
+        size, content_hash = copy_entry(entry, file_path)
+    except UNREADABLE_ENTRY_ERRORS as e:
+        os.remove(file_path)
+        record_entry(cursor, ingest["id"], seq, entry.name, "skipped", detail=f"Unreadable: {str(e)}")
+        return
+    
+    duplicate_of = find_duplicate(cursor, ingest["patient_id"], content_hash)
+    if duplicate_of:
+        os.remove(file_path)
+        record_entry(cursor, ingest["id"], seq, entry.name, "duplicate", document_id=duplicate_of,
+                     detail=f"Same content as document {duplicate_of}")
+        return
+    
+    written.append(file_path)
+    document_id, job_id = insert_patient_document(cursor, ingest["patient_id"], ingest["directory_id"], name,
+                                                  document_type(name), size, file_path, ingest["priority"],
+                                                  content_hash)
+    record_entry(cursor, ingest["id"], seq, entry.name, "added", document_id, job_id)
+
+def run_ingest(ingest_id: str, entries: List[IngestEntry], notify=None) -> Dict[str, Any]:
+    """
+    File an ingest's entries as patient documents, INGEST_BATCH_SIZE per transaction
+    
+    Each committed batch wakes the job workers (notify), so analysis of the first
+    documents overlaps copying the rest. If an entry fails with anything other than
+    an unreadable archive entry, the open batch is rolled back, its copied files are
+    removed and the ingest is marked failed; earlier batches stay filed.
+    """
+    conn = sqlite3.connect('dip_analysis.db', timeout=30)
+    cursor = conn.cursor()
+    ingest = get_ingest(cursor, ingest_id)
+    written: List[str] = []
+    try:
+        for seq, entry in enumerate(entries, 1):
+            ingest_entry(cursor, ingest, seq, entry, written)
+            if seq % INGEST_BATCH_SIZE == 0:
+                conn.commit()
+                written = []
+                if notify:
+                    notify()
+        finish_ingest(cursor, ingest_id, "completed")
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        for file_path in written:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        logging.error(f"Ingest {ingest_id} failed: {str(e)}")
+        finish_ingest(cursor, ingest_id, "failed", str(e))
+        conn.commit()
+    if notify:
+        notify()
+    ingest = get_ingest(cursor, ingest_id)
+    conn.close()
+    return ingest
+
+def ingest_archive(ingest_id: str, archive: zipfile.ZipFile, entries: List[IngestEntry]):
+    """Background thread for an uploaded archive; the staged copy is removed when it is done"""
+    try:
+        run_ingest(ingest_id, entries, JOB_QUEUE.notify)
+    finally:
+        archive.close()
+        os.remove(archive.filename)
+
+@app.post("/patients/{patient_id}/directories/{directory_id}/ingest", status_code=202)
+async def ingest_patient_archive(patient_id: str, directory_id: str, file: UploadFile = File(...),
+                                 priority: Optional[str] = Query(None)):
+    """
+    Bulk-ingest a ZIP archive of documents into a patient directory
+    
+    PDF, TXT, DOC, DOCX and RTF entries are filed as patient documents and queued for
+    analysis; entries with the same content as one of the patient's documents are
+    recorded as duplicates, anything else is skipped. The response (202 Accepted)
+    comes back once the archive is stored; GET /ingests/{ingest_id} or its events
+    stream report progress. priority is the analysis jobs' class: bulk (default) or upload.
+    Folders on the server are ingested with the CLI: python bulk_ingest.py
+    """
+    import uuid
+    ingest_id = uuid.uuid4().hex
+    archive_path, archive, started = None, None, False
+    try:
+        priority_class = resolve_priority(priority, "bulk")
+        
+        # The upload is spooled to a temporary file; stage a copy the ingest thread can keep reading
+        try:
+            archive_path = await asyncio.to_thread(stage_archive, ingest_id, file.file, MAX_UPLOAD_BYTES)
+        except ValueError as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        if not zipfile.is_zipfile(archive_path):
+            raise HTTPException(status_code=400, detail="File is not a ZIP archive")
+        
+        archive = zipfile.ZipFile(archive_path)
+        try:
+            entries = zip_entries(archive)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        ingest = start_ingest(ingest_id, patient_id, directory_id, file.filename or "archive.zip",
+                              priority_class, len(entries))
+        if ingest is None:
+            raise HTTPException(status_code=404, detail="Directory not found")
+        
+        threading.Thread(target=ingest_archive, args=(ingest_id, archive, entries),
+                         name=f"ingest-{ingest_id[:8]}", daemon=True).start()
+        started = True
+        
+        return {
+            "success": True,
+            "ingest_id": ingest_id,
+            "status": ingest["status"],
+            "total": ingest["total"],
+            "priority": priority_class,
+            "status_url": f"/ingests/{ingest_id}",
+            "events_url": f"/ingests/{ingest_id}/events",
+            "message": f"Ingesting {ingest['total']} files",
+            "timestamp": datetime.now().isoformat()
+        }
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error starting ingest into directory {directory_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to start ingest: {str(e)}")
+    finally:
+        if not started:
+            if archive:
+                archive.close()
+            if archive_path and os.path.exists(archive_path):
+                os.remove(archive_path)
+
+@app.get("/ingests/{ingest_id}")
+async def get_ingest_status(ingest_id: str, after: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=1000)):
+    """Counters and analysis progress of a bulk ingest, with its entries after seq `after`"""
     try:
         conn = sqlite3.connect('dip_analysis.db')
         cursor = conn.cursor()
+        progress = ingest_progress(cursor, ingest_id)
+        entries = ingest_entries(cursor, ingest_id, after, limit) if progress else []
+        conn.close()
         
+        if progress is None:
+            raise HTTPException(status_code=404, detail="Ingest not found")
+        
+        return {
+            "success": True,
+            "ingest": progress,
+            "entries": entries,
+            "timestamp": datetime.now().isoformat()
+        }
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error getting ingest {ingest_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to get ingest: {str(e)}")
+
+@app.get("/ingests/{ingest_id}/events")
+async def stream_ingest_events(ingest_id: str, request: Request, last_event_id: Optional[str] = Header(None)):
+    """
+    Server-sent events for a bulk ingest
+    
+    One "entry" event per processed file (its id is the entry's seq, so a reconnecting
+    client resumes after its Last-Event-ID), a "progress" event whenever the counters
+    or the analysis job counts change, and a final "done" event once every entry is
+    filed and every added document analyzed.
+    """
+    after = 0
+    if last_event_id is not None:
+        if not last_event_id.isdigit():
+            raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+        after = int(last_event_id)
+    
+    # The events generator runs on the event loop, the thread that opens the connection, and closes it when the stream ends
+    conn = sqlite3.connect('dip_analysis.db')
+    cursor = conn.cursor()
+    if get_ingest(cursor, ingest_id) is None:
+        conn.close()
+        raise HTTPException(status_code=404, detail="Ingest not found")
+    
+    async def events():
+        last_seq, last_progress, idle = after, None, 0.0
+        try:
+            while True:
+                entries = ingest_entries(cursor, ingest_id, last_seq)
+                for entry in entries:
+                    last_seq = entry["seq"]
+                    yield f"id: {entry['seq']}\nevent: entry\ndata: {json.dumps(entry)}\n\n"
+                progress = ingest_progress(cursor, ingest_id)
+                if progress != last_progress:
+                    last_progress, idle = progress, 0.0
+                    yield f"event: progress\ndata: {json.dumps(progress)}\n\n"
+                if entries:
+                    continue
+                if progress["done"]:
+                    yield f"event: done\ndata: {json.dumps(progress)}\n\n"
+                    return
+                if await request.is_disconnected():
+                    return
+                await asyncio.sleep(JOB_EVENTS_POLL_SECONDS)
+                idle += JOB_EVENTS_POLL_SECONDS
+                if idle >= JOB_EVENTS_KEEPALIVE_SECONDS:
+                    idle = 0.0
+                    yield ": keepalive\n\n"
+        finally:
+            conn.close()
+    
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def hl7_patient(cursor, parsed: Dict[str, Any]) -> str:
+    """The patient a message is about, created with the default directories on first sight"""
+    patient = parsed["patient"]
+    patient_id = find_hl7_patient(cursor, patient)
+    if patient_id is None:
+        metadata = {"gender": patient["gender"], "source": "hl7", "identifiers": [
+            {"authority": patient["authority"], "identifier": patient["identifier"]}
+        ]}
+        patient_id, _ = insert_patient(cursor, patient["name"] or f"Patient {patient['identifier']}",
+                                       patient["date_of_birth"], metadata)
+        record_hl7_patient(cursor, patient, patient_id)
+    elif parsed["message_type"] == "ADT":
+        # Admit / update messages carry the registration system's current demographics;
+        # fields the message leaves empty keep their stored values
+        cursor.execute('''
+            UPDATE patients
+            SET name = COALESCE(?, name), date_of_birth = COALESCE(?, date_of_birth),
+                metadata = CASE WHEN ? IS NULL THEN metadata
+                                ELSE json_set(COALESCE(metadata, '{}'), '$.gender', ?) END,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (patient["name"], patient["date_of_birth"], patient["gender"], patient["gender"], patient_id))
+    return patient_id
+
+def hl7_directory(cursor, patient_id: str, name: str) -> str:
+    """The patient's default directory with this name, recreated if it was deleted"""
+    cursor.execute('''
+        SELECT id FROM directories WHERE patient_id = ? AND name = ? ORDER BY sort_order LIMIT 1
+    ''', (patient_id, name))
+    row = cursor.fetchone()
+    if row:
+        return row[0]
+    import uuid
+    directory_id = str(uuid.uuid4())
+    sort_order, dir_data = next((i, d) for i, d in enumerate(DEFAULT_DIRECTORIES) if d["name"] == name)
+    cursor.execute('''
+        INSERT INTO directories (id, name, type, patient_id, icon, color, sort_order)
+        VALUES (?, ?, 'default', ?, ?, ?, ?)
+    ''', (directory_id, name, patient_id, dir_data["icon"], dir_data["color"], sort_order))
+    return directory_id
+
+def store_hl7_message(cursor, parsed: Dict[str, Any], written: List[str]) -> str:
+    """Store one message's patient and document; returns the ACK text"""
+    patient_id = hl7_patient(cursor, parsed)
+    document = parsed["document"]
+    if document is None:
+        record_hl7_message(cursor, parsed, patient_id)
+        return "Patient updated"
+    
+    text = document["text"].encode()
+    content_hash = hashlib.sha256(text).hexdigest()
+    duplicate_of = find_duplicate(cursor, patient_id, content_hash)
+    if duplicate_of:
+        record_hl7_message(cursor, parsed, patient_id, duplicate_of)
+        return f"Same content as document {duplicate_of}"
+    
+    directory_id = hl7_directory(cursor, patient_id, document["directory"])
+    file_name = document_file_name(document)
+    file_path = patient_document_path(patient_id, directory_id, file_name)
+    with open(file_path, "wb") as f:
+        f.write(text)
+    written.append(file_path)
+    document_id, job_id = insert_patient_document(cursor, patient_id, directory_id, file_name, "text/plain",
+                                                  len(text), file_path, "upload", content_hash)
+    record_hl7_message(cursor, parsed, patient_id, document_id, job_id)
+    return f"Stored as document {document_id}"
+
+def store_hl7_messages(messages: List[Dict[str, Any]]) -> List[Tuple[str, str]]:
+    """
+    Store a batch of parsed HL7 messages in one transaction; returns (ACK code, text) per message
+    
+    Each message has its own savepoint, so one that fails is answered AE (and its
+    file removed) without holding back the rest. A message stored before - same
+    sending facility and control id, re-sent because its ACK was lost - is answered
+    AA again. If the commit itself fails the exception reaches the listener, which
+    answers AE to the whole batch.
+    """
+    conn = sqlite3.connect('dip_analysis.db', timeout=30, isolation_level=None)
+    cursor = conn.cursor()
+    results: List[Tuple[str, str]] = []
+    written: List[str] = []
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        for parsed in messages:
+            if stored_message(cursor, parsed):
+                results.append(("AA", "Already received"))
+                continue
+            message_files: List[str] = []
+            cursor.execute('SAVEPOINT hl7_message')
+            try:
+                results.append(("AA", store_hl7_message(cursor, parsed, message_files)))
+                cursor.execute('RELEASE hl7_message')
+                written.extend(message_files)
+            except Exception as e:
+                cursor.execute('ROLLBACK TO hl7_message')
+                cursor.execute('RELEASE hl7_message')
+                for file_path in message_files:
+                    os.remove(file_path)
+                logging.error(f"Error storing HL7 message {parsed['control_id']}: {str(e)}")
+                results.append(("AE", f"Could not store the message: {str(e)}"))
+        cursor.execute('COMMIT')
+        written = []
+    except Exception:
+        if conn.in_transaction:
+            cursor.execute('ROLLBACK')
+        raise
+    finally:
+        # Files of a batch that did not commit
+        for file_path in written:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        conn.close()
+    return results
+
+@app.get("/hl7/stats")
+async def hl7_listener_stats():
+    """Counters of this process's HL7 v2 MLLP listener (started when HL7_LISTENER_PORT is set)"""
+    return {
+        "success": True,
+        "enabled": HL7_LISTENER is not None,
+        "port": int(HL7_LISTENER_PORT) if HL7_LISTENER_PORT else None,
+        "stats": HL7_LISTENER.stats() if HL7_LISTENER else None,
+        "timestamp": datetime.now().isoformat()
+    }
+
+# Text analyzed per patient document; resumable uploads can be far larger than this
+MAX_DOCUMENT_TEXT_CHARS = 20 * 1000 * 1000
+TEXT_READ_CHUNK_BYTES = 1024 * 1024
+
+def read_document_text(source: IO[bytes], file_type: Optional[str], max_chars: int) -> str:
+    """
+    Text of a PDF, DOCX, RTF or plain text document, at most max_chars characters
+    
+    The format comes from the file's first bytes (file_type only decides for files
+    that do not say); DOCX and RTF are streamed (document_text), so memory stays
+    bounded for large files. Raises DocumentTextError for unreadable files and
+    legacy binary .doc files.
+    """
+    document_format = sniff_format(source.read(16), file_type)
+    source.seek(0)
+    if document_format == 'pdf':
+        pages, length = [], 0
+        with pdfplumber.open(source) as pdf:
+            for page in pdf.pages:
+                pages.append(page.extract_text() or "")
+                page.close()   # Drop the page's parsed layout, or every page stays cached until the end
+                length += len(pages[-1])
+                if length >= max_chars:
+                    break
+        return "\n".join(pages)[:max_chars]
+    if document_format == 'docx':
+        return docx_text(source, max_chars)
+    if document_format == 'rtf':
+        return rtf_text(source, max_chars)
+    if document_format == 'doc':
+        raise DocumentTextError("Legacy binary Word (.doc) files are not supported, save the document as DOCX")
+    # Chunked: read(max_chars) would allocate max_chars bytes up front, however small the file
+    raw = bytearray()
+    while len(raw) < max_chars and (chunk := source.read(min(TEXT_READ_CHUNK_BYTES, max_chars - len(raw)))):
+        raw += chunk
+    try:
+        return raw.decode('utf-8')
+    except UnicodeDecodeError as e:
+        if e.start >= len(raw) - 3:
+            return raw.decode('utf-8', errors='ignore')   # Cut inside the last character
+        return raw.decode('latin-1')
+
+def extract_document_text(file_path: str, file_type: str) -> str:
+    with open(file_path, "rb") as f:
+        text = read_document_text(f, file_type, MAX_DOCUMENT_TEXT_CHARS)
+    if len(text) >= MAX_DOCUMENT_TEXT_CHARS:
+        logging.warning(f"Text truncated to {MAX_DOCUMENT_TEXT_CHARS} characters for file: {file_path}")
+    return text
+
+def copy_forward_source(cursor, patient_id: str, document_id: str,
+                        signature) -> Optional[Tuple[str, float, Dict[str, Any]]]:
+    """The patient's analyzed document this one was most likely copied forward from, with its results"""
+    for source_id, similarity in find_near_duplicates(cursor, patient_id, signature, exclude=document_id):
         cursor.execute('''
-            SELECT pd.*, ar.confidence_score, ar.results
+            SELECT ar.results FROM patient_documents pd
+            JOIN analysis_results ar ON ar.id = pd.analysis_id
+            WHERE pd.id = ?
+        ''', (source_id,))
+        row = cursor.fetchone()
+        if row:
+            results = json.loads(row[0])
+            if prior_analysis(results, DEFAULT_ANALYSIS_PROFILE, None):
+                return source_id, similarity, results
+    return None
+
+def process_document_job(cursor, job: Dict[str, Any]) -> int:
+    """Analysis job handler: extract, analyze, then store and index the results
+
+    Extraction and analysis run before anything is written; the writes all go through
+    the worker's cursor and commit together with the job's completion. A note that
+    is a near duplicate of one of the patient's analyzed documents is flagged as
+    copied forward from it, and only the sentences that changed are analyzed.
+    """
+    cursor.execute('SELECT 1 FROM patient_documents WHERE id = ?', (job["document_id"],))
+    if not cursor.fetchone():
+        raise PermanentJobError("Document was deleted before it was analyzed")
+    
+    try:
+        text = extract_document_text(job["file_path"], job["file_type"])
+    except DocumentTextError as e:
+        raise PermanentJobError(str(e))
+    
+    patient_id = job["patient_id"]
+    signature = minhash_signature(text)
+    source = copy_forward_source(cursor, patient_id, job["document_id"], signature) if signature else None
+    analysis_results = asyncio.run(analyze_medical_text_advanced(text, priority=job["priority"], tenant=patient_id,
+                                                                 prior=source[2] if source else None))
+    if source:
+        analysis_results["copy_forward"].update(source_document_id=source[0], similarity=source[1])
+    
+    analysis_id = save_analysis_result(
+        user_id=f"patient_{patient_id}",
+        file_name=job["file_name"],
+        file_type=job["file_type"],
+        analysis_type="patient_document",
+        results=analysis_results,
+        confidence_score=analysis_results.get("confidence_score", 0),
+        cursor=cursor
+    )
+    cursor.execute('UPDATE patient_documents SET analysis_id = ?, copy_forward_of = ? WHERE id = ?',
+                   (analysis_id, source[0] if source else None, job["document_id"]))
+    if cursor.rowcount == 0:
+        # Deleted while it was being analyzed: index nothing (the job's transaction is rolled back)
+        raise PermanentJobError("Document was deleted while it was analyzed")
+    if signature:
+        record_signature(cursor, job["document_id"], patient_id, signature)
+    
+    index_document_entities(cursor, analysis_id, patient_id, analysis_results.get("medical_entities", []))
+    record_observations(cursor, analysis_id, patient_id, analysis_results.get("measurements", []))
+    if SEARCH_INDEX_AVAILABLE:
+        index_document(cursor, analysis_id, patient_id, job["file_name"], text, analysis_results)
+    record_document_event(cursor, analysis_id, patient_id, analysis_results)
+    build_patient_rollup(cursor, patient_id)
+    return analysis_id
+
+JOB_EVENTS_POLL_SECONDS = 0.5
+JOB_EVENTS_KEEPALIVE_SECONDS = 15
+
+@app.get("/jobs/stats")
+async def get_job_stats():
+    """Analysis job counts by status, the leases held by each worker and this process's analysis slots"""
+    try:
+        conn = sqlite3.connect('dip_analysis.db')
+        cursor = conn.cursor()
+        counts = job_counts(cursor)
+        queued = queued_by_priority(cursor)
+        leases = active_leases(cursor)
+        conn.close()
+        
+        return {
+            "success": True,
+            "jobs": counts,
+            "queued_by_priority": queued,
+            "leases": leases,
+            "scheduler": ANALYSIS_SCHEDULER.stats(),
+            "workers": len(JOB_QUEUE.threads),
+            "timestamp": datetime.now().isoformat()
+        }
+        
+    except Exception as e:
+        logging.error(f"Error getting job stats: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to get job stats: {str(e)}")
+
+@app.get("/jobs/{job_id}")
+async def get_analysis_job(job_id: int):
+    """Status of a document analysis job (queued, running, completed or failed)"""
+    try:
+        conn = sqlite3.connect('dip_analysis.db')
+        job = get_job(conn.cursor(), job_id)
+        conn.close()
+        
+        if job is None:
+            raise HTTPException(status_code=404, detail="Job not found")
+        
+        return {
+            "success": True,
+            "job": job,
+            "timestamp": datetime.now().isoformat()
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error getting job {job_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to get job: {str(e)}")
+
+def job_event(job: Dict[str, Any]) -> str:
+    """One SSE message; the id is the job's completion_seq"""
+    data = {name: job[name] for name in ("id", "document_id", "directory_id", "file_name", "status",
+                                         "analysis_id", "error", "finished_at")}
+    return f"id: {job['completion_seq']}\nevent: job\ndata: {json.dumps(data)}\n\n"
+
+@app.get("/patients/{patient_id}/jobs/events")
+async def stream_patient_job_events(patient_id: str, request: Request,
+                                    after: Optional[int] = Query(None, ge=0),
+                                    follow: bool = Query(True),
+                                    last_event_id: Optional[str] = Header(None)):
+    """
+    Server-sent events: one "job" event per finished analysis job of the patient
+    
+    Starts after completion_seq `after` (or the Last-Event-ID a reconnecting client
+    sends), otherwise with the jobs that finish from now on. follow=false returns
+    the events so far and closes the stream.
+    """
+    if after is None and last_event_id is not None:
+        if not last_event_id.isdigit():
+            raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+        after = int(last_event_id)
+    
+    # The events generator runs on the event loop, the thread that opens the connection, and closes it when the stream ends
+    conn = sqlite3.connect('dip_analysis.db')
+    cursor = conn.cursor()
+    if after is None:
+        after = latest_completion_seq(cursor, patient_id) if follow else 0
+    
+    async def events():
+        last_seq, idle = after, 0.0
+        try:
+            while True:
+                jobs = finished_jobs(cursor, patient_id, last_seq)
+                for job in jobs:
+                    last_seq = job["completion_seq"]
+                    yield job_event(job)
+                if not follow:
+                    return
+                if jobs:
+                    idle = 0.0
+                    continue
+                if await request.is_disconnected():
+                    return
+                await asyncio.sleep(JOB_EVENTS_POLL_SECONDS)
+                idle += JOB_EVENTS_POLL_SECONDS
+                if idle >= JOB_EVENTS_KEEPALIVE_SECONDS:
+                    idle = 0.0
+                    yield ": keepalive\n\n"
+        finally:
+            conn.close()
+    
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/search/documents")
+async def search_patient_documents(q: str = Query(..., min_length=1, max_length=500),
+                                   patient_id: Optional[str] = Query(None),
+                                   limit: int = Query(20, ge=1, le=100),
+                                   offset: int = Query(0, ge=0, le=10000),
+                                   raw: bool = Query(False)):
+    """
+    Full-text search over patient document text, names and extracted entities
+    
+    Results are BM25 ranked with <mark> highlighted snippets. Every word of q must
+    match (the last one as a prefix); raw=true takes q as FTS5 query syntax instead.
+    patient_id restricts the search to one patient's documents.
+    """
+    try:
+        if not SEARCH_INDEX_AVAILABLE:
+            raise HTTPException(status_code=503, detail="Document search not available (SQLite FTS5 missing)")
+        
+        match = build_match_query(q, raw)
+        if not match:
+            raise HTTPException(status_code=400, detail="Search query has no searchable terms")
+        
+        conn = sqlite3.connect('dip_analysis.db')
+        cursor = conn.cursor()
+        try:
+            results, has_more = search_documents(cursor, match, patient_id, limit, offset)
+        except sqlite3.OperationalError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid search query: {str(e)}")
+        finally:
+            conn.close()
+        
+        return {
+            "success": True,
+            "query": q,
+            "results": results,
+            "count": len(results),
+            "has_more": has_more,
+            "next_offset": offset + len(results) if has_more else None,
+            "timestamp": datetime.now().isoformat()
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error searching documents: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Search failed: {str(e)}")
+
+@app.get("/cohorts/query")
+async def query_cohort(q: str = Query(..., min_length=1, max_length=1000),
+                       level: str = Query("patient"),
+                       limit: int = Query(100, ge=0, le=1000),
+                       offset: int = Query(0, ge=0)):
+    """
+    Find patients (or documents) by the entities in their analyzed documents
+    
+    q is a boolean expression over entity terms, e.g.
+    metformin AND hba1c AND NOT insulin, or (medications:"insulin glargine" OR metformin) diabetes.
+    Adjacent terms are ANDed; label:term restricts a term to one entity label or category.
+    level=patient matches across all of a patient's documents, level=document within one document.
+    """
+    try:
+        if level not in COHORT_LEVELS:
+            raise HTTPException(status_code=400, detail=f"Unknown level. Use one of: {', '.join(COHORT_LEVELS)}")
+        try:
+            query_tree = parse_cohort_query(q)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid cohort query: {str(e)}")
+        
+        start_time = datetime.now()
+        conn = sqlite3.connect('dip_analysis.db')
+        cursor = conn.cursor()
+        
+        matches, term_counts = COHORT_INDEX.evaluate(cursor, query_tree, level)
+        evaluated_ms = (datetime.now() - start_time).total_seconds() * 1000
+        
+        page = []
+        for position, member in enumerate(iter_bits(matches)):
+            if position >= offset + limit:
+                break
+            if position >= offset:
+                page.append(member)
+        
+        # Resolve just the requested page back to patients / documents
+        members = []
+        if page:
+            placeholders = ",".join("?" * len(page))
+            if level == "patient":
+                cursor.execute(f'''
+                    SELECT pk.id, p.id, p.name, p.document_count, p.last_activity
+                    FROM patient_keys pk
+                    JOIN patients p ON p.id = pk.patient_id
+                    WHERE pk.id IN ({placeholders})
+                ''', page)
+                found = {row[0]: {"patient_id": row[1], "name": row[2], "document_count": row[3],
+                                  "last_activity": row[4]} for row in cursor.fetchall()}
+            else:
+                cursor.execute(f'''
+                    SELECT analysis_id, id, name, patient_id, directory_id, uploaded_at
+                    FROM patient_documents
+                    WHERE analysis_id IN ({placeholders})
+                ''', page)
+                found = {row[0]: {"document_id": row[1], "name": row[2], "patient_id": row[3],
+                                  "directory_id": row[4], "analysis_id": row[0], "uploaded_at": row[5]}
+                         for row in cursor.fetchall()}
+            members = [found[member] for member in page if member in found]
+        
+        conn.close()
+        
+        total = matches.bit_count()
+        return {
+            "success": True,
+            "query": q,
+            "level": level,
+            "total": total,
+            "results": members,
+            "count": len(members),
+            "has_more": offset + len(page) < total,
+            "term_matches": term_counts,
+            "evaluation_ms": round(evaluated_ms, 3),
+            "timestamp": datetime.now().isoformat()
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error running cohort query: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Cohort query failed: {str(e)}")
+
+@app.get("/cohorts/stats")
+async def get_cohort_index_stats():
+    """Cohort bitset cache statistics"""
+    return {
+        "success": True,
+        "cohort_index": COHORT_INDEX.stats(),
+        "timestamp": datetime.now().isoformat()
+    }
+
+def parse_month_param(value: Optional[str], param_name: str) -> Optional[int]:
+    if value is None:
+        return None
+    try:
+        return month_code(value)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid {param_name}: {str(e)}")
+
+def run_entity_analytics(method: str, *args) -> Dict[str, Any]:
+    """Refresh the entity snapshot and run one query on it"""
+    if ENTITY_ANALYTICS is None:
+        raise HTTPException(status_code=503, detail="Entity analytics not available (NumPy missing)")
+    
+    start_time = datetime.now()
+    conn = sqlite3.connect('dip_analysis.db')
+    cursor = conn.cursor()
+    result = ENTITY_ANALYTICS.query(cursor, method, *args)
+    conn.close()
+    
+    return {
+        "success": True,
+        **result,
+        "query_ms": round((datetime.now() - start_time).total_seconds() * 1000, 3),
+        "timestamp": datetime.now().isoformat()
+    }
+
+@app.get("/analytics/entities/top")
+async def get_top_entities(label: Optional[str] = None,
+                           since: Optional[str] = None,
+                           until: Optional[str] = None,
+                           limit: int = Query(20, ge=1, le=500)):
+    """
+    Most frequent entities across all analyses (counted once per analysis)
+    
+    label takes an entity label (CONDITION) or category (conditions);
+    since / until are inclusive months (YYYY-MM).
+    """
+    try:
+        return run_entity_analytics("top_entities", entity_label(label) if label else None,
+                                    parse_month_param(since, "since"), parse_month_param(until, "until"), limit)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error getting top entities: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Entity analytics failed: {str(e)}")
+
+@app.get("/analytics/entities/monthly")
+async def get_entity_monthly_frequency(label: Optional[str] = None,
+                                       entities: Optional[str] = None,
+                                       since: Optional[str] = None,
+                                       until: Optional[str] = None,
+                                       limit: int = Query(5, ge=1, le=50)):
+    """
+    Month-by-month analysis counts for the given entities (comma-separated),
+    or for the top `limit` entities of the label when none are given
+    """
+    try:
+        names = [name.strip() for name in entities.split(",") if name.strip()] if entities else []
+        return run_entity_analytics("monthly_frequency", entity_label(label) if label else None, names,
+                                    parse_month_param(since, "since"), parse_month_param(until, "until"), limit)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error getting monthly entity frequency: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Entity analytics failed: {str(e)}")
+
+@app.get("/analytics/entities/cooccurrence")
+async def get_entity_cooccurrence(entity: str = Query(..., min_length=1),
+                                  label: Optional[str] = None,
+                                  partner_label: Optional[str] = None,
+                                  since: Optional[str] = None,
+                                  until: Optional[str] = None,
+                                  limit: int = Query(20, ge=1, le=500),
+                                  by_month: bool = False):
+    """
+    Entities found in the same analyses as `entity`, most frequent first
+    
+    share is the fraction of the entity's analyses that also mention the partner;
+    by_month adds a monthly series for each partner.
+    """
+    try:
+        return run_entity_analytics("cooccurrence", entity, entity_label(label) if label else None,
+                                    entity_label(partner_label) if partner_label else None,
+                                    parse_month_param(since, "since"), parse_month_param(until, "until"),
+                                    limit, by_month)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error getting entity co-occurrence: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Entity analytics failed: {str(e)}")
+
+@app.get("/analytics/entities/stats")
+async def get_entity_analytics_stats():
+    """Entity snapshot size and freshness"""
+    if ENTITY_ANALYTICS is None:
+        raise HTTPException(status_code=503, detail="Entity analytics not available (NumPy missing)")
+    return {
+        "success": True,
+        "snapshot": ENTITY_ANALYTICS.stats(),
+        "timestamp": datetime.now().isoformat()
+    }
+
+def parse_time_param(value: Optional[str], param_name: str, end_of_day: bool = False) -> Optional[str]:
+    """ISO date or datetime as a TIMESTAMP string comparable with CURRENT_TIMESTAMP values"""
+    if value is None:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {param_name}: expected YYYY-MM-DD or an ISO datetime")
+    if end_of_day and len(value) == 10:
+        parsed = parsed.replace(hour=23, minute=59, second=59)
+    return parsed.strftime('%Y-%m-%d %H:%M:%S')
+
+def require_analyte(name: str) -> str:
+    analyte = resolve_analyte(name)
+    if analyte is None:
+        raise HTTPException(status_code=400, detail=f"Unknown analyte '{name}'. See /labs/analytes")
+    return analyte
+
+@app.get("/labs/analytes")
+async def get_lab_analytes():
+    """Analytes the measurement parser recognizes, with canonical units and reference ranges"""
+    ranges = reference_ranges()
+    return {
+        "success": True,
+        "analytes": [{
+            "analyte": analyte,
+            "label": label,
+            "unit": unit,
+            "aliases": list(aliases),
+            "reference_range": {"low": ranges[analyte][0], "high": ranges[analyte][1]} if analyte in ranges else None
+        } for analyte, (label, unit, aliases, _) in ANALYTES.items()],
+        "timestamp": datetime.now().isoformat()
+    }
+
+@app.get("/labs/patients")
+async def find_patients_by_lab_value(analyte: str = Query(..., min_length=1),
+                                     above: Optional[float] = None,
+                                     below: Optional[float] = None,
+                                     since: Optional[str] = None,
+                                     until: Optional[str] = None,
+                                     limit: int = Query(100, ge=1, le=1000),
+                                     offset: int = Query(0, ge=0)):
+    """
+    Patients with an observation of the analyte strictly above / below the given values,
+    e.g. analyte=hba1c&above=8&since=2025-01-01. Values are in the analyte's canonical unit.
+    """
+    try:
+        canonical = require_analyte(analyte)
+        since_value = parse_time_param(since, "since")
+        until_value = parse_time_param(until, "until", end_of_day=True)
+        
+        conn = sqlite3.connect('dip_analysis.db')
+        cursor = conn.cursor()
+        patients, has_more = find_patients_in_range(cursor, canonical, above, below, since_value, until_value,
+                                                    limit, offset)
+        conn.close()
+        
+        return {
+            "success": True,
+            "analyte": canonical,
+            "unit": ANALYTES[canonical][1],
+            "patients": patients,
+            "count": len(patients),
+            "has_more": has_more,
+            "timestamp": datetime.now().isoformat()
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error querying lab values: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Lab query failed: {str(e)}")
+
+@app.get("/patients/{patient_id}/labs")
+async def get_patient_labs(patient_id: str):
+    """Latest value of every lab and vital sign recorded for a patient"""
+    try:
+        conn = sqlite3.connect('dip_analysis.db')
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT 1 FROM patients WHERE id = ?', (patient_id,))
+        if not cursor.fetchone():
+            conn.close()
+            raise HTTPException(status_code=404, detail="Patient not found")
+        
+        latest = latest_patient_values(cursor, patient_id)
+        conn.close()
+        
+        return {
+            "success": True,
+            "patient_id": patient_id,
+            "labs": latest,
+            "timestamp": datetime.now().isoformat()
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error getting patient labs: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to get patient labs: {str(e)}")
+
+@app.get("/patients/{patient_id}/labs/{analyte}")
+async def get_patient_lab_trend(patient_id: str, analyte: str,
+                                since: Optional[str] = None,
+                                until: Optional[str] = None):
+    """One patient's values of an analyte over time"""
+    try:
+        canonical = require_analyte(analyte)
+        since_value = parse_time_param(since, "since")
+        until_value = parse_time_param(until, "until", end_of_day=True)
+        
+        conn = sqlite3.connect('dip_analysis.db')
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT 1 FROM patients WHERE id = ?', (patient_id,))
+        if not cursor.fetchone():
+            conn.close()
+            raise HTTPException(status_code=404, detail="Patient not found")
+        
+        series = patient_trend(cursor, patient_id, canonical, since_value, until_value)
+        conn.close()
+        
+        return {
+            "success": True,
+            "patient_id": patient_id,
+            "analyte": canonical,
+            "unit": ANALYTES[canonical][1],
+            "series": series,
+            "count": len(series),
+            "timestamp": datetime.now().isoformat()
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error getting lab trend: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to get lab trend: {str(e)}")
+
+def timeline_cursor(events: List[Dict[str, Any]]) -> str:
+    return encode_cursor([events[-1]["occurred_at"], events[-1]["analysis_id"]])
+
+@app.get("/patients/{patient_id}/timeline")
+async def get_patient_timeline(patient_id: str,
+                               cursor: Optional[str] = Query(None),
+                               limit: int = Query(50, ge=1, le=500)):
+    """
+    Patient page summary: problem list, active medications, latest labs and events by date
+    
+    The first page is the patient's stored rollup (one primary-key read). Older events
+    are paged with the returned next_cursor, which reads timeline_events only.
+    """
+    try:
+        conn = sqlite3.connect('dip_analysis.db')
+        db_cursor = conn.cursor()
+        
+        if cursor is None:
+            rollup = patient_rollup(db_cursor, patient_id)
+            conn.commit()  # keeps a rollup rebuilt from stale
+            conn.close()
+            if rollup is None:
+                raise HTTPException(status_code=404, detail="Patient not found")
+            
+            last_day = rollup["events"][-1]["events"] if rollup["events"] else []
+            return {
+                "success": True,
+                "timeline": rollup,
+                "next_cursor": timeline_cursor(last_day) if rollup["has_more_events"] else None,
+                "timestamp": datetime.now().isoformat()
+            }
+        
+        occurred_at, analysis_id = decode_cursor(cursor)
+        events, has_more = event_rows(db_cursor, patient_id, limit, (occurred_at, analysis_id))
+        conn.close()
+        
+        return {
+            "success": True,
+            "patient_id": patient_id,
+            "events": events_by_date(events),
+            "next_cursor": timeline_cursor(events) if has_more else None,
+            "timestamp": datetime.now().isoformat()
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error getting patient timeline: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to get patient timeline: {str(e)}")
+
+DOCUMENT_FIELDS = ["id", "name", "file_type", "file_size", "file_path", "directory_id", "patient_id",
+                   "analysis_id", "uploaded_at", "tags", "analysis_status", "copy_forward_of"]
+DOCUMENT_INCLUDES = ["confidence_score", "analysis_results"]
+
+# Response field -> SQL expression; analysis_status is derived from analysis_id and,
+# while that is unset, the document's latest analysis job
+DOCUMENT_COLUMNS = {
+    "id": "pd.id",
+    "name": "pd.name",
+    "file_type": "pd.file_type",
+    "file_size": "pd.file_size",
+    "file_path": "pd.file_path",
+    "directory_id": "pd.directory_id",
+    "patient_id": "pd.patient_id",
+    "analysis_id": "pd.analysis_id",
+    "uploaded_at": "pd.uploaded_at",
+    "tags": "pd.tags",
+    "copy_forward_of": "pd.copy_forward_of",
+    "analysis_status": '''CASE WHEN pd.analysis_id IS NOT NULL THEN 'completed'
+                              ELSE (SELECT status FROM analysis_jobs j WHERE j.document_id = pd.id
+                                    ORDER BY j.id DESC LIMIT 1) END''',
+    "confidence_score": "ar.confidence_score",
+    "analysis_results": "ar.results"
+}
+
+def document_row(row, names: List[str]) -> Dict[str, Any]:
+    document = {}
+    for name, value in zip(names, row):
+        if name == "tags":
+            value = json.loads(value) if value else []
+        elif name == "analysis_status":
+            value = value if value in ("completed", "failed") else "pending"  # queued / running
+        elif name == "confidence_score":
+            value = value if value else None
+        elif name == "analysis_results":
+            value = json.loads(value) if value else None
+        document[name] = value
+    return document
+
+@app.get("/patients/{patient_id}/directories/{directory_id}/documents")
+async def get_directory_documents(patient_id: str, directory_id: str,
+                                  fields: Optional[str] = Query(None),
+                                  include: Optional[str] = Query(None)):
+    """
+    Get documents in a specific directory
+    
+    Returns the document columns only; analysis data is fetched per document from
+    /analysis/{analysis_id} or requested here with include=confidence_score,analysis_results.
+    fields restricts the document columns returned (default: all of DOCUMENT_FIELDS).
+    """
+    try:
+        names = resolve_projection(fields, DOCUMENT_FIELDS, DOCUMENT_FIELDS)
+        names += resolve_projection(include, DOCUMENT_INCLUDES, [], "include")
+        
+        conn = sqlite3.connect('dip_analysis.db')
+        cursor = conn.cursor()
+        
+        # analysis_results is only joined when something from it was asked for
+        join = ""
+        if any(name in DOCUMENT_INCLUDES for name in names):
+            join = "LEFT JOIN analysis_results ar ON pd.analysis_id = ar.id"
+        
+        cursor.execute(f'''
+            SELECT {", ".join(DOCUMENT_COLUMNS[name] for name in names)}
             FROM patient_documents pd
-            LEFT JOIN analysis_results ar ON pd.analysis_id = ar.id
+            {join}
             WHERE pd.patient_id = ? AND pd.directory_id = ?
             ORDER BY pd.uploaded_at DESC
         ''', (patient_id, directory_id))
         
-        documents = []
-        for row in cursor.fetchall():
-            documents.append({
-                "id": row[0],
-                "name": row[1],
-                "file_type": row[2],
-                "file_size": row[3],
-                "file_path": row[4],
-                "directory_id": row[5],
-                "patient_id": row[6],
-                "analysis_id": row[7],
-                "uploaded_at": row[8],
-                "tags": json.loads(row[9]) if row[9] else [],
-                "analysis_status": "completed" if row[7] else "pending",
-                "confidence_score": row[10] if row[10] else None,
-                "analysis_results": json.loads(row[11]) if row[11] else None
-            })
+        documents = [document_row(row, names) for row in cursor.fetchall()]
         
         conn.close()
         
@@ -1276,10 +3287,99 @@ async def get_directory_documents(patient_id: str, directory_id: str):
             "timestamp": datetime.now().isoformat()
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error fetching directory documents: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to fetch documents: {str(e)}")
 
+@app.delete("/patients/{patient_id}/directories/{directory_id}/documents/{document_id}")
+async def delete_patient_document(patient_id: str, directory_id: str, document_id: str):
+    """Delete a patient document and its file; triggers clean up counters and derived indexes"""
+    try:
+        conn = sqlite3.connect('dip_analysis.db')
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT file_path FROM patient_documents
+            WHERE id = ? AND patient_id = ? AND directory_id = ?
+        ''', (document_id, patient_id, directory_id))
+        row = cursor.fetchone()
+        if not row:
+            conn.close()
+            raise HTTPException(status_code=404, detail="Document not found")
+        
+        cursor.execute('DELETE FROM patient_documents WHERE id = ?', (document_id,))
+        build_patient_rollup(cursor, patient_id)
+        
+        conn.commit()
+        conn.close()
+        
+        if row[0] and os.path.isfile(row[0]):
+            os.remove(row[0])
+        
+        return {
+            "success": True,
+            "document_id": document_id,
+            "message": "Document deleted successfully",
+            "timestamp": datetime.now().isoformat()
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error deleting patient document: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to delete document: {str(e)}")
+
+def fhir_export_response(resource_types: Optional[str], since: Optional[str], patient_id: Optional[str],
+                         accept_encoding: Optional[str]) -> StreamingResponse:
+    """Validate $export parameters and stream the NDJSON, gzipped if the client accepts it"""
+    types = [t.strip() for t in resource_types.split(",") if t.strip()] if resource_types else list(FHIR_RESOURCE_TYPES)
+    unknown = [t for t in types if t not in FHIR_RESOURCE_TYPES]
+    if unknown or not types:
+        raise HTTPException(status_code=400, detail=f"Unsupported _type {', '.join(unknown)}. Use any of: {', '.join(FHIR_RESOURCE_TYPES)}")
+    try:
+        since_timestamp = parse_since(since) if since else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # The generator is resumed from Starlette's thread pool, so the connection must not be pinned
+    conn = sqlite3.connect('dip_analysis.db', check_same_thread=False)
+    if patient_id is not None and not conn.execute('SELECT 1 FROM patients WHERE id = ?', (patient_id,)).fetchone():
+        conn.close()
+        raise HTTPException(status_code=404, detail="Patient not found")
+    # Pass this back as _since for the next incremental export
+    transaction_time = conn.execute("SELECT strftime('%Y-%m-%dT%H:%M:%SZ', 'now')").fetchone()[0]
+    
+    body = export_resources(conn, types, since_timestamp, patient_id)
+    headers = {"X-Transaction-Time": transaction_time, "Cache-Control": "no-store", "Vary": "Accept-Encoding"}
+    if accept_encoding and "gzip" in accept_encoding.lower():
+        body = gzip_stream(body)
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(body, media_type="application/fhir+ndjson", headers=headers)
+
+@app.get("/fhir/$export")
+async def fhir_bulk_export(resource_types: Optional[str] = Query(None, alias="_type"),
+                           since: Optional[str] = Query(None, alias="_since"),
+                           accept_encoding: Optional[str] = Header(None)):
+    """
+    FHIR bulk export: every patient's records as NDJSON FHIR R4 resources
+    
+    _type limits the export to some of Patient, DocumentReference, Observation, Condition
+    and MedicationStatement (comma separated); _since (an instant, e.g. 2025-03-01T00:00:00Z)
+    exports only what changed at or after it. The X-Transaction-Time header is the _since to use
+    for the next incremental export. Sent gzipped when the client accepts gzip.
+    """
+    return fhir_export_response(resource_types, since, None, accept_encoding)
+
+@app.get("/fhir/Patient/{patient_id}/$export")
+async def fhir_patient_export(patient_id: str,
+                              resource_types: Optional[str] = Query(None, alias="_type"),
+                              since: Optional[str] = Query(None, alias="_since"),
+                              accept_encoding: Optional[str] = Header(None)):
+    """FHIR bulk export of one patient's records (same parameters as /fhir/$export)"""
+    return fhir_export_response(resource_types, since, patient_id, accept_encoding)
+
 # Server startup
 if __name__ == "__main__":
     import uvicorn
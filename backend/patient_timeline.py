@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Patient Timeline - materialized per-patient rollups for the patient page
+Each analyzed patient document adds one timeline event plus one problem source row
+per condition / medication it mentions. patient_rollups keeps the page-ready JSON
+for a patient (problem list, active medications, latest labs and recent events by
+date); it is rebuilt from that patient's own rows whenever one of their documents
+is added or removed, so opening a patient is a single primary-key read.
+
+Deletes go through triggers on patient_documents and patients, which drop the
+derived rows and mark the rollup stale; the next read rebuilds it.
+"""
+import json
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from cohort_index import normalize_entity
+from lab_values import latest_patient_values
+
+# Entity categories tracked per patient, and the rollup list each one feeds
+PROBLEM_KINDS = {
+    "conditions": "condition",
+    "medications": "medication"
+}
+
+TIMELINE_EVENTS = 50          # Most recent events embedded in the rollup
+ACTIVE_MEDICATION_DAYS = 180  # Mentioned this close to the latest document = active
+EVENT_ENTITY_LIMIT = 10       # Entities listed per event and kind
+
+def create_timeline_tables(cursor) -> bool:
+    """Create the timeline tables and triggers; returns True if they were created by this call"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'patient_rollups'")
+    exists = cursor.fetchone() is not None
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS timeline_events (
+            analysis_id INTEGER PRIMARY KEY,
+            patient_id TEXT NOT NULL,
+            document_id TEXT NOT NULL,
+            directory_id TEXT,
+            document_name TEXT,
+            occurred_at TIMESTAMP NOT NULL,
+            summary TEXT,
+            details TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_timeline_events_patient
+        ON timeline_events(patient_id, occurred_at, analysis_id)
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS problem_sources (
+            patient_id TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            entity_norm TEXT NOT NULL,
+            analysis_id INTEGER NOT NULL,
+            display TEXT NOT NULL,
+            seen_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (patient_id, kind, entity_norm, analysis_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_problem_sources_analysis ON problem_sources(analysis_id)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS patient_rollups (
+            patient_id TEXT PRIMARY KEY,
+            rollup TEXT NOT NULL,
+            stale INTEGER NOT NULL DEFAULT 0,
+            built_at TIMESTAMP NOT NULL
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_patient_documents_delete_timeline
+        AFTER DELETE ON patient_documents
+        WHEN OLD.analysis_id IS NOT NULL
+        BEGIN
+            DELETE FROM timeline_events WHERE analysis_id = OLD.analysis_id;
+            DELETE FROM problem_sources WHERE analysis_id = OLD.analysis_id;
+            UPDATE patient_rollups SET stale = 1 WHERE patient_id = OLD.patient_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_patients_delete_timeline
+        AFTER DELETE ON patients
+        BEGIN
+            DELETE FROM timeline_events WHERE patient_id = OLD.id;
+            DELETE FROM problem_sources WHERE patient_id = OLD.id;
+            DELETE FROM patient_rollups WHERE patient_id = OLD.id;
+        END
+    ''')
+    return not exists
+
+def _entity_names(entities: List[Dict[str, Any]]) -> List[Tuple[str, str]]:
+    """Distinct (normalized, display) names in document order"""
+    names = {}
+    for entity in entities:
+        norm = normalize_entity(entity.get("text", ""))
+        if norm and not norm[0].isdigit() and norm not in names:
+            names[norm] = entity["text"].strip()
+    return list(names.items())
+
+def record_document_event(cursor, analysis_id: int, patient_id: str, results: Dict[str, Any]):
+    """Add a patient document's timeline event and problem sources, dated by its upload time"""
+    categorized = results.get("categorized_entities", {})
+    names = {kind: _entity_names(categorized.get(category, [])) for category, kind in PROBLEM_KINDS.items()}
+    details = {
+        "conditions": [display for _, display in names["condition"][:EVENT_ENTITY_LIMIT]],
+        "medications": [display for _, display in names["medication"][:EVENT_ENTITY_LIMIT]],
+        "critical_findings": [finding.get("text") for finding in results.get("critical_findings", [])],
+        "abnormal_results": [
+            {"analyte": m["analyte"], "value": m["value"], "unit": m["unit"], "flag": m["flag"]}
+            for m in results.get("measurements", []) if m.get("flag") in ("high", "low")
+        ],
+        "measurement_count": len(results.get("measurements", []))
+    }
+    cursor.execute('''
+        INSERT OR REPLACE INTO timeline_events (analysis_id, patient_id, document_id, directory_id,
+                                                document_name, occurred_at, summary, details)
+        SELECT analysis_id, ?, id, directory_id, name, uploaded_at, ?, ?
+        FROM patient_documents WHERE analysis_id = ?
+    ''', (patient_id, results.get("summary"), json.dumps(details), analysis_id))
+    cursor.executemany('''
+        INSERT OR IGNORE INTO problem_sources (patient_id, kind, entity_norm, analysis_id, display, seen_at)
+        SELECT ?, ?, ?, analysis_id, ?, uploaded_at FROM patient_documents WHERE analysis_id = ?
+    ''', [(patient_id, kind, norm, display, analysis_id)
+          for kind, kind_names in names.items() for norm, display in kind_names])
+    cursor.execute('UPDATE patient_rollups SET stale = 1 WHERE patient_id = ?', (patient_id,))
+
+def backfill_timeline(cursor) -> int:
+    """Record events for every analyzed patient document from its stored results"""
+    cursor.execute('''
+        SELECT pd.analysis_id, pd.patient_id, ar.results
+        FROM patient_documents pd
+        JOIN analysis_results ar ON ar.id = pd.analysis_id
+        WHERE json_valid(ar.results)
+    ''')
+    rows = cursor.fetchall()
+    for analysis_id, patient_id, results in rows:
+        record_document_event(cursor, analysis_id, patient_id, json.loads(results))
+    return len(rows)
+
+def event_rows(cursor, patient_id: str, limit: int,
+               before: Optional[Tuple[str, int]] = None) -> Tuple[List[Dict[str, Any]], bool]:
+    """A patient's events newest first, optionally strictly older than (occurred_at, analysis_id)"""
+    conditions, params = ["patient_id = ?"], [patient_id]
+    if before is not None:
+        conditions.append("(occurred_at, analysis_id) < (?, ?)")
+        params.extend(before)
+    cursor.execute(f'''
+        SELECT analysis_id, document_id, directory_id, document_name, occurred_at, summary, details
+        FROM timeline_events
+        WHERE {" AND ".join(conditions)}
+        ORDER BY occurred_at DESC, analysis_id DESC
+        LIMIT ?
+    ''', params + [limit + 1])
+    rows = cursor.fetchall()
+    return [{
+        "analysis_id": row[0],
+        "document_id": row[1],
+        "directory_id": row[2],
+        "document_name": row[3],
+        "occurred_at": row[4],
+        "summary": row[5],
+        **(json.loads(row[6]) if row[6] else {})
+    } for row in rows[:limit]], len(rows) > limit
+
+def events_by_date(events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Group newest-first events under their calendar date"""
+    days = []
+    for event in events:
+        date = (event["occurred_at"] or "")[:10]
+        if not days or days[-1]["date"] != date:
+            days.append({"date": date, "events": []})
+        days[-1]["events"].append(event)
+    return days
+
+def _problem_list(cursor, patient_id: str, kind: str) -> List[Dict[str, Any]]:
+    cursor.execute('''
+        SELECT MIN(display), MIN(seen_at), MAX(seen_at), COUNT(*)
+        FROM problem_sources
+        WHERE patient_id = ? AND kind = ?
+        GROUP BY entity_norm
+        ORDER BY MAX(seen_at) DESC, COUNT(*) DESC, entity_norm
+    ''', (patient_id, kind))
+    return [{
+        "name": row[0],
+        "first_seen": row[1],
+        "last_seen": row[2],
+        "documents": row[3]
+    } for row in cursor.fetchall()]
+
+def build_patient_rollup(cursor, patient_id: str) -> Dict[str, Any]:
+    """Rebuild and store one patient's rollup from their events, problem sources and labs"""
+    events, has_more = event_rows(cursor, patient_id, TIMELINE_EVENTS)
+    cursor.execute('SELECT COUNT(*), MIN(occurred_at), MAX(occurred_at) FROM timeline_events WHERE patient_id = ?',
+                   (patient_id,))
+    event_count, first_event_at, last_event_at = cursor.fetchone()
+
+    medications = _problem_list(cursor, patient_id, "medication")
+    cutoff = None
+    if last_event_at:
+        cursor.execute('SELECT datetime(?, ?)', (last_event_at, f'-{ACTIVE_MEDICATION_DAYS} days'))
+        cutoff = cursor.fetchone()[0]
+
+    built_at = datetime.now().isoformat()
+    rollup = {
+        "patient_id": patient_id,
+        "event_count": event_count,
+        "first_event_at": first_event_at,
+        "last_event_at": last_event_at,
+        "problems": _problem_list(cursor, patient_id, "condition"),
+        "active_medications": [m for m in medications if cutoff is not None and m["last_seen"] >= cutoff],
+        "past_medications": [m for m in medications if cutoff is None or m["last_seen"] < cutoff],
+        "latest_labs": latest_patient_values(cursor, patient_id),
+        "events": events_by_date(events),
+        "has_more_events": has_more,
+        "built_at": built_at
+    }
+    cursor.execute('''
+        INSERT OR REPLACE INTO patient_rollups (patient_id, rollup, stale, built_at) VALUES (?, ?, 0, ?)
+    ''', (patient_id, json.dumps(rollup), built_at))
+    return rollup
+
+def patient_rollup(cursor, patient_id: str) -> Optional[Dict[str, Any]]:
+    """The stored rollup, rebuilt first if it is stale or missing; None for an unknown patient"""
+    cursor.execute('SELECT rollup, stale FROM patient_rollups WHERE patient_id = ?', (patient_id,))
+    row = cursor.fetchone()
+    if row and not row[1]:
+        return json.loads(row[0])
+    if not row:
+        cursor.execute('SELECT 1 FROM patients WHERE id = ?', (patient_id,))
+        if not cursor.fetchone():
+            return None
+    return build_patient_rollup(cursor, patient_id)
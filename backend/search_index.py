@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Document Search Index - SQLite FTS5 over patient document text
+Each analyzed patient document gets one row in the document_search virtual table
+(document name, extracted text and the entity strings found in it), keyed by the
+document's analysis_id so rows can be found and removed without a scan.
+
+Per-patient scoping is done inside FTS5: patient_scope holds the patient id as a
+single token, so a scoped query intersects the term doclists with that patient's
+short doclist instead of ranking every match and filtering afterwards.
+"""
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+SNIPPET_TOKENS = 16
+MAX_QUERY_TERMS = 32
+
+# Searchable columns; patient_scope is only ever queried by scope_token()
+TEXT_COLUMNS = "{name content entities}"
+
+TERM = re.compile(r'\w+', re.UNICODE)
+NON_WORD = re.compile(r'\W+', re.UNICODE)
+
+def scope_token(patient_id: str) -> str:
+    """Patient id as one FTS token (uuid without hyphens)"""
+    return NON_WORD.sub('', patient_id)
+
+def create_search_index(cursor) -> bool:
+    """Create the FTS5 table and its delete trigger.
+
+    Returns True if the table was created by this call (so it needs a backfill).
+    Raises sqlite3.OperationalError when SQLite was built without FTS5.
+    """
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'document_search'")
+    exists = cursor.fetchone() is not None
+
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS document_search USING fts5(
+            name,
+            content,
+            entities,
+            patient_scope,
+            tokenize = 'porter unicode61 remove_diacritics 2'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_patient_documents_delete_search
+        AFTER DELETE ON patient_documents
+        WHEN OLD.analysis_id IS NOT NULL
+        BEGIN
+            DELETE FROM document_search WHERE rowid = OLD.analysis_id;
+        END
+    ''')
+    return not exists
+
+def backfill_search_index(cursor) -> int:
+    """Index every analyzed patient document from its stored analysis results"""
+    cursor.execute('''
+        INSERT OR REPLACE INTO document_search (rowid, name, content, entities, patient_scope)
+        SELECT pd.analysis_id, pd.name,
+               COALESCE(json_extract(ar.results, '$.extracted_text'), ''),
+               COALESCE((SELECT group_concat(json_extract(e.value, '$.text'), ' ')
+                         FROM json_each(ar.results, '$.medical_entities') e), ''),
+               replace(pd.patient_id, '-', '')
+        FROM patient_documents pd
+        JOIN analysis_results ar ON ar.id = pd.analysis_id
+        WHERE json_valid(ar.results)
+    ''')
+    return cursor.rowcount
+
+def index_document(cursor, analysis_id: int, patient_id: str, name: str, text: str,
+                   analysis_results: Dict[str, Any]):
+    """Add (or replace) one document's row in the search index"""
+    entities = " ".join(entity["text"] for entity in analysis_results.get("medical_entities", []))
+    cursor.execute('''
+        INSERT OR REPLACE INTO document_search (rowid, name, content, entities, patient_scope)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (analysis_id, name, text, entities, scope_token(patient_id)))
+
+def build_match_query(query: str, raw: bool = False) -> str:
+    """Turn free text into an FTS5 query: every word must match, the last one as a prefix.
+
+    raw=True passes the query through as FTS5 syntax (phrases, OR, NOT, NEAR, column filters).
+    """
+    if raw:
+        return f"{TEXT_COLUMNS} : ({query})" if query.strip() else ""
+    terms = TERM.findall(query)[:MAX_QUERY_TERMS]
+    if not terms:
+        return ""
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += "*"
+    return f"{TEXT_COLUMNS} : ({' '.join(quoted)})"
+
+def search_documents(cursor, match: str, patient_id: Optional[str] = None,
+                     limit: int = 20, offset: int = 0) -> Tuple[List[Dict[str, Any]], bool]:
+    """BM25-ranked matches with highlighted snippets; returns (page, has_more).
+
+    Name matches weigh more than body text, entity strings in between. Snippets
+    always come from the document text, not the entity list.
+    """
+    if patient_id:
+        token = scope_token(patient_id)
+        if not token:
+            return [], False
+        match = f'({match}) AND patient_scope : "{token}"'
+
+    cursor.execute(f'''
+        SELECT pd.id, pd.name, pd.patient_id, pd.directory_id, pd.analysis_id, pd.uploaded_at,
+               bm25(document_search, 10.0, 1.0, 4.0, 0.0) AS score,
+               highlight(document_search, 0, '<mark>', '</mark>'),
+               snippet(document_search, 1, '<mark>', '</mark>', '…', {SNIPPET_TOKENS})
+        FROM document_search
+        JOIN patient_documents pd ON pd.analysis_id = document_search.rowid
+        WHERE document_search MATCH ?
+        ORDER BY score
+        LIMIT ? OFFSET ?
+    ''', (match, limit + 1, offset))
+    rows = cursor.fetchall()
+
+    results = [{
+        "document_id": row[0],
+        "name": row[1],
+        "patient_id": row[2],
+        "directory_id": row[3],
+        "analysis_id": row[4],
+        "uploaded_at": row[5],
+        "score": round(-row[6], 6),
+        "name_highlighted": row[7],
+        "snippet": row[8]
+    } for row in rows[:limit]]
+    return results, len(rows) > limit
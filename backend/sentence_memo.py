@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Sentence Memo - bounded LRU cache of per-sentence extraction results
+Copy-forwarded and templated notes repeat the same sentences, so the
+extraction stages key their results by a hash of the normalized sentence
+and only scan sentences they have not seen before.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+class SentenceMemo:
+    """Thread-safe LRU memo with hit/miss counters"""
+
+    def __init__(self, max_entries: int = 50000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def sentence_key(sentence: str) -> bytes:
+        """Hash of the normalized (trimmed, lowercased) sentence"""
+        return hashlib.blake2b(sentence.strip().lower().encode("utf-8"), digest_size=16).digest()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+# Shared by every pipeline run in the process
+SENTENCE_MEMO = SentenceMemo()
@@ -0,0 +1,82 @@
+"""
+Shared fixtures for the backend tests
+Run from the backend directory: python -m pytest tests
+Every test runs in its own temporary directory, so the SQLite databases the
+modules open by relative path (dip_analysis.db, fast_medical.db) are fresh and
+the checked-in ones are never touched.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# (term, category, source_db, confidence)
+MEDICAL_TERMS = [
+    ("chest pain", "SYMPTOM", "Common-Terms", 0.95),
+    ("pain", "SYMPTOM", "Common-Terms", 0.95),
+    ("hypertension", "CONDITION", "ICD-10", 0.95),
+    ("diabetes mellitus", "CONDITION", "ICD-10", 0.95),
+    ("diabetes", "CONDITION", "ICD-10", 0.95),
+    ("asthma", "CONDITION", "ICD-10", 0.9),
+    ("fever", "SYMPTOM", "Common-Terms", 0.95),
+    ("edema", "SYMPTOM", "Common-Terms", 0.9),
+    ("metformin", "MEDICATION", "Common-Terms", 0.95),
+    ("lisinopril", "MEDICATION", "Common-Terms", 0.95),
+    ("aspirin", "MEDICATION", "Common-Terms", 0.95),
+    ("St. John's wort", "MEDICATION", "Common-Terms", 0.9),
+    ("glucose", "LAB_VALUES", "LOINC", 0.95)
+]
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+@pytest.fixture
+def medical_db(tmp_path, monkeypatch):
+    """A small term dictionary in place of fast_medical.db, with an empty sentence memo"""
+    import fast_medical_db
+    from sentence_memo import SENTENCE_MEMO
+
+    db = fast_medical_db.FastMedicalDatabase(str(tmp_path / "fast_medical.db"))
+    db.conn.executemany(
+        "INSERT INTO medical_terms (term, category, source_db, confidence, term_lower) VALUES (?, ?, ?, ?, ?)",
+        [(term, category, source, confidence, term.lower()) for term, category, source, confidence in MEDICAL_TERMS]
+    )
+    db.conn.commit()
+    monkeypatch.setattr(fast_medical_db, "_fast_db_instance", db)
+    SENTENCE_MEMO.clear()
+    yield db
+    SENTENCE_MEMO.clear()
+    db.conn.close()
+
+@pytest.fixture
+def database(medical_db):
+    """A fresh dip_analysis.db created by init_database, and a connection to it"""
+    import sqlite3
+
+    import main
+
+    main.init_database()
+    conn = sqlite3.connect("dip_analysis.db")
+    yield conn
+    conn.close()
+
+@pytest.fixture
+def add_document(database, tmp_path):
+    """add_document(patient_id, directory_id, text) -> (document_id, job): a stored text document and its queued job"""
+    import main
+    from job_queue import get_job
+
+    def add(patient_id, directory_id, text, file_name="note.txt"):
+        cursor = database.cursor()
+        path = tmp_path / f"{len(list(tmp_path.glob('*.txt')))}-{file_name}"
+        path.write_text(text)
+        document_id, job_id = main.insert_patient_document(cursor, patient_id, directory_id, file_name, "text/plain",
+                                                           len(text), str(path), "upload")
+        database.commit()
+        return document_id, get_job(cursor, job_id)
+
+    return add
@@ -0,0 +1,44 @@
+from analysis_pipeline import run_analysis
+
+NOTE = "History of hypertension and diabetes mellitus. Takes metformin and lisinopril daily."
+
+def entity_pairs(response):
+    return [(entity["text"].lower(), entity["label"]) for entity in response["medical_entities"]]
+
+def test_search_terms_limit_counts_requested_categories_only(medical_db):
+    # Conditions rank first (longer terms), so a limit of 2 without the filter holds no medication
+    assert [term for term, _, _ in medical_db.search_terms(NOTE.lower(), limit=2)] == ["diabetes mellitus", "hypertension"]
+    assert medical_db.search_terms(NOTE.lower(), limit=2, categories=["MEDICATION"]) == [
+        ("lisinopril", "MEDICATION", "Common-Terms"), ("metformin", "MEDICATION", "Common-Terms")
+    ]
+
+def test_category_filter_keeps_only_requested_entities(medical_db):
+    _, response = run_analysis(NOTE, categories=["medications"])
+    assert sorted(entity_pairs(response)) == [("lisinopril", "MEDICATION"), ("metformin", "MEDICATION")]
+
+def test_dictionary_hits_keep_the_database_ranking(medical_db):
+    # Equal length: fever outranks edema on confidence, whatever the alphabet says
+    _, response = run_analysis("Edema and fever. Chest pain, then pain at rest.")
+    ids = {(entity["text"], entity["start_pos"]): entity["id"]
+           for entity in response["medical_entities"] if entity["source"] != "Pattern"}
+    assert ids == {("chest pain", 17): 1, ("fever", 10): 2, ("edema", 0): 3, ("pain", 23): 4}
+
+def test_dictionary_limit_applies_to_the_whole_document(medical_db, monkeypatch):
+    import analysis_pipeline
+
+    monkeypatch.setitem(analysis_pipeline.ANALYSIS_PROFILES["standard"], "dictionary_limit", 2)
+    text = "Diabetes mellitus noted. Takes aspirin."
+    # The second sentence alone is in the memo, aspirin and all
+    run_analysis("Takes aspirin.")
+
+    _, response = run_analysis(text)
+    # As one search of the whole text: the two longest terms, and no aspirin
+    assert [term for term, _, _ in medical_db.search_terms(text.lower(), limit=2)] == ["diabetes mellitus", "diabetes"]
+    assert sorted(entity["text"] for entity in response["medical_entities"]
+                  if entity["source"] != "Pattern") == ["diabetes", "diabetes mellitus"]
+
+def test_entities_across_sentence_boundaries_are_found(medical_db):
+    _, response = run_analysis("Takes St. John's wort daily.\nBlood pressure 120/80\nmmHg.")
+    pairs = entity_pairs(response)
+    assert ("st. john's wort", "MEDICATION") in pairs
+    assert ("120/80\nmmhg", "VITAL_SIGNS") in pairs
@@ -0,0 +1,32 @@
+import io
+import os
+
+import pytest
+
+from bulk_ingest import INGEST_DIR, stage_archive
+from upload_sessions import COPY_BUFFER_BYTES
+
+class CountingStream(io.BytesIO):
+    def __init__(self, data):
+        super().__init__(data)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        piece = super().read(size)
+        self.bytes_read += len(piece)
+        return piece
+
+def test_archive_over_the_limit_stops_staging_and_leaves_nothing():
+    stream = CountingStream(b"x" * (5 * COPY_BUFFER_BYTES))
+
+    with pytest.raises(ValueError):
+        stage_archive("too-big", stream, COPY_BUFFER_BYTES + 1)
+
+    # Staging stops at the first piece past the limit
+    assert stream.bytes_read == 2 * COPY_BUFFER_BYTES
+    assert os.listdir(INGEST_DIR) == []
+
+def test_archive_within_the_limit_is_staged():
+    path = stage_archive("small", io.BytesIO(b"PK archive"), COPY_BUFFER_BYTES)
+    with open(path, "rb") as f:
+        assert f.read() == b"PK archive"
@@ -0,0 +1,98 @@
+import random
+import sqlite3
+
+from analysis_pipeline import run_analysis
+from copy_forward import prior_analysis, run_copy_forward_analysis
+from sentence_memo import SENTENCE_MEMO
+
+SENTENCES = [
+    "Patient reports chest pain radiating to the left arm.",
+    "No fever or chills overnight.",
+    "History of hypertension and diabetes mellitus.",
+    "Glucose 180 mg/dL this morning.",
+    "BP 142/90 mmHg, pulse 88 bpm.",
+    "Continue metformin 500 mg twice daily.",
+    "Started lisinopril 10 mg for hypertension.",
+    "Mild edema in both ankles, pain improved.",
+    "Asthma controlled on albuterol as needed.",
+    "Aspirin held before the procedure.",
+    "Family history of diabetes in the mother.",
+    "Temp 38.2 C, fever resolved by evening.",
+    "Denies shortness of breath or cough.",
+    "Repeat glucose 126 mg/dL, creatinine 1.1 mg/dL.",
+    "Lives alone, quit smoking last year.",
+    "Plan: chest x-ray and echocardiogram."
+]
+
+def without_ids(response):
+    """The response apart from entity ids and the copy_forward block"""
+    entities = [{k: v for k, v in entity.items() if k != "id"} for entity in response["medical_entities"]]
+    categorized = {category: [{k: v for k, v in entity.items() if k != "id"} for entity in found]
+                   for category, found in response["categorized_entities"].items()}
+    rest = {k: v for k, v in response.items()
+            if k not in ("medical_entities", "categorized_entities", "copy_forward")}
+    return entities, categorized, rest
+
+def edited(rng, sentences):
+    sentences = list(sentences)
+    for _ in range(rng.randint(1, 4)):
+        edit = rng.choice(("insert", "delete", "change", "move"))
+        position = rng.randrange(len(sentences))
+        if edit == "insert":
+            sentences.insert(position, rng.choice(SENTENCES))
+        elif edit == "delete" and len(sentences) > 2:
+            del sentences[position]
+        elif edit == "change":
+            sentences[position] = sentences[position].replace(".", ", stable.", 1)
+        elif edit == "move":
+            sentences.insert(rng.randrange(len(sentences)), sentences.pop(position))
+    return sentences
+
+def analyses(earlier, later):
+    SENTENCE_MEMO.clear()
+    _, prior = run_analysis(earlier)
+    SENTENCE_MEMO.clear()
+    _, full = run_analysis(later)
+    SENTENCE_MEMO.clear()
+    _, incremental = run_copy_forward_analysis(later, prior)
+    return prior, full, incremental
+
+def test_copy_forward_matches_a_full_analysis(medical_db):
+    rng = random.Random(50)
+    for _ in range(200):
+        earlier = [rng.choice(SENTENCES) for _ in range(rng.randint(4, 10))]
+        later = edited(rng, earlier)
+        _, full, incremental = analyses("\n".join(earlier), "\n".join(later))
+        assert without_ids(incremental) == without_ids(full), (earlier, later)
+
+def test_only_changed_sentences_are_analyzed(medical_db):
+    earlier = "\n".join(SENTENCES[:6])
+    later = "\n".join(SENTENCES[:3] + ["Glucose 95 mg/dL after breakfast."] + SENTENCES[4:6])
+    _, full, incremental = analyses(earlier, later)
+
+    assert without_ids(incremental) == without_ids(full)
+    assert incremental["copy_forward"]["sentences_analyzed"] == 1
+    assert [m["value"] for m in incremental["measurements"]] == [m["value"] for m in full["measurements"]]
+
+def test_entity_mentioned_earlier_in_a_new_sentence_replaces_the_carried_one(medical_db):
+    earlier = "\n".join(SENTENCES[4:8])
+    later = "\n".join([SENTENCES[2]] + SENTENCES[4:8])
+    _, full, incremental = analyses(earlier, later)
+
+    assert without_ids(incremental) == without_ids(full)
+    hypertension = [e for e in incremental["medical_entities"] if e["text"].lower() == "hypertension"]
+    assert [e["start_pos"] for e in hypertension] == [later.lower().index("hypertension")]
+
+def test_results_from_an_older_dictionary_are_not_carried(medical_db):
+    _, prior = run_analysis("\n".join(SENTENCES[:4]))
+    assert prior_analysis(prior, "standard", None)
+
+    # The dictionary is rebuilt by a separate script, as expand_medical_db.py does
+    conn = sqlite3.connect(medical_db.db_path)
+    conn.execute(
+        "INSERT INTO medical_terms (term, category, source_db, confidence, term_lower) VALUES (?, ?, ?, ?, ?)",
+        ("wheezing", "SYMPTOM", "Common-Terms", 0.9, "wheezing")
+    )
+    conn.commit()
+    conn.close()
+    assert not prior_analysis(prior, "standard", None)
@@ -0,0 +1,31 @@
+import main
+from entity_analytics import EntitySnapshot
+
+NOTE = "Patient with hypertension and chest pain. Started lisinopril."
+
+def analyze(database, add_document, name):
+    cursor = database.cursor()
+    patient_id, directories = main.insert_patient(cursor, name, None, {})
+    _, job = add_document(patient_id, directories["Follow-ups"], NOTE)
+    main.process_document_job(cursor, job)
+    database.commit()
+    return patient_id
+
+def top(snapshot, database):
+    result = snapshot.query(database.cursor(), "top_entities", None, None, None, 10)
+    return result["analyses"], {entity["entity"]: entity["analyses"] for entity in result["entities"]}
+
+def test_analyses_of_deleted_patients_drop_out_of_the_snapshot(database, add_document):
+    deleted = analyze(database, add_document, "Deleted Patient")
+    analyze(database, add_document, "Kept Patient")
+    snapshot = EntitySnapshot()
+    analyses, counts = top(snapshot, database)
+    assert analyses == 2 and counts["hypertension"] == 2
+
+    database.execute("DELETE FROM patients WHERE id = ?", (deleted,))
+    database.commit()
+
+    analyses, counts = top(snapshot, database)
+    assert analyses == 1 and counts["hypertension"] == 1
+    # A snapshot built from scratch agrees
+    assert top(EntitySnapshot(), database) == (analyses, counts)
@@ -0,0 +1,21 @@
+import json
+import sqlite3
+
+import main
+from fhir_export import export_resources, parse_since
+
+def exported_patients(since):
+    # export_resources closes the connection it streams from
+    body = b"".join(export_resources(sqlite3.connect("dip_analysis.db"), ["Patient"], parse_since(since)))
+    return [json.loads(line)["id"] for line in body.splitlines()]
+
+def test_change_in_the_transaction_time_second_is_exported_again(database):
+    cursor = database.cursor()
+    patient_id, _ = main.insert_patient(cursor, "Same Second", None, {})
+    # The previous export's X-Transaction-Time, then an update within that same second
+    transaction_time = "2025-03-01T12:00:00Z"
+    cursor.execute("UPDATE patients SET updated_at = ? WHERE id = ?", ("2025-03-01 12:00:00", patient_id))
+    database.commit()
+
+    assert exported_patients(transaction_time) == [patient_id]
+    assert exported_patients("2025-03-01T12:00:01Z") == []
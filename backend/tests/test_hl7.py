@@ -0,0 +1,52 @@
+import asyncio
+import json
+
+import main
+from hl7_listener import parse_message
+
+def adt(control_id, pid):
+    return (f"MSH|^~\\&|REG|GENERAL HOSPITAL|XNOSIS|XNOSIS|20261019083000||ADT^A08|{control_id}|P|2.5.1\r"
+            f"PID|1||{pid}").encode()
+
+def stored_patient(cursor, patient_id):
+    cursor.execute("SELECT name, date_of_birth, json_extract(metadata, '$.gender') FROM patients WHERE id = ?",
+                   (patient_id,))
+    return cursor.fetchone()
+
+def hl7_patient_id(cursor):
+    cursor.execute("SELECT patient_id FROM hl7_patient_ids WHERE identifier = 'MRN100'")
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def test_adt_update_keeps_demographics_the_message_leaves_out(database):
+    results = main.store_hl7_messages([
+        parse_message(adt("1", "MRN100^^^GH||Doe^Jane^Q||19800214|F")),
+        parse_message(adt("2", "MRN100^^^GH||||19800214"))
+    ])
+    assert [code for code, _ in results] == ["AA", "AA"]
+
+    cursor = database.cursor()
+    patient_id = hl7_patient_id(cursor)
+    assert stored_patient(cursor, patient_id) == ("Jane Q Doe", "1980-02-14", "female")
+
+    main.store_hl7_messages([parse_message(adt("3", "MRN100^^^GH||Doe^Janet||19800215|F"))])
+    assert stored_patient(cursor, patient_id) == ("Janet Doe", "1980-02-15", "female")
+
+def test_new_patient_without_a_name_is_named_after_the_identifier(database):
+    main.store_hl7_messages([parse_message(adt("1", "MRN100^^^GH"))])
+
+    cursor = database.cursor()
+    assert stored_patient(cursor, hl7_patient_id(cursor)) == ("Patient MRN100", None, None)
+
+def test_message_for_a_deleted_patient_creates_a_new_one(database):
+    main.store_hl7_messages([parse_message(adt("1", "MRN100^^^GH||Doe^Jane||19800214|F"))])
+    cursor = database.cursor()
+    deleted = hl7_patient_id(cursor)
+    asyncio.run(main.delete_patient(deleted))
+    assert hl7_patient_id(cursor) is None
+
+    main.store_hl7_messages([parse_message(adt("2", "MRN100^^^GH||Doe^Jane||19800214|F"))])
+    patient_id = hl7_patient_id(cursor)
+    assert patient_id not in (None, deleted)
+    cursor.execute("SELECT metadata FROM patients WHERE id = ?", (patient_id,))
+    assert json.loads(cursor.fetchone()[0])["source"] == "hl7"
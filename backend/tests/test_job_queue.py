@@ -0,0 +1,92 @@
+import sqlite3
+import time
+
+import main
+from job_queue import JobQueue, get_job
+
+NOTE = "Patient with hypertension. Started lisinopril. Glucose 180 mg/dL."
+
+def queued_document(database, add_document):
+    patient_id, directories = main.insert_patient(database.cursor(), "Queued Patient", None, {})
+    document_id, job = add_document(patient_id, directories["Follow-ups"], NOTE)
+    return document_id, job["id"]
+
+def table_rows(cursor, table):
+    cursor.execute(f"SELECT COUNT(*) FROM {table}")
+    return cursor.fetchone()[0]
+
+def test_claimed_job_is_analyzed_and_completed(database, add_document):
+    document_id, job_id = queued_document(database, add_document)
+    queue = JobQueue()
+    queue.handler = main.process_document_job
+    cursor = database.cursor()
+
+    job = queue.claim(cursor, "node-a:1")
+    assert job["id"] == job_id and job["lease_owner"] == "node-a:1"
+    assert queue.claim(cursor, "node-b:1") is None
+    queue.run_job(database, job)
+
+    job = get_job(cursor, job_id)
+    assert job["status"] == "completed" and job["lease_owner"] is None
+    cursor.execute("SELECT analysis_id FROM patient_documents WHERE id = ?", (document_id,))
+    assert cursor.fetchone()[0] == job["analysis_id"]
+
+def test_expired_lease_is_claimed_again_and_the_old_owner_discards_its_results(database, add_document):
+    _, job_id = queued_document(database, add_document)
+    queue = JobQueue()
+    queue.handler = main.process_document_job
+    cursor = database.cursor()
+
+    stale = queue.claim(cursor, "node-a:1")
+    cursor.execute("UPDATE analysis_jobs SET lease_expires_at = ? WHERE id = ?", (time.time() - 1, job_id))
+    database.commit()
+    job = queue.claim(cursor, "node-b:1")
+    assert job["id"] == job_id and job["attempts"] == 2
+
+    queue.run_job(database, stale)
+    assert table_rows(cursor, "analysis_results") == 0
+    assert get_job(cursor, job_id)["lease_owner"] == "node-b:1"
+
+    queue.run_job(database, job)
+    assert get_job(cursor, job_id)["status"] == "completed"
+    assert table_rows(cursor, "analysis_results") == 1
+
+def test_failed_job_is_queued_again_with_a_backoff(database, add_document):
+    _, job_id = queued_document(database, add_document)
+    queue = JobQueue()
+
+    def flaky(cursor, job):
+        raise RuntimeError("analysis slot unavailable")
+
+    queue.handler = flaky
+    cursor = database.cursor()
+    queue.run_job(database, queue.claim(cursor, "node-a:1"))
+
+    job = get_job(cursor, job_id)
+    assert job["status"] == "queued" and job["error"] == "analysis slot unavailable"
+    assert job["next_attempt_at"] > time.time()
+    assert queue.claim(cursor, "node-a:1") is None
+
+def test_document_deleted_during_analysis_fails_the_job_without_indexing(database, add_document, monkeypatch):
+    document_id, job_id = queued_document(database, add_document)
+    extract_document_text = main.extract_document_text
+
+    def extract_then_delete(file_path, file_type):
+        # The user deletes the document while the worker is analyzing it
+        other = sqlite3.connect("dip_analysis.db")
+        other.execute("DELETE FROM patient_documents WHERE id = ?", (document_id,))
+        other.commit()
+        other.close()
+        return extract_document_text(file_path, file_type)
+
+    monkeypatch.setattr(main, "extract_document_text", extract_then_delete)
+    queue = JobQueue()
+    queue.handler = main.process_document_job
+    cursor = database.cursor()
+    queue.run_job(database, queue.claim(cursor, "node-a:1"))
+
+    job = get_job(cursor, job_id)
+    assert job["status"] == "failed" and job["error"] == "Document was deleted while it was analyzed"
+    for table in ("analysis_results", "entity_postings", "lab_observations", "document_search",
+                  "document_signatures", "timeline_events"):
+        assert table_rows(cursor, table) == 0, table
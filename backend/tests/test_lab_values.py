@@ -0,0 +1,14 @@
+from lab_values import extract_measurement_spans
+
+def measured(sentence):
+    return [(analyte, value, unit) for _, _, analyte, value, _, unit in extract_measurement_spans(sentence)]
+
+def test_value_in_a_unit_the_analyte_is_not_measured_in_is_dropped():
+    assert measured("height 5 ft 10 in") == []
+    assert measured("height 5'10\"") == []
+    assert measured("glucose 10 mmol/mol") == []
+    assert measured("height 70 inches") == [("height", 177.8, "inches")]
+
+def test_word_after_the_value_is_not_taken_for_a_unit():
+    assert measured("glucose 180 in the morning") == [("glucose", 180.0, "")]
+    assert measured("glucose 180") == [("glucose", 180.0, "")]
@@ -0,0 +1,20 @@
+from analysis_pipeline import AnalysisOptions
+from live_analysis import LiveDocument
+
+def entity_spans(document):
+    return sorted((entity["text"], entity["start_pos"], entity["end_pos"]) for entity in document.entities())
+
+def test_edit_offsets_are_code_points(medical_db):
+    # The emoji is one code point here but two UTF-16 units in the browser
+    text = "Feeling 😀 today. Takes metformin daily."
+    document = LiveDocument(AnalysisOptions())
+    document.reset(text)
+
+    position = text.index("daily")
+    document.apply_edit(position, position + len("daily"), "and aspirin daily")
+
+    fresh = LiveDocument(AnalysisOptions())
+    fresh.reset(document.text)
+    assert document.text == "Feeling 😀 today. Takes metformin and aspirin daily."
+    assert entity_spans(document) == entity_spans(fresh)
+    assert ("aspirin", 37, 44) in entity_spans(document)   # 38 in UTF-16 units
@@ -0,0 +1,61 @@
+import asyncio
+
+import main
+
+NOTE = "Patient with hypertension and chest pain. Started lisinopril. Glucose 180 mg/dL."
+
+# Index rows of an analyzed document, by analysis_id (or document_id)
+ANALYSIS_ROWS = {
+    "entity_postings": "analysis_id",
+    "indexed_documents": "analysis_id",
+    "lab_observations": "analysis_id",
+    "document_search": "rowid",
+    "timeline_events": "analysis_id"
+}
+DOCUMENT_ROWS = {
+    "patient_documents": "id",
+    "document_signatures": "document_id",
+    "document_lsh_buckets": "document_id"
+}
+
+def analyzed_document(database, add_document, name):
+    cursor = database.cursor()
+    patient_id, directories = main.insert_patient(cursor, name, None, {})
+    document_id, job = add_document(patient_id, directories["Follow-ups"], NOTE)
+    analysis_id = main.process_document_job(cursor, job)
+    database.commit()
+    return patient_id, document_id, analysis_id
+
+def row_counts(cursor, document_id, analysis_id):
+    counts = {}
+    for tables, key in ((ANALYSIS_ROWS, analysis_id), (DOCUMENT_ROWS, document_id)):
+        for table, column in tables.items():
+            cursor.execute(f"SELECT COUNT(*) FROM {table} WHERE {column} = ?", (key,))
+            counts[table] = cursor.fetchone()[0]
+    return counts
+
+def test_deleting_a_patient_removes_documents_and_index_rows(database, add_document):
+    deleted = analyzed_document(database, add_document, "Deleted Patient")
+    kept = analyzed_document(database, add_document, "Kept Patient")
+    cursor = database.cursor()
+    assert all(row_counts(cursor, *deleted[1:]).values())
+
+    asyncio.run(main.delete_patient(deleted[0]))
+
+    assert not any(row_counts(cursor, *deleted[1:]).values())
+    cursor.execute("SELECT COUNT(*) FROM directories WHERE patient_id = ?", (deleted[0],))
+    assert cursor.fetchone()[0] == 0
+    assert all(row_counts(cursor, *kept[1:]).values())
+
+def test_init_database_removes_documents_of_already_deleted_patients(database, add_document):
+    patient_id, document_id, analysis_id = analyzed_document(database, add_document, "Deleted Patient")
+    cursor = database.cursor()
+    # A patient deleted before the cascade trigger existed left its documents behind
+    cursor.execute("DROP TRIGGER trg_patients_delete_documents")
+    cursor.execute("DELETE FROM patients WHERE id = ?", (patient_id,))
+    database.commit()
+    assert row_counts(cursor, document_id, analysis_id)["patient_documents"] == 1
+
+    main.init_database()
+
+    assert not any(row_counts(cursor, document_id, analysis_id).values())
@@ -0,0 +1,111 @@
+import asyncio
+import base64
+import hashlib
+
+import httpx
+
+import main
+from upload_sessions import advance_session, claim_chunk, create_session, get_session, part_path, release_chunk
+
+def open_session(database, size):
+    patient_id, directories = main.insert_patient(database.cursor(), "Upload Patient", None, {})
+    session = create_session(database.cursor(), "upload-1", patient_id, directories["Imaging"], "chart.txt",
+                             "text/plain", size, None, "upload")
+    database.commit()
+    return session
+
+def test_claim_keeps_a_second_writer_off_the_offset(database):
+    open_session(database, 8)
+    cursor = database.cursor()
+
+    assert claim_chunk(cursor, "upload-1", 0, "first")
+    assert not claim_chunk(cursor, "upload-1", 0, "second")
+    assert not advance_session(cursor, "upload-1", 0, 4, "second")
+
+    release_chunk(cursor, "upload-1", "first")
+    assert claim_chunk(cursor, "upload-1", 0, "second")
+    assert advance_session(cursor, "upload-1", 0, 4, "second")
+    assert get_session(cursor, "upload-1")["received"] == 4
+    assert claim_chunk(cursor, "upload-1", 4, "first")
+
+def test_claim_of_a_request_that_never_finished_lapses(database):
+    open_session(database, 8)
+    cursor = database.cursor()
+    assert claim_chunk(cursor, "upload-1", 0, "crashed")
+    cursor.execute("UPDATE upload_sessions SET writer_expires_at = datetime('now', '-1 seconds')")
+
+    assert claim_chunk(cursor, "upload-1", 0, "retry")
+    assert not advance_session(cursor, "upload-1", 0, 4, "crashed")
+    assert advance_session(cursor, "upload-1", 0, 4, "retry")
+
+def test_concurrent_chunks_at_the_same_offset_write_only_once(database):
+    open_session(database, 8)
+    started, resume = asyncio.Event(), asyncio.Event()
+
+    async def slow_body():
+        yield b"AAAA"
+        started.set()
+        await resume.wait()
+        yield b"AAAA"
+
+    async def send():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            async def second():
+                await started.wait()
+                try:
+                    return await client.patch("/upload-sessions/upload-1", content=b"BBBBBBBB", headers={
+                        "Upload-Offset": "0",
+                        "Upload-Checksum": "sha256 " + base64.b64encode(hashlib.sha256(b"BBBBBBBB").digest()).decode()
+                    })
+                finally:
+                    resume.set()
+
+            return await asyncio.gather(
+                client.patch("/upload-sessions/upload-1", content=slow_body(), headers={"Upload-Offset": "0"}),
+                second()
+            )
+
+    first, second = asyncio.run(send())
+
+    assert first.status_code == 200 and first.json()["offset"] == 8
+    assert second.status_code == 409
+    with open(part_path("upload-1"), "rb") as f:
+        assert f.read() == b"AAAAAAAA"
+
+def test_rejected_chunk_releases_its_claim(database):
+    open_session(database, 8)
+
+    async def send():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            bad = await client.patch("/upload-sessions/upload-1", content=b"AAAAAAAA", headers={
+                "Upload-Offset": "0",
+                "Upload-Checksum": "sha256 " + base64.b64encode(hashlib.sha256(b"other").digest()).decode()
+            })
+            retry = await client.patch("/upload-sessions/upload-1", content=b"AAAAAAAA", headers={"Upload-Offset": "0"})
+            return bad, retry
+
+    bad, retry = asyncio.run(send())
+
+    assert bad.status_code == 460
+    assert retry.status_code == 200 and retry.json()["offset"] == 8
+
+def test_concurrent_finalizes_file_the_upload_once(database):
+    open_session(database, 8)
+
+    async def send():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            await client.patch("/upload-sessions/upload-1", content=b"AAAAAAAA", headers={"Upload-Offset": "0"})
+            finalizes = await asyncio.gather(*(client.post("/upload-sessions/upload-1/finalize") for _ in range(3)))
+            again = await client.post("/upload-sessions/upload-1/finalize")
+            return finalizes, again
+
+    finalizes, again = asyncio.run(send())
+
+    # The file is hashed and moved in a worker thread; the others wait on the claim
+    filed = [r.json()["document_id"] for r in finalizes if r.status_code == 202]
+    assert filed and all(r.status_code in (202, 409) for r in finalizes)
+    assert again.status_code == 202 and set(filed) == {again.json()["document_id"]}
+    assert database.execute("SELECT COUNT(*) FROM patient_documents").fetchone()[0] == 1
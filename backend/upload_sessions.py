@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Resumable Uploads - tus-style chunked uploads into the patient document store
+A client creates a session for one file (its size and target patient directory),
+then sends the bytes in chunks: each chunk states the offset it starts at and
+optionally a checksum of its own bytes ("sha256 <base64 digest>"). Chunks are
+streamed straight into a part file under upload_sessions/, so server memory does
+not depend on the file or chunk size. A chunk only counts once it arrived whole
+and its checksum matched; after a disconnect the client asks for the session's
+offset and continues from there.
+
+Only one request at a time writes into the part file: a chunk first claims the
+session's current offset (writer, held until CHUNK_CLAIM_SECONDS pass without it
+finishing), and a second request for the same offset is turned away until the
+first has advanced the session or given up.
+
+Finalizing moves the part file into the document store, creates the patient
+document and queues its analysis, like a regular upload.
+"""
+import base64
+import hashlib
+import os
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+
+UPLOAD_SESSION_DIR = "upload_sessions"      # Outside the static /uploads mount
+MAX_UPLOAD_BYTES = 2 * 1024 * 1024 * 1024   # 2 GB per file
+MAX_CHUNK_BYTES = 64 * 1024 * 1024          # Largest accepted chunk
+CHUNK_SIZE = 8 * 1024 * 1024                # Chunk size suggested to clients
+UPLOAD_SESSION_HOURS = 24                   # Idle sessions expire after this long
+CHECKSUM_ALGORITHMS = ("sha256", "sha1", "md5")
+COPY_BUFFER_BYTES = 1024 * 1024
+CHUNK_CLAIM_SECONDS = 600                   # A claim of a request that never finished (server died) lapses after this
+
+SESSION_COLUMNS = ["id", "patient_id", "directory_id", "file_name", "file_type", "size", "received",
+                   "checksum", "priority", "status", "document_id", "job_id", "created_at", "updated_at",
+                   "expires_at"]
+
+# Columns added after the first release of upload_sessions
+ADDED_COLUMNS = {
+    "writer": "TEXT",
+    "writer_expires_at": "TIMESTAMP"
+}
+
+class ChecksumMismatch(Exception):
+    """A chunk's or the whole file's bytes do not match the checksum the client sent"""
+
+def create_upload_tables(cursor) -> bool:
+    """Create upload_sessions; returns True if it was created by this call"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'upload_sessions'")
+    exists = cursor.fetchone() is not None
+
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS upload_sessions (
+            id TEXT PRIMARY KEY,
+            patient_id TEXT NOT NULL,
+            directory_id TEXT NOT NULL,
+            file_name TEXT NOT NULL,
+            file_type TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            received INTEGER NOT NULL DEFAULT 0,
+            checksum TEXT,
+            priority TEXT NOT NULL DEFAULT 'upload',
+            status TEXT NOT NULL DEFAULT 'open' CHECK(status IN ('open', 'finalized', 'aborted')),
+            document_id TEXT,
+            job_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP NOT NULL,
+            {", ".join(f"{column} {definition}" for column, definition in ADDED_COLUMNS.items())}
+        )
+    ''')
+    if exists:
+        cursor.execute('PRAGMA table_info(upload_sessions)')
+        columns = {row[1] for row in cursor.fetchall()}
+        for column, definition in ADDED_COLUMNS.items():
+            if column not in columns:
+                cursor.execute(f'ALTER TABLE upload_sessions ADD COLUMN {column} {definition}')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_upload_sessions_expiry ON upload_sessions(status, expires_at)')
+    return not exists
+
+def part_path(upload_id: str) -> str:
+    return os.path.join(UPLOAD_SESSION_DIR, f"{upload_id}.part")
+
+def parse_checksum(value: str) -> Tuple[str, bytes]:
+    """Parse "<algorithm> <base64 digest>" into the algorithm and the raw digest"""
+    algorithm, _, encoded = value.strip().partition(" ")
+    algorithm = algorithm.lower()
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        raise ValueError(f"Unsupported checksum algorithm '{algorithm}'. Use one of: {', '.join(CHECKSUM_ALGORITHMS)}")
+    try:
+        return algorithm, base64.b64decode(encoded.strip(), validate=True)
+    except ValueError:
+        raise ValueError("Checksum digest must be base64 encoded")
+
+def create_session(cursor, upload_id: str, patient_id: str, directory_id: str, file_name: str,
+                   file_type: str, size: int, checksum: Optional[str], priority: str) -> Dict[str, Any]:
+    """Record a new session and create its empty part file"""
+    os.makedirs(UPLOAD_SESSION_DIR, exist_ok=True)
+    open(part_path(upload_id), "wb").close()
+    cursor.execute(f'''
+        INSERT INTO upload_sessions (id, patient_id, directory_id, file_name, file_type, size, checksum,
+                                     priority, expires_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, datetime('now', '+{UPLOAD_SESSION_HOURS} hours'))
+    ''', (upload_id, patient_id, directory_id, file_name, file_type, size, checksum, priority))
+    return get_session(cursor, upload_id)
+
+def get_session(cursor, upload_id: str) -> Optional[Dict[str, Any]]:
+    """An open, finalized or aborted session; None if it does not exist or expired unfinished"""
+    cursor.execute(f'''
+        SELECT {", ".join(SESSION_COLUMNS)} FROM upload_sessions
+        WHERE id = ? AND (status != 'open' OR expires_at > datetime('now'))
+    ''', (upload_id,))
+    row = cursor.fetchone()
+    return dict(zip(SESSION_COLUMNS, row)) if row else None
+
+def claim_chunk(cursor, upload_id: str, offset: int, writer: str) -> bool:
+    """Reserve the chunk at offset for one request; False if the session moved on or another request is writing it"""
+    cursor.execute(f'''
+        UPDATE upload_sessions
+        SET writer = ?, writer_expires_at = datetime('now', '+{CHUNK_CLAIM_SECONDS} seconds')
+        WHERE id = ? AND status = 'open' AND received = ?
+          AND (writer IS NULL OR writer_expires_at <= datetime('now'))
+    ''', (writer, upload_id, offset))
+    return cursor.rowcount == 1
+
+def release_chunk(cursor, upload_id: str, writer: str):
+    """Give up a claim whose chunk was not accepted, so the client can send it again"""
+    cursor.execute('UPDATE upload_sessions SET writer = NULL, writer_expires_at = NULL WHERE id = ? AND writer = ?',
+                   (upload_id, writer))
+
+async def write_chunk(upload_id: str, offset: int, chunks: AsyncIterator[bytes], limit: int,
+                      algorithm: Optional[str] = None) -> Tuple[int, bytes]:
+    """Stream a chunk into the part file at offset; returns (bytes written, digest)
+
+    The caller holds the claim on offset (claim_chunk). Raises ValueError once more
+    than `limit` bytes arrive. Bytes past the session's recorded offset only count
+    after advance_session, so a chunk that was cut off or rejected is simply
+    overwritten by the retry.
+    """
+    digest = hashlib.new(algorithm or "sha256")
+    written = 0
+    with open(part_path(upload_id), "r+b") as f:
+        f.seek(offset)
+        async for piece in chunks:
+            written += len(piece)
+            if written > limit:
+                raise ValueError(f"Chunk exceeds the {limit} bytes this session accepts at offset {offset}")
+            digest.update(piece)
+            f.write(piece)
+    return written, digest.digest()
+
+def advance_session(cursor, upload_id: str, offset: int, written: int, writer: str) -> bool:
+    """Move the session's offset past a complete chunk and end the claim; False if the claim lapsed and was taken"""
+    cursor.execute(f'''
+        UPDATE upload_sessions
+        SET received = received + ?, writer = NULL, writer_expires_at = NULL, updated_at = CURRENT_TIMESTAMP,
+            expires_at = datetime('now', '+{UPLOAD_SESSION_HOURS} hours')
+        WHERE id = ? AND status = 'open' AND received = ? AND writer = ?
+    ''', (written, upload_id, offset, writer))
+    return cursor.rowcount == 1
+
+def verify_part(session: Dict[str, Any]) -> str:
+    """Cut the part file to the session size and check the whole-file checksum, if one was given
+
+    Returns the file's SHA-256 (hex), the content hash patient documents are deduplicated by.
+    """
+    path = part_path(session["id"])
+    os.truncate(path, session["size"])
+    algorithm, expected = parse_checksum(session["checksum"]) if session["checksum"] else (None, None)
+    content_hash = hashlib.sha256()
+    digest = hashlib.new(algorithm) if algorithm and algorithm != "sha256" else None
+    with open(path, "rb") as f:
+        while piece := f.read(COPY_BUFFER_BYTES):
+            content_hash.update(piece)
+            if digest:
+                digest.update(piece)
+    if expected is not None and (digest or content_hash).digest() != expected:
+        raise ChecksumMismatch("Uploaded file does not match its checksum")
+    return content_hash.hexdigest()
+
+def finish_session(cursor, upload_id: str, status: str, document_id: Optional[str] = None,
+                   job_id: Optional[int] = None) -> bool:
+    """Close an open session as finalized or aborted; False if it was no longer open"""
+    cursor.execute('''
+        UPDATE upload_sessions
+        SET status = ?, document_id = ?, job_id = ?, updated_at = CURRENT_TIMESTAMP
+        WHERE id = ? AND status = 'open'
+    ''', (status, document_id, job_id, upload_id))
+    return cursor.rowcount == 1
+
+def purge_expired_sessions(cursor) -> int:
+    """Delete unfinished sessions past their expiry together with their part files"""
+    cursor.execute('''
+        DELETE FROM upload_sessions
+        WHERE status = 'open' AND expires_at <= datetime('now')
+        RETURNING id
+    ''')
+    expired = [row[0] for row in cursor.fetchall()]
+    for upload_id in expired:
+        if os.path.exists(part_path(upload_id)):
+            os.remove(part_path(upload_id))
+    return len(expired)
@@ -0,0 +1,176 @@
+"use client"
+
+import { useState, useEffect, useRef, useCallback } from 'react'
+
+// Live entity highlighting over the /ws/analyze WebSocket.
+// Each text change is sent as a single edit (common prefix/suffix diff);
+// the server re-analyzes only the touched sentences and replies with
+// added/removed entities. Nothing is stored until save() is called.
+//
+// The server counts offsets in code points (Python str indexes) while JS strings
+// index UTF-16 code units, so edits are sent, and entities published, converted
+// between the two; they only differ once the text holds astral characters (emoji).
+
+export interface LiveEntity {
+  id: number
+  text: string
+  label: string
+  start_pos: number
+  end_pos: number
+  confidence: number
+  source: string
+}
+
+interface UseLiveAnalysisProps {
+  analysisProfile?: 'fast' | 'standard' | 'deep'
+  categories?: string[]
+  onSaved?: (analysisId: number, results: any) => void
+}
+
+const LIVE_ANALYSIS_URL = 'ws://localhost:8000/ws/analyze'
+const SURROGATE = /[\uD800-\uDFFF]/
+
+const isHighSurrogate = (code: number) => code >= 0xd800 && code <= 0xdbff
+const isLowSurrogate = (code: number) => code >= 0xdc00 && code <= 0xdfff
+
+// Code points in text[0:index] (index in UTF-16 code units, not inside a surrogate pair)
+function toCodePoints(text: string, index: number): number {
+  if (!SURROGATE.test(text)) return index
+  let count = 0
+  for (let i = 0; i < index; i++) {
+    if (!(isLowSurrogate(text.charCodeAt(i)) && i > 0 && isHighSurrogate(text.charCodeAt(i - 1)))) count++
+  }
+  return count
+}
+
+// UTF-16 index of every code point offset in text (0..number of code points)
+function utf16Offsets(text: string): number[] {
+  const offsets = [0]
+  for (let i = 0; i < text.length; i++) {
+    if (isLowSurrogate(text.charCodeAt(i)) && i > 0 && isHighSurrogate(text.charCodeAt(i - 1))) {
+      offsets[offsets.length - 1] = i + 1
+    } else {
+      offsets.push(i + 1)
+    }
+  }
+  return offsets
+}
+
+export function useLiveAnalysis({
+  analysisProfile = 'fast',
+  categories,
+  onSaved
+}: UseLiveAnalysisProps = {}) {
+  const [entities, setEntities] = useState<LiveEntity[]>([])
+  const [isConnected, setIsConnected] = useState(false)
+  const [error, setError] = useState<string | null>(null)
+  const socketRef = useRef<WebSocket | null>(null)
+  const entitiesRef = useRef<Map<number, LiveEntity>>(new Map())
+  const lastTextRef = useRef('')
+  const onSavedRef = useRef(onSaved)
+  onSavedRef.current = onSaved
+
+  // Entities are kept in the server's code point offsets and published in UTF-16 ones
+  const publish = () => {
+    const sorted = Array.from(entitiesRef.current.values()).sort((a, b) => a.start_pos - b.start_pos)
+    const text = lastTextRef.current
+    if (!SURROGATE.test(text)) {
+      setEntities(sorted)
+      return
+    }
+    const offsets = utf16Offsets(text)
+    const at = (position: number) => offsets[Math.min(position, offsets.length - 1)]
+    setEntities(sorted.map((entity) => ({ ...entity, start_pos: at(entity.start_pos), end_pos: at(entity.end_pos) })))
+  }
+
+  useEffect(() => {
+    const socket = new WebSocket(LIVE_ANALYSIS_URL)
+    socketRef.current = socket
+
+    socket.onopen = () => {
+      setIsConnected(true)
+      socket.send(JSON.stringify({
+        type: 'init',
+        text: lastTextRef.current,
+        analysis_profile: analysisProfile,
+        categories
+      }))
+    }
+
+    socket.onmessage = (event) => {
+      const message = JSON.parse(event.data)
+
+      if (message.type === 'snapshot') {
+        entitiesRef.current = new Map(message.entities.map((e: LiveEntity) => [e.id, e]))
+        publish()
+      } else if (message.type === 'diff') {
+        const current = entitiesRef.current
+        message.removed.forEach((id: number) => current.delete(id))
+        current.forEach((entity) => {
+          if (entity.start_pos >= message.shift.from) {
+            entity.start_pos += message.shift.delta
+            entity.end_pos += message.shift.delta
+          }
+        })
+        message.added.forEach((entity: LiveEntity) => current.set(entity.id, entity))
+        publish()
+      } else if (message.type === 'saved') {
+        onSavedRef.current?.(message.analysis_id, message.results)
+      } else if (message.type === 'error') {
+        setError(message.error)
+      }
+    }
+
+    socket.onclose = () => setIsConnected(false)
+
+    return () => socket.close()
+    // eslint-disable-next-line react-hooks/exhaustive-deps
+  }, [analysisProfile, (categories || []).join(',')])
+
+  // Call with the full new text on every change; only the changed range is sent
+  const updateText = useCallback((text: string) => {
+    const previous = lastTextRef.current
+    lastTextRef.current = text
+
+    const socket = socketRef.current
+    if (!socket || socket.readyState !== WebSocket.OPEN || previous === text) return
+
+    let prefix = 0
+    const maxPrefix = Math.min(previous.length, text.length)
+    while (prefix < maxPrefix && previous[prefix] === text[prefix]) prefix++
+
+    let suffix = 0
+    const maxSuffix = Math.min(previous.length, text.length) - prefix
+    while (
+      suffix < maxSuffix &&
+      previous[previous.length - 1 - suffix] === text[text.length - 1 - suffix]
+    ) suffix++
+
+    // Never split a surrogate pair: the server only sees whole code points
+    if (prefix > 0 && isHighSurrogate(previous.charCodeAt(prefix - 1))) prefix--
+    if (suffix > 0 && isLowSurrogate(previous.charCodeAt(previous.length - suffix))) suffix--
+
+    socket.send(JSON.stringify({
+      type: 'edit',
+      start: toCodePoints(previous, prefix),
+      end: toCodePoints(previous, previous.length - suffix),
+      text: text.slice(prefix, text.length - suffix)
+    }))
+  }, [])
+
+  const save = useCallback(() => {
+    const socket = socketRef.current
+    if (socket && socket.readyState === WebSocket.OPEN) {
+      setError(null)
+      socket.send(JSON.stringify({ type: 'save' }))
+    }
+  }, [])
+
+  return {
+    entities,
+    isConnected,
+    error,
+    updateText,
+    save
+  }
+}
@@ -0,0 +1,83 @@
+const API_URL = "http://localhost:8000"
+
+// Files above this size go through the resumable /upload-sessions API
+export const RESUMABLE_UPLOAD_THRESHOLD = 10 * 1024 * 1024
+const MAX_CHUNK_RETRIES = 5
+
+async function sha256Base64(data: ArrayBuffer): Promise<string> {
+  const digest = new Uint8Array(await crypto.subtle.digest("SHA-256", data))
+  let binary = ""
+  digest.forEach(byte => { binary += String.fromCharCode(byte) })
+  return `sha256 ${btoa(binary)}`
+}
+
+async function currentOffset(uploadUrl: string): Promise<number> {
+  const res = await fetch(`${API_URL}${uploadUrl}`)
+  if (!res.ok) {
+    throw new Error(`Upload failed: ${await res.text()}`)
+  }
+  return (await res.json()).offset
+}
+
+/**
+ * Upload a patient document in checksummed chunks, resuming from the server's
+ * offset after a failed chunk. Resolves with the finalize response (document_id,
+ * job_id, status_url), the same shape as a regular 202 document upload.
+ */
+export async function uploadResumable(
+  file: File,
+  patientId: string,
+  directoryId: string,
+  onProgress?: (fraction: number) => void
+): Promise<any> {
+  const createRes = await fetch(`${API_URL}/upload-sessions`, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({
+      patient_id: patientId,
+      directory_id: directoryId,
+      file_name: file.name,
+      file_type: file.type,
+      size: file.size
+    })
+  })
+  if (!createRes.ok) {
+    throw new Error(`Upload failed: ${await createRes.text()}`)
+  }
+  const session = await createRes.json()
+
+  let offset = session.offset
+  let failures = 0
+  while (offset < file.size) {
+    const chunk = await file.slice(offset, offset + session.chunk_size).arrayBuffer()
+    try {
+      const res = await fetch(`${API_URL}${session.upload_url}`, {
+        method: "PATCH",
+        headers: {
+          "Content-Type": "application/offset+octet-stream",
+          "Upload-Offset": String(offset),
+          "Upload-Checksum": await sha256Base64(chunk)
+        },
+        body: chunk
+      })
+      if (!res.ok) {
+        throw new Error(`Chunk at ${offset} failed: ${await res.text()}`)
+      }
+      offset = (await res.json()).offset
+      failures = 0
+    } catch (err) {
+      if (++failures > MAX_CHUNK_RETRIES) {
+        throw err
+      }
+      await new Promise(resolve => setTimeout(resolve, 1000 * failures))
+      offset = await currentOffset(session.upload_url)
+    }
+    onProgress?.(offset / file.size)
+  }
+
+  const finalizeRes = await fetch(`${API_URL}${session.upload_url}/finalize`, { method: "POST" })
+  if (!finalizeRes.ok) {
+    throw new Error(`Upload failed: ${await finalizeRes.text()}`)
+  }
+  return finalizeRes.json()
+}